@@ -15,6 +15,8 @@ import matplotlib.gridspec
 from matplotlib.animation import FuncAnimation, ArtistAnimation, PillowWriter, FFMpegWriter
 from matplotlib.axes import Axes
 
+from big_rl.utils.evaluation import ResultsReader
+
 
 def render_trajectory_video(
         data, rewards, steps, trail_length=5, 
@@ -564,20 +566,9 @@ def plot_shaped_rewards(shaped_rewards, rewards, directory='./'):
     print(f'Saved figure to {os.path.abspath(filename)}')
 
 
-if __name__ == '__main__':
-    # Parse arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--results', type=str, default=None,
-                        help='Path to results file.')
-    parser.add_argument('--video-format', type=str, default=None,
-                        choices=['webm', 'mp4', 'gif'],
-                        help='Video format to save trajectory video in.')
-    parser.add_argument('--output', type=str, default='./output',
-                        help='Output directory.')
-    args = parser.parse_args()
-
-    # Read results
-    results = torch.load(args.results)
+def load_results(filename):
+    """ Load the attention, hidden state, reward and shaped reward of each step of each episode from a results file saved with `torch.save` by `evaluate_model.py`. """
+    results = torch.load(filename)
 
     attention_data = []
     hidden_state_data = []
@@ -611,6 +602,53 @@ if __name__ == '__main__':
         )
 
     print(results[0]['results'].keys())
+    return attention_data, hidden_state_data, reward_data, shaped_reward_data
+
+
+def load_results_h5(filename):
+    """ Same as `load_results`, for an HDF5 results file (see `big_rl.utils.evaluation.ResultsWriter`). Only the columns that are used are read. """
+    attention_columns = ['attention/0/0', 'attention/0/1', 'attention/1/0', 'attention/1/1', 'attention/2/action', 'attention/2/value']
+
+    attention_data = []
+    hidden_state_data = []
+    reward_data = []
+    shaped_reward_data = []
+    with ResultsReader(filename) as reader:
+        for i in tqdm(range(len(reader))):
+            episode = reader.episode(i, columns=[*attention_columns, *reader.columns('hidden'), 'reward', *reader.columns('shaped_reward')])
+            length = reader.episode_length[i]
+            attention_data.append(np.concatenate([
+                episode[c].reshape(length, -1) for c in attention_columns
+            ], axis=1))
+            hidden_state_data.append(np.concatenate([
+                episode[c].reshape(length, -1) for c in reader.columns('hidden')
+            ], axis=1))
+            reward_data.append(episode['reward'])
+            shaped_reward_data.append(
+                episode['shaped_reward'].reshape(length, -1).mean(1)
+                if 'shaped_reward' in episode else np.zeros(0)
+            )
+        print(reader.columns())
+    return attention_data, hidden_state_data, reward_data, shaped_reward_data
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--results', type=str, default=None,
+                        help='Path to results file.')
+    parser.add_argument('--video-format', type=str, default=None,
+                        choices=['webm', 'mp4', 'gif'],
+                        help='Video format to save trajectory video in.')
+    parser.add_argument('--output', type=str, default='./output',
+                        help='Output directory.')
+    args = parser.parse_args()
+
+    # Read results
+    if args.results.endswith('.h5'):
+        attention_data, hidden_state_data, reward_data, shaped_reward_data = load_results_h5(args.results)
+    else:
+        attention_data, hidden_state_data, reward_data, shaped_reward_data = load_results(args.results)
 
     # Plot results
     plot_trajectory(
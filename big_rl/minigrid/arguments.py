@@ -1,5 +1,7 @@
 from argparse import ArgumentParser
 
+from big_rl.model.low_precision import PRECISIONS
+
 
 def init_parser_trainer(parser: ArgumentParser):
     parser.add_argument('--max-steps', type=int, default=0, help='Number of transitions to train for. If 0, train forever.')
@@ -24,6 +26,28 @@ def init_parser_trainer(parser: ArgumentParser):
     parser.add_argument('--max-grad-norm', type=float, default=0.5, help='Maximum gradient norm.')
     parser.add_argument('--warmup-steps', type=int, default=0, help='Number of warmup steps on the environment before we start training on the generated samples.')
     parser.add_argument('--update-hidden-after-grad', action='store_true', help='Update the hidden state after the gradient step.')
+    parser.add_argument('--recompute-rollout-outputs', action='store_true', help='Recompute the state values and action probabilities of the rollout before the PPO update instead of reusing the outputs computed while collecting the rollout. Always enabled if `--inference-precision` isn\'t fp32.')
+    parser.add_argument('--num-recurrent-minibatches', type=int, default=1, help='Number of minibatches to split the environments into for each PPO epoch. Each minibatch results in one gradient step.')
+    parser.add_argument('--bptt-length', type=int, default=None, help='Number of time steps to backpropagate through when computing the PPO losses. The rollout is split into chunks of this length, each starting from the hidden state saved during the rollout. By default, the whole rollout is used.')
+    parser.add_argument('--shuffle-bptt-chunks', action='store_true', help='Process the truncated BPTT minibatches in a random order instead of in temporal order.')
+    parser.add_argument('--concurrent-rollouts', action='store_true', help='Collect the rollouts of all task groups concurrently, with one thread per group, instead of one group after another.')
+    parser.add_argument('--fuse-task-groups', action='store_true', help='Compute the losses of all task groups in one batch instead of running the model separately on each group. Cannot be used with `--num-recurrent-minibatches`.')
+
+    parser.add_argument('--profile', action='store_true', help='Time each phase of training (env steps, inference, loss computation, backward pass, optimizer step, logging) and periodically report percentiles to the console and W&B.')
+    parser.add_argument('--profile-interval', type=int, default=10, help='Number of updates between profiler reports. Only applies with `--profile`.')
+    parser.add_argument('--profile-window', type=int, default=100, help='Number of recent timings of each phase that the reported percentiles are computed over. Only applies with `--profile`.')
+    parser.add_argument('--profile-jsonl', type=str, default=None, help='File to which the profiler reports are appended as JSON lines. Only applies with `--profile`.')
+    parser.add_argument('--profile-cuda-sync', action='store_true', help='Synchronize CUDA at the start and end of each profiled phase so that GPU time is attributed to the right phase. This slows down training. Only applies with `--profile`.')
+    parser.add_argument('--log-flush-interval', type=int, default=1, help='Number of updates between transfers of the logged metrics from the GPU. Metrics are copied asynchronously and sent to W&B one flush later. If 0, metrics are sent immediately, which synchronizes with the GPU every time something is logged.')
+    parser.add_argument('--log-attention', action='store_true', help='Record the attention weights of ModularPolicy5 models during training and log the largest weight given to each input. Recording keeps extra tensors on the device after every forward pass, so it is off by default.')
+    parser.add_argument('--check-nan-grads', action='store_true', help='Check for NaN or infinite gradients after each backward pass and drop into the debugger if any are found.')
+
+    parser.add_argument('--actor-learner', action='store_true', help='Train with asynchronous actor processes and a V-trace learner (IMPALA) instead of PPO.')
+    parser.add_argument('--num-actors', type=int, default=4, help='Number of actor processes. Only applies with `--actor-learner`.')
+    parser.add_argument('--trajectories-per-batch', type=int, default=None, help='Number of actor trajectories in each training batch. Defaults to the number of actors. Only applies with `--actor-learner`.')
+    parser.add_argument('--trajectory-queue-size', type=int, default=None, help='Maximum number of trajectories waiting for the learner. Defaults to twice the batch size. Only applies with `--actor-learner`.')
+    parser.add_argument('--vtrace-rho-clip', type=float, default=1.0, help='Truncation level of the V-trace importance weights. Only applies with `--actor-learner`.')
+    parser.add_argument('--vtrace-c-clip', type=float, default=1.0, help='Truncation level of the V-trace trace-cutting coefficients. Only applies with `--actor-learner`.')
 
     parser.add_argument('--random-score', type=float, nargs='*', default=None, help='Random score for each environment.')
     parser.add_argument('--max-score', type=float, nargs='*', default=None, help='Max score for each environment.')
@@ -46,3 +70,19 @@ def init_parser_model(parser: ArgumentParser):
                         help='Size of the model\'s hidden state. Only applies to LSTM models.')
     parser.add_argument('--ff-size', type=int, nargs='*', default=[1024],
                         help='Size of the model\'s fully connected feedforward layers. Only applies to attention models.')
+    parser.add_argument('--fused-recurrent-cell', action='store_true',
+                        help='Use the fused implementation of the recurrent layers (BatchRecurrentAttention16Layer_v3), which avoids copying the inputs of the feedforward layers. The outputs are the same and checkpoints can be loaded with or without this option. Only applies to models with a RecurrentAttention16 core.')
+    parser.add_argument('--kv-groups', type=int, default=None,
+                        help='Share the key and value projections of the core attention between this many groups of modules in each layer (grouped-query attention), so keys and values are projected once per group instead of once per module. Checkpoints without shared projections can be loaded, in which case the projections of each group are averaged. Only applies to models with a RecurrentAttention15 or RecurrentAttention16 core.')
+    parser.add_argument('--kv-groups-method', type=str, default='mean', choices=['mean', 'first'],
+                        help='How the key and value projections of each group are initialized from the per-module projections when `--kv-groups` is set. "mean": average of the group. "first": the first module of the group.')
+    parser.add_argument('--fuse-output-modules', action='store_true',
+                        help='Compute all linear output heads (value, action, etc.) in one batched attention call instead of one call per head. The outputs are the same, and checkpoints can be loaded with or without this option, but optimizer states cannot be shared between the two. Only applies to modular policies.')
+    parser.add_argument('--compile-model', action='store_true',
+                        help='Compile the forward pass with `torch.compile`. The forward pass is specialized to each set of observation keys it receives, which removes most of the Python overhead per step. The first calls are slow while the model is compiled. Only applies to ModularPolicy8.')
+    parser.add_argument('--compile-backend', type=str, default='inductor',
+                        help='Backend passed to `torch.compile` when `--compile-model` is set.')
+    parser.add_argument('--compile-cache-dir', type=str, default=None,
+                        help='Directory where compiled graphs are cached between runs when `--compile-model` is set. Defaults to the PyTorch cache directory.')
+    parser.add_argument('--inference-precision', type=str, default='fp32', choices=PRECISIONS,
+                        help='Precision of the model used to select actions. "bf16" runs a bf16 copy of the model under autocast. "int8" runs a copy with the large linear layers dynamically quantized to int8 (CPU only). When training, the model is still trained in full precision and the copy is refreshed before each rollout, so the actions are sampled from a slightly different policy than the one being trained. The state values and action probabilities of the rollout are always recomputed in full precision for the PPO update (as with `--recompute-rollout-outputs`).')
@@ -22,7 +22,8 @@ def init_model(observation_space, action_space,
         'obs (image)': {
             'type': 'ImageInput56',
             'config': {
-                'in_channels': observation_space['obs (image)'].shape[0]
+                'in_channels': observation_space['obs (image)'].shape[0],
+                'scale': 1/255, # Images are passed to the model as uint8
             },
         },
         'reward': {
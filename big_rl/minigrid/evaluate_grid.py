@@ -0,0 +1,250 @@
+""" Evaluate a grid of (checkpoint, environment, seed) jobs on a pool of worker processes.
+
+Each worker imports the libraries, builds the environment presets once, and keeps the most recently used models and environments in memory, so the startup cost of `evaluate_model.py` is paid once per worker rather than once per job. Jobs are submitted checkpoint by checkpoint so that consecutive jobs tend to reuse the same model. All results go to one `ResultsStore` directory, and jobs that are already in the store are skipped, so an interrupted evaluation can be restarted with the same command. The evaluation settings (see `job_settings`) are part of each job, so running again with different settings (e.g. more episodes or another inference precision) evaluates the jobs again rather than reusing the old results.
+
+Usage:
+
+    python -m big_rl.minigrid.evaluate_grid --models a.pt b.pt --envs fetch-004 fetch-004-shaped --seeds 0 1 2 --num-workers 8 --results-dir results/ --model-type ModularPolicy8 --recurrence-type RecurrentAttention16 --architecture 3 3
+"""
+
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import itertools
+import os
+import time
+import traceback
+from typing import Any, Dict
+
+import gymnasium.vector
+import numpy as np
+import torch
+import torch.multiprocessing
+from tqdm import tqdm
+
+from big_rl.minigrid.envs import make_env
+from big_rl.minigrid.arguments import init_parser_model
+from big_rl.minigrid.common import env_config_presets, init_model
+from big_rl.utils import merge_space, torch_save
+from big_rl.utils.evaluation import ResultsStore, ResultsWriter, episode_summary
+from big_rl.model.model import group_kv_projections_
+from big_rl.model.low_precision import LowPrecisionPolicy
+from big_rl.model.recurrent_attention_16 import RecurrentAttention16, BatchRecurrentAttention16Layer_v3
+
+
+# Worker state. Each worker process has its own copy.
+_args = None
+_env_config_presets = None
+_models = OrderedDict()
+_envs = OrderedDict()
+
+
+def _init_worker(args):
+    global _args, _env_config_presets
+    _args = args
+    _env_config_presets = env_config_presets()
+    torch.set_num_threads(args.threads_per_worker)
+
+
+def _cache_get(cache, key, create_fn, max_size, close_fn=None):
+    """ Get `key` from an LRU cache, creating it with `create_fn()` if it's missing. """
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    while len(cache) >= max_size:
+        _, value = cache.popitem(last=False)
+        if close_fn is not None:
+            close_fn(value)
+    cache[key] = create_fn()
+    return cache[key]
+
+
+def _load_model(model_filename, model_envs):
+    assert _args is not None and _env_config_presets is not None
+    args = _args
+    device = torch.device('cpu')
+    dummy_envs = [make_env(**_env_config_presets[e]) for e in model_envs]
+    model = init_model(
+            observation_space = merge_space(*[e.observation_space for e in dummy_envs]),
+            action_space = dummy_envs[0].action_space,
+            model_type = args.model_type,
+            recurrence_type = args.recurrence_type,
+            architecture = args.architecture,
+            ff_size = args.ff_size,
+            hidden_size = args.hidden_size,
+            device = device,
+    )
+    for e in dummy_envs:
+        e.close()
+    model.to(device)
+    if args.fuse_output_modules and hasattr(model, 'fuse_output_modules'):
+        model.fuse_output_modules() # type: ignore
+    if args.fused_recurrent_cell:
+        if not isinstance(getattr(model, 'attention', None), RecurrentAttention16):
+            raise ValueError('`--fused-recurrent-cell` only applies to models with a RecurrentAttention16 core.')
+        model.attention.convert_layer_type(BatchRecurrentAttention16Layer_v3) # type: ignore
+        model.to(device)
+    if args.kv_groups is not None:
+        group_kv_projections_(model, args.kv_groups, method=args.kv_groups_method)
+
+    checkpoint = torch.load(model_filename, map_location=device)
+    model.load_state_dict(checkpoint['model'], strict=False)
+    model.eval()
+
+    if args.inference_precision != 'fp32':
+        model = LowPrecisionPolicy(model, args.inference_precision) # type: ignore
+    return model, checkpoint.get('step')
+
+
+def _make_vector_env(env_name):
+    assert _args is not None and _env_config_presets is not None
+    env_config = _env_config_presets[env_name]
+    # The workers already run in parallel, so the environments of a job are stepped in the worker's own process
+    return gymnasium.vector.SyncVectorEnv([lambda: make_env(**env_config) for _ in range(_args.num_envs)]) # type: ignore
+
+
+def job_settings(args) -> Dict[str, Any]:
+    """ Settings of `args` that can change the results of a job. They are added to every job, so they are part of its key in the `ResultsStore` and recorded in the index. """
+    return {
+        'num_episodes': args.num_episodes,
+        'num_envs': args.num_envs,
+        'model_envs': args.model_envs,
+        'model_type': args.model_type,
+        'recurrence_type': args.recurrence_type,
+        'architecture': args.architecture,
+        'hidden_size': args.hidden_size,
+        'ff_size': args.ff_size,
+        'fused_recurrent_cell': args.fused_recurrent_cell,
+        'fuse_output_modules': args.fuse_output_modules,
+        'kv_groups': args.kv_groups,
+        'kv_groups_method': args.kv_groups_method if args.kv_groups is not None else None,
+        'inference_precision': args.inference_precision,
+        'record_details': args.record_details,
+        'record_targets': args.record_targets,
+    }
+
+
+def run_job(job, filename):
+    """ Evaluate one job in the current worker and save its results to `filename` (see `ResultsStore.path`). With the 'h5' format, each episode is written as soon as it finishes, so the full results are never held in memory nor sent back to the main process. Returns a summary of each episode (see `episode_summary`) and metadata for the index. """
+    from big_rl.minigrid.evaluate_model import test_batched, preprocess_obs_batched
+    import big_rl.minigrid.evaluate_model
+    assert _args is not None
+    args = _args
+    big_rl.minigrid.evaluate_model.device = torch.device('cpu') # Used by `preprocess_obs_batched`
+
+    start_time = time.time()
+    model_envs = tuple(args.model_envs) if args.model_envs is not None else (job['env'],)
+    model, checkpoint_step = _cache_get(
+            _models, (job['model'], model_envs),
+            lambda: _load_model(job['model'], model_envs),
+            max_size = args.model_cache_size)
+    env = _cache_get(
+            _envs, job['env'],
+            lambda: _make_vector_env(job['env']),
+            max_size = args.env_cache_size,
+            close_fn = lambda e: e.close())
+
+    torch.manual_seed(job['seed'])
+    np.random.seed(job['seed'])
+    if args.results_format == 'h5':
+        with ResultsWriter(filename) as writer:
+            def write_episode(i, episode):
+                writer.write_episode(episode, index=i)
+                return episode_summary(episode, keys=())
+            summaries = test_batched(
+                    model, env, args.num_episodes, preprocess_obs_batched,
+                    record_details = args.record_details,
+                    record_targets = args.record_targets,
+                    seed = job['seed'],
+                    episode_fn = write_episode,
+            )
+    else:
+        test_results = test_batched(
+                model, env, args.num_episodes, preprocess_obs_batched,
+                record_details = args.record_details,
+                record_targets = args.record_targets,
+                seed = job['seed'],
+        )
+        torch_save(test_results, filename)
+        summaries = [episode_summary(episode, keys=()) for episode in test_results]
+    return summaries, {
+        'checkpoint_step': checkpoint_step,
+        'time': time.time() - start_time,
+        'worker': os.getpid(),
+    }
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='Evaluate every combination of checkpoints, environments and seeds on a pool of worker processes. The results are written to a ResultsStore directory.')
+    parser.add_argument('--models', type=str, nargs='+', required=True,
+                        help='Paths to the model checkpoints to evaluate.')
+    parser.add_argument('--envs', type=str, nargs='+', required=True,
+                        help='Environment presets to evaluate each checkpoint on.')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0],
+                        help='Seeds of the environments and action sampling. Each seed is a separate job.')
+    parser.add_argument('--model-envs', type=str, nargs='*', default=None,
+                        help='Environments whose observation spaces are used to initialize the models. If not specified, the environment of each job is used.')
+    parser.add_argument('--results-dir', type=str, required=True,
+                        help='Directory where the results are saved. Jobs whose results are already in this directory are skipped.')
+    parser.add_argument('--results-format', type=str, default='h5', choices=['h5', 'pt'],
+                        help='File format of the results of each job. "h5": columnar HDF5 file (see `big_rl.utils.evaluation.ResultsWriter`), written by the worker one episode at a time. "pt": `torch.save` of the list of episodes, which the worker keeps in memory until the job is done.')
+    parser.add_argument('--num-episodes', type=int, default=10,
+                        help='Number of episodes per job.')
+    parser.add_argument('--num-envs', type=int, default=1,
+                        help='Number of environments each worker runs in parallel for a job, with one batched forward pass per step.')
+    parser.add_argument('--num-workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes. If 0, jobs run in the main process.')
+    parser.add_argument('--threads-per-worker', type=int, default=1,
+                        help='Number of threads used by PyTorch in each worker.')
+    parser.add_argument('--model-cache-size', type=int, default=2,
+                        help='Number of models each worker keeps in memory.')
+    parser.add_argument('--env-cache-size', type=int, default=2,
+                        help='Number of vector environments each worker keeps in memory.')
+    parser.add_argument('--record-details', action='store_true',
+                        help='Record the attention and hidden states of every step, as `evaluate_model.py --results` does. This makes the results much larger.')
+    parser.add_argument('--record-targets', action='store_true',
+                        help='Record the goal string of every step. Only applies to environments with a `goal_str` attribute.')
+    init_parser_model(parser)
+    args = parser.parse_args()
+
+    # Checkpoint-major order, so that consecutive jobs reuse the same model
+    settings = job_settings(args)
+    jobs = [
+        {'model': os.path.abspath(model), 'env': env, 'seed': seed, 'settings': settings}
+        for model, env, seed in itertools.product(args.models, args.envs, args.seeds)
+    ]
+    store = ResultsStore(args.results_dir, format=args.results_format)
+    pending = [job for job in jobs if not store.contains(job)]
+    print(f'{len(jobs)} jobs, {len(jobs) - len(pending)} already done.')
+
+    num_errors = 0
+    start_time = time.time()
+    if args.num_workers == 0:
+        _init_worker(args)
+        for job in tqdm(pending):
+            try:
+                summaries, metadata = run_job(job, store.path(job))
+                store.add(job, summaries, **metadata)
+            except Exception:
+                num_errors += 1
+                store.write_error(job, traceback.format_exc())
+                tqdm.write(f'Job {job} failed:\n{traceback.format_exc()}')
+    else:
+        # Spawn rather than fork, so the workers don't inherit the main process's threads
+        ctx = torch.multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=args.num_workers, mp_context=ctx, initializer=_init_worker, initargs=(args,)) as pool:
+            futures = {pool.submit(run_job, job, store.path(job)): job for job in pending}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                job = futures[future]
+                try:
+                    summaries, metadata = future.result()
+                except Exception:
+                    num_errors += 1
+                    store.write_error(job, traceback.format_exc())
+                    tqdm.write(f'Job {job} failed:\n{traceback.format_exc()}')
+                    continue
+                store.add(job, summaries, **metadata)
+
+    print(f'Finished {len(pending) - num_errors} jobs in {time.time() - start_time:.1f} s ({num_errors} failed).')
+    print(f'Results saved to {os.path.abspath(args.results_dir)}')
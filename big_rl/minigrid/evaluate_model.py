@@ -1,10 +1,12 @@
 import argparse
 from collections import defaultdict
+import functools
 import itertools
 import os
 from typing import Tuple, Optional, Any
 
 import cv2
+import gymnasium.vector
 import numpy as np
 import torch
 from tqdm import tqdm
@@ -14,9 +16,13 @@ from fonts.ttf import Roboto # type: ignore
 from big_rl.minigrid.envs import make_env
 from big_rl.minigrid.arguments import init_parser_model
 from big_rl.minigrid.common import env_config_presets, init_model
-from big_rl.minigrid.hidden_info.train import TARGET_KEYS
-from big_rl.utils import merge_space
+from big_rl.utils import merge_space, obs_to_tensor
+from big_rl.utils.evaluation import AsyncVideoWriter, ResultsWriter, episode_summary, evaluate_vector_env, select_batch
+from big_rl.model.model import introspection, group_kv_projections_
+from big_rl.model.low_precision import LowPrecisionPolicy
+from big_rl.model.recurrent_attention_16 import RecurrentAttention16, BatchRecurrentAttention16Layer_v3
 from big_rl.minigrid.hidden_info.hidden_info import OBJECTS
+from big_rl.minigrid.hidden_info.probes import ProbeBank, find_probes, flatten_hidden
 
 
 def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, hidden_info_fn=None, verbose=False):
@@ -47,7 +53,7 @@ def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, hidden_in
     terminated = False
     truncated = False
     for _ in steps_iterator:
-        with torch.no_grad():
+        with torch.no_grad(), introspection(model):
             model_output = model(obs, hidden)
 
             hidden = model_output['hidden']
@@ -63,9 +69,9 @@ def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, hidden_in
         results['regret'].append(info.get('regret', None))
         if model.has_attention:
             results['attention'].append((
-                [x.numpy() for x in model.last_attention],
-                [x.numpy() for x in model.last_ff_gating],
-                {k: v.numpy() for k,v in model.last_output_attention.items()},
+                [x.cpu().numpy() for x in model.last_attention],
+                [x.cpu().numpy() for x in model.last_ff_gating],
+                {k: v.cpu().numpy() for k,v in model.last_output_attention.items()},
             ))
             results['shaped_reward'].append(compute_shaped_reward(model))
         results['hidden'].append([
@@ -75,7 +81,7 @@ def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, hidden_in
         if hasattr(env, 'goal_str'):
             results['target'].append(env.goal_str) # type: ignore
         if hidden_info_fn is not None:
-            results['hidden_info'] = hidden_info_fn(hidden)
+            results['hidden_info'] = {k: v[0] for k,v in hidden_info_fn(hidden).items()}
 
         episode_reward += float(reward)
         episode_length += 1
@@ -104,6 +110,72 @@ def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, hidden_in
     }
 
 
+def test_batched(model, env, num_episodes, preprocess_obs_fn, record_details=True, record_targets=False, hidden_info_fn=None, seed=None, episode_fn=None, verbose=False):
+    """ Same as `test()`, but runs `num_episodes` episodes in parallel on the vector environment `env`, with one batched forward pass per step. Returns a list with one entry per episode, each in the format returned by `test()`. Videos and shaped reward predictions are not supported. If given, `hidden_info_fn` (see `make_hidden_info_fn`) is run once per step on the hidden states of all environments. If `record_details` is False, the attention, hidden state and input label streams are left empty, which avoids running the model with introspection enabled. If `record_targets` is True, the goal string of each environment is read after every step. `seed` is passed to `env.reset()`. See `evaluate_vector_env` for `episode_fn`. """
+
+    def init_results():
+        return {
+            'reward': [],
+            'regret': [],
+            'attention': [],
+            'hidden': [],
+            'input_labels': [],
+            'target': [], # Goal string
+            'shaped_reward': [], # Predicted shaped reward
+            'hidden_info': None,
+        }
+
+    def sample_action(model_output):
+        action_probs = model_output['action'].softmax(1)
+        action_dist = torch.distributions.Categorical(action_probs)
+        return action_dist.sample().cpu().numpy()
+
+    # Output of `hidden_info_fn` for the last step, shared by all environments
+    last_hidden_info = {'model_output': None, 'hidden_info': None}
+
+    def record(results, model, model_output, index, reward, info, done):
+        results['reward'].append(reward)
+        results['regret'].append(info.get('regret', None))
+        if hidden_info_fn is not None:
+            if last_hidden_info['model_output'] is not model_output:
+                last_hidden_info['model_output'] = model_output
+                last_hidden_info['hidden_info'] = hidden_info_fn(model_output['hidden'])
+            results['hidden_info'] = {k: v[index] for k,v in last_hidden_info['hidden_info'].items()}
+        if record_details:
+            if model.has_attention:
+                results['attention'].append((
+                    [x.cpu().numpy() for x in select_batch(model.last_attention, index)],
+                    [x.cpu().numpy() for x in select_batch(model.last_ff_gating, index)],
+                    {k: v.cpu().numpy() for k,v in select_batch(model.last_output_attention, index).items()},
+                ))
+            results['hidden'].append([
+                x.cpu().detach().numpy() for x in select_batch(model_output['hidden'], index)
+            ])
+            results['input_labels'].append(model.last_input_labels)
+        if 'goal_str' in info:
+            results['target'].append(info['goal_str'])
+        if done and 'supervised_trials' in info:
+            results['supervision'] = {
+                'supervised_trials': info['supervised_trials'],
+                'unsupervised_trials': info['unsupervised_trials'],
+                'supervised_reward': info['supervised_reward'],
+                'unsupervised_reward': info['unsupervised_reward'],
+            }
+
+    return evaluate_vector_env(
+            model, env, num_episodes,
+            preprocess_obs_fn = preprocess_obs_fn,
+            sample_action_fn = sample_action,
+            init_results_fn = init_results,
+            record_fn = record,
+            introspect = record_details,
+            env_attrs = ['goal_str'] if record_targets else [],
+            seed = seed,
+            episode_fn = episode_fn,
+            verbose = verbose,
+    )
+
+
 def split_results_by_target(results):
     """ Split up the results by target object. This is used when the target is randomized in the middle of an episode to get information on how well the agent performs for each target change. """
 
@@ -137,31 +209,16 @@ def compute_shaped_reward(model):
     return output.cpu().detach()
 
 
-def make_hidden_info_fn(model_filenames): # FIXME: Lots of hard-coded values
-    from big_rl.minigrid.hidden_info.train import make_model, TARGET_KEYS
-
-    models = {}
+def make_hidden_info_fn(model_filenames: dict, device=None):
+    """ Load the hidden info probes in `model_filenames` (indexed by target key) once, and return a function that runs all of them on a batch of hidden states with one fused forward pass (see `big_rl.minigrid.hidden_info.probes.ProbeBank`). The function returns a dictionary of numpy arrays of shape (batch size, ...). """
+    bank = ProbeBank.load(model_filenames, device=device)
 
-    def foo(hidden):
-        nonlocal models
+    def hidden_info_fn(hidden):
         with torch.no_grad():
-            hidden = torch.cat([h.flatten() for h in hidden])
-            if len(models) == 0:
-                for target_key in TARGET_KEYS:
-                    models[target_key] = make_model(
-                        target_key=target_key,
-                        input_size=hidden.shape[0],
-                    )
-                    #models[target_key].load_state_dict(torch.load(model_filenames[target_key], map_location='cpu'))
-                    #print(f'Loaded {model_filenames[target_key]} for hidden info')
-
-            return {
-                'target_idx': models['target_idx'](hidden).softmax(0).numpy(),
-                'target_pos': models['target_pos'](hidden).numpy(),
-                'wall_map': models['wall_map'](hidden).sigmoid().numpy(),
-            }
-    
-    return foo
+            outputs = bank(flatten_hidden(hidden).to(bank.input_layer.weight.device))
+        return {k: v.cpu().numpy() for k,v in outputs.items()}
+
+    return hidden_info_fn
 
 
 def concat_images(images, padding=0, direction='h', align=0):
@@ -192,15 +249,15 @@ def concat_images(images, padding=0, direction='h', align=0):
     else:
         raise ValueError('direction must be "h" or "v"')
 
-def draw_attention(core_attention, query_gating, output_attention, input_labels):
-    block_size = 24
-    padding = 2
-
-    font_family = Roboto
-    font_size = 18
-    font = PIL.ImageFont.truetype(font_family, font_size)
+@functools.lru_cache(maxsize=None)
+def get_font(font_family=Roboto, font_size=18):
+    """ Load a font. Fonts are cached, so each font is only read once per process. """
+    return PIL.ImageFont.truetype(font_family, font_size)
 
-    # Core modules
+@functools.lru_cache(maxsize=16)
+def draw_core_labels(input_labels: tuple, block_size=24, padding=2):
+    """ Draw the rotated input labels of the core attention. The labels rarely change between frames, so the image is cached. The returned image is shared and must not be modified. """
+    font = get_font()
     core_labels = []
     for label in input_labels:
         text_width, text_height = font.getsize(label)
@@ -218,7 +275,24 @@ def draw_attention(core_attention, query_gating, output_attention, input_labels)
         )
         core_labels.append(img)
     core_labels_concat = concat_images(core_labels, padding=padding, direction='v', align=-1)
-    core_labels_concat = core_labels_concat.rotate(90, expand=True)
+    return core_labels_concat.rotate(90, expand=True)
+
+def _to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        return x.cpu().numpy()
+    return np.asarray(x)
+
+def draw_attention(core_attention, query_gating, output_attention, input_labels):
+    block_size = 24
+    padding = 2
+
+    # The recorded values can be tensors left on the device they were computed on or numpy arrays. Copy them to the host once rather than reading them one element at a time.
+    core_attention = [_to_numpy(layer) for layer in core_attention]
+    query_gating = [_to_numpy(layer) for layer in query_gating]
+    output_attention = {k: _to_numpy(v) for k,v in output_attention.items()}
+
+    # Core modules
+    core_labels_concat = draw_core_labels(tuple(input_labels), block_size=block_size, padding=padding)
 
     core_images = []
     for layer in core_attention:
@@ -278,21 +352,10 @@ def draw_attention(core_attention, query_gating, output_attention, input_labels)
             )
         output_images[k] = img
 
-    text_images = {}
-    for k in output_attention.keys():
-        text_width, text_height = font.getsize(k)
-        img = PIL.Image.new('RGB',
-                (text_width+2*padding, text_height+2*padding),
-                color=(255,255,255))
-        draw = PIL.ImageDraw.Draw(img)
-        draw.fontmode = 'L' # type: ignore
-        draw.text(
-                (padding, padding),
-                k,
-                font=font,
-                fill=(0,0,0)
-        )
-        text_images[k] = img
+    text_images = {
+        k: draw_text(k, padding=padding)
+        for k in output_attention.keys()
+    }
 
     output_images_concat = concat_images(
             [
@@ -320,8 +383,10 @@ def draw_attention(core_attention, query_gating, output_attention, input_labels)
 
     return all_images_concat
 
+@functools.lru_cache(maxsize=1024)
 def draw_text(text, font_family=Roboto, font_size=18, color=(0,0,0), padding=2):
-    font = PIL.ImageFont.truetype(font_family, font_size)
+    """ Draw a line of text. Most of the text in a video (labels, small rewards, object names) repeats from frame to frame, so the images are cached. The returned image is shared and must not be modified. """
+    font = get_font(font_family, font_size)
 
     text_width, text_height = font.getsize(text)
     img = PIL.Image.new('RGB',
@@ -337,11 +402,14 @@ def draw_text(text, font_family=Roboto, font_size=18, color=(0,0,0), padding=2):
     )
     return img
 
-def draw_rewards(rewards: list, target_object):
+def draw_rewards(rewards: list, target_object, total=None):
+    """ Draw the last 5 rewards, the total reward and the target. If `total` is given, `rewards` only needs to contain the last 5 rewards. """
+    if total is None:
+        total = sum(rewards)
     img1 = draw_text(
             'Reward: ' + ' '.join(f'{r}' for r in reversed(rewards[-5:])))
     img2 = draw_text(
-            f'Total Reward: {sum(rewards):.2f}')
+            f'Total Reward: {total:.2f}')
     img3 = draw_text(f'Target: {target_object}')
     return concat_images([img1, img2, img3], direction='v', align=-1)
 
@@ -355,7 +423,7 @@ def draw_observations(observations: dict):
     return concat_images(images, direction='v', align=-1)
 
 def draw_hidden_info(hidden_info: dict):
-    """ Draw a bar plot of what the agent believes the probability of each object being the target is. """
+    """ Draw a bar plot of what the agent believes the probability of each object being the target is. Only the predictions of the probes that were loaded are drawn. """
 
     def draw_target_idx():
         text_images = [
@@ -395,7 +463,10 @@ def draw_hidden_info(hidden_info: dict):
         draw = PIL.ImageDraw.Draw(img)
 
         # Walls
-        wall_probs = np.array(hidden_info['wall_map']).reshape(25,25)
+        if 'wall_map' in hidden_info:
+            wall_probs = np.array(hidden_info['wall_map']).reshape(25,25)
+        else:
+            wall_probs = np.zeros((25,25))
         for i in range(25):
             for j in range(25):
                 x = i*(square_size+padding) + padding
@@ -419,127 +490,155 @@ def draw_hidden_info(hidden_info: dict):
         )
 
         # Target object location
-        target_pos = hidden_info['target_pos']
-        x = (target_pos[0]+25/2)*(square_size+padding) + padding
-        y = (target_pos[1]+25/2)*(square_size+padding) + padding
-        draw.line(
-                (x-square_size/2, y-square_size/2, x+square_size/2, y+square_size/2),
-                fill=(0,255,0),
-                width=2,
-        )
-        draw.line(
-                (x-square_size/2, y+square_size/2, x+square_size/2, y-square_size/2),
-                fill=(0,255,0),
-                width=2,
-        )
+        if 'target_pos' in hidden_info:
+            target_pos = hidden_info['target_pos']
+            x = (target_pos[0]+25/2)*(square_size+padding) + padding
+            y = (target_pos[1]+25/2)*(square_size+padding) + padding
+            draw.line(
+                    (x-square_size/2, y-square_size/2, x+square_size/2, y+square_size/2),
+                    fill=(0,255,0),
+                    width=2,
+            )
+            draw.line(
+                    (x-square_size/2, y+square_size/2, x+square_size/2, y-square_size/2),
+                    fill=(0,255,0),
+                    width=2,
+            )
 
         return img
 
+    images = []
+    if 'wall_map' in hidden_info or 'target_pos' in hidden_info:
+        images += [draw_text('Wall Map'), draw_map()]
+    if 'target_idx' in hidden_info:
+        images += [draw_text('Target Probabilities'), draw_target_idx()]
+    if len(images) == 0:
+        images.append(draw_text('No Hidden Info'))
     return concat_images(
-            [
-                draw_text('Wall Map'),
-                draw_map(),
-                draw_text('Target Probabilities'),
-                draw_target_idx(),
-            ],
+            images,
             direction='v',
             align=0,
     )
 
-class VideoCallback:
-    def __init__(self, filename: str, 
-                 size: Optional[Tuple[int,int]] = None,
-                 fps: int = 30):
-        if not filename.endswith('.webm'):
-            raise ValueError('filename must end with .webm')
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-
-        self.filename = filename
-        self.fps = fps
-
-        if size is not None:
-            self._video_writer = cv2.VideoWriter( # type: ignore
-                    filename,
-                    cv2.VideoWriter_fourcc(*'VP80'), # type: ignore
-                    fps,
-                    (env.envs[0].unwrapped.width*32, env.envs[0].unwrapped.height*32), # type: ignore
-            )
-        else:
-            self._video_writer = None
-
-    def get_video_writer(self, frame=None):
-        if self._video_writer is None:
-            assert frame is not None
-            self._video_writer = cv2.VideoWriter( # type: ignore
-                    self.filename,
-                    cv2.VideoWriter_fourcc(*'VP80'), # type: ignore
-                    self.fps,
-                    (frame.shape[1], frame.shape[0]),
-            )
-        return self._video_writer
-
-    def __call__(self, model, env, obs, results):
-        frame = env.render()
-
-        obs_image = draw_observations(obs)
-        if model.has_attention:
-            attn_img = draw_attention(
-                    core_attention = model.last_attention,
-                    query_gating = model.last_ff_gating,
-                    output_attention = model.last_output_attention,
-                    input_labels = results['input_labels'][-1],
-            )
-        else:
-            attn_img = draw_text('No Attention')
-        rewards_img = draw_rewards(
-                [
-                    rew
-                    for rew,reg in zip(results['reward'],results['regret'])
-                    if reg is not None
-                ],
-                env.goal_str
-        )
-        hidden_info_img = draw_hidden_info(results['hidden_info'])
-        frame_and_attn = concat_images(
-            [
-                concat_images(
-                    [PIL.Image.fromarray(frame), obs_image],
-                    padding=2,
-                    direction='v',
-                    align=-1,
-                ),
-                concat_images(
-                    [attn_img, rewards_img],
-                    padding = 5,
-                    direction='h',
-                )
-            ],
-            padding = 5,
-            direction = 'v',
-            align = 0,
+def compose_frame(snapshot: dict) -> np.ndarray:
+    """ Draw one video frame from the values captured by `VideoCallback`. Returns a BGR image, as expected by `cv2.VideoWriter`. This runs in the video workers, so it only takes picklable values. """
+    obs_image = draw_observations(snapshot['obs'])
+    if snapshot['attention'] is not None:
+        core_attention, query_gating, output_attention = snapshot['attention']
+        attn_img = draw_attention(
+                core_attention = core_attention,
+                query_gating = query_gating,
+                output_attention = output_attention,
+                input_labels = snapshot['input_labels'],
         )
+    else:
+        attn_img = draw_text('No Attention')
+    rewards_img = draw_rewards(
+            snapshot['rewards'],
+            snapshot['target'],
+            total = snapshot['total_reward'],
+    )
+    frame_and_attn = concat_images(
+        [
+            concat_images(
+                [PIL.Image.fromarray(snapshot['frame']), obs_image],
+                padding=2,
+                direction='v',
+                align=-1,
+            ),
+            concat_images(
+                [attn_img, rewards_img],
+                padding = 5,
+                direction='h',
+            )
+        ],
+        padding = 5,
+        direction = 'v',
+        align = 0,
+    )
+    if snapshot['hidden_info'] is not None:
         final_img = concat_images(
-                [frame_and_attn, hidden_info_img],
+                [frame_and_attn, draw_hidden_info(snapshot['hidden_info'])],
                 padding = 5,
                 direction='h',
                 align=0,
         )
+    else:
+        final_img = frame_and_attn
+
+    return np.ascontiguousarray(np.array(final_img)[:,:,::-1])
+
+class VideoCallback:
+    """ Save a video of the episodes with the attention, rewards and hidden info drawn next to each frame.
+
+    Calling the callback only renders the environment and copies the values needed to draw the frame. The frames are drawn with `compose_frame` and written in the background by an `AsyncVideoWriter` (see its documentation for `num_workers`, `max_queue_size` and `block`). Frames are dropped instead of slowing down the evaluation if the workers fall behind, unless `block` is True.
+    """
+    def __init__(self, filename: str, 
+                 size: Optional[Tuple[int,int]] = None,
+                 fps: int = 30,
+                 num_workers: int = 2,
+                 max_queue_size: int = 64,
+                 block: bool = False):
+        self._writer = AsyncVideoWriter(
+                filename,
+                compose_frame_fn = compose_frame,
+                size = size,
+                fps = fps,
+                num_workers = num_workers,
+                max_queue_size = max_queue_size,
+                block = block,
+        )
+
+    @property
+    def num_dropped_frames(self) -> int:
+        return self._writer.num_dropped_frames
 
-        final_img = np.array(final_img)[:,:,::-1]
-        video_writer = self.get_video_writer(final_img)
-        video_writer.write(final_img)
+    def __call__(self, model, env, obs, results):
+        if not self._writer.ready():
+            return
+
+        rewards = [
+            rew
+            for rew,reg in zip(results['reward'],results['regret'])
+            if reg is not None
+        ]
+        snapshot = {
+            'frame': env.render(),
+            'obs': {
+                k: v.cpu().numpy()
+                for k,v in obs.items()
+                if k in ['reward', 'obs (shaped_reward)', 'action']
+            },
+            # `test()` already copied the attention of this step to the host
+            'attention': results['attention'][-1] if model.has_attention else None,
+            'input_labels': results['input_labels'][-1],
+            'rewards': rewards[-5:],
+            'total_reward': sum(rewards),
+            'target': results['target'][-1] if len(results['target']) > 0 else None,
+            'hidden_info': results['hidden_info'],
+        }
+        self._writer.write(snapshot)
 
     def close(self):
-        if self._video_writer is not None:
-            self._video_writer.release()
-            self._video_writer = None
+        self._writer.close()
 
 
 def preprocess_obs(obs):
-    obs_scale = { 'obs (image)': 1.0 / 255.0 }
+    obs_scale = {}
     obs_ignore = ['obs (mission)']
     return {
-        k: torch.tensor(v, dtype=torch.float, device=device).unsqueeze(0)*obs_scale.get(k,1)
+        k: obs_to_tensor(v, device, obs_scale.get(k,1)).unsqueeze(0)
+        for k,v in obs.items()
+        if k not in obs_ignore
+    }
+
+
+def preprocess_obs_batched(obs):
+    """ Same as `preprocess_obs`, for a batch of observations from a vector environment. """
+    obs_scale = {}
+    obs_ignore = ['obs (mission)']
+    return {
+        k: obs_to_tensor(v, device, obs_scale.get(k,1))
         for k,v in obs.items()
         if k not in obs_ignore
     }
@@ -556,16 +655,29 @@ if __name__ == '__main__':
                         help='Environments whose observation spaces are used to initialize the model. If not specified, the "--env" environment will be used.')
     parser.add_argument('--num-episodes', type=int, default=1,
                         help='Number of episodes to test for.')
+    parser.add_argument('--num-envs', type=int, default=1,
+                        help='Number of environments to run in parallel. If greater than 1, the episodes are run on a vector environment with one batched forward pass per step. Videos are not supported in this case.')
+    parser.add_argument('--sync-vector-env', action='store_true',
+                        help='If set, the vector environment used with `--num-envs` runs the environments in the main process instead of one subprocess per environment.')
     parser.add_argument('--verbose', action='store_true', default=False)
     parser.add_argument('--video', type=str, default='test.webm',
                         help='Path to a video file to save.')
     parser.add_argument('--no-video', action='store_true', default=False,
                         help='Do not save a video of the episode. By default, a video is saved to "test.webm".')
+    parser.add_argument('--video-workers', type=int, default=2,
+                        help='Number of processes that draw the video frames in the background. If 0, the frames are drawn by a single background thread.')
+    parser.add_argument('--video-no-drop', action='store_true',
+                        help='Wait for the video workers when they fall behind, instead of dropping frames.')
+    parser.add_argument('--hidden-info-probes', type=str, default=None,
+                        help='Path to the hidden info probes trained with `big_rl.minigrid.hidden_info.train`, with "{key}" in place of the target key (e.g. "probes/{key}.pt"). Target keys without a file are skipped. The predictions of the last step are drawn in the video and kept in the results.')
     parser.add_argument('--results', type=str, default=None,
-                        help='Path to a file to save results.')
+                        help='Path to a file to save results. If the file name ends with ".h5", each episode is written to an HDF5 file as soon as it ends (see `big_rl.utils.evaluation.ResultsWriter`), and only the rewards, regrets and targets are kept in memory. Otherwise, all results are saved with `torch.save` at the end.')
     init_parser_model(parser)
     args = parser.parse_args()
 
+    if args.num_envs > 1 and not args.no_video:
+        raise ValueError('Videos can only be saved with `--num-envs 1`. Use `--no-video` to run environments in parallel.')
+
     # Create environment
     ENV_CONFIG_PRESETS = env_config_presets()
     env_config = ENV_CONFIG_PRESETS[args.env]
@@ -590,6 +702,15 @@ if __name__ == '__main__':
             device = device,
     )
     model.to(device)
+    if args.fuse_output_modules and hasattr(model, 'fuse_output_modules'):
+        model.fuse_output_modules() # type: ignore
+    if args.fused_recurrent_cell:
+        if not isinstance(getattr(model, 'attention', None), RecurrentAttention16):
+            raise ValueError('`--fused-recurrent-cell` only applies to models with a RecurrentAttention16 core.')
+        model.attention.convert_layer_type(BatchRecurrentAttention16Layer_v3) # type: ignore
+        model.to(device)
+    if args.kv_groups is not None:
+        group_kv_projections_(model, args.kv_groups, method=args.kv_groups_method)
 
     if args.model is not None:
         checkpoint = torch.load(args.model, map_location=device)
@@ -602,21 +723,47 @@ if __name__ == '__main__':
     if 'step' in checkpoint:
         print(f'Checkpoint step: {checkpoint["step"]:,}')
 
+    if args.inference_precision != 'fp32':
+        model = LowPrecisionPolicy(model, args.inference_precision) # type: ignore
+
     # Test model
     video_filename = os.path.abspath(args.video)
     if args.no_video:
         video_callback = None
     else:
-        video_callback = VideoCallback(video_filename)
-
-    hidden_info_fn = make_hidden_info_fn({
-        k: f'./debug-model-{k}.pt' for k in TARGET_KEYS
-    })
-
-    test_results = [
-            test(model, env_config, preprocess_obs, video_callback_fn=video_callback, hidden_info_fn=hidden_info_fn, verbose=args.verbose)
-            for _ in tqdm(range(args.num_episodes))
-    ]
+        video_callback = VideoCallback(video_filename, num_workers=args.video_workers, block=args.video_no_drop)
+
+    if args.hidden_info_probes is not None:
+        probe_filenames = find_probes(args.hidden_info_probes)
+        if len(probe_filenames) == 0:
+            raise ValueError(f'No hidden info probes found matching "{args.hidden_info_probes}".')
+        print(f'Loaded hidden info probes: {", ".join(probe_filenames.keys())}')
+        hidden_info_fn = make_hidden_info_fn(probe_filenames, device=device)
+    else:
+        hidden_info_fn = None
+
+    # Write results to disk as episodes finish
+    results_writer = None
+    if args.results is not None and args.results.endswith('.h5'):
+        results_writer = ResultsWriter(os.path.abspath(args.results))
+
+    def save_episode(episode_number, episode):
+        if results_writer is None:
+            return None
+        results_writer.write_episode(episode, index=episode_number)
+        return episode_summary(episode)
+
+    if args.num_envs > 1:
+        VectorEnv = gymnasium.vector.SyncVectorEnv if args.sync_vector_env else gymnasium.vector.AsyncVectorEnv
+        test_env = VectorEnv([lambda: make_env(**env_config) for _ in range(args.num_envs)]) # type: ignore
+        # Attention and hidden states are only needed if the results are saved
+        test_results = test_batched(model, test_env, args.num_episodes, preprocess_obs_batched, record_details=args.results is not None, record_targets=hasattr(env, 'goal_str'), hidden_info_fn=hidden_info_fn, episode_fn=save_episode, verbose=True)
+        test_env.close()
+    else:
+        test_results = []
+        for i in tqdm(range(args.num_episodes)):
+            episode = test(model, env_config, preprocess_obs, video_callback_fn=video_callback, hidden_info_fn=hidden_info_fn, verbose=args.verbose)
+            test_results.append(save_episode(i, episode) or episode)
 
     if video_callback is not None:
         video_callback.close()
@@ -701,7 +848,10 @@ if __name__ == '__main__':
 
     if args.results is not None:
         results_filename = os.path.abspath(args.results)
-        torch.save(test_results, results_filename)
+        if results_writer is not None:
+            results_writer.close()
+        else:
+            torch.save(test_results, results_filename)
         print(f'Results saved to {results_filename}')
 
     breakpoint()
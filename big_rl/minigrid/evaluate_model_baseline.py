@@ -4,6 +4,7 @@ import os
 from typing import Tuple, Optional, Any
 
 import cv2
+import gymnasium.vector
 import numpy as np
 import torch
 from tqdm import tqdm
@@ -13,7 +14,9 @@ from fonts.ttf import Roboto # type: ignore
 from big_rl.minigrid.envs import make_env
 from big_rl.minigrid.arguments import init_parser_model
 from big_rl.minigrid.common import env_config_presets, init_model
-from big_rl.utils import merge_space
+from big_rl.utils import merge_space, obs_to_tensor
+from big_rl.utils.evaluation import evaluate_vector_env
+from big_rl.model.model import introspection
 
 
 def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, verbose=False):
@@ -41,7 +44,7 @@ def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, verbose=F
     terminated = False
     truncated = False
     for _ in steps_iterator:
-        with torch.no_grad():
+        with torch.no_grad(), introspection(model):
             model_output = model(obs)
 
             action_probs = model_output['action'].softmax(1)
@@ -55,9 +58,9 @@ def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, verbose=F
         results['regret'].append(info.get('regret', None))
         if model.has_attention:
             results['attention'].append((
-                [x.numpy() for x in model.last_attention],
-                [x.numpy() for x in model.last_ff_gating],
-                {k: v.numpy() for k,v in model.last_output_attention.items()},
+                [x.cpu().numpy() for x in model.last_attention],
+                [x.cpu().numpy() for x in model.last_ff_gating],
+                {k: v.cpu().numpy() for k,v in model.last_output_attention.items()},
             ))
             results['shaped_reward'].append(compute_shaped_reward(model))
         results['input_labels'].append(model.last_input_labels)
@@ -93,6 +96,51 @@ def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, verbose=F
     }
 
 
+def test_batched(model, env, num_episodes, preprocess_obs_fn, record_targets=False, verbose=False):
+    """ Same as `test()`, but runs `num_episodes` episodes in parallel on the vector environment `env`, with one batched forward pass per step. Returns a list with one entry per episode, each in the format returned by `test()`. Videos are not supported. If `record_targets` is True, the goal string of each environment is read after every step. """
+    def init_results():
+        return {
+            'reward': [],
+            'regret': [],
+            'attention': [],
+            'input_labels': [],
+            'target': [], # Goal string
+            'shaped_reward': [], # Predicted shaped reward
+        }
+
+    def sample_action(model_output):
+        action_probs = model_output['action'].softmax(1)
+        action_dist = torch.distributions.Categorical(action_probs)
+        return action_dist.sample().cpu().numpy()
+
+    def record(results, model, model_output, index, reward, info, done):
+        results['reward'].append(reward)
+        results['regret'].append(info.get('regret', None))
+        results['input_labels'].append(model.last_input_labels)
+        if 'goal_str' in info:
+            results['target'].append(info['goal_str'])
+        if done:
+            if 'supervised_trials' in info:
+                results['supervision'] = {
+                    'supervised_trials': info['supervised_trials'],
+                    'unsupervised_trials': info['unsupervised_trials'],
+                    'supervised_reward': info['supervised_reward'],
+                    'unsupervised_reward': info['unsupervised_reward'],
+                }
+            results['reward_by_trial'] = info['reward_by_trial']
+            results['regret_by_trial'] = info['regret_by_trial']
+
+    return evaluate_vector_env(
+            model, env, num_episodes,
+            preprocess_obs_fn = preprocess_obs_fn,
+            sample_action_fn = sample_action,
+            init_results_fn = init_results,
+            record_fn = record,
+            env_attrs = ['goal_str'] if record_targets else [],
+            verbose = verbose,
+    )
+
+
 def split_results_by_target(results):
     """ Split up the results by target object. This is used when the target is randomized in the middle of an episode to get information on how well the agent performs for each target change. """
 
@@ -264,10 +312,21 @@ class VideoCallback:
 
 
 def preprocess_obs(obs):
-    obs_scale = { 'obs (image)': 1.0 / 255.0 }
+    obs_scale = {}
+    obs_ignore = ['obs (mission)']
+    return {
+        k: obs_to_tensor(v, device, obs_scale.get(k,1)).unsqueeze(0)
+        for k,v in obs.items()
+        if k not in obs_ignore
+    }
+
+
+def preprocess_obs_batched(obs):
+    """ Same as `preprocess_obs`, for a batch of observations from a vector environment. """
+    obs_scale = {}
     obs_ignore = ['obs (mission)']
     return {
-        k: torch.tensor(v, dtype=torch.float, device=device).unsqueeze(0)*obs_scale.get(k,1)
+        k: obs_to_tensor(v, device, obs_scale.get(k,1))
         for k,v in obs.items()
         if k not in obs_ignore
     }
@@ -284,6 +343,10 @@ if __name__ == '__main__':
                         help='Environments whose observation spaces are used to initialize the model. If not specified, the "--env" environment will be used.')
     parser.add_argument('--num-episodes', type=int, default=1,
                         help='Number of episodes to test for.')
+    parser.add_argument('--num-envs', type=int, default=1,
+                        help='Number of environments to run in parallel. If greater than 1, the episodes are run on a vector environment with one batched forward pass per step. Videos are not supported in this case.')
+    parser.add_argument('--sync-vector-env', action='store_true',
+                        help='If set, the vector environment used with `--num-envs` runs the environments in the main process instead of one subprocess per environment.')
     parser.add_argument('--verbose', action='store_true', default=False)
     parser.add_argument('--video', type=str, default='test.webm',
                         help='Path to a video file to save.')
@@ -294,6 +357,9 @@ if __name__ == '__main__':
     init_parser_model(parser)
     args = parser.parse_args()
 
+    if args.num_envs > 1 and not args.no_video:
+        raise ValueError('Videos can only be saved with `--num-envs 1`. Use `--no-video` to run environments in parallel.')
+
     # Create environment
     ENV_CONFIG_PRESETS = env_config_presets()
     env_config = ENV_CONFIG_PRESETS[args.env]
@@ -342,10 +408,16 @@ if __name__ == '__main__':
     else:
         video_callback = VideoCallback(video_filename)
 
-    test_results = [
-            test(model, env_config, preprocess_obs, video_callback_fn=video_callback, verbose=args.verbose)
-            for _ in tqdm(range(args.num_episodes))
-    ]
+    if args.num_envs > 1:
+        VectorEnv = gymnasium.vector.SyncVectorEnv if args.sync_vector_env else gymnasium.vector.AsyncVectorEnv
+        test_env = VectorEnv([lambda: make_env(**env_config) for _ in range(args.num_envs)]) # type: ignore
+        test_results = test_batched(model, test_env, args.num_episodes, preprocess_obs_batched, record_targets=hasattr(env, 'goal_str'), verbose=True)
+        test_env.close()
+    else:
+        test_results = [
+                test(model, env_config, preprocess_obs, video_callback_fn=video_callback, verbose=args.verbose)
+                for _ in tqdm(range(args.num_episodes))
+        ]
 
     if video_callback is not None:
         video_callback.close()
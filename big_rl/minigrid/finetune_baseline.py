@@ -18,7 +18,7 @@ from frankenstein.advantage.gae import generalized_advantage_estimate
 from frankenstein.loss.policy_gradient import clipped_advantage_policy_gradient_loss
 
 from big_rl.minigrid.envs import make_env
-from big_rl.utils import merge_space
+from big_rl.utils import merge_space, obs_to_tensor
 from big_rl.minigrid.common import init_model, env_config_presets
 
 
@@ -244,7 +244,7 @@ def train_single_env(
 
     def preprocess_input(obs: Dict[str, Any]) -> Dict[str, torch.Tensor]:
         return {
-            k: torch.tensor(v, device=device)*obs_scale.get(k,1)
+            k: obs_to_tensor(v, device, obs_scale.get(k,1))
             for k,v in obs.items() if k not in obs_ignore
         }
 
@@ -274,7 +274,7 @@ def train_single_env(
             # Select action
             with torch.no_grad():
                 model_output = model({
-                    k: torch.tensor(v, dtype=torch.float, device=device)*obs_scale.get(k,1)
+                    k: obs_to_tensor(v, device, obs_scale.get(k,1))
                     for k,v in obs.items()
                     if k not in obs_ignore
                 })
@@ -579,7 +579,7 @@ def finetune(
             lr_scheduler = lr_scheduler,
             max_steps = max_steps,
             rollout_length = rollout_length,
-            obs_scale = {'obs (image)': 1.0/255.0},
+            obs_scale = {},
             reward_clip = reward_clip,
             reward_scale = reward_scale,
             discount = discount,
@@ -717,7 +717,7 @@ if __name__ == '__main__':
     #        lr_scheduler = lr_scheduler,
     #        max_steps = args.max_steps,
     #        rollout_length = args.rollout_length,
-    #        obs_scale = {'obs (image)': 1.0/255.0},
+    #        obs_scale = {},
     #        reward_clip = args.reward_clip,
     #        reward_scale = args.reward_scale,
     #        discount = args.discount,
@@ -12,7 +12,7 @@ from tqdm import tqdm
 from big_rl.minigrid.envs import make_env
 from big_rl.minigrid.arguments import init_parser_model
 from big_rl.minigrid.common import env_config_presets, init_model
-from big_rl.utils import merge_space
+from big_rl.utils import merge_space, obs_to_tensor
 from big_rl.minigrid.hidden_info.hidden_info import OBJ_TO_IDX, get_all_objects_pos, get_all_objects_vector, get_relative_target_obj_pos, get_target_obj_idx, get_target_objs, get_relative_wall_map, OBJECTS
 
 
@@ -79,10 +79,10 @@ def run_episodes(model, env_config, preprocess_obs_fn, num_episodes, max_episode
 
 
 def preprocess_obs(obs):
-    obs_scale = { 'obs (image)': 1.0 / 255.0 }
+    obs_scale = {}
     obs_ignore = ['obs (mission)']
     return {
-        k: torch.tensor(v, dtype=torch.float, device=device).unsqueeze(0)*obs_scale.get(k,1)
+        k: obs_to_tensor(v, device, obs_scale.get(k,1)).unsqueeze(0)
         for k,v in obs.items()
         if k not in obs_ignore
     }
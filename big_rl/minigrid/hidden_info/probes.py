@@ -0,0 +1,199 @@
+""" Run the hidden info probes trained with `train.py` together, on batches of hidden states.
+
+The probes are small MLPs that all read the same flattened hidden state. `ProbeBank` concatenates their first layers into a single linear layer, so the (large) hidden state is only multiplied once, and stacks the remaining layers of probes with the same hidden sizes so that they run as one batched matrix multiplication. The cost of decoding a step therefore grows much more slowly with the number of probes than running each probe separately.
+
+It can be used online, on the hidden states of a vector environment (see `evaluate_model.make_hidden_info_fn`), or offline on a dataset collected by `collect_data.py`:
+
+    python -m big_rl.minigrid.hidden_info.probes --dataset val-dataset.h5 --probes 'models/{key}.pt' --output predictions.h5
+"""
+
+import argparse
+from collections import defaultdict
+import os
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from big_rl.minigrid.hidden_info.train import TARGET_KEYS, Model, make_model
+
+
+def flatten_hidden(hidden: Sequence[torch.Tensor]) -> torch.Tensor:
+    """ Flatten a batch of recurrent hidden states into the inputs of the probes. The batch dimension of each tensor is the second to last one, as returned by the models. Returns a tensor of shape (batch size, input size), where each row is the same as `torch.cat([h.flatten() for h in hidden])` on the hidden state of a single environment, which is what `collect_data.py` saves. """
+    return torch.cat([h.movedim(-2, 0).flatten(1) for h in hidden], dim=1)
+
+
+def apply_activation(target_key: str, output: torch.Tensor) -> torch.Tensor:
+    """ Convert the output of a probe into the quantity it predicts, matching the loss it was trained with (see `train.make_loss`). """
+    if target_key == 'target_idx':
+        return output.softmax(-1)
+    elif target_key in ['wall_map', 'object_presence']:
+        return output.sigmoid()
+    return output
+
+
+def _linear_layers(probe: Model) -> List[torch.nn.Linear]:
+    return [m for m in probe.seq if isinstance(m, torch.nn.Linear)]
+
+
+class ProbeBank(torch.nn.Module):
+    def __init__(self, probes: Mapping[str, Model]):
+        """ Fuse trained probes into one module. The probes are not modified.
+
+        Args:
+            probes: Probes to run, indexed by their target key. All probes must take inputs of the same size.
+        """
+        super().__init__()
+
+        layers = {k: _linear_layers(p) for k,p in probes.items()}
+        input_sizes = set(l[0].in_features for l in layers.values())
+        if len(input_sizes) != 1:
+            raise ValueError(f'All probes must have the same input size. Received {input_sizes}.')
+        self.input_size = input_sizes.pop()
+        self.keys = list(probes.keys())
+
+        # Probes with the same hidden sizes share their layers after the first. Probes without hidden layers are put in their own group each, since their outputs have different sizes.
+        groups: Dict[Tuple, List[str]] = defaultdict(list)
+        for k,l in layers.items():
+            if len(l) == 1:
+                groups[(k,)].append(k)
+            else:
+                groups[tuple(x.out_features for x in l[:-1])].append(k)
+        self.groups = list(groups.values())
+
+        # First layer of every probe, ordered by group so that each group's slice is contiguous
+        first_layers = [layers[k][0] for g in self.groups for k in g]
+        self.input_layer = torch.nn.Linear(self.input_size, sum(l.out_features for l in first_layers))
+        with torch.no_grad():
+            self.input_layer.weight.copy_(torch.cat([l.weight for l in first_layers]))
+            self.input_layer.bias.copy_(torch.cat([l.bias for l in first_layers])) # type: ignore
+        self.group_slices = []
+        start = 0
+        for g in self.groups:
+            size = sum(layers[k][0].out_features for k in g)
+            self.group_slices.append((start, start+size))
+            start += size
+
+        # Remaining layers of each group, stacked to shape (group size, output size, input size) like the weights of `torch.nn.Linear`, which is faster to multiply by than the transpose. Output layers are zero-padded to the largest output of the group.
+        self.output_sizes = {k: l[-1].out_features for k,l in layers.items()}
+        self.group_weights = torch.nn.ParameterList()
+        self.group_biases = torch.nn.ParameterList()
+        self.group_num_layers = []
+        for g in self.groups:
+            num_layers = len(layers[g[0]]) - 1
+            self.group_num_layers.append(num_layers)
+            for i in range(1, num_layers+1):
+                in_size = layers[g[0]][i].in_features
+                out_size = max(layers[k][i].out_features for k in g)
+                weight = torch.zeros(len(g), out_size, in_size)
+                bias = torch.zeros(len(g), 1, out_size)
+                for j,k in enumerate(g):
+                    l = layers[k][i]
+                    weight[j,:l.out_features,:] = l.weight.detach()
+                    bias[j,0,:l.out_features] = l.bias.detach()
+                self.group_weights.append(torch.nn.Parameter(weight, requires_grad=False))
+                self.group_biases.append(torch.nn.Parameter(bias, requires_grad=False))
+
+    def forward(self, x: torch.Tensor, activation: bool = True) -> Dict[str, torch.Tensor]:
+        """ Run all probes on a batch of flattened hidden states of shape (batch size, input size). Returns the output of each probe, of shape (batch size, output size). If `activation` is True, the outputs are converted to probabilities or positions with `apply_activation`, otherwise the raw outputs are returned. """
+        x = self.input_layer(x)
+        outputs = {}
+        param_idx = 0
+        for g, (start, end), num_layers in zip(self.groups, self.group_slices, self.group_num_layers):
+            if num_layers == 0:
+                outputs[g[0]] = x[:, start:end]
+                continue
+            h = x[:, start:end].relu()
+            h = h.reshape(h.shape[0], len(g), -1).transpose(0, 1) # (group size, batch size, hidden size)
+            for i in range(num_layers):
+                h = torch.baddbmm(self.group_biases[param_idx], h, self.group_weights[param_idx].transpose(1, 2))
+                param_idx += 1
+                if i < num_layers - 1:
+                    h = h.relu()
+            for j,k in enumerate(g):
+                outputs[k] = h[j, :, :self.output_sizes[k]]
+        if activation:
+            outputs = {k: apply_activation(k, v) for k,v in outputs.items()}
+        return {k: outputs[k] for k in self.keys}
+
+    @torch.no_grad()
+    def predict(self, hidden, batch_size: int = 4096, activation: bool = True, verbose: bool = False) -> Dict[str, np.ndarray]:
+        """ Run the probes on an array of flattened hidden states of shape (N, input size), such as the "hidden" dataset saved by `collect_data.py`. Any object that can be sliced along its first dimension (numpy array, tensor, h5py dataset) can be used, and it is read `batch_size` rows at a time. """
+        device = self.input_layer.weight.device
+        outputs = defaultdict(list)
+        batch_starts = range(0, len(hidden), batch_size)
+        if verbose:
+            batch_starts = tqdm(batch_starts)
+        for start in batch_starts:
+            x = torch.as_tensor(np.asarray(hidden[start:start+batch_size]), dtype=torch.float, device=device)
+            for k,v in self(x, activation=activation).items():
+                outputs[k].append(v.cpu().numpy())
+        if len(outputs) == 0:
+            return {k: np.zeros((0, self.output_sizes[k]), dtype=np.float32) for k in self.keys}
+        return {k: np.concatenate(v) for k,v in outputs.items()}
+
+    @classmethod
+    def load(cls, model_filenames: Mapping[str, str], device: Optional[torch.device] = None) -> 'ProbeBank':
+        """ Load probes saved by `train.py`, indexed by target key. The input size of each probe is read from its saved weights. """
+        probes = {}
+        for target_key, filename in model_filenames.items():
+            state_dict = torch.load(filename, map_location='cpu')
+            probe = make_model(
+                    target_key = target_key,
+                    input_size = state_dict['seq.0.weight'].shape[1],
+            )
+            probe.load_state_dict(state_dict)
+            probes[target_key] = probe
+        bank = cls(probes)
+        bank.eval()
+        if device is not None:
+            bank.to(device)
+        return bank
+
+
+def find_probes(pattern: str, target_keys: Sequence[str] = TARGET_KEYS) -> Dict[str, str]:
+    """ Find the probe files matching `pattern`, where "{key}" is replaced by each target key, e.g. "models/{key}.pt". Target keys without a file are skipped. """
+    if '{key}' not in pattern:
+        raise ValueError(f'The probe file pattern must contain "{{key}}". Received "{pattern}".')
+    filenames = {k: pattern.format(key=k) for k in target_keys}
+    return {k: f for k,f in filenames.items() if os.path.isfile(f)}
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='Run the trained hidden info probes on a dataset of hidden states collected by `collect_data.py` and save their predictions.')
+    parser.add_argument('--dataset', type=str, default='./val-dataset.h5',
+                        help='Path to a dataset of hidden states.')
+    parser.add_argument('--probes', type=str, required=True,
+                        help='Path to the trained probes, with "{key}" in place of the target key (e.g. "models/{key}.pt"). Target keys without a file are skipped.')
+    parser.add_argument('--output', type=str, default='./predictions.h5',
+                        help='Path to a file to save the predictions. Each probe\'s predictions are saved in a dataset named after its target key.')
+    parser.add_argument('--batch-size', type=int, default=4096,
+                        help='Number of hidden states processed at once.')
+    parser.add_argument('--raw', action='store_true',
+                        help='Save the raw outputs of the probes instead of probabilities.')
+    parser.add_argument('--cuda', action='store_true',
+                        help='Use CUDA.')
+    args = parser.parse_args()
+
+    if args.cuda and torch.cuda.is_available():
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+
+    model_filenames = find_probes(args.probes)
+    if len(model_filenames) == 0:
+        raise ValueError(f'No probes found matching "{args.probes}".')
+    print(f'Loaded probes: {", ".join(model_filenames.keys())}')
+    bank = ProbeBank.load(model_filenames, device=device)
+
+    with h5py.File(args.dataset, 'r') as dataset:
+        predictions = bank.predict(dataset['hidden'], batch_size=args.batch_size, activation=not args.raw, verbose=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with h5py.File(args.output, 'w') as f:
+        for k,v in predictions.items():
+            f.create_dataset(k, data=v)
+    print(f'Saved predictions to {os.path.abspath(args.output)}')
@@ -9,7 +9,9 @@ import pygame
 from big_rl.minigrid.envs import make_env
 from big_rl.minigrid.arguments import init_parser_model
 from big_rl.minigrid.common import env_config_presets, init_model
-from big_rl.utils import merge_space
+from big_rl.utils import merge_space, obs_to_tensor
+from big_rl.model.model import introspection
+from big_rl.model.low_precision import LowPrecisionPolicy
 
 
 def render_text(surface, text: list[str], font, color=(255,255,255), padding=5):
@@ -107,7 +109,7 @@ def test(model, env_config, preprocess_obs_fn):
         # Run a step in the environment
         obs['obs (shaped_reward)'] = np.array([user_reward], dtype=np.float32)
         obs = preprocess_obs_fn(obs)
-        with torch.no_grad():
+        with torch.no_grad(), introspection(model):
             model_output = model(obs, hidden)
 
             hidden = model_output['hidden']
@@ -123,9 +125,9 @@ def test(model, env_config, preprocess_obs_fn):
         results['regret'].append(info.get('regret', None))
         if model.has_attention:
             results['attention'].append((
-                [x.numpy() for x in model.last_attention],
-                [x.numpy() for x in model.last_ff_gating],
-                {k: v.numpy() for k,v in model.last_output_attention.items()},
+                [x.cpu().numpy() for x in model.last_attention],
+                [x.cpu().numpy() for x in model.last_ff_gating],
+                {k: v.cpu().numpy() for k,v in model.last_output_attention.items()},
             ))
         results['hidden'].append([
             x.cpu().detach().numpy() for x in model.last_hidden
@@ -163,10 +165,10 @@ def test(model, env_config, preprocess_obs_fn):
 
 
 def preprocess_obs(obs):
-    obs_scale = { 'obs (image)': 1.0 / 255.0 }
+    obs_scale = {}
     obs_ignore = ['obs (mission)']
     return {
-        k: torch.tensor(v, dtype=torch.float, device=device).unsqueeze(0)*obs_scale.get(k,1)
+        k: obs_to_tensor(v, device, obs_scale.get(k,1)).unsqueeze(0)
         for k,v in obs.items()
         if k not in obs_ignore
     }
@@ -231,5 +233,8 @@ if __name__ == '__main__':
         else:
             print('No model specified, using random model. (debug mode)')
 
+    if args.inference_precision != 'fp32':
+        model = LowPrecisionPolicy(model, args.inference_precision) # type: ignore
+
     # Test model
     test(model, env_config, preprocess_obs)
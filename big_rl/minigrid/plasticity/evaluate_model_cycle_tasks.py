@@ -18,7 +18,7 @@ import wandb
 from big_rl.minigrid.envs import make_env
 from big_rl.minigrid.arguments import init_parser_model
 from big_rl.minigrid.common import env_config_presets, init_model
-from big_rl.utils import merge_space
+from big_rl.utils import merge_space, obs_to_tensor
 
 
 def test(model, env_configs, num_envs, preprocess_obs_fn, steps_per_env, num_cycles, num_tasks, verbose=False):
@@ -108,10 +108,10 @@ def split_results_by_target(results):
 
 
 def preprocess_obs(obs):
-    obs_scale = { 'obs (image)': 1.0 / 255.0 }
+    obs_scale = {}
     obs_ignore = ['obs (mission)']
     return {
-        k: torch.tensor(v, dtype=torch.float, device=device)*obs_scale.get(k,1)
+        k: obs_to_tensor(v, device, obs_scale.get(k,1))
         for k,v in obs.items()
         if k not in obs_ignore
     }
@@ -26,7 +26,7 @@ from frankenstein.advantage.gae import generalized_advantage_estimate
 from frankenstein.loss.policy_gradient import clipped_advantage_policy_gradient_loss
 
 from big_rl.minigrid.envs import make_env
-from big_rl.utils import merge_space
+from big_rl.utils import merge_space, obs_to_tensor
 from big_rl.minigrid.common import init_model, env_config_presets
 
 
@@ -221,7 +221,7 @@ def train_single_env(
 
     def preprocess_input(obs: Dict[str, Any]) -> Dict[str, torch.Tensor]:
         return {
-            k: torch.tensor(v, device=device)*obs_scale.get(k,1)
+            k: obs_to_tensor(v, device, obs_scale.get(k,1))
             for k,v in obs.items() if k not in obs_ignore
         }
 
@@ -252,7 +252,7 @@ def train_single_env(
             # Select action
             with torch.no_grad():
                 model_output = model({
-                    k: torch.tensor(v, dtype=torch.float, device=device)*obs_scale.get(k,1)
+                    k: obs_to_tensor(v, device, obs_scale.get(k,1))
                     for k,v in obs.items()
                     if k not in obs_ignore
                 })
@@ -548,7 +548,7 @@ def finetune(
                     optimizer = optimizer,
                     lr_scheduler = lr_scheduler,
                     rollout_length = rollout_length,
-                    obs_scale = {'obs (image)': 1.0/255.0},
+                    obs_scale = {},
                     reward_clip = reward_clip,
                     reward_scale = reward_scale,
                     discount = discount,
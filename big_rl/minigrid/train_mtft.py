@@ -20,7 +20,8 @@ from frankenstein.advantage.gae import generalized_advantage_estimate
 from frankenstein.loss.policy_gradient import clipped_advantage_policy_gradient_loss
 
 from big_rl.minigrid.envs import make_env
-from big_rl.utils import torch_save, zip2, merge_space, generate_id
+from big_rl.model.model import set_introspection
+from big_rl.utils import torch_save, zip2, merge_space, generate_id, obs_to_tensor
 from big_rl.minigrid.common import init_model, env_config_presets
 
 
@@ -246,7 +247,7 @@ def train_single_env(
 
     def preprocess_input(obs: Dict[str, Any]) -> Dict[str, torch.Tensor]:
         return {
-            k: torch.tensor(v, device=device)*obs_scale.get(k,1)
+            k: obs_to_tensor(v, device, obs_scale.get(k,1))
             for k,v in obs.items() if k not in obs_ignore
         }
 
@@ -275,7 +276,7 @@ def train_single_env(
         # Select action
         with torch.no_grad():
             model_output = model({
-                k: torch.tensor(v, dtype=torch.float, device=device)*obs_scale.get(k,1)
+                k: obs_to_tensor(v, device, obs_scale.get(k,1))
                 for k,v in obs.items()
                 if k not in obs_ignore
             })
@@ -337,7 +338,7 @@ def train_single_env(
             # Select action
             with torch.no_grad():
                 model_output = model({
-                    k: torch.tensor(v, dtype=torch.float, device=device)*obs_scale.get(k,1)
+                    k: obs_to_tensor(v, device, obs_scale.get(k,1))
                     for k,v in obs.items()
                     if k not in obs_ignore
                 })
@@ -386,7 +387,7 @@ def train_single_env(
                 episode_true_reward[done] = 0
                 episode_steps[done] = 0
 
-        if type(model).__name__ == 'ModularPolicy5':
+        if type(model).__name__ == 'ModularPolicy5' and model.introspect: # type: ignore
             assert isinstance(model.last_attention, list)
             assert isinstance(model.last_input_labels, list)
             assert isinstance(model.last_output_attention, dict)
@@ -648,6 +649,7 @@ if __name__ == '__main__':
             device = device,
     )
     model.to(device)
+    set_introspection(model, args.log_attention)
 
     # Initialize optimizer
     if args.optimizer == 'Adam':
@@ -695,7 +697,7 @@ if __name__ == '__main__':
             lr_scheduler = lr_scheduler,
             max_steps = args.max_steps,
             rollout_length = args.rollout_length,
-            obs_scale = {'obs (image)': 1.0/255.0},
+            obs_scale = {},
             reward_clip = args.reward_clip,
             reward_scale = args.reward_scale,
             discount = args.discount,
@@ -20,7 +20,8 @@ from frankenstein.advantage.gae import generalized_advantage_estimate
 from frankenstein.loss.policy_gradient import clipped_advantage_policy_gradient_loss
 
 from big_rl.minigrid.envs import make_env
-from big_rl.utils import torch_save, zip2, merge_space, generate_id
+from big_rl.model.model import set_introspection
+from big_rl.utils import torch_save, zip2, merge_space, generate_id, obs_to_tensor
 from big_rl.minigrid.common import init_model, env_config_presets
 
 
@@ -49,16 +50,12 @@ def compute_ppo_losses(
 
     n = len(history.obs_history)
     num_training_envs = len(reward[0])
-    initial_hidden = model.init_hidden(num_training_envs) # type: ignore
 
     with torch.no_grad():
         net_output = []
         curr_hidden = tuple([h[0].detach() for h in hidden])
         for o,term in zip2(obs,terminal):
-            curr_hidden = tuple([
-                torch.where(term.unsqueeze(1), init_h, h)
-                for init_h,h in zip(initial_hidden,curr_hidden)
-            ])
+            curr_hidden = model.reset_hidden_(curr_hidden, term) # type: ignore
             o = preprocess_input_fn(o) if preprocess_input_fn is not None else o
             no = model(o,curr_hidden)
             curr_hidden = no['hidden']
@@ -85,12 +82,9 @@ def compute_ppo_losses(
     for _ in range(num_epochs):
         net_output = []
         curr_hidden = tuple([h[0].detach() for h in hidden])
-        initial_hidden = model.init_hidden(num_training_envs) # type: ignore
+        initial_hidden = model.initial_hidden() # type: ignore
         for o,term in zip2(obs,terminal):
-            curr_hidden = tuple([
-                torch.where(term.unsqueeze(1), init_h, h)
-                for init_h,h in zip(initial_hidden,curr_hidden)
-            ])
+            curr_hidden = model.reset_hidden_(curr_hidden, term, initial_hidden) # type: ignore
             o = preprocess_input_fn(o) if preprocess_input_fn is not None else o
             no = model(o,curr_hidden)
             curr_hidden = no['hidden']
@@ -216,7 +210,7 @@ def train_single_env(
 
     def preprocess_input(obs: Dict[str, Any]) -> Dict[str, torch.Tensor]:
         return {
-            k: torch.tensor(v, device=device)*obs_scale.get(k,1)
+            k: obs_to_tensor(v, device, obs_scale.get(k,1))
             for k,v in obs.items() if k not in obs_ignore
         }
 
@@ -247,7 +241,7 @@ def train_single_env(
         # Select action
         with torch.no_grad():
             model_output = model({
-                k: torch.tensor(v, dtype=torch.float, device=device)*obs_scale.get(k,1)
+                k: obs_to_tensor(v, device, obs_scale.get(k,1))
                 for k,v in obs.items()
                 if k not in obs_ignore
             }, hidden)
@@ -267,10 +261,7 @@ def train_single_env(
 
         if done.any():
             # Reset hidden state for finished episodes
-            hidden = tuple(
-                    torch.where(torch.tensor(done, device=device).unsqueeze(1), h0, h)
-                    for h0,h in zip(model.init_hidden(num_envs), hidden) # type: ignore (???)
-            )
+            hidden = model.reset_hidden_(hidden, done) # type: ignore
             # Print stats
             for env_label, env_id in env_label_to_id.items():
                 done2 = done & (env_ids == env_id)
@@ -315,7 +306,7 @@ def train_single_env(
             # Select action
             with torch.no_grad():
                 model_output = model({
-                    k: torch.tensor(v, dtype=torch.float, device=device)*obs_scale.get(k,1)
+                    k: obs_to_tensor(v, device, obs_scale.get(k,1))
                     for k,v in obs.items()
                     if k not in obs_ignore
                 }, hidden)
@@ -359,10 +350,7 @@ def train_single_env(
                         global_step_counter = global_step_counter,
                 )
                 # Reset hidden state for finished episodes
-                hidden = tuple(
-                        torch.where(torch.tensor(done, device=device).unsqueeze(1), h0, h)
-                        for h0,h in zip(model.init_hidden(num_envs), hidden) # type: ignore (???)
-                )
+                hidden = model.reset_hidden_(hidden, done) # type: ignore
                 # Save episode rewards
                 for r in episode_reward[done]:
                     episode_rewards.append(r)
@@ -371,7 +359,7 @@ def train_single_env(
                 episode_true_reward[done] = 0
                 episode_steps[done] = 0
 
-        if type(model).__name__ == 'ModularPolicy5':
+        if type(model).__name__ == 'ModularPolicy5' and model.introspect: # type: ignore
             assert isinstance(model.last_attention, list)
             assert isinstance(model.last_input_labels, list)
             assert isinstance(model.last_output_attention, dict)
@@ -659,6 +647,8 @@ if __name__ == '__main__':
     }
     outer_model = init_model(**model_kwargs).to(device)
     inner_model = [init_model(**model_kwargs).to(device) for _ in envs]
+    for m in inner_model:
+        set_introspection(m, args.log_attention)
 
     # Initialize optimizer
     if args.optimizer == 'Adam':
@@ -714,7 +704,7 @@ if __name__ == '__main__':
             lr_scheduler = lr_scheduler,
             max_steps = args.max_steps,
             rollout_length = args.rollout_length,
-            obs_scale = {'obs (image)': 1.0/255.0},
+            obs_scale = {},
             reward_clip = args.reward_clip,
             reward_scale = args.reward_scale,
             discount = args.discount,
@@ -0,0 +1,334 @@
+import copy
+from typing import Dict, Tuple, Union
+
+import torch
+from torchtyping.tensor_type import TensorType
+
+from big_rl.model.model import BatchLinear, BatchMultiHeadAttentionEinsum, GreyscaleImageInput, ImageInput56, _mask_attention_weights
+
+
+PRECISIONS = ['fp32', 'bf16', 'int8']
+
+
+# Dynamic int8 quantization
+# Weights are quantized to int8 once (per output feature), and the activations are quantized on the fly (per row) at each call. The int8 matrix products are computed with `torch._int_mm`, which accumulates in int32.
+
+
+def _quantize_weight(weight: TensorType[...,'in_features','out_features',float]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """ Symmetric quantization of a weight matrix with one scale per output feature. Returns the int8 weights and their scales (shape `(..., 1, out_features)`). """
+    scale = weight.abs().amax(-2, keepdim=True).clamp(min=1e-8) / 127
+    return (weight / scale).round().clamp(-127, 127).to(torch.int8), scale
+
+
+def _quantize_rows(x: TensorType[...,'features',float]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """ Symmetric quantization with one scale per row. Returns the int8 values and their scales (shape `(..., 1)`). """
+    scale = x.abs().amax(-1, keepdim=True).clamp(min=1e-8) / 127
+    return (x / scale).round_().to(torch.int8), scale
+
+
+def int8_matmul(x: TensorType[...,'in_features',float], qweight: TensorType['in_features','out_features',torch.int8], scale: TensorType['out_features',float]) -> torch.Tensor:
+    """ Compute `x @ (qweight * scale)` with int8 inputs. `x` is quantized with one scale per row. """
+    shape = x.shape
+    x_q, x_scale = _quantize_rows(x.reshape(-1, shape[-1]))
+    output = torch._int_mm(x_q, qweight).float() * x_scale * scale
+    return output.view(*shape[:-1], qweight.shape[1])
+
+
+class Int8Linear(torch.nn.Module):
+    """ Inference-only int8 version of `torch.nn.Linear`. """
+    def __init__(self, module: torch.nn.Linear):
+        super().__init__()
+        self.register_buffer('qweight', torch.zeros(module.in_features, module.out_features, dtype=torch.int8, device=module.weight.device))
+        self.register_buffer('scale', torch.zeros(module.out_features, device=module.weight.device))
+        self.register_buffer('bias', None if module.bias is None else torch.zeros_like(module.bias.detach()))
+        self.copy_from_float(module)
+
+    @torch.no_grad()
+    def copy_from_float(self, module: torch.nn.Linear):
+        qweight, scale = _quantize_weight(module.weight.t())
+        self.qweight.copy_(qweight)
+        self.scale.copy_(scale.squeeze(0))
+        if self.bias is not None:
+            self.bias.copy_(module.bias)
+
+    def forward(self, x):
+        output = int8_matmul(x, self.qweight, self.scale)
+        if self.bias is not None:
+            output = output + self.bias
+        return output
+
+
+class Int8Conv2d(torch.nn.Module):
+    """ Inference-only int8 version of `torch.nn.Conv2d`, computed as a matrix product over the image patches. Only supports `groups=1` and zero padding. """
+    def __init__(self, module: torch.nn.Conv2d):
+        super().__init__()
+        if module.groups != 1 or module.padding_mode != 'zeros' or isinstance(module.padding, str):
+            raise ValueError('Only convolutions with groups=1 and explicit zero padding can be quantized.')
+        self.out_channels = module.out_channels
+        self.kernel_size = module.kernel_size
+        self.stride = module.stride
+        self.padding = module.padding
+        self.dilation = module.dilation
+        in_features = module.in_channels * module.kernel_size[0] * module.kernel_size[1]
+        self.register_buffer('qweight', torch.zeros(in_features, module.out_channels, dtype=torch.int8, device=module.weight.device))
+        self.register_buffer('scale', torch.zeros(module.out_channels, device=module.weight.device))
+        self.register_buffer('bias', None if module.bias is None else torch.zeros_like(module.bias.detach()))
+        self.copy_from_float(module)
+
+    @torch.no_grad()
+    def copy_from_float(self, module: torch.nn.Conv2d):
+        qweight, scale = _quantize_weight(module.weight.flatten(1).t())
+        self.qweight.copy_(qweight)
+        self.scale.copy_(scale.squeeze(0))
+        if self.bias is not None:
+            self.bias.copy_(module.bias)
+
+    def forward(self, x: TensorType['batch_size','channels','height','width',float]):
+        batch_size, _, height, width = x.shape
+        out_height = (height + 2*self.padding[0] - self.dilation[0]*(self.kernel_size[0]-1) - 1) // self.stride[0] + 1
+        out_width = (width + 2*self.padding[1] - self.dilation[1]*(self.kernel_size[1]-1) - 1) // self.stride[1] + 1
+        patches = torch.nn.functional.unfold(x, self.kernel_size, dilation=self.dilation, padding=self.padding, stride=self.stride) # (batch_size, in_features, num_patches)
+        output = int8_matmul(patches.transpose(1,2), self.qweight, self.scale) # (batch_size, num_patches, out_channels)
+        if self.bias is not None:
+            output = output + self.bias
+        return output.transpose(1,2).reshape(batch_size, self.out_channels, out_height, out_width)
+
+
+class Int8BatchLinear(torch.nn.Module):
+    """ Inference-only int8 version of `BatchLinear`.
+
+    When the input is shared by all modules (unbatched, or batched but expanded from a single tensor), the weights of all modules are multiplied in a single int8 matrix product. Otherwise, one product is computed per module.
+    """
+    def __init__(self,
+            weight: TensorType['num_modules','in_features','out_features',float],
+            bias: TensorType['num_modules',1,'out_features',float],
+            default_batch: bool = False):
+        super().__init__()
+        self.default_batch = default_batch
+        num_modules, in_features, out_features = weight.shape
+        self.register_buffer('qweight', torch.zeros(num_modules, in_features, out_features, dtype=torch.int8, device=weight.device))
+        self.register_buffer('qweight_shared', torch.zeros(in_features, num_modules*out_features, dtype=torch.int8, device=weight.device))
+        self.register_buffer('scale', torch.zeros(num_modules, 1, out_features, device=weight.device))
+        self.register_buffer('bias', torch.zeros(num_modules, 1, out_features, device=weight.device))
+        self.quantize_(weight, bias)
+
+    @classmethod
+    def from_float(cls, module: BatchLinear) -> 'Int8BatchLinear':
+        return cls(module.weight.detach(), module.bias.detach(), default_batch=module.default_batch)
+
+    @torch.no_grad()
+    def quantize_(self, weight, bias):
+        """ Update the quantized weights in place. """
+        qweight, scale = _quantize_weight(weight)
+        self.qweight.copy_(qweight)
+        self.qweight_shared.copy_(qweight.permute(1,0,2).flatten(1))
+        self.scale.copy_(scale)
+        self.bias.copy_(bias)
+
+    def copy_from_float(self, module: BatchLinear):
+        self.quantize_(module.weight, module.bias)
+
+    def forward(self, x, batched=None):
+        if batched is None:
+            batched = self.default_batch
+        num_modules, _, out_features = self.qweight.shape
+        if batched and x.shape[0] == num_modules and x.stride(0) != 0:
+            # The inputs are quantized together, but there is no batched int8 matrix product, so each module is multiplied separately
+            x_q, x_scale = _quantize_rows(x.reshape(num_modules, -1, x.shape[-1]))
+            output = torch.stack([
+                torch._int_mm(x_q[i], self.qweight[i])
+                for i in range(num_modules)
+            ]).float() * x_scale * self.scale + self.bias
+            return output.view(*x.shape[:-1], out_features)
+        if batched:
+            x = x[0] # Same input for all modules
+        output = int8_matmul(x, self.qweight_shared, self.scale.flatten()) # (..., num_modules*out_features)
+        output = output.view(*x.shape[:-1], num_modules, out_features).movedim(-2, 0)
+        return output + self.bias.view(num_modules, *[1]*(x.dim()-1), out_features)
+
+
+class Int8BatchMultiHeadAttentionEinsum(torch.nn.Module):
+    """ Inference-only int8 version of `BatchMultiHeadAttentionEinsum`. The input and output projections are quantized. The attention weights are computed in full precision. """
+    def __init__(self, module: BatchMultiHeadAttentionEinsum):
+        super().__init__()
+        self.num_modules = module.num_modules
+        self.num_heads = module.num_heads
+        self.key_size = module.key_size
+        self.default_batch = module.default_batch
+
+        w_q, w_k, w_v = module.in_weight
+        b_q, b_k, b_v = module.in_bias
+        self.q_proj = Int8BatchLinear(w_q.detach().transpose(-2,-1), b_q.detach().unsqueeze(1))
+        self.k_proj = Int8BatchLinear(w_k.detach().transpose(-2,-1), b_k.detach().unsqueeze(1))
+        self.v_proj = Int8BatchLinear(w_v.detach().transpose(-2,-1), b_v.detach().unsqueeze(1))
+        self.out_proj = Int8BatchLinear(module.out_weight.detach().transpose(-2,-1), module.out_bias.detach())
+
+    def copy_from_float(self, module: BatchMultiHeadAttentionEinsum):
+        for proj, w, b in zip([self.q_proj, self.k_proj, self.v_proj], module.in_weight, module.in_bias):
+            proj.quantize_(w.transpose(-2,-1), b.unsqueeze(1))
+        self.out_proj.quantize_(module.out_weight.transpose(-2,-1), module.out_bias)
+
+    def forward(self, query, key, value, batched=None, attn_mask=None):
+        """ Same inputs and outputs as `BatchMultiHeadAttentionEinsum.forward`. """
+        if batched is None:
+            batched = self.default_batch
+        num_modules = self.num_modules
+        num_heads = self.num_heads
+        head_dim = self.key_size // num_heads
+        batch_size, embed_dim = query.shape[-2:]
+        num_inputs = key.shape[-3]
+
+        q = self.q_proj(query, batched=(query.dim() == 3)) # (num_modules, batch_size, embed_dim)
+        k = self.k_proj(key, batched=batched) # (num_modules, num_inputs, batch_size, embed_dim)
+        v = self.v_proj(value, batched=batched)
+
+        q = q.contiguous().view(1, num_modules * batch_size * num_heads, head_dim).transpose(0, 1)
+        k = k.transpose(0,1).contiguous().view(num_inputs, num_modules * batch_size * num_heads, head_dim).transpose(0, 1)
+        v = v.transpose(0,1).contiguous().view(num_inputs, num_modules * batch_size * num_heads, head_dim).transpose(0, 1)
+
+        q = q / head_dim ** 0.5
+        attn_output_weights = torch.bmm(q, k.transpose(-2, -1))
+        attn_output_weights = _mask_attention_weights(attn_output_weights, attn_mask, num_modules)
+        attn_output_weights = torch.softmax(attn_output_weights, dim=-1)
+        attn_output = torch.bmm(attn_output_weights, v)
+
+        attn_output = attn_output.transpose(0, 1).contiguous().view(num_modules, batch_size, embed_dim)
+        attn_output = self.out_proj(attn_output, batched=True)
+
+        attn_output = attn_output.unsqueeze(1)
+
+        return attn_output, attn_output_weights.view(num_modules, batch_size, num_heads, 1, num_inputs).mean(2)
+
+
+INT8_MODULES = (Int8Linear, Int8Conv2d, Int8BatchLinear, Int8BatchMultiHeadAttentionEinsum)
+
+
+def quantize_int8_(model: torch.nn.Module, min_weight_size: int = 4096, quantize_conv: bool = False) -> torch.nn.Module:
+    """ Replace the modules of `model` that can be quantized with their int8 versions, in place. This includes the `BatchLinear` and `BatchMultiHeadAttentionEinsum` modules, and the linear layers of the image input modules. Layers whose weight matrix (per module) has fewer than `min_weight_size` elements are left in full precision, since quantizing the activations costs more than it saves on small matrix products.
+
+    The convolutions of the image input modules are only quantized if `quantize_conv` is True. Extracting the image patches for `Int8Conv2d` usually costs more than the int8 product saves compared to the native fp32 convolution.
+
+    Returns:
+        The modified model.
+    """
+    def quantize_children(module: torch.nn.Module, in_image_input: bool):
+        for name, child in module.named_children():
+            replacement = None
+            if type(child) is BatchLinear:
+                if child.weight[0].numel() >= min_weight_size:
+                    replacement = Int8BatchLinear.from_float(child)
+            elif type(child) is BatchMultiHeadAttentionEinsum:
+                replacement = Int8BatchMultiHeadAttentionEinsum(child)
+            elif in_image_input and type(child) is torch.nn.Linear:
+                if child.weight.numel() >= min_weight_size:
+                    replacement = Int8Linear(child)
+            elif in_image_input and quantize_conv and type(child) is torch.nn.Conv2d:
+                replacement = Int8Conv2d(child)
+            if replacement is not None:
+                setattr(module, name, replacement)
+            else:
+                quantize_children(child, in_image_input or isinstance(child, (ImageInput56, GreyscaleImageInput)))
+    quantize_children(model, False)
+    return model
+
+
+# Inference wrapper
+
+
+def _cast_floats(x, dtype: torch.dtype):
+    if isinstance(x, torch.Tensor):
+        return x.to(dtype) if x.is_floating_point() and x.dtype != dtype else x
+    if isinstance(x, dict):
+        return {k: _cast_floats(v, dtype) for k,v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(_cast_floats(v, dtype) for v in x)
+    return x
+
+
+class LowPrecisionPolicy(torch.nn.Module):
+    """
+    Inference-only copy of a model in reduced precision, used to select actions during rollouts and evaluation. The wrapped model stays in full precision and remains the source of truth for training. `refresh()` must be called after it is updated to copy the new weights.
+
+    - `fp32`: The model is called directly and nothing is copied.
+    - `bf16`: The copy's floating point weights are stored in bf16, and it is called under bf16 autocast. Keeping a bf16 copy avoids casting every weight on every call, which autocast alone would do.
+    - `int8`: The copy's large layers are quantized to int8 (see `quantize_int8_`). Only supported on CPU.
+
+    Floating point outputs (including the hidden state) are always returned in fp32, so that the rest of the code, and the learner, never see reduced precision tensors. The hidden state helpers (`init_hidden`, `initial_hidden`, `reset_hidden_`) use the full precision model. Other attributes that aren't defined here (e.g. `last_hidden`, `has_attention`) are looked up on the copy, with the `last_*` values cast to fp32, so this can be used in place of the model in rollout and evaluation code.
+    """
+    def __init__(self, model: torch.nn.Module, precision: str = 'fp32', **quantize_kwargs):
+        """
+        Args:
+            model: The full precision model.
+            precision: One of `PRECISIONS`.
+            quantize_kwargs: Passed to `quantize_int8_`. Only used for int8.
+        """
+        super().__init__()
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown precision: {precision}. Valid values are: {", ".join(PRECISIONS)}.')
+        self.precision = precision
+        self.device_type = next(model.parameters()).device.type
+        object.__setattr__(self, 'source_model', model) # Not registered as a submodule so that its parameters aren't duplicated in `parameters()` and `state_dict()`
+
+        if precision == 'fp32':
+            self.actor = model
+            return
+        if precision == 'int8' and self.device_type != 'cpu':
+            raise ValueError('int8 inference is only supported on CPU.')
+
+        # Tensors saved from the last forward pass (`last_*`) may be part of an autograd graph, which can't be deep-copied. The copy doesn't need them.
+        memo = {}
+        for module in model.modules():
+            for k,v in vars(module).items():
+                if k.startswith('last_'):
+                    memo[id(v)] = None
+        actor = copy.deepcopy(model, memo)
+        if precision == 'bf16':
+            actor.to(torch.bfloat16)
+        else:
+            quantize_int8_(actor, **quantize_kwargs)
+        actor.requires_grad_(False)
+        self.actor = actor
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            if name == 'actor':
+                raise
+            value = getattr(self.actor, name)
+            if name.startswith('last_'):
+                # Values recorded by the copy during the last forward pass are in its precision
+                return _cast_floats(value, torch.float)
+            return value
+
+    @torch.no_grad()
+    def refresh(self):
+        """ Copy the current weights of the full precision model to the reduced precision copy. """
+        if self.precision == 'fp32':
+            return
+        source_modules = dict(self.source_model.named_modules())
+        quantized_prefixes = []
+        for name, module in self.actor.named_modules():
+            if isinstance(module, INT8_MODULES) and not any(name.startswith(p) for p in quantized_prefixes):
+                module.copy_from_float(source_modules[name])
+                quantized_prefixes.append(f'{name}.')
+        source_state = self.source_model.state_dict()
+        for k,v in self.actor.state_dict().items():
+            if k in source_state and not any(k.startswith(p) for p in quantized_prefixes):
+                v.copy_(source_state[k])
+
+    def init_hidden(self, batch_size: int = 1):
+        return self.source_model.init_hidden(batch_size) # type: ignore
+
+    def initial_hidden(self):
+        return self.source_model.initial_hidden() # type: ignore
+
+    def reset_hidden_(self, *args, **kwargs):
+        return self.source_model.reset_hidden_(*args, **kwargs) # type: ignore
+
+    def forward(self, inputs: Dict[str, torch.Tensor], hidden: Tuple[torch.Tensor, ...]) -> Dict[str, Union[torch.Tensor, Tuple[torch.Tensor, ...], Dict]]:
+        if self.precision == 'fp32':
+            return self.actor(inputs, hidden)
+        with torch.autocast(self.device_type, dtype=torch.bfloat16, enabled=(self.precision == 'bf16')):
+            output = self.actor(inputs, hidden)
+        return _cast_floats(output, torch.float)
@@ -1,13 +1,151 @@
+import contextlib
 import itertools
-from typing import List, Dict, Sequence, Tuple, Iterable
+from typing import List, Dict, Optional, Sequence, Tuple, Iterable
 import math
 
+import numpy as np
 import torch
 from torchtyping.tensor_type import TensorType
 from torch.utils.data.dataloader import default_collate
 
 #from big_rl.model.recurrent_attention_16 import RecurrentAttention16 # XXX: Causes circular imports
 
+# Hidden state
+
+class ResettableHiddenMixin:
+    """ Hidden state resets for models that implement `init_hidden(batch_size)`, where the batch is the second to last dimension of every hidden tensor.
+
+    The initial state is computed once with a batch size of 1 and broadcasted over the batch, so resetting the state of finished episodes does not allocate a new batch of initial states. The cached initial state is recomputed whenever a parameter of the model is modified (e.g. by an optimizer step or `load_state_dict`) or moved to another device.
+    """
+    _initial_hidden_cache = None
+
+    def initial_hidden(self) -> Tuple[torch.Tensor, ...]:
+        """ The initial hidden state with a batch size of 1. If gradients are enabled, it is recomputed so that gradients can flow to any learned initial state. """
+        if torch.is_grad_enabled():
+            return self.init_hidden(1) # type: ignore
+        key = tuple((p.data_ptr(), p._version) for p in self.parameters()) # type: ignore
+        if self._initial_hidden_cache is None or self._initial_hidden_cache[0] != key:
+            self._initial_hidden_cache = (key, self.init_hidden(1)) # type: ignore
+        return self._initial_hidden_cache[1]
+
+    def reset_hidden_(self, hidden: Tuple[torch.Tensor, ...], done, initial_hidden: Tuple[torch.Tensor, ...] = None) -> Tuple[torch.Tensor, ...]:
+        """ Reset the hidden state of the batch elements where `done` is True.
+
+        The hidden tensors are modified in place when possible, i.e. when gradients are disabled and the tensors don't share memory between batch elements (as the output of `init_hidden` does). Otherwise, new tensors are created. The reset hidden state is returned in both cases.
+
+        Args:
+            hidden: The hidden state to reset.
+            done: Boolean numpy array or tensor of shape `(batch_size,)`.
+            initial_hidden: Initial hidden state with a batch size of 1. If not provided, `initial_hidden()` is used.
+        """
+        if isinstance(done, np.ndarray) and not done.any():
+            return hidden
+        if initial_hidden is None:
+            initial_hidden = self.initial_hidden()
+        done = torch.as_tensor(done, device=hidden[0].device)
+        if torch.is_grad_enabled():
+            in_place = False
+        else:
+            in_place = all(h.is_contiguous() and not h.requires_grad for h in hidden)
+        if in_place:
+            for h0,h in zip(initial_hidden, hidden):
+                torch.where(done.unsqueeze(1), h0, h, out=h)
+            return hidden
+        return tuple(
+            torch.where(done.unsqueeze(1), h0, h)
+            for h0,h in zip(initial_hidden, hidden)
+        )
+
+
+class SequenceForwardMixin:
+    """ Sequence forward pass for models whose input modules don't depend on the hidden state.
+
+    The model must implement `_encode_inputs(inputs)`, which runs the input modules and returns the input labels and lists of keys and values of shape `(1, batch_size, ...)`, and `_forward_core(input_labels, input_keys, input_vals, hidden)`, which computes the rest of the forward pass. `forward()` is equivalent to calling both in sequence.
+    """
+    def forward_sequence(self,
+            inputs: Dict[str,TensorType['seq_len','batch_size','observation_shape']],
+            hidden: Tuple[torch.Tensor, ...],
+            done: TensorType['seq_len','batch_size'] = None,
+            initial_hidden: Tuple[torch.Tensor, ...] = None):
+        """ Run the model over a sequence of inputs. The inputs at all time steps are encoded in one batch, and only the recurrent core is run one time step at a time.
+
+        Args:
+            inputs: Dictionary of tensors of shape `(seq_len, batch_size, ...)`.
+            hidden: Hidden state before the first time step.
+            done: If provided, the hidden state of batch element `b` is reset (see `reset_hidden_`) before time step `t` wherever `done[t,b]` is True.
+            initial_hidden: Initial hidden state used for resets, with a batch size of 1. Defaults to `initial_hidden()`.
+
+        Returns:
+            A dictionary with the outputs of each output module stacked along the first dimension, and the hidden state after the last time step under `hidden`.
+        """
+        if len(inputs) == 0:
+            raise ValueError('At least one input is needed to determine the sequence length.')
+        seq_len, batch_size = next(iter(inputs.values())).shape[:2]
+
+        flat_inputs = {k: v.reshape(seq_len*batch_size, *v.shape[2:]) for k,v in inputs.items()}
+        input_labels, input_keys, input_vals = self._encode_inputs(flat_inputs) # type: ignore
+        input_keys = [k.view(k.shape[0], seq_len, batch_size, *k.shape[2:]) for k in input_keys]
+        input_vals = [v.view(v.shape[0], seq_len, batch_size, *v.shape[2:]) for v in input_vals]
+
+        if done is not None and initial_hidden is None:
+            initial_hidden = self.initial_hidden() # type: ignore
+        outputs = []
+        for t in range(seq_len):
+            if done is not None:
+                hidden = self.reset_hidden_(hidden, done[t], initial_hidden) # type: ignore
+            output = self._forward_core( # type: ignore
+                    input_labels,
+                    [k[:,t] for k in input_keys],
+                    [v[:,t] for v in input_vals],
+                    hidden)
+            hidden = output['hidden']
+            outputs.append(output)
+
+        return {
+            **{
+                k: torch.stack([o[k] for o in outputs])
+                for k in outputs[0].keys() if k not in ['hidden', 'misc']
+            },
+            'hidden': hidden,
+        }
+
+
+# Introspection
+
+class IntrospectionMixin:
+    """ Modules that can record intermediate values of the forward pass (attention weights, gating values) for analysis and visualization.
+
+    Recording is off by default, since it is only needed by the evaluation scripts and would otherwise keep extra tensors alive on every time step of training. Use `introspection()` or `set_introspection()` to turn it on. The recorded tensors are detached but stay on the device they were computed on, so it is up to the consumer to copy them to the host when needed.
+    """
+    introspect: bool = False
+
+
+def set_introspection(module: torch.nn.Module, enabled: bool = True):
+    """ Turn recording of intermediate values on or off for `module` and all of its submodules. """
+    for m in module.modules():
+        if isinstance(m, IntrospectionMixin):
+            m.introspect = enabled
+
+
+@contextlib.contextmanager
+def introspection(module: torch.nn.Module, enabled: bool = True):
+    """ Context manager that turns recording of intermediate values on (or off) for `module` and all of its submodules, and restores the previous settings on exit.
+
+    Usage:
+
+        with introspection(model):
+            output = model(obs, hidden)
+        attention = [a.cpu() for a in model.last_attention]
+    """
+    previous = [(m, m.introspect) for m in module.modules() if isinstance(m, IntrospectionMixin)]
+    set_introspection(module, enabled)
+    try:
+        yield module
+    finally:
+        for m, introspect in previous:
+            m.introspect = introspect
+
+
 # Recurrences
 
 class RecurrentAttention(torch.nn.Module):
@@ -893,6 +1031,29 @@ class BatchMultiHeadAttentionBroadcast(torch.nn.Module):
         return list(self.attentions) # type: ignore
 
 
+def _mask_attention_weights(attn_output_weights: torch.Tensor, attn_mask: Optional[torch.Tensor], num_modules: int) -> torch.Tensor:
+    """ Apply `attn_mask` of shape `(num_modules, num_inputs)` to the pre-softmax attention weights of shape `(num_modules * batch_size * num_heads, 1, num_inputs)`. Inputs where the mask is False get a weight of zero after the softmax. """
+    if attn_mask is None:
+        return attn_output_weights
+    num_inputs = attn_output_weights.shape[-1]
+    return attn_output_weights.view(num_modules, -1, num_inputs).masked_fill(
+            ~attn_mask.view(num_modules, 1, num_inputs), float('-inf')
+    ).view(attn_output_weights.shape)
+
+
+def _merge_modules(params: Sequence[torch.nn.Parameter], order: Optional[Sequence[int]] = None, num_groups: int = 1) -> torch.nn.Parameter:
+    """ Return a new parameter containing the entries of all `params` concatenated along the first (module) dimension. The modules of each parameter are split into `num_groups` consecutive groups, and each group is concatenated separately. If `order` is given, the concatenated modules of each group are reordered so that the i-th module is the `order[i]`-th one. """
+    x = torch.cat([p.detach().reshape(num_groups, -1, *p.shape[1:]) for p in params], dim=1)
+    if order is not None:
+        x = x[:,torch.as_tensor(order, device=x.device)]
+    return torch.nn.Parameter(x.flatten(0,1).clone(), requires_grad=params[0].requires_grad)
+
+
+def _select_modules(param: torch.nn.Parameter, index: torch.Tensor) -> torch.nn.Parameter:
+    """ Return a new parameter containing the entries of `param` selected by `index` along the first (module) dimension. """
+    return torch.nn.Parameter(param.detach()[index].clone(), requires_grad=param.requires_grad)
+
+
 class BatchMultiHeadAttentionEinsum(torch.nn.Module):
     def __init__(self, modules: List[torch.nn.MultiheadAttention], key_size, num_heads, default_batch=False):
         super(BatchMultiHeadAttentionEinsum, self).__init__()
@@ -917,23 +1078,43 @@ class BatchMultiHeadAttentionEinsum(torch.nn.Module):
             default_collate([a.out_proj.bias for a in modules]).unsqueeze(1).detach()
         )
 
-    def forward(self, query, key, value, batched=None):
+    def remove_modules(self, mask: Sequence[bool]):
+        """ Remove the attention modules whose entry in `mask` is False, in place. See `BatchLinear.remove_modules`. """
+        assert len(mask) == self.num_modules, f"Mask must be the same length as the number of modules. Expected {self.num_modules}. Received {len(mask)}"
+        index = torch.tensor(mask, dtype=torch.bool, device=self.out_weight.device)
+        self.in_weight = torch.nn.ParameterList([_select_modules(w, index) for w in self.in_weight])
+        self.in_bias = torch.nn.ParameterList([_select_modules(b, index) for b in self.in_bias])
+        self.out_weight = _select_modules(self.out_weight, index)
+        self.out_bias = _select_modules(self.out_bias, index)
+        self.num_modules = int(index.sum().item())
+
+    def merge(self, others: Sequence['BatchMultiHeadAttentionEinsum'], order: Optional[Sequence[int]] = None):
+        """ Append the attention modules of `others` to this module, in place. See `BatchLinear.merge`. """
+        modules = [self, *others]
+        self.in_weight = torch.nn.ParameterList([_merge_modules(w, order) for w in zip(*[m.in_weight for m in modules])])
+        self.in_bias = torch.nn.ParameterList([_merge_modules(b, order) for b in zip(*[m.in_bias for m in modules])])
+        self.out_weight = _merge_modules([m.out_weight for m in modules], order)
+        self.out_bias = _merge_modules([m.out_bias for m in modules], order)
+        self.num_modules = sum(m.num_modules for m in modules)
+
+    def forward(self, query, key, value, batched=None, attn_mask=None):
+        """ `attn_mask` is an optional boolean tensor of shape `(num_modules, num_inputs)`, which is False where a module is not allowed to attend to an input. """
         if batched is None:
             batched = self.default_batch
         if batched:
-            return self.forward_batch(query, key, value)
+            return self.forward_batch(query, key, value, attn_mask)
         else:
-            return self.forward_unbatched(query, key, value)
+            return self.forward_unbatched(query, key, value, attn_mask)
 
-    def forward_unbatched(self, query, key, value):
-        """ Feed the same inputs to all MHA modules """
+    def forward_unbatched(self, query, key, value, attn_mask=None):
+        """ Feed the same inputs to all MHA modules. The query can also be given separately for each module, with shape `(num_modules, batch_size, embed_dim)`, while still sharing the keys and values. """
         #nbmha = NonBatchMultiHeadAttention(self.attentions, self.key_size, self.num_heads)
         #y = nbmha(query, key, value, batched=False)
 
         num_heads = self.num_heads
         embed_dim = self.key_size
         head_dim = embed_dim // num_heads
-        batch_size, embed_dim = query.shape
+        batch_size, embed_dim = query.shape[-2:]
         num_inputs, _, _ = key.shape
 
         num_modules = self.num_modules
@@ -941,7 +1122,10 @@ class BatchMultiHeadAttentionEinsum(torch.nn.Module):
         w_q, w_k, w_v = self.in_weight
         b_q, b_k, b_v = self.in_bias
 
-        q = query.unsqueeze(0) @ w_q.transpose(-2,-1) + b_q.unsqueeze(1)
+        if len(query.shape) == 3:
+            q = query @ w_q.transpose(-2,-1) + b_q.unsqueeze(1)
+        else:
+            q = query.unsqueeze(0) @ w_q.transpose(-2,-1) + b_q.unsqueeze(1)
         k = torch.einsum('ijk,lmk -> lijm', key, w_k) + b_k.unsqueeze(1).unsqueeze(2)
         v = torch.einsum('ijk,lmk -> lijm', value, w_v) + b_v.unsqueeze(1).unsqueeze(2)
 
@@ -951,6 +1135,7 @@ class BatchMultiHeadAttentionEinsum(torch.nn.Module):
 
         q = q / math.sqrt(head_dim)
         attn_output_weights = torch.bmm(q, k.transpose(-2, -1))
+        attn_output_weights = _mask_attention_weights(attn_output_weights, attn_mask, num_modules)
         attn_output_weights = torch.softmax(attn_output_weights, dim=-1)
         attn_output = torch.bmm(attn_output_weights, v)
 
@@ -961,7 +1146,7 @@ class BatchMultiHeadAttentionEinsum(torch.nn.Module):
 
         return attn_output, attn_output_weights.view(num_modules, batch_size, num_heads, 1, num_inputs).mean(2)
 
-    def forward_batch(self, query, key, value):
+    def forward_batch(self, query, key, value, attn_mask=None):
         num_heads = self.num_heads
         embed_dim = self.key_size
         head_dim = embed_dim // num_heads
@@ -983,6 +1168,7 @@ class BatchMultiHeadAttentionEinsum(torch.nn.Module):
 
         q = q / math.sqrt(head_dim)
         attn_output_weights = torch.bmm(q, k.transpose(-2, -1))
+        attn_output_weights = _mask_attention_weights(attn_output_weights, attn_mask, num_modules)
         attn_output_weights = torch.softmax(attn_output_weights, dim=-1)
         attn_output = torch.bmm(attn_output_weights, v)
 
@@ -1019,6 +1205,148 @@ class BatchMultiHeadAttentionEinsum(torch.nn.Module):
         return modules
 
 
+class BatchGroupedKVAttentionEinsum(torch.nn.Module):
+    """ Same as `BatchMultiHeadAttentionEinsum`, except that the key and value projections are shared by groups of modules, as in grouped-query attention. The modules are split into `num_kv_groups` groups of consecutive modules, and the keys and values are only projected once per group instead of once per module. Each module keeps its own query and output projections.
+
+    When all modules receive the same keys and values (as in the recurrent cores, where the inputs are expanded to all modules), the projected keys and values have shape `(num_kv_groups, num_inputs, batch_size, key_size)` instead of `(num_modules, num_inputs, batch_size, key_size)`.
+
+    The parameters have the same names as those of `BatchMultiHeadAttentionEinsum`. The key and value projections of the modules in each group are combined with `method` (see `_group`), both when the module is created and when a state dict with separate key and value projections for each module is loaded.
+    """
+    def __init__(self, modules: List[torch.nn.MultiheadAttention], key_size, num_heads, num_kv_groups: int = 1, default_batch=False, method: str = 'mean'):
+        super(BatchGroupedKVAttentionEinsum, self).__init__()
+
+        self.num_modules = len(modules)
+        self.num_heads = num_heads
+        self.key_size = key_size
+        self.num_kv_groups = num_kv_groups
+        self.default_batch = default_batch
+        self.method = method
+        if self.num_modules % num_kv_groups != 0:
+            raise ValueError(f'The number of modules ({self.num_modules}) must be divisible by the number of key/value groups ({num_kv_groups}).')
+
+        w_q, w_k, w_v = default_collate([a.in_proj_weight.chunk(3) for a in modules])
+        b_q, b_k, b_v = default_collate([a.in_proj_bias.chunk(3) for a in modules])
+        self.in_weight = torch.nn.ParameterList([
+            torch.nn.Parameter(x.detach())
+            for x in [w_q, self._group(w_k, method), self._group(w_v, method)]
+        ])
+        self.in_bias = torch.nn.ParameterList([
+            torch.nn.Parameter(x.detach())
+            for x in [b_q, self._group(b_k, method), self._group(b_v, method)]
+        ])
+        self.out_weight = torch.nn.Parameter(
+            default_collate([a.out_proj.weight for a in modules]).detach()
+        )
+        self.out_bias = torch.nn.Parameter(
+            default_collate([a.out_proj.bias for a in modules]).unsqueeze(1).detach()
+        )
+
+    @classmethod
+    def from_attention(cls, module: BatchMultiHeadAttentionEinsum, num_kv_groups: int, method: str = 'mean') -> 'BatchGroupedKVAttentionEinsum':
+        """ Convert a `BatchMultiHeadAttentionEinsum` module. The key and value projections of the modules in each group are averaged if `method` is 'mean', or the projections of the first module of each group are used if `method` is 'first'. The same method is used for state dicts loaded into the converted module later. """
+        return cls(module.to_multihead_attention_modules(), key_size=module.key_size, num_heads=module.num_heads, num_kv_groups=num_kv_groups, default_batch=module.default_batch, method=method)
+
+    def _group(self, x: torch.Tensor, method: str = 'mean') -> torch.Tensor:
+        """ Reduce per-module projections of shape `(num_modules, ...)` to per-group projections of shape `(num_kv_groups, ...)`. """
+        x = x.detach().reshape(self.num_kv_groups, -1, *x.shape[1:])
+        if method == 'mean':
+            return x.mean(1)
+        elif method == 'first':
+            return x[:,0].clone()
+        raise ValueError(f'Unknown method {method}. Valid values are: mean, first.')
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for k in ['in_weight.1', 'in_weight.2', 'in_bias.1', 'in_bias.2']:
+            if f'{prefix}{k}' in state_dict and state_dict[f'{prefix}{k}'].shape[0] == self.num_modules != self.num_kv_groups:
+                state_dict[f'{prefix}{k}'] = self._group(state_dict[f'{prefix}{k}'], self.method)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, query, key, value, batched=None, attn_mask=None):
+        """ Same inputs and outputs as `BatchMultiHeadAttentionEinsum.forward`. """
+        if batched is None:
+            batched = self.default_batch
+
+        w_q, w_k, w_v = self.in_weight
+        b_q, b_k, b_v = self.in_bias
+
+        if not batched:
+            k = torch.einsum('ijk,lmk -> lijm', key, w_k) + b_k.unsqueeze(1).unsqueeze(2)
+            v = torch.einsum('ijk,lmk -> lijm', value, w_v) + b_v.unsqueeze(1).unsqueeze(2)
+        elif key.stride(0) == 0 and value.stride(0) == 0:
+            # The same keys and values expanded to all modules, so they only need to be projected once per group
+            k = torch.einsum('ijk,lmk -> lijm', key[0], w_k) + b_k.unsqueeze(1).unsqueeze(2)
+            v = torch.einsum('ijk,lmk -> lijm', value[0], w_v) + b_v.unsqueeze(1).unsqueeze(2)
+        else:
+            # Different keys and values for each module. Each module uses the projection of its group.
+            group_size = self.num_modules // self.num_kv_groups
+            k = torch.einsum('lijk,lmk -> lijm', key, w_k.repeat_interleave(group_size, 0)) + b_k.repeat_interleave(group_size, 0).unsqueeze(1).unsqueeze(2)
+            v = torch.einsum('lijk,lmk -> lijm', value, w_v.repeat_interleave(group_size, 0)) + b_v.repeat_interleave(group_size, 0).unsqueeze(1).unsqueeze(2)
+
+        num_modules = self.num_modules
+        num_heads = self.num_heads
+        embed_dim = self.key_size
+        head_dim = embed_dim // num_heads
+        batch_size = query.shape[-2]
+        num_groups, num_inputs = k.shape[:2]
+
+        # q: (num_groups, modules_per_group, batch_size, num_heads, head_dim)
+        # k, v: (num_groups, num_inputs, batch_size, num_heads, head_dim)
+        q = torch.matmul(query, w_q.transpose(-2,-1)) + b_q.unsqueeze(1)
+        q = q.view(num_groups, -1, batch_size, num_heads, head_dim) / math.sqrt(head_dim)
+        k = k.view(num_groups, num_inputs, batch_size, num_heads, head_dim)
+        v = v.view(num_groups, num_inputs, batch_size, num_heads, head_dim)
+
+        attn_output_weights = torch.einsum('gmbhd,gibhd -> gmbhi', q, k)
+        if attn_mask is not None:
+            attn_output_weights = attn_output_weights.masked_fill(
+                    ~attn_mask.view(num_groups, -1, 1, 1, num_inputs), float('-inf'))
+        attn_output_weights = torch.softmax(attn_output_weights, dim=-1)
+        attn_output = torch.einsum('gmbhi,gibhd -> gmbhd', attn_output_weights, v)
+
+        attn_output = attn_output.reshape(num_modules, batch_size, embed_dim)
+        attn_output = torch.einsum ('nbi,nji-> nbj', attn_output, self.out_weight) + self.out_bias
+
+        attn_output = attn_output.unsqueeze(1)
+
+        return attn_output, attn_output_weights.mean(3).reshape(num_modules, batch_size, 1, num_inputs)
+
+    def to_multihead_attention_modules(self) -> List[torch.nn.MultiheadAttention]:
+        group_size = self.num_modules // self.num_kv_groups
+        modules = [
+                torch.nn.MultiheadAttention(self.key_size, self.num_heads)
+                for _ in range(self.num_modules)
+        ]
+        for i, m in enumerate(modules):
+            g = i // group_size
+            m.in_proj_weight = torch.nn.Parameter(
+                torch.cat([ self.in_weight[0][i], self.in_weight[1][g], self.in_weight[2][g] ]).detach()
+            )
+            m.in_proj_bias = torch.nn.Parameter(
+                torch.cat([ self.in_bias[0][i], self.in_bias[1][g], self.in_bias[2][g] ]).detach()
+            )
+            m.out_proj.weight = torch.nn.Parameter(
+                self.out_weight[i].detach()
+            )
+            m.out_proj.bias = torch.nn.Parameter(
+                self.out_bias[i].squeeze(0).detach()
+            )
+
+        return modules
+
+
+def group_kv_projections_(model: torch.nn.Module, num_kv_groups: int, method: str = 'mean') -> torch.nn.Module:
+    """ Replace the attention of the recurrent core layers of `model` (`RecurrentAttention15` and `RecurrentAttention16` layers) with `BatchGroupedKVAttentionEinsum`, in place. The key and value projections are shared by `num_kv_groups` groups of modules in each layer. Layers whose number of modules is not divisible by `num_kv_groups` are left unchanged. See `BatchGroupedKVAttentionEinsum.from_attention` for `method`. Returns `model`. """
+    from big_rl.model.recurrent_attention_16 import RecurrentAttention16Layer # Avoid circular imports
+    for m in model.modules():
+        if not isinstance(m, (RecurrentAttention15, RecurrentAttention16Layer)):
+            continue
+        attention = getattr(m, 'attention', None)
+        if type(attention) is not BatchMultiHeadAttentionEinsum or attention.num_modules % num_kv_groups != 0:
+            continue
+        m.attention = BatchGroupedKVAttentionEinsum.from_attention(attention, num_kv_groups, method).to(attention.out_weight.device)
+    return model
+
+
 class NonBatchLinear(torch.nn.Module):
     def __init__(self, modules, default_batch=False):
         super(NonBatchLinear, self).__init__()
@@ -1092,6 +1420,19 @@ class BatchLinear(torch.nn.Module):
 
         return output
 
+    def remove_modules(self, mask: Sequence[bool]):
+        """ Remove the linear modules whose entry in `mask` is False, in place. The weights of the remaining modules are copied into smaller parameters, so any optimizer holding the old parameters has to be recreated. """
+        assert len(mask) == self.weight.shape[0], f"Mask must be the same length as the number of modules. Expected {self.weight.shape[0]}. Received {len(mask)}"
+        index = torch.tensor(mask, dtype=torch.bool, device=self.weight.device)
+        self.weight = _select_modules(self.weight, index)
+        self.bias = _select_modules(self.bias, index)
+
+    def merge(self, others: Sequence['BatchLinear'], order: Optional[Sequence[int]] = None, num_groups: int = 1):
+        """ Append the linear modules of `others` to this module, in place. If the modules are stacked in `num_groups` consecutive groups (e.g. the four MLPs of a `BatchRecurrentAttention16Layer_v2`), each group is concatenated separately so that the layout is preserved. If `order` is given, the modules of each group are reordered so that the i-th module is the `order[i]`-th of the concatenated modules. """
+        modules = [self, *others]
+        self.weight = _merge_modules([m.weight for m in modules], order, num_groups)
+        self.bias = _merge_modules([m.bias for m in modules], order, num_groups)
+
     def to_linear_modules(self) -> List[torch.nn.Linear]:
         num_modules, input_size, output_size= self.weight.shape
         modules = [torch.nn.Linear(input_size, output_size) for _ in range(num_modules)]
@@ -1103,6 +1444,19 @@ class BatchLinear(torch.nn.Module):
 # Everything else
 
 
+def _scaled_conv(conv: torch.nn.Sequential, x: torch.Tensor, scale: float) -> torch.Tensor:
+    """ Equivalent to `conv(x.float() * scale)`, but the scale is folded into the weights of the first convolution so that the input does not need to be scaled. This lets images be stored and passed to the model as `uint8`. """
+    first = conv[0]
+    x = x.float()
+    if scale != 1 and isinstance(first, torch.nn.Conv2d):
+        x = first._conv_forward(x, first.weight * scale, first.bias)
+    else:
+        x = first(x * scale)
+    for layer in conv[1:]:
+        x = layer(x)
+    return x
+
+
 class GreyscaleImageInput(torch.nn.Module):
     def __init__(self, key_size: int, value_size: int, in_channels: int, scale: float = 1.0):
         super().__init__()
@@ -1124,7 +1478,7 @@ class GreyscaleImageInput(torch.nn.Module):
         self.fc_key = torch.nn.Linear(in_features=512, out_features=key_size)
         self.fc_value = torch.nn.Linear(in_features=512, out_features=value_size)
     def forward(self, x: TensorType['batch_size','frame_stack','height','width',float]):
-        x = self.conv(x * self.scale)
+        x = _scaled_conv(self.conv, x, self.scale)
         return {
             'key': self.fc_key(x),
             'value': self.fc_value(x),
@@ -1152,7 +1506,7 @@ class ImageInput56(torch.nn.Module):
         self.fc_key = torch.nn.Linear(in_features=512, out_features=key_size)
         self.fc_value = torch.nn.Linear(in_features=512, out_features=value_size)
     def forward(self, x: TensorType['batch_size','channels','height','width',float]):
-        x = self.conv(x.float() * self.scale)
+        x = _scaled_conv(self.conv, x, self.scale)
         return {
             'key': self.fc_key(x),
             'value': self.fc_value(x),
@@ -1165,7 +1519,7 @@ class ScalarInput(torch.nn.Module):
         self.value_size = value_size
         self.key = torch.nn.Parameter(torch.rand([key_size]))
     def forward(self, value: TensorType['batch_size',float]):
-        batch_size = int(torch.tensor(value.shape).prod().item())
+        batch_size = value.numel()
         batch_shape = value.shape
         assert len(batch_shape) == 2
         assert batch_shape[-1] == 1, 'Last dimension of input to ScalarInput has to be size 1.'
@@ -1217,7 +1571,7 @@ class DiscreteInput(torch.nn.Module):
         else:
             self.key = torch.nn.Parameter(torch.rand([input_size, key_size])-0.5)
     def forward(self, x: TensorType['batch_size',int]):
-        batch_size = int(torch.tensor(x.shape).prod().item())
+        batch_size = x.numel()
         batch_shape = x.shape
         assert len(batch_shape) == 1, 'Input to DiscreteInput has to be a 1D tensor.'
         x = x.long().flatten()
@@ -1283,7 +1637,7 @@ class MatrixInput(torch.nn.Module):
         }
 
 
-class ModularPolicy(torch.nn.Module):
+class ModularPolicy(ResettableHiddenMixin, IntrospectionMixin, torch.nn.Module):
     def __init__(self, inputs, num_actions, input_size, key_size, value_size, num_heads, ff_size, num_blocks=1,
             recurrence_type='RecurrentAttention'):
         super().__init__()
@@ -1380,8 +1734,9 @@ class ModularPolicy(torch.nn.Module):
             output = attention(x, keys, values)
             x = output['x']
             new_hidden.append((output['key'], output['value']))
-            self.last_attention.append([h.cpu().detach() for h in output['attn_output_weights']])
-            self.last_ff_gating.append(output['output_gate'].cpu().detach())
+            if self.introspect:
+                self.last_attention.append([h.detach() for h in output['attn_output_weights']])
+                self.last_ff_gating.append(output['output_gate'].detach())
         x = self.fc_output(x)
 
         return {
@@ -1449,7 +1804,153 @@ class StateIndependentOutput(torch.nn.Module):
         }
 
 
-class ModularPolicy2(torch.nn.Module):
+class BatchLinearOutput(torch.nn.Module):
+    """ Several `LinearOutput` modules evaluated in one batch.
+
+    Each `LinearOutput` runs its own attention over the same keys and values. Here, the queries of all modules are stacked and the attention of all modules is computed with a single `BatchMultiHeadAttentionEinsum`, so the key and value projections of all modules are done together rather than in one call per module. The final linear layers are padded to the largest output size and applied with one batched matrix multiplication.
+
+    The outputs are the same as those of the original modules, and `to_linear_outputs()` converts back to separate `LinearOutput` modules.
+    """
+    def __init__(self, modules: Dict[str, 'LinearOutput']):
+        super().__init__()
+
+        if len(modules) == 0:
+            raise ValueError('At least one module is needed.')
+        attentions = [m.attention for m in modules.values()]
+
+        self.names = list(modules.keys())
+        self.output_sizes = [m.output_size for m in modules.values()]
+        self.key_size = attentions[0].embed_dim
+        self.num_heads = attentions[0].num_heads
+
+        max_output_size = max(self.output_sizes)
+        ff_weight = torch.zeros(len(modules), max_output_size, self.key_size, device=modules[self.names[0]].query.device)
+        ff_bias = torch.zeros(len(modules), max_output_size, device=ff_weight.device)
+        for i,m in enumerate(modules.values()):
+            ff_weight[i,:m.output_size] = m.ff.weight.detach()
+            ff_bias[i,:m.output_size] = m.ff.bias.detach()
+
+        self.query = torch.nn.Parameter(torch.stack([m.query.detach() for m in modules.values()]))
+        self.attention = BatchMultiHeadAttentionEinsum(attentions, key_size=self.key_size, num_heads=self.num_heads)
+        self.ff_weight = torch.nn.Parameter(ff_weight)
+        self.ff_bias = torch.nn.Parameter(ff_bias)
+
+    def forward(self,
+            key: TensorType['num_blocks','batch_size','hidden_size',float],
+            value: TensorType['num_blocks','batch_size','hidden_size',float],
+            ) -> Dict[str,Dict[str,TensorType]]:
+        """ Returns a dictionary with the output of each module, in the same format as the output of `LinearOutput`. """
+        assert len(key.shape) == 3, f'Key shape must be [num_blocks,batch_size,hidden_size]. Got {key.shape}'
+        assert len(value.shape) == 3, f'Value shape must be [num_blocks,batch_size,hidden_size]. Got {value.shape}'
+        batch_size = key.shape[1]
+        attn_output, attn_output_weights = self.attention(
+                self.query.unsqueeze(1).expand(-1, batch_size, -1),
+                key,
+                value,
+                batched=False,
+        ) # (num_modules, 1, batch_size, value_size), (num_modules, batch_size, 1, num_blocks)
+        output = torch.baddbmm(self.ff_bias.unsqueeze(1), attn_output.squeeze(1), self.ff_weight.transpose(1,2)) # (num_modules, batch_size, max_output_size)
+        return {
+            name: {
+                'output': output[i,:,:output_size],
+                'attn_output_weights': attn_output_weights[i],
+            }
+            for i,(name,output_size) in enumerate(zip(self.names, self.output_sizes))
+        }
+
+    def to_linear_outputs(self) -> Dict[str, 'LinearOutput']:
+        modules = {}
+        with torch.no_grad():
+            attentions = self.attention.to_multihead_attention_modules()
+            for i,(name,output_size) in enumerate(zip(self.names, self.output_sizes)):
+                m = LinearOutput(output_size, self.key_size, self.num_heads)
+                m.query = torch.nn.Parameter(self.query[i].clone())
+                m.attention = attentions[i].to(self.query.device)
+                m.ff.weight = torch.nn.Parameter(self.ff_weight[i,:output_size].clone())
+                m.ff.bias = torch.nn.Parameter(self.ff_bias[i,:output_size].clone())
+                modules[name] = m
+        return modules
+
+
+class FusedOutputMixin:
+    """ Models with a `torch.nn.ModuleDict` of output modules under `output_modules`, which can be replaced by a `BatchLinearOutput` to compute all `LinearOutput` heads at once. Other types of output modules are left as they are.
+
+    The model must compute its outputs with `_run_output_modules()` so that the same code works whether or not the outputs are fused. Fusing changes the names of the parameters in the state dict, but state dicts are converted when loaded, so checkpoints saved from fused and unfused models can be loaded by either.
+    """
+    def fuse_output_modules(self):
+        """ Replace all `LinearOutput` modules with a `BatchLinearOutput`. Does nothing if the output modules are already fused or there are no `LinearOutput` modules. """
+        if getattr(self, 'fused_output_modules', None) is not None:
+            return
+        output_modules: torch.nn.ModuleDict = self.output_modules # type: ignore
+        linear_outputs = {k: v for k,v in output_modules.items() if type(v) is LinearOutput}
+        if len(linear_outputs) == 0:
+            return
+        self._output_module_names = list(output_modules.keys())
+        self.fused_output_modules = BatchLinearOutput(linear_outputs)
+        self.output_modules = torch.nn.ModuleDict({
+            k: v for k,v in output_modules.items() if k not in linear_outputs
+        })
+
+    def unfuse_output_modules(self):
+        """ Inverse of `fuse_output_modules()`. """
+        fused_output_modules = getattr(self, 'fused_output_modules', None)
+        if fused_output_modules is None:
+            return
+        linear_outputs = fused_output_modules.to_linear_outputs()
+        output_modules: torch.nn.ModuleDict = self.output_modules # type: ignore
+        self.output_modules = torch.nn.ModuleDict({
+            k: linear_outputs[k] if k in linear_outputs else output_modules[k]
+            for k in self._output_module_names
+        })
+        del self.fused_output_modules
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self._convert_output_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs) # type: ignore
+
+    def _convert_output_state_dict(self, state_dict, prefix):
+        """ Convert the parameters of the output modules in `state_dict` (in place) to match whether the output modules of this model are fused. """
+        def pop_prefix(p):
+            return {k[len(p):]: state_dict.pop(k) for k in list(state_dict.keys()) if k.startswith(p)}
+        fused_prefix = f'{prefix}fused_output_modules.'
+        has_fused_keys = any(k.startswith(fused_prefix) for k in state_dict.keys())
+        fused_output_modules = getattr(self, 'fused_output_modules', None)
+        output_modules: torch.nn.ModuleDict = self.output_modules # type: ignore
+        if fused_output_modules is not None and not has_fused_keys:
+            if not all(f'{prefix}output_modules.{k}.query' in state_dict for k in fused_output_modules.names):
+                return # Let `load_state_dict` report the missing keys
+            linear_outputs = fused_output_modules.to_linear_outputs()
+            for k,m in linear_outputs.items():
+                m.load_state_dict(pop_prefix(f'{prefix}output_modules.{k}.'))
+            for k,v in BatchLinearOutput(linear_outputs).state_dict().items():
+                state_dict[fused_prefix+k] = v
+        elif fused_output_modules is None and has_fused_keys:
+            linear_outputs = {k: v for k,v in output_modules.items() if type(v) is LinearOutput}
+            if len(linear_outputs) == 0:
+                return
+            fused_output_modules = BatchLinearOutput(linear_outputs)
+            fused_output_modules.load_state_dict(pop_prefix(fused_prefix))
+            for k,m in fused_output_modules.to_linear_outputs().items():
+                for k2,v in m.state_dict().items():
+                    state_dict[f'{prefix}output_modules.{k}.{k2}'] = v
+
+    def _run_output_modules(self, key, value) -> Iterable[Tuple[str, Dict[str, torch.Tensor]]]:
+        """ Yields the name and output of each output module, in the order in which the modules were defined. """
+        fused_output_modules = getattr(self, 'fused_output_modules', None)
+        output_modules: torch.nn.ModuleDict = self.output_modules # type: ignore
+        if fused_output_modules is None:
+            for k,v in output_modules.items():
+                yield k, v(key, value)
+            return
+        fused_output = fused_output_modules(key, value)
+        for k in self._output_module_names:
+            if k in fused_output:
+                yield k, fused_output[k]
+            else:
+                yield k, output_modules[k](key, value)
+
+
+class ModularPolicy2(ResettableHiddenMixin, IntrospectionMixin, FusedOutputMixin, torch.nn.Module):
     def __init__(self, inputs, outputs, input_size, key_size, value_size, num_heads, ff_size, num_blocks=1, recurrence_type='RecurrentAttention'):
         super().__init__()
         self.key_size = key_size
@@ -1568,8 +2069,9 @@ class ModularPolicy2(torch.nn.Module):
             output = attention(x, keys, values)
             x = output['x']
             new_hidden.append((output['key'], output['value']))
-            self.last_attention.append([h.cpu().detach() for h in output['attn_output_weights']])
-            self.last_ff_gating.append(output['output_gate'].cpu().detach())
+            if self.introspect:
+                self.last_attention.append([h.detach() for h in output['attn_output_weights']])
+                self.last_ff_gating.append(output['output_gate'].detach())
         new_hidden = default_collate(new_hidden)
 
         # Compute output
@@ -1584,10 +2086,10 @@ class ModularPolicy2(torch.nn.Module):
             new_hidden[1]
         ], dim=0)
 
-        for k,v in self.output_modules.items():
-            y = v(keys, values)
+        for k,y in self._run_output_modules(keys, values):
             output[k] = y['output']
-            self.last_output_attention.append([h.cpu().detach() for h in y['attn_output_weights']])
+            if self.introspect:
+                self.last_output_attention.append([h.detach() for h in y['attn_output_weights']])
 
         return {
             **output,
@@ -1602,7 +2104,7 @@ class ModularPolicy2(torch.nn.Module):
         )
 
 
-class ModularPolicy3(torch.nn.Module): # TODO
+class ModularPolicy3(ResettableHiddenMixin, IntrospectionMixin, FusedOutputMixin, torch.nn.Module): # TODO
     def __init__(self, inputs, outputs, input_size, key_size, value_size, num_heads, ff_size, chain_length=1, depth=1, width=1, recurrence_type='RecurrentAttention'):
         super().__init__()
         self._key_size = key_size
@@ -1747,8 +2249,9 @@ class ModularPolicy3(torch.nn.Module): # TODO
             output = attention(x, keys, values)
             x = output['x']
             new_hidden.append((output['key'], output['value']))
-            self.last_attention.append([h.cpu().detach() for h in output['attn_output_weights']])
-            self.last_ff_gating.append(output['output_gate'].cpu().detach())
+            if self.introspect:
+                self.last_attention.append([h.detach() for h in output['attn_output_weights']])
+                self.last_ff_gating.append(output['output_gate'].detach())
         new_hidden = default_collate(new_hidden)
 
         # Compute output
@@ -1763,10 +2266,10 @@ class ModularPolicy3(torch.nn.Module): # TODO
             new_hidden[1]
         ], dim=0)
 
-        for k,v in self.output_modules.items():
-            y = v(keys, values)
+        for k,y in self._run_output_modules(keys, values):
             output[k] = y['output']
-            self.last_output_attention.append([h.cpu().detach() for h in y['attn_output_weights']])
+            if self.introspect:
+                self.last_output_attention.append([h.detach() for h in y['attn_output_weights']])
 
         return {
             **output,
@@ -1781,7 +2284,7 @@ class ModularPolicy3(torch.nn.Module): # TODO
         )
 
 
-class ModularPolicy4(torch.nn.Module):
+class ModularPolicy4(ResettableHiddenMixin, IntrospectionMixin, FusedOutputMixin, torch.nn.Module):
     """
     Transformer architecture in the style of a fully connected feedforward network.
     """
@@ -1956,8 +2459,9 @@ class ModularPolicy4(torch.nn.Module):
             new_values = layer_output['value']
             keys = new_keys
             values = new_values
-            self.last_attention.append([h.cpu().detach() for h in layer_output['attn_output_weights']])
-            self.last_ff_gating.append(layer_output['output_gate'].cpu().detach())
+            if self.introspect:
+                self.last_attention.append([h.detach() for h in layer_output['attn_output_weights']])
+                self.last_ff_gating.append(layer_output['output_gate'].detach())
 
         # Compute output
         output = {}
@@ -1971,10 +2475,10 @@ class ModularPolicy4(torch.nn.Module):
             new_values
         ], dim=0)
 
-        for k,v in self.output_modules.items():
-            y = v(keys, values)
+        for k,y in self._run_output_modules(keys, values):
             output[k] = y['output']
-            self.last_output_attention.append([h.cpu().detach() for h in y['attn_output_weights']])
+            if self.introspect:
+                self.last_output_attention.append([h.detach() for h in y['attn_output_weights']])
 
         return {
             **output,
@@ -2035,8 +2539,9 @@ class ModularPolicy4(torch.nn.Module):
         if layer_output is not None: # Save output from last layer
             new_keys = layer_output['key']
             new_values = layer_output['value']
-            self.last_attention.append([h.cpu().detach() for h in layer_output['attn_output_weights']])
-            self.last_ff_gating.append(layer_output['output_gate'].cpu().detach())
+            if self.introspect:
+                self.last_attention.append([h.detach() for h in layer_output['attn_output_weights']])
+                self.last_ff_gating.append(layer_output['output_gate'].detach())
 
         # Compute output
         output = {}
@@ -2054,7 +2559,8 @@ class ModularPolicy4(torch.nn.Module):
             with torch.cuda.stream(s):
                 y = v(keys, values)
                 output[k] = y['output']
-                self.last_output_attention.append([h.cpu().detach() for h in y['attn_output_weights']])
+                if self.introspect:
+                    self.last_output_attention.append([h.detach() for h in y['attn_output_weights']])
         torch.cuda.synchronize()
 
         return {
@@ -2071,7 +2577,7 @@ class ModularPolicy4(torch.nn.Module):
         )
 
 
-class ModularPolicy5(torch.nn.Module):
+class ModularPolicy5(ResettableHiddenMixin, SequenceForwardMixin, IntrospectionMixin, FusedOutputMixin, torch.nn.Module):
     """
     Transformer architecture in the style of a fully connected feedforward network, but all blocks in a layer share weights.
     """
@@ -2186,12 +2692,9 @@ class ModularPolicy5(torch.nn.Module):
     def forward(self,
             inputs: Dict[str,TensorType['batch_size','observation_shape']],
             hidden: List[TensorType['num_blocks','batch_size','hidden_size']]):
-        assert len(hidden) == 2+len(self.initial_hidden_state)
-
-        self.last_attention = []
-        self.last_ff_gating = []
-        self.last_output_attention = {}
+        return self._forward_core(*self._encode_inputs(inputs), hidden)
 
+    def _encode_inputs(self, inputs: Dict[str,TensorType['batch_size','observation_shape']]):
         # Compute input to core module
         input_labels = []
         input_keys = []
@@ -2221,6 +2724,16 @@ class ModularPolicy5(torch.nn.Module):
                 input_labels.append(k)
                 input_keys.append(y['key'].unsqueeze(0))
                 input_vals.append(y['value'].unsqueeze(0))
+
+        return input_labels, input_keys, input_vals
+
+    def _forward_core(self, input_labels, input_keys, input_vals,
+            hidden: List[TensorType['num_blocks','batch_size','hidden_size']]):
+        assert len(hidden) == 2+len(self.initial_hidden_state)
+
+        self.last_attention = []
+        self.last_ff_gating = []
+        self.last_output_attention = {}
         self.last_input_labels = input_labels
 
         #batch_size = inputs['reward'].shape[0]
@@ -2258,10 +2771,9 @@ class ModularPolicy5(torch.nn.Module):
             new_values = layer_output['value']
             keys = new_keys
             values = new_values
-            self.last_attention.append(
-                    layer_output['attn_output_weights'].cpu().detach())
-            self.last_ff_gating.append(
-                    layer_output['output_gate'].cpu().detach())
+            if self.introspect:
+                self.last_attention.append(layer_output['attn_output_weights'].detach())
+                self.last_ff_gating.append(layer_output['output_gate'].detach())
 
         # Compute output
         output = {}
@@ -2275,16 +2787,20 @@ class ModularPolicy5(torch.nn.Module):
             new_values
         ], dim=0)
 
-        for k,v in self.output_modules.items():
-            y = v(keys, values)
+        output_attention = {}
+        for k,y in self._run_output_modules(keys, values):
             output[k] = y['output']
-            self.last_output_attention[k] = y['attn_output_weights'].cpu().detach().squeeze(1) # (batch_size, seq_len)
+            if self.introspect:
+                output_attention[k] = y['attn_output_weights'].detach().squeeze(1) # (batch_size, seq_len)
+        self.last_output_attention = output_attention
 
-        self.last_hidden = (new_keys, new_values, *new_internal_state)
+        # Use local variables for the returned values rather than the `last_*` attributes, since they can be overwritten if the model is called from multiple threads.
+        new_hidden = (new_keys, new_values, *new_internal_state)
+        self.last_hidden = new_hidden
 
         return {
             **output,
-            'hidden': self.last_hidden,
+            'hidden': new_hidden,
             'misc': {
                 'core_output': layer_output,
                 'input_labels': input_labels,
@@ -2304,7 +2820,7 @@ class ModularPolicy5(torch.nn.Module):
         return True
 
 
-class ModularPolicy5LSTM(torch.nn.Module):
+class ModularPolicy5LSTM(ResettableHiddenMixin, FusedOutputMixin, torch.nn.Module):
     """
     Same as ModularPolicy5, but with LSTM instead of attention
     """
@@ -2437,15 +2953,15 @@ class ModularPolicy5LSTM(torch.nn.Module):
         value = h_1.view(1, batch_size, -1)
         key = torch.zeros_like(value, device=device)
 
-        for k,v in self.output_modules.items():
-            y = v(key, value)
+        for k,y in self._run_output_modules(key, value):
             output[k] = y['output']
 
-        self.last_hidden = (h_1, c_1)
+        new_hidden = (h_1, c_1)
+        self.last_hidden = new_hidden
 
         return {
             **output,
-            'hidden': self.last_hidden,
+            'hidden': new_hidden,
             'misc': {
                 #'core_output': layer_output,
                 #'input_labels': input_labels,
@@ -2475,7 +2991,7 @@ class ModularPolicy6(ModularPolicy5):
         )
 
 
-class ModularPolicy7(torch.nn.Module):
+class ModularPolicy7(ResettableHiddenMixin, IntrospectionMixin, FusedOutputMixin, torch.nn.Module):
     """
     Copied ModularPolicy5 and made modifications to work with the API changes in RecurrentAttention15.
 
@@ -2673,16 +3189,20 @@ class ModularPolicy7(torch.nn.Module):
             new_values
         ], dim=0)
 
-        for k,v in self.output_modules.items():
-            y = v(keys, values)
+        output_attention = {}
+        for k,y in self._run_output_modules(keys, values):
             output[k] = y['output']
-            self.last_output_attention[k] = y['attn_output_weights'].cpu().detach().squeeze(1) # (batch_size, seq_len)
+            if self.introspect:
+                output_attention[k] = y['attn_output_weights'].detach().squeeze(1) # (batch_size, seq_len)
+        self.last_output_attention = output_attention
 
-        self.last_hidden = (new_keys, new_values, *new_state)
+        # Use local variables for the returned values rather than the `last_*` attributes, since they can be overwritten if the model is called from multiple threads.
+        new_hidden = (new_keys, new_values, *new_state)
+        self.last_hidden = new_hidden
 
         return {
             **output,
-            'hidden': self.last_hidden,
+            'hidden': new_hidden,
             'misc': {
                 'core_output': layer_output,
                 'input_labels': input_labels,
@@ -1,10 +1,11 @@
-from typing import List, Dict, Tuple, Any
+import os
+from typing import List, Dict, Tuple, Any, Optional
 from typing_extensions import Protocol # Needed for python<=3.7. Can import from typing in 3.8.
 
 import torch
 from torchtyping.tensor_type import TensorType
 
-from big_rl.model.model import GreyscaleImageInput, ImageInput56, ScalarInput, DiscreteInput, LinearInput, MatrixInput, LinearOutput, StateIndependentOutput
+from big_rl.model.model import GreyscaleImageInput, ImageInput56, ScalarInput, DiscreteInput, LinearInput, MatrixInput, LinearOutput, StateIndependentOutput, ResettableHiddenMixin, SequenceForwardMixin, IntrospectionMixin, FusedOutputMixin
 from big_rl.model.recurrent_attention_16 import RecurrentAttention16
 
 
@@ -29,10 +30,13 @@ class RecurrenceProtocol(Protocol):
         ...
 
 
-class ModularPolicy8(torch.nn.Module):
+class ModularPolicy8(ResettableHiddenMixin, SequenceForwardMixin, IntrospectionMixin, FusedOutputMixin, torch.nn.Module):
     """
     Same as ModularPolicy7 except the core modules are one module instead of being a list of modules.
     """
+    _static_forwards: Optional[Dict[frozenset, 'StaticInputForward']] = None
+    _static_compile_kwargs: Optional[Dict[str, Any]] = None
+
     def __init__(self, inputs, outputs, input_size, key_size, value_size, num_heads, recurrence_type='RecurrentAttention16', recurrence_kwargs={}):
         super().__init__()
         self._key_size = key_size
@@ -121,51 +125,70 @@ class ModularPolicy8(torch.nn.Module):
     def forward(self,
             inputs: Dict[str,TensorType['batch_size','observation_shape']],
             hidden: List[TensorType['num_blocks','batch_size','hidden_size']]):
-        assert len(hidden) == 2+self.attention.state_size
-
-        self.last_attention = []
-        self.last_ff_gating = []
-        self.last_output_attention = {}
+        return self._forward_core(*self._encode_inputs(inputs), hidden)
 
-        # Compute input to core module
-        input_labels = []
-        input_keys = []
-        input_vals = []
-        for k,module in self.input_modules.items():
+    def _input_plan(self, input_keys) -> List[Tuple[str, Any]]:
+        """ The input modules that are run when the inputs have the keys `input_keys`, in the order that their outputs are concatenated. Each entry is a tuple of the input module name and either a list of input keys passed as positional arguments or a dictionary mapping keyword arguments to input keys. """
+        plan = []
+        for k in self.input_modules.keys():
             module_config = self._input_modules_config[k]
             if 'inputs' in module_config:
                 input_mapping = module_config['inputs']
-                module_inputs = {}
-                for dest_key, src_key in input_mapping.items():
-                    if src_key not in inputs:
-                        module_inputs = None
-                        break
-                    module_inputs[dest_key] = inputs[src_key]
-                if module_inputs is not None:
-                    y = module(**module_inputs)
-                    input_labels.append(k)
-                    input_keys.append(y['key'].unsqueeze(0))
-                    input_vals.append(y['value'].unsqueeze(0))
+                if all(src_key in input_keys for src_key in input_mapping.values()):
+                    plan.append((k, dict(input_mapping)))
             else:
                 if 'input_mapping' in module_config:
                     # Map other inputs to this module
                     # if multiple available inputs map to this module, include all of them
-                    input_mapping = module_config['input_mapping']
-                    for alternate_key in input_mapping:
-                        if alternate_key not in inputs:
-                            continue
-                        y = module(inputs[alternate_key])
-                        input_labels.append(k)
-                        input_keys.append(y['key'].unsqueeze(0))
-                        input_vals.append(y['value'].unsqueeze(0))
-                elif k in inputs:
-                    module_inputs = inputs[k]
-                    y = module(module_inputs)
-                    input_labels.append(k)
-                    input_keys.append(y['key'].unsqueeze(0))
-                    input_vals.append(y['value'].unsqueeze(0))
-                else:
-                    continue # Skip this input module if no data is provided
+                    for alternate_key in module_config['input_mapping']:
+                        if alternate_key in input_keys:
+                            plan.append((k, [alternate_key]))
+                elif k in input_keys:
+                    plan.append((k, [k]))
+                # Skip this input module if no data is provided
+        return plan
+
+    def _encode_inputs(self, inputs: Dict[str,TensorType['batch_size','observation_shape']]):
+        static_forward = self._get_static_forward(inputs)
+        if static_forward is not None:
+            input_keys, input_vals = static_forward.encode(inputs)
+            return static_forward.input_labels, [input_keys], [input_vals]
+
+        # Compute input to core module
+        input_labels = []
+        input_keys = []
+        input_vals = []
+        for k,args in self._input_plan(inputs.keys()):
+            module = self.input_modules[k]
+            if isinstance(args, dict):
+                y = module(**{dest_key: inputs[src_key] for dest_key, src_key in args.items()})
+            else:
+                y = module(*[inputs[a] for a in args])
+            input_labels.append(k)
+            input_keys.append(y['key'].unsqueeze(0))
+            input_vals.append(y['value'].unsqueeze(0))
+
+        return input_labels, input_keys, input_vals
+
+    def _forward_core(self, input_labels, input_keys, input_vals,
+            hidden: List[TensorType['num_blocks','batch_size','hidden_size']]):
+        assert len(hidden) == 2+self.attention.state_size
+
+        # Keys and values that were encoded by a static forward pass are stacked into a single tensor, and the labels point back to it.
+        static_forward = getattr(input_labels, 'static_forward', None)
+        if static_forward is not None and not self.introspect:
+            output, new_hidden = static_forward.core(input_keys[0], input_vals[0], tuple(hidden))
+            self.last_input_labels = input_labels
+            self.last_hidden = new_hidden
+            return {
+                **output,
+                'hidden': new_hidden,
+                'misc': {'input_labels': input_labels},
+            }
+
+        self.last_attention = []
+        self.last_ff_gating = []
+        self.last_output_attention = {}
         self.last_input_labels = input_labels
 
         keys = torch.cat([
@@ -199,27 +222,32 @@ class ModularPolicy8(torch.nn.Module):
         ], dim=0)
 
         output = {}
-        for k,v in self.output_modules.items():
-            y = v(keys, values)
+        output_attention = {}
+        for k,y in self._run_output_modules(keys, values):
             output[k] = y['output']
-            self.last_output_attention[k] = y['attn_output_weights'].cpu().detach().squeeze(1) # (batch_size, seq_len)
+            if self.introspect:
+                output_attention[k] = y['attn_output_weights'].detach().squeeze(1) # (batch_size, seq_len)
+        self.last_output_attention = output_attention
 
-        self.last_hidden = (new_keys, new_values, *core_output['state'])
+        # Use local variables for the returned values rather than the `last_*` attributes, since they can be overwritten if the model is called from multiple threads.
+        new_hidden = (new_keys, new_values, *core_output['state'])
+        self.last_hidden = new_hidden
 
         #self.last_attention = core_output['misc']['attention'] # type: ignore
         #self.last_ff_gating = core_output['misc']['gates'] # type: ignore
 
-        self.last_output = {
+        output = {
             **output,
-            'hidden': self.last_hidden,
+            'hidden': new_hidden,
             'misc': {
                 'core_output': core_output,
                 'input_labels': input_labels,
-                'output_attention': self.last_output_attention,
+                'output_attention': output_attention,
             }
         }
+        self.last_output = output
 
-        return self.last_output
+        return output
 
     def init_hidden(self, batch_size: int = 1):
         device = next(self.parameters()).device
@@ -233,3 +261,136 @@ class ModularPolicy8(torch.nn.Module):
     @property
     def has_attention(self):
         return False # TODO: Disabled drawing attention until it's implemented in `evalute_model.py`.
+
+    def enable_static_forward(self, compile: bool = True, cache_dir: Optional[str] = None, **compile_kwargs):
+        """ Run the forward pass through a `StaticInputForward` specialized to the set of input keys it is called with. A specialization is created (and compiled, if `compile` is True) the first time a new set of input keys is seen. The static forward pass is skipped while introspection is enabled, since it does not record attention weights.
+
+        Args:
+            compile: If True, the specialized forward passes are compiled with `torch.compile`. Otherwise, they run eagerly, which still avoids re-resolving the input modules on each call.
+            cache_dir: Directory where compiled graphs are cached between runs (see `set_compile_cache_dir`).
+            compile_kwargs: Keyword arguments passed to `torch.compile` (e.g. `backend`, `mode`, `dynamic`).
+        """
+        if cache_dir is not None:
+            set_compile_cache_dir(cache_dir)
+        self._static_forwards = {}
+        self._static_compile_kwargs = compile_kwargs if compile else None
+
+    def disable_static_forward(self):
+        self._static_forwards = None
+        self._static_compile_kwargs = None
+
+    @property
+    def static_forward_enabled(self) -> bool:
+        return self._static_forwards is not None
+
+    def _get_static_forward(self, inputs) -> Optional['StaticInputForward']:
+        if self._static_forwards is None or self.introspect:
+            return None
+        input_keys = frozenset(inputs.keys())
+        static_forward = self._static_forwards.get(input_keys)
+        if static_forward is None:
+            static_forward = StaticInputForward(self, input_keys, compile_kwargs=self._static_compile_kwargs)
+            self._static_forwards[input_keys] = static_forward
+        return static_forward
+
+    def warmup_static_forward(self, inputs: Dict[str,torch.Tensor], hidden: Tuple[torch.Tensor, ...], seq_len: Optional[int] = None):
+        """ Run the static forward pass on `inputs` so that it is compiled before it is needed. The forward pass is run once without gradients (as in rollouts) and once with gradients (as in training). If `seq_len` is given, `forward_sequence` is also run on a sequence of that length made by repeating `inputs`. Outputs are discarded. """
+        if not self.static_forward_enabled:
+            raise RuntimeError('Static forward pass is not enabled. Call `enable_static_forward()` first.')
+        hidden = tuple(h.detach() for h in hidden)
+        with torch.no_grad():
+            self(inputs, hidden)
+        self(inputs, hidden)
+        if seq_len is not None:
+            seq_inputs = {k: v.unsqueeze(0).expand(seq_len, *v.shape) for k,v in inputs.items()}
+            done = torch.zeros(seq_len, next(iter(inputs.values())).shape[0], dtype=torch.bool, device=hidden[0].device)
+            with torch.no_grad():
+                self.forward_sequence(seq_inputs, hidden, done)
+            self.forward_sequence(seq_inputs, hidden, done)
+
+    def __getstate__(self):
+        # Compiled functions can't be copied or pickled. The copy uses the regular forward pass until `enable_static_forward()` is called on it.
+        state = self.__dict__.copy()
+        state.pop('_static_forwards', None)
+        state.pop('_static_compile_kwargs', None)
+        return state
+
+
+class StaticInputLabels(list):
+    """ Input labels returned by a static forward pass. The keys and values that go with them are stacked into one tensor, and `static_forward` points back to the `StaticInputForward` that produced them. """
+    static_forward: 'StaticInputForward'
+
+
+class StaticInputForward:
+    """
+    The forward pass of a `ModularPolicy8` specialized to a fixed set of input keys. The input modules that apply to those keys, and the inputs each one is called with, are resolved once at construction, so the forward pass is a fixed sequence of tensor operations with no dictionary lookups on the config or checks on which inputs are present. This makes it suitable for graph capture with `torch.compile`, which also removes most of the Python overhead that dominates at small batch sizes.
+
+    The encoder and the core are compiled separately so that the inputs of a whole sequence can still be encoded in one batch (see `SequenceForwardMixin.forward_sequence`). The model's parameters are not copied, so updates to the model are seen by the compiled functions.
+    """
+    def __init__(self, model: ModularPolicy8, input_keys, compile_kwargs: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            model: The model whose forward pass is specialized.
+            input_keys: The keys of the input dictionary. Inputs with other keys are not accepted.
+            compile_kwargs: If provided, `encode` and `core` are compiled with `torch.compile(**compile_kwargs)`.
+        """
+        self.model = model
+        self.input_keys = frozenset(input_keys)
+        self.plan = model._input_plan(self.input_keys)
+        self.input_labels = StaticInputLabels(label for label,_ in self.plan)
+        self.input_labels.static_forward = self
+
+        if compile_kwargs is not None:
+            self.encode = torch.compile(self._encode, **compile_kwargs)
+            self.core = torch.compile(self._core, **compile_kwargs)
+        else:
+            self.encode = self._encode
+            self.core = self._core
+
+    def _encode(self, inputs: Dict[str,torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Run the input modules and return their keys and values stacked along the first dimension. """
+        input_keys = []
+        input_vals = []
+        for label,args in self.plan:
+            module = self.model.input_modules[label]
+            if isinstance(args, dict):
+                y = module(**{dest_key: inputs[src_key] for dest_key, src_key in args.items()})
+            else:
+                y = module(*[inputs[a] for a in args])
+            input_keys.append(y['key'])
+            input_vals.append(y['value'])
+        if len(input_keys) == 0:
+            batch_size = next(iter(inputs.values())).shape[0]
+            device = next(self.model.parameters()).device
+            empty = torch.zeros(0, batch_size, self.model._key_size, device=device)
+            return empty, empty
+        return torch.stack(input_keys), torch.stack(input_vals)
+
+    def _core(self, input_keys: torch.Tensor, input_vals: torch.Tensor, hidden: Tuple[torch.Tensor, ...]) -> Tuple[Dict[str, torch.Tensor], Tuple[torch.Tensor, ...]]:
+        """ Run the core and output modules on the stacked input keys and values. Returns the outputs of each output module and the new hidden state. """
+        model = self.model
+        core_output = model.attention(
+                tuple(hidden[2:]),
+                torch.cat([input_keys, hidden[0]]),
+                torch.cat([input_vals, hidden[1]]))
+        new_keys = core_output['key']
+        new_values = core_output['value']
+        keys = torch.cat([input_keys, new_keys])
+        values = torch.cat([input_vals, new_values])
+        output = {k: y['output'] for k,y in model._run_output_modules(keys, values)}
+        return output, (new_keys, new_values, *core_output['state'])
+
+    def __call__(self, inputs: Dict[str,torch.Tensor], hidden: Tuple[torch.Tensor, ...]):
+        output, new_hidden = self.core(*self.encode(inputs), tuple(hidden))
+        return {**output, 'hidden': new_hidden}
+
+
+def set_compile_cache_dir(cache_dir: str):
+    """ Cache the graphs compiled by `torch.compile` in `cache_dir` so that later runs can skip most of the compilation. Must be called before the first compilation. """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+    import torch._functorch.config
+    if hasattr(torch._functorch.config, 'enable_autograd_cache'):
+        torch._functorch.config.enable_autograd_cache = True
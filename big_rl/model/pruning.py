@@ -0,0 +1,123 @@
+from typing import Dict, List, Sequence
+
+import torch
+
+from big_rl.model.modular_policy_8 import ModularPolicy8
+from big_rl.model.recurrent_attention_16 import RecurrentAttention16
+
+
+CRITERIA = ['attention', 'gates', 'product']
+
+
+class ModuleUsage:
+    """
+    Accumulates per-module usage statistics of the `RecurrentAttention16` core of a `ModularPolicy8` over an evaluation run, and turns them into a pruning mask.
+
+    Two statistics are kept for each module:
+    - Attention: The attention weight that the module's output receives from its consumers, i.e. the modules of the next layer, or the output modules and (through the recurrent hidden state) the first layer for the last layer. Summed over consumers and averaged over the batch and time steps.
+    - Gates: The mean of the module's key and value gates. A module whose gates stay closed barely changes its output, so its output is close to a constant.
+
+    The model must be run with introspection enabled (see `big_rl.model.model.introspection`) so that the attention weights and gates are recorded.
+
+    Usage:
+
+        usage = ModuleUsage(model)
+        with torch.no_grad(), introspection(model):
+            for obs in ...:
+                output = model(obs, hidden)
+                usage.update(output)
+        mask = usage.mask(fraction=0.25)
+        prune_(model, mask)
+    """
+    def __init__(self, model: ModularPolicy8):
+        if not isinstance(model.attention, RecurrentAttention16):
+            raise NotImplementedError(f'Module usage statistics are only supported for RecurrentAttention16 cores. Got {type(model.attention).__name__}.')
+        self.architecture = [layer._num_modules for layer in model.attention._layers]
+        self.attention = [torch.zeros(n) for n in self.architecture]
+        self.gates = [torch.zeros(n) for n in self.architecture]
+        self.count = 0
+
+    def update(self, output: Dict):
+        """ Add the statistics of one forward pass. `output` is the output of the model's forward pass. """
+        misc = output['misc']
+        if 'core_output' not in misc:
+            raise RuntimeError('The model output does not contain the core output. Make sure introspection is enabled and the static forward pass is not used.')
+        core_misc = misc['core_output']['misc']
+        attention = core_misc['attention'] # (num_modules, batch_size, seq_len) per layer
+        gates = core_misc['gates']
+        if len(attention) == 0:
+            raise RuntimeError('No attention weights were recorded. Make sure introspection is enabled.')
+
+        num_layers = len(self.architecture)
+        num_outputs = self.architecture[-1]
+        # The first layer attends to the inputs, followed by the outputs of the last layer from the previous time step
+        num_inputs = attention[0].shape[-1] - num_outputs
+
+        for i in range(num_layers):
+            if i < num_layers-1:
+                received = attention[i+1].sum(0).mean(0)
+            else:
+                received = attention[0][:,:,num_inputs:].sum(0).mean(0)
+                for output_attention in misc['output_attention'].values():
+                    received = received + output_attention[:,num_inputs:].mean(0)
+            self.attention[i] += received.detach().float().cpu()
+            self.gates[i] += ((gates[i]['key'] + gates[i]['value']) / 2).detach().float().mean(1).view(-1).cpu()
+        self.count += 1
+
+    def scores(self, criterion: str = 'product') -> List[torch.Tensor]:
+        """ Utility of each module, one tensor of shape `(num_modules,)` per layer. Higher is more useful.
+
+        Args:
+            criterion: 'attention' (attention received), 'gates' (mean key/value gate) or 'product' (attention received times mean gate).
+        """
+        if self.count == 0:
+            raise RuntimeError('No statistics were collected.')
+        if criterion == 'attention':
+            return [a / self.count for a in self.attention]
+        elif criterion == 'gates':
+            return [g / self.count for g in self.gates]
+        elif criterion == 'product':
+            return [a * g / self.count**2 for a,g in zip(self.attention, self.gates)]
+        raise ValueError(f'Unknown criterion {criterion}. Valid values are: {", ".join(CRITERIA)}.')
+
+    def mask(self, fraction: float = 0., threshold: float = 0., criterion: str = 'product', min_modules: int = 1) -> List[List[bool]]:
+        """ Mask of the modules to keep (see `RecurrentAttention16.remove_modules`). See `prune_mask`. """
+        return prune_mask(self.scores(criterion), fraction=fraction, threshold=threshold, min_modules=min_modules)
+
+
+def prune_mask(scores: Sequence[torch.Tensor], fraction: float = 0., threshold: float = 0., min_modules: int = 1) -> List[List[bool]]:
+    """ Choose the modules to remove from each layer given their utility scores. Layers are pruned independently.
+
+    Args:
+        scores: Utility of each module, one tensor per layer.
+        fraction: Fraction of the modules of each layer to remove, starting from the lowest score.
+        threshold: Modules whose score is below `threshold` times the highest score of their layer are also removed.
+        min_modules: Minimum number of modules kept in each layer.
+
+    Returns:
+        One list of booleans per layer, which is True for the modules that are kept.
+    """
+    mask = []
+    for s in scores:
+        n = len(s)
+        order = s.argsort(descending=True)
+        num_keep = max(n - int(fraction * n), min(min_modules, n))
+        keep = torch.zeros(n, dtype=torch.bool)
+        keep[order[:num_keep]] = True
+        if threshold > 0:
+            keep &= s >= threshold * s.max()
+            keep[order[:min(min_modules, n)]] = True
+        mask.append(keep.tolist())
+    return mask
+
+
+def prune_(model: ModularPolicy8, mask: List[List[bool]]) -> ModularPolicy8:
+    """ Remove the modules of the `RecurrentAttention16` core of `model` whose entry in `mask` is False, in place. Returns `model`. The hidden state shape changes if modules are removed from the last layer, so hidden states must be reinitialized with `model.init_hidden()` afterwards. Optimizers holding the model's parameters have to be recreated. """
+    if not isinstance(model.attention, RecurrentAttention16):
+        raise NotImplementedError(f'Pruning is only supported for RecurrentAttention16 cores. Got {type(model.attention).__name__}.')
+    model.attention.remove_modules(mask)
+    if model.static_forward_enabled:
+        # Compiled specializations were traced with the old parameters
+        model._static_forwards = {}
+    return model
+
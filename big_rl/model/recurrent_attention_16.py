@@ -2,13 +2,14 @@ from __future__ import annotations
 from abc import ABC, abstractmethod
 import copy
 import itertools
-from typing import Tuple, List, Type
+from typing import Optional, Tuple, List, Type
 
 import torch
 from torchtyping.tensor_type import TensorType
 
-from big_rl.model.model import BatchMultiHeadAttentionEinsum, NonBatchMultiHeadAttention, BatchMultiHeadAttentionBroadcast
+from big_rl.model.model import BatchMultiHeadAttentionEinsum, NonBatchMultiHeadAttention, BatchMultiHeadAttentionBroadcast, BatchGroupedKVAttentionEinsum
 from big_rl.model.model import BatchLinear, NonBatchLinear
+from big_rl.model.model import IntrospectionMixin
 
 
 class RecurrentAttention16Layer(torch.nn.Module, ABC):
@@ -96,6 +97,9 @@ class BatchRecurrentAttention16Layer_v2(RecurrentAttention16Layer):
                 torch.nn.Parameter(torch.zeros([num_modules, value_size])),
         ])
 
+        # Optional (num_modules, num_masked_inputs) boolean mask of the inputs each module can attend to. Set by `merge()` to keep merged models independent. It covers the last `num_masked_inputs` inputs, and the inputs before them can be attended to by all modules. It is saved in the state dict, so a merged model keeps its isolation when it is reloaded.
+        self.register_buffer('attention_mask', None)
+
     def forward(self,
             state: Tuple[
                 TensorType['num_blocks','batch_size','input_size',float], # Internal state
@@ -117,13 +121,21 @@ class BatchRecurrentAttention16Layer_v2(RecurrentAttention16Layer):
         prev_key = state[2] # (num_blocks, batch_size, key_size)
         prev_value = state[3] # (num_blocks, batch_size, value_size)
 
+        attention_mask = self.attention_mask
+        if attention_mask is not None and attention_mask.shape[1] < key.shape[0]:
+            attention_mask = torch.cat([
+                attention_mask.new_ones([num_modules, key.shape[0] - attention_mask.shape[1]]),
+                attention_mask,
+            ], dim=1)
+
         # attn_output: (num_blocks, 1, batch_size, value_size)
         # attn_output_weights: (num_blocks, batch_size, 1, seq_len)
         # The extra size 1 dimension is the number of queries. We only provide 1 query per module, so it's size 1.
         attn_output, attn_output_weights = self.attention(
                 prev_query, 
                 key.expand([num_modules, *key.shape]),
-                value.expand([num_modules, *value.shape])
+                value.expand([num_modules, *value.shape]),
+                **({} if attention_mask is None else {'attn_mask': attention_mask}),
         )
 
         # Remove the extra query dimension
@@ -186,6 +198,40 @@ class BatchRecurrentAttention16Layer_v2(RecurrentAttention16Layer):
             for x in self.default_state
         )
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if f'{prefix}weight_in' in state_dict:
+            _convert_layer_state_dict(state_dict, prefix, BatchRecurrentAttention16Layer_v3, self)
+        # The mask is only in the state dict if it isn't None, so the buffer is created with the right shape before it is loaded
+        if f'{prefix}attention_mask' in state_dict:
+            self.attention_mask = torch.zeros_like(state_dict[f'{prefix}attention_mask'], dtype=torch.bool, device=self.default_state[0].device)
+        elif f'{prefix}default_state.0' in state_dict:
+            self.attention_mask = None
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def remove_modules(self, mask: List[bool]):
+        """ Remove the modules whose entry in `mask` is False, in place, by shrinking the stacked parameters. Unlike `ablate()`, the layer is not copied or converted to a non-batched layer. """
+        assert len(mask) == self._num_modules, f"Mask must be the same length as the number of modules. Expected {self._num_modules}. Received {len(mask)}"
+
+        # The MLPs are stacked by group (query, key, value, state), then by module
+        for m in itertools.chain(self.fc_outputs, self.fc_gates):
+            if isinstance(m, BatchLinear):
+                m.remove_modules(list(mask)*4)
+        self.attention.remove_modules(mask)
+        self.default_state = _select_default_state(self.default_state, mask)
+        if self.attention_mask is not None:
+            self.attention_mask = self.attention_mask[torch.tensor(mask, dtype=torch.bool, device=self.attention_mask.device)]
+
+        self._num_modules = sum(mask)
+
+    def merge(self, module: BatchRecurrentAttention16Layer_v2, positions=None):
+        """ Add the modules of `module` to this layer, in place, by concatenating the stacked parameters. Same as `NonBatchRecurrentAttention16Layer.merge`: if `positions` is given, the modules of `module` are placed at those indices of the merged layer, and the modules of this layer fill the remaining indices in order. Otherwise, they are appended. """
+        num_modules = self._num_modules + module._num_modules
+        if positions is None:
+            sources = [0]*self._num_modules + [1]*module._num_modules
+        else:
+            sources = [1 if i in positions else 0 for i in range(num_modules)]
+        _merge_layers_v2_(self, [module], sources)
+
     def to_nonbatched(self):
         return _batchedv2_to_nonbatched(self)
 
@@ -194,6 +240,229 @@ class BatchRecurrentAttention16Layer_v2(RecurrentAttention16Layer):
         return _to_batchedv2(obj)
 
 
+class BatchRecurrentAttention16Layer_v3(RecurrentAttention16Layer):
+    """ Same computation as `BatchRecurrentAttention16Layer_v2`, with the parameters laid out so that the feedforward part of the layer can be computed without copying its inputs.
+
+    - The first layer of all eight MLPs of a module (the four outputs and the four gates, which all take the same input) is stored as one weight matrix, so it is computed with a single batched matrix multiplication over the modules instead of copying the input four times.
+    - Activations are kept in a transposed `(num_modules*8, size, batch_size)` layout so that the MLPs of all modules and groups can be batched together without reshaping.
+    - The gated updates of the query, key, value and state are computed with a single `torch.lerp`.
+    - The attention uses the same keys and values for all modules instead of expanding them.
+
+    The state dict is converted when loading, so checkpoints saved with `BatchRecurrentAttention16Layer_v2` layers can be loaded into this layer and vice versa.
+    """
+    def __init__(self, input_size, key_size, value_size, num_heads, ff_size, num_modules):
+        super().__init__()
+
+        # Preprocess and validate parameters
+        assert input_size == key_size == value_size
+        if isinstance(ff_size, int):
+            ff_size = [ff_size]
+
+        # Save parameters
+        self._input_size = input_size
+        self._key_size = key_size
+        self._value_size = value_size
+        self._num_heads = num_heads
+        self._ff_size = ff_size
+        self._num_modules = num_modules
+
+        # Initialize fully-connected modules from a v2 layer so that they are initialized the same way
+        # Group order: output query, key, value, state, then gate query, key, value, state
+        v2 = BatchRecurrentAttention16Layer_v2(input_size, key_size, value_size, num_heads, ff_size, num_modules)
+        self.weight_in = torch.nn.Parameter(torch.empty(0))
+        self.bias_in = torch.nn.Parameter(torch.empty(0))
+        self.weight_hidden = torch.nn.ParameterList()
+        self.bias_hidden = torch.nn.ParameterList()
+        if len(ff_size) > 0:
+            self.weight_out = torch.nn.Parameter(torch.empty(0))
+            self.bias_out = torch.nn.Parameter(torch.empty(0))
+            self.weight_gate = torch.nn.Parameter(torch.empty(0))
+            self.bias_gate = torch.nn.Parameter(torch.empty(0))
+        self._copy_mlps_from_v2(v2)
+
+        # Initialize attention module
+        self.attention = v2.attention
+
+        # Initialize default state
+        self.default_state = v2.default_state
+
+    def _copy_mlps_from_v2(self, v2: BatchRecurrentAttention16Layer_v2):
+        num_modules = self._num_modules
+        def group_weights(linear: BatchLinear):
+            """ (num_modules*4, in, out) ordered by group then module -> (num_modules, 4, out, in) """
+            w = linear.weight.detach()
+            return w.view(4, num_modules, *w.shape[1:]).transpose(0,1).transpose(2,3)
+        def group_biases(linear: BatchLinear):
+            """ (num_modules*4, 1, out) ordered by group then module -> (num_modules, 4, out, 1) """
+            b = linear.bias.detach()
+            return b.view(4, num_modules, -1, 1).transpose(0,1)
+        output_layers = [m for m in v2.fc_outputs if isinstance(m, BatchLinear)]
+        gate_layers = [m for m in v2.fc_gates if isinstance(m, BatchLinear)]
+        with torch.no_grad():
+            # First layer: (num_modules, 4*out_size + 4*gate_size, in_size)
+            self.weight_in = torch.nn.Parameter(torch.cat([
+                group_weights(output_layers[0]).flatten(1,2),
+                group_weights(gate_layers[0]).flatten(1,2),
+            ], dim=1).contiguous())
+            self.bias_in = torch.nn.Parameter(torch.cat([
+                group_biases(output_layers[0]).flatten(1,2),
+                group_biases(gate_layers[0]).flatten(1,2),
+            ], dim=1).contiguous())
+            # Hidden layers: (num_modules*8, out_size, in_size)
+            self.weight_hidden = torch.nn.ParameterList([
+                torch.nn.Parameter(torch.cat([group_weights(o), group_weights(g)], dim=1).flatten(0,1).contiguous())
+                for o,g in zip(output_layers[1:-1], gate_layers[1:-1])
+            ])
+            self.bias_hidden = torch.nn.ParameterList([
+                torch.nn.Parameter(torch.cat([group_biases(o), group_biases(g)], dim=1).flatten(0,1).contiguous())
+                for o,g in zip(output_layers[1:-1], gate_layers[1:-1])
+            ])
+            # Last layer: (num_modules, 4, out_size, in_size)
+            if len(self._ff_size) > 0:
+                self.weight_out = torch.nn.Parameter(group_weights(output_layers[-1]).contiguous())
+                self.bias_out = torch.nn.Parameter(group_biases(output_layers[-1]).contiguous())
+                self.weight_gate = torch.nn.Parameter(group_weights(gate_layers[-1]).contiguous())
+                self.bias_gate = torch.nn.Parameter(group_biases(gate_layers[-1]).contiguous())
+
+    def _copy_mlps_to_v2(self, v2: BatchRecurrentAttention16Layer_v2):
+        num_modules = self._num_modules
+        output_sizes = [*self._ff_size, self._value_size]
+        gate_sizes = [*self._ff_size, 1]
+        def ungroup(w, b):
+            """ (num_modules, 4, out, in), (num_modules, 4, out, 1) -> (num_modules*4, in, out), (num_modules*4, 1, out) ordered by group then module """
+            return (
+                w.transpose(2,3).transpose(0,1).flatten(0,1).contiguous(),
+                b.transpose(2,3).transpose(0,1).flatten(0,1).contiguous(),
+            )
+        w_in = self.weight_in.detach().view(num_modules, -1, self.weight_in.shape[-1])
+        b_in = self.bias_in.detach()
+        layers = [(
+            (w_in[:,:4*output_sizes[0]].reshape(num_modules, 4, output_sizes[0], -1), b_in[:,:4*output_sizes[0]].reshape(num_modules, 4, output_sizes[0], 1)),
+            (w_in[:,4*output_sizes[0]:].reshape(num_modules, 4, gate_sizes[0], -1), b_in[:,4*output_sizes[0]:].reshape(num_modules, 4, gate_sizes[0], 1)),
+        )]
+        for w,b in zip(self.weight_hidden, self.bias_hidden):
+            w = w.detach().view(num_modules, 8, *w.shape[1:])
+            b = b.detach().view(num_modules, 8, *b.shape[1:])
+            layers.append(((w[:,:4], b[:,:4]), (w[:,4:], b[:,4:])))
+        if len(self._ff_size) > 0:
+            layers.append((
+                (self.weight_out.detach(), self.bias_out.detach()),
+                (self.weight_gate.detach(), self.bias_gate.detach()),
+            ))
+        output_layers = [m for m in v2.fc_outputs if isinstance(m, BatchLinear)]
+        gate_layers = [m for m in v2.fc_gates if isinstance(m, BatchLinear)]
+        with torch.no_grad():
+            for (o,g),output_layer,gate_layer in zip(layers, output_layers, gate_layers):
+                output_layer.weight.data, output_layer.bias.data = ungroup(*o)
+                gate_layer.weight.data, gate_layer.bias.data = ungroup(*g)
+
+    def forward(self,
+            state: Tuple[
+                TensorType['num_blocks','batch_size','input_size',float], # Internal state
+                TensorType['num_blocks','batch_size','key_size',float], # Previous query
+                TensorType['num_blocks','batch_size','key_size',float], # Previous key
+                TensorType['num_blocks','batch_size','value_size',float], # Previous value
+            ],
+            key: TensorType['seq_len','batch_size','key_size',float],
+            value: TensorType['seq_len','batch_size','value_size',float],
+        ):
+        num_modules = self._num_modules
+        batch_size = key.shape[1]
+        assert num_modules == state[0].size(0)
+        assert len(state) == 4
+
+        prev_internal_state, prev_query, prev_key, prev_value = state
+
+        # Same keys and values for all modules, so they don't need to be expanded
+        attn_output, attn_output_weights = self.attention(prev_query, key, value, batched=False)
+        attn_output = attn_output.squeeze(1) # (num_blocks, batch_size, value_size)
+        attn_output_weights = attn_output_weights.squeeze(2) # (num_blocks, batch_size, seq_len)
+
+        # Feedforward layers, with activations of shape (num_blocks, size, batch_size)
+        fc_input = torch.cat([attn_output, prev_internal_state], dim=2).relu()
+        x = torch.baddbmm(self.bias_in, self.weight_in, fc_input.transpose(1,2)) # (num_blocks, 4*output_size+4*gate_size, batch_size)
+        if len(self._ff_size) == 0:
+            outputs = x[:,:4*self._value_size].view(num_modules, 4, self._value_size, batch_size)
+            gates = x[:,4*self._value_size:].view(num_modules, 4, 1, batch_size)
+        else:
+            x = x.relu().view(num_modules*8, -1, batch_size)
+            for w,b in zip(self.weight_hidden, self.bias_hidden):
+                x = torch.baddbmm(b, w, x).relu()
+            x = x.view(num_modules, 8, -1, batch_size)
+            outputs = torch.matmul(self.weight_out, x[:,:4]) + self.bias_out # (num_blocks, 4, value_size, batch_size)
+            gates = torch.matmul(self.weight_gate, x[:,4:]) + self.bias_gate # (num_blocks, 4, 1, batch_size)
+        outputs = outputs.relu().tanh().permute(1,0,3,2) # (4, num_blocks, batch_size, value_size)
+        gates = gates.sigmoid().permute(1,0,3,2) # (4, num_blocks, batch_size, 1)
+
+        # Gated update: gate * output + (1 - gate) * previous
+        gated_output_queries, gated_output_keys, gated_output_values, gated_output_state = torch.lerp(
+                torch.stack([prev_query, prev_key, prev_value, prev_internal_state]),
+                outputs,
+                gates,
+        )
+        output_query_gate, output_key_gate, output_value_gate, output_state_gate = gates
+
+        return { # seq_len = number of inputs receives
+            'attn_output': attn_output, # (num_blocks, batch_size, value_size)
+            'attn_output_weights': attn_output_weights, # (num_blocks, batch_size, seq_len)
+            'gates': {
+                'query': output_query_gate, # (num_blocks, batch_size)
+                'key': output_key_gate, # (num_blocks, batch_size)
+                'value': output_value_gate, # (num_blocks, batch_size)
+                'state': output_state_gate, # (num_blocks, batch_size)
+            },
+            'key': gated_output_keys, # (num_blocks, batch_size, key_size)
+            'value': gated_output_values, # (num_blocks, batch_size, value_size)
+            'state': (
+                gated_output_state, # (num_blocks, batch_size, input_size)
+                gated_output_queries, # (num_blocks, batch_size, key_size)
+                gated_output_keys, # (num_blocks, batch_size, key_size)
+                gated_output_values, # (num_blocks, batch_size, value_size)
+            )
+        }
+
+    def init_state(self, batch_size) -> Tuple[torch.Tensor, ...]:
+        return tuple(
+            x.unsqueeze(1).expand([self._num_modules, batch_size, x.shape[1]])
+            for x in self.default_state
+        )
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if f'{prefix}fc_outputs.1.weight' in state_dict:
+            _convert_layer_state_dict(state_dict, prefix, BatchRecurrentAttention16Layer_v2, self)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def remove_modules(self, mask: List[bool]):
+        """ Remove the modules whose entry in `mask` is False, in place. See `BatchRecurrentAttention16Layer_v2.remove_modules`. """
+        assert len(mask) == self._num_modules, f"Mask must be the same length as the number of modules. Expected {self._num_modules}. Received {len(mask)}"
+        index = torch.tensor(mask, dtype=torch.bool, device=self.weight_in.device)
+        def select(p, num_groups=1):
+            x = p.detach().view(self._num_modules, -1, *p.shape[1:]) if num_groups > 1 else p.detach()
+            x = x[index].clone()
+            return torch.nn.Parameter(x.flatten(0,1) if num_groups > 1 else x, requires_grad=p.requires_grad)
+
+        self.weight_in = select(self.weight_in)
+        self.bias_in = select(self.bias_in)
+        self.weight_hidden = torch.nn.ParameterList([select(w, 8) for w in self.weight_hidden])
+        self.bias_hidden = torch.nn.ParameterList([select(b, 8) for b in self.bias_hidden])
+        if len(self._ff_size) > 0:
+            self.weight_out = select(self.weight_out)
+            self.bias_out = select(self.bias_out)
+            self.weight_gate = select(self.weight_gate)
+            self.bias_gate = select(self.bias_gate)
+        self.attention.remove_modules(mask)
+        self.default_state = _select_default_state(self.default_state, mask)
+
+        self._num_modules = sum(mask)
+
+    def to_nonbatched(self):
+        return _batchedv3_to_batchedv2(self).to_nonbatched()
+
+    @classmethod
+    def from_nonbatched(cls, obj):
+        return _batchedv2_to_batchedv3(_to_batchedv2(obj))
+
+
 class BatchRecurrentAttention16Layer(RecurrentAttention16Layer):
     def __init__(self, input_size, key_size, value_size, num_heads, ff_size, num_modules, batch_type: str = 'einsum'):
         super().__init__()
@@ -588,12 +857,12 @@ class NonBatchRecurrentAttention16Layer(RecurrentAttention16Layer):
         self._num_modules += module._num_modules
 
 
-class RecurrentAttention16(torch.nn.Module):
+class RecurrentAttention16(IntrospectionMixin, torch.nn.Module):
     """ Same as RecurrentAttention14, but added gating to the output keys and values. 
     
     API changes:
     - `forward()` takes three inputs: state, key, value. It also outputs a dictionary with the same three keys.
-        - Debugging values: `attn_output`, `attn_output_weights`, `gates`
+        - Debugging values: `attn_output`, `attn_output_weights`, `gates`. The attention weights and gates of each layer are also returned under `misc` if introspection is enabled (see `IntrospectionMixin`).
     - `init_hidden(batch_size)` returns a tuple which is used to initialize the state.
 
     Previously, `forward()` had a `initial_x` input which was used as a default query. This doesn't change between batches, so it makes more sense for this to be a parameter of the model than an input. Unclear why I made it a parameter of the parent module rather than of the recurrence module.
@@ -632,8 +901,9 @@ class RecurrentAttention16(torch.nn.Module):
             current_value = layer_output['value']
             new_state.append(layer_output['state'])
 
-            extras_attention.append(layer_output['attn_output_weights'].cpu().detach())
-            extras_gating.append({k:v.cpu().detach() for k,v in layer_output['gates'].items()})
+            if self.introspect:
+                extras_attention.append(layer_output['attn_output_weights'].detach())
+                extras_gating.append({k:v.detach() for k,v in layer_output['gates'].items()})
 
         return {
             # Required outputs
@@ -663,8 +933,28 @@ class RecurrentAttention16(torch.nn.Module):
         """ The number of elements in the state tuple. """
         return len(self._architecture) * 4
 
+    def remove_modules(self, mask: List[List[bool]]):
+        """ Remove the modules whose entry in `mask` is False, in place. `mask` has one list per layer. Layers that can't be shrunk in place are converted to non-batched layers and back. The keys and values of a layer are computed per input, so removing modules from a layer does not change the shapes of the parameters of the next layer. Layers with grouped key/value projections are not supported. """
+        _validate_mask(self, mask)
+        _check_ungrouped(self._layers, 'remove_modules')
+        for i, (layer, layer_mask) in enumerate(zip(self._layers, mask)):
+            if hasattr(layer, 'remove_modules'):
+                layer.remove_modules(layer_mask)
+            else:
+                nonbatched = layer.to_nonbatched()
+                nonbatched.remove_modules(layer_mask)
+                self._layers[i] = type(layer).from_nonbatched(nonbatched) # type: ignore
+            # The inputs of the next layer are the outputs of this layer. The outputs of the last layer are fed back to the first layer at the next step, as its last inputs.
+            next_layer = self._layers[(i+1) % len(self._layers)]
+            next_mask = getattr(next_layer, 'attention_mask', None)
+            if next_mask is not None:
+                next_layer.attention_mask = next_mask[:,torch.tensor(layer_mask, dtype=torch.bool, device=next_mask.device)]
+        self._architecture = [sum(m) for m in mask]
+
     def convert_layer_type(self, layer_cls: Type[RecurrentAttention16Layer]):
-        """ Convert all layers to a new type. """
+        """ Convert all layers to a new type. Layers with an attention mask (see `merge`) can't be converted, since only `BatchRecurrentAttention16Layer_v2` supports masks. """
+        for layer in self._layers:
+            _check_unmasked(layer, f'convert to {layer_cls.__name__}')
         self._layers = torch.nn.ModuleList([
             layer_cls.from_nonbatched(layer.to_nonbatched()) # type: ignore
             for layer in self._layers
@@ -716,7 +1006,14 @@ def _batched_to_nonbatched(rec: BatchRecurrentAttention16Layer) -> NonBatchRecur
     return output
 
 
+def _check_unmasked(layer, operation: str):
+    """ Raise an error if `layer` has an attention mask (see `merge`), which would be lost by `operation`. """
+    if getattr(layer, 'attention_mask', None) is not None:
+        raise ValueError(f'Cannot {operation} a layer with an attention mask, since the mask would be lost and the modules of merged models would no longer be isolated. Only BatchRecurrentAttention16Layer_v2 supports attention masks.')
+
+
 def _batchedv2_to_nonbatched(rec: BatchRecurrentAttention16Layer_v2) -> NonBatchRecurrentAttention16Layer:
+    _check_unmasked(rec, 'convert to NonBatchRecurrentAttention16Layer')
     rec = copy.deepcopy(rec)
     output = NonBatchRecurrentAttention16Layer(
         input_size = rec._input_size,
@@ -877,37 +1174,183 @@ def _to_batchedv2(rec: NonBatchRecurrentAttention16Layer) -> BatchRecurrentAtten
     return output
 
 
-# Resizing / Ablation / Merging utils
+def _batchedv2_to_batchedv3(rec: BatchRecurrentAttention16Layer_v2) -> BatchRecurrentAttention16Layer_v3:
+    _check_unmasked(rec, 'convert to BatchRecurrentAttention16Layer_v3')
+    rec = copy.deepcopy(rec)
+    output = BatchRecurrentAttention16Layer_v3(
+        input_size = rec._input_size,
+        key_size = rec._key_size,
+        value_size = rec._value_size,
+        num_heads = rec._num_heads,
+        ff_size = rec._ff_size,
+        num_modules = rec._num_modules,
+    )
 
+    # Convert linear layers
+    output._copy_mlps_from_v2(rec)
 
-def ablate(model: RecurrentAttention16, mask: List[List[bool]]) -> RecurrentAttention16:
-    """ Return a new RecurrentAttention16 model with the specified modules removed.
-    """
+    # Convert attention
+    if isinstance(rec.attention, BatchGroupedKVAttentionEinsum):
+        output.attention = rec.attention
+    else:
+        output.attention = BatchMultiHeadAttentionEinsum(
+            rec.attention.to_multihead_attention_modules(),
+            key_size=rec._key_size,
+            num_heads=rec._num_heads,
+            default_batch=True,
+        )
+
+    # Copy default state
+    output.default_state = rec.default_state
+
+    return output
+
+
+def _batchedv3_to_batchedv2(rec: BatchRecurrentAttention16Layer_v3) -> BatchRecurrentAttention16Layer_v2:
+    rec = copy.deepcopy(rec)
+    output = BatchRecurrentAttention16Layer_v2(
+        input_size = rec._input_size,
+        key_size = rec._key_size,
+        value_size = rec._value_size,
+        num_heads = rec._num_heads,
+        ff_size = rec._ff_size,
+        num_modules = rec._num_modules,
+    )
+
+    # Convert linear layers
+    rec._copy_mlps_to_v2(output)
+
+    # Copy attention and default state
+    output.attention = rec.attention
+    output.default_state = rec.default_state
+
+    return output
 
-    # Validation
+
+def _convert_layer_state_dict(state_dict, prefix, source_cls, target: RecurrentAttention16Layer):
+    """ Convert the parameters of a layer of type `source_cls` in `state_dict` (in place) to the parameter layout of `target`. """
+    source = source_cls(target._input_size, target._key_size, target._value_size, target._num_heads, target._ff_size, target._num_modules) # type: ignore
+    if isinstance(target.attention, BatchGroupedKVAttentionEinsum):
+        # Grouped key/value projections are shared by both layouts. Per-module projections in `state_dict` are grouped when loaded, with the method of `target.attention`.
+        source.attention = copy.deepcopy(target.attention)
+    source.to(next(target.parameters()).device)
+    if f'{prefix}attention_mask' in state_dict and not isinstance(target, BatchRecurrentAttention16Layer_v2):
+        raise ValueError(f'The layer {prefix[:-1]} of the checkpoint has an attention mask (see `merge`), which {type(target).__name__} does not support. Load it into a BatchRecurrentAttention16Layer_v2 layer.')
+    source_keys = [k for k in state_dict.keys() if k.startswith(prefix) and k[len(prefix):] in source.state_dict()]
+    source.load_state_dict({k[len(prefix):]: state_dict.pop(k) for k in source_keys})
+    if source_cls is BatchRecurrentAttention16Layer_v2:
+        converted = _batchedv2_to_batchedv3(source) # type: ignore
+    else:
+        converted = _batchedv3_to_batchedv2(source) # type: ignore
+    for k,v in converted.state_dict().items():
+        state_dict[prefix+k] = v
+
+
+# Resizing / Ablation / Merging utils
+
+
+def _validate_mask(model: RecurrentAttention16, mask: List[List[bool]]):
     num_layers = len(model._layers)
     assert len(mask) == num_layers, f"Mask shape must match model shape. Expected {num_layers} layers, got {len(mask)}"
 
     layer_size = [layer._num_modules for layer in model._layers]
     assert all(len(m) == s for m, s in zip(mask, layer_size)), f"Mask shape must match model shape. Expected {layer_size}, got {[len(m) for m in mask]}"
 
-    # Convert to non-batched layers
-    model = copy.deepcopy(model)
-    original_layer_type = type(model._layers[0])
-    model.convert_layer_type(NonBatchRecurrentAttention16Layer)
 
-    for layer, layer_mask in zip(model._layers, mask):
-        assert isinstance(layer, NonBatchRecurrentAttention16Layer)
-        layer.remove_modules(layer_mask)
+def _check_ungrouped(layers, operation: str):
+    """ Raise an error if any of `layers` has grouped key/value projections (see `big_rl.model.model.group_kv_projections_`). Modules can't be removed or merged without breaking up the groups. """
+    if any(isinstance(getattr(layer, 'attention', None), BatchGroupedKVAttentionEinsum) for layer in layers):
+        raise ValueError(f'Cannot {operation} layers with grouped key/value projections. Group the projections after calling `{operation}`, or load a checkpoint without grouped projections.')
+
+
+def _select_default_state(default_state: torch.nn.ParameterList, mask: List[bool]) -> torch.nn.ParameterList:
+    index = torch.tensor(mask, dtype=torch.bool, device=default_state[0].device)
+    return torch.nn.ParameterList([
+        torch.nn.Parameter(s.detach()[index].clone(), requires_grad=s.requires_grad)
+        for s in default_state
+    ])
 
-    # Convert back to original layer type
-    model.convert_layer_type(original_layer_type) # type: ignore
 
+def ablate(model: RecurrentAttention16, mask: List[List[bool]]) -> RecurrentAttention16:
+    """ Return a new RecurrentAttention16 model with the specified modules removed. Use `RecurrentAttention16.remove_modules()` to remove them from `model` in place instead.
+    """
+    _validate_mask(model, mask)
+    model = copy.deepcopy(model)
+    model.remove_modules(mask)
     return model
 
 
-def merge(models: List[RecurrentAttention16]):
-    ...
+def _merge_layers_v2_(layer: BatchRecurrentAttention16Layer_v2, others: List[BatchRecurrentAttention16Layer_v2], sources: List[int]):
+    """ Add the modules of `others` to `layer`, in place. `sources[i]` is the index of the layer (0 for `layer`, `j+1` for `others[j]`) that the i-th module of the merged layer comes from. Modules from the same layer keep their relative order. """
+    layers = [layer, *others]
+    _check_ungrouped(layers, 'merge')
+    for other in others:
+        assert (other._input_size, other._key_size, other._value_size, other._num_heads, list(other._ff_size)) == (layer._input_size, layer._key_size, layer._value_size, layer._num_heads, list(layer._ff_size)), 'Only layers with the same sizes can be merged.'
+    counts = [l._num_modules for l in layers]
+    assert sorted(sources) == [i for i,n in enumerate(counts) for _ in range(n)], f'Invalid module sources {sources} for layers of sizes {counts}.'
+
+    # Index of each module of the merged layer in the concatenation of all layers' modules
+    next_index = list(itertools.accumulate([0, *counts[:-1]]))
+    order = []
+    for src in sources:
+        order.append(next_index[src])
+        next_index[src] += 1
+
+    # The MLPs are stacked by group (query, key, value, state), then by module
+    for modules in zip(*[itertools.chain(l.fc_outputs, l.fc_gates) for l in layers]):
+        if isinstance(modules[0], BatchLinear):
+            modules[0].merge(modules[1:], order, num_groups=4)
+    layer.attention.merge([l.attention for l in others], order)
+    layer.default_state = torch.nn.ParameterList([
+        torch.nn.Parameter(torch.cat([s.detach() for s in states])[torch.tensor(order)].clone(), requires_grad=states[0].requires_grad)
+        for states in zip(*[l.default_state for l in layers])
+    ])
+    layer.attention_mask = None
+
+    layer._num_modules = sum(counts)
+
+
+def merge(models: List[RecurrentAttention16], sources: Optional[List[List[int]]] = None, isolate: bool = True) -> RecurrentAttention16:
+    """ Return a new RecurrentAttention16 model containing the modules of all `models`, layer by layer, as a single batched core of `BatchRecurrentAttention16Layer_v2` layers. The per-module parameter stacks are concatenated directly, without converting to non-batched layers.
+
+    Args:
+        models: Models to merge. They must have the same number of layers and the same sizes, but the layers can have different numbers of modules.
+        sources: For each layer, the index of the model that each module of the merged layer comes from. Modules from the same model keep their relative order. By default, the modules of the first model come first, followed by those of the second model, etc.
+        isolate: If True, the modules from each model only attend to the outputs of the previous layer's modules from the same model. The inputs of the first layer are expected to end with the keys and values output by the last layer at the previous step, as in `ModularPolicy8`, and the first layer's modules only attend to those from the same model (all other inputs are shared). The merged core then computes the same outputs as running each model separately on the same inputs, with the outputs and states concatenated in the order given by `sources`. The masks are saved in the state dict, and are restored when the checkpoint is loaded into `BatchRecurrentAttention16Layer_v2` layers. Converting the merged model to another layer type (e.g. with `convert_layer_type`) raises a ValueError. If False, the modules can attend to the outputs of all modules of the previous layer.
+
+    Returns:
+        The merged model. The input models are unchanged.
+
+    Models with grouped key/value projections (see `big_rl.model.model.group_kv_projections_`) can't be merged. Merge them before grouping the projections.
+    """
+    num_layers = len(models[0]._layers)
+    assert all(len(m._layers) == num_layers for m in models), 'Models must have the same number of layers.'
+    _check_ungrouped([l for m in models for l in m._layers], 'merge')
+    if sources is None:
+        sources = [
+            [i for i,m in enumerate(models) for _ in range(m._architecture[l])]
+            for l in range(num_layers)
+        ]
+    assert len(sources) == num_layers, f'Expected module sources for {num_layers} layers. Got {len(sources)}.'
+
+    output = copy.deepcopy(models[0])
+    layers = []
+    for l in range(num_layers):
+        model_layers = [
+            copy.deepcopy(m._layers[l]) if isinstance(m._layers[l], BatchRecurrentAttention16Layer_v2) else BatchRecurrentAttention16Layer_v2.from_nonbatched(m._layers[l].to_nonbatched()) # type: ignore
+            for m in models
+        ]
+        layer = model_layers[0]
+        _merge_layers_v2_(layer, model_layers[1:], sources[l])
+        if isolate:
+            # The inputs of the first layer end with the outputs of the last layer at the previous step
+            prev_sources = torch.tensor(sources[l-1] if l > 0 else sources[-1], device=layer.default_state[0].device)
+            layer.attention_mask = torch.tensor(sources[l], device=prev_sources.device).unsqueeze(1) == prev_sources.unsqueeze(0)
+        layers.append(layer)
+    output._layers = torch.nn.ModuleList(layers)
+    output._architecture = [len(s) for s in sources]
+
+    return output
 
 
 if __name__ == '__main__':
@@ -943,9 +1386,11 @@ if __name__ == '__main__':
     )
     batched_module = BatchRecurrentAttention16Layer.from_nonbatched(nonbatched_module)
     batched_module_v2 = BatchRecurrentAttention16Layer_v2.from_nonbatched(nonbatched_module)
+    batched_module_v3 = BatchRecurrentAttention16Layer_v3.from_nonbatched(nonbatched_module)
 
     batched_module.to(device)
     batched_module_v2.to(device)
+    batched_module_v3.to(device)
     nonbatched_module.to(device)
 
     batch_size = 8
@@ -958,6 +1403,8 @@ if __name__ == '__main__':
         batched_module(state, key, value)
     def test_batched_v2():
         batched_module_v2(state, key, value)
+    def test_batched_v3():
+        batched_module_v3(state, key, value)
     def test_nonbatched():
         nonbatched_module(state, key, value)
 
@@ -975,6 +1422,13 @@ if __name__ == '__main__':
     print(f'{num_iterations / total_time} iterations per second')
     print(f'{total_time / num_iterations} seconds per iteration')
 
+    print('-'*80)
+    print(f'{num_iterations} iterations of batched v3, forward only')
+    total_time = timeit.Timer(test_batched_v3).timeit(number=num_iterations)
+    print(f'{num_iterations} iterations took {total_time} seconds')
+    print(f'{num_iterations / total_time} iterations per second')
+    print(f'{total_time / num_iterations} seconds per iteration')
+
     print('-'*80)
     print(f'{num_iterations} iterations of nonbatched, forward only')
     total_time = timeit.Timer(test_nonbatched).timeit(number=num_iterations)
@@ -4,33 +4,44 @@ import os
 from typing import Tuple, Optional
 
 import cv2
+import gymnasium.vector
 import numpy as np
 import torch
 from tqdm import tqdm
 import PIL.Image, PIL.ImageDraw, PIL.ImageFont
 from fonts.ttf import Roboto # type: ignore
+from big_rl.model.model import introspection, group_kv_projections_
+from big_rl.model.low_precision import LowPrecisionPolicy
 from big_rl.model.modular_policy_8 import ModularPolicy8
-from big_rl.model.recurrent_attention_16 import RecurrentAttention16 # type: ignore
+from big_rl.model.recurrent_attention_16 import RecurrentAttention16, BatchRecurrentAttention16Layer_v3 # type: ignore
 
 from big_rl.mujoco.envs import make_env
 from big_rl.minigrid.arguments import init_parser_model
 from big_rl.mujoco.common import env_config_presets, init_model
-from big_rl.utils import merge_space
+from big_rl.utils import merge_space, obs_to_tensor
+from big_rl.utils.evaluation import ResultsWriter, episode_summary, evaluate_vector_env, select_batch
 
 
-def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, verbose=False, render=False, num_episodes=1, warmup_episodes=0):
+def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, verbose=False, render=False, num_episodes=1, warmup_episodes=0, episode_fn=None):
+    """ Run `num_episodes` episodes with `test2()`. If `episode_fn` is given, it is called as `episode_fn(episode_number, episode)` after each episode, and its return value (if not None) is kept in place of the episode. """
+    def finish(ep, episode):
+        if episode_fn is None:
+            return episode
+        output = episode_fn(ep, episode)
+        return episode if output is None else output
+
     if warmup_episodes > 0:
         env = make_env(**env_config)
         for _ in tqdm(range(warmup_episodes), desc='Warmup'):
             test2(model, env, preprocess_obs_fn, video_callback_fn, verbose)
         return [
-            test2(model, env, preprocess_obs_fn, video_callback_fn, verbose)
-            for _ in tqdm(range(num_episodes), desc='Test')
+            finish(ep, test2(model, env, preprocess_obs_fn, video_callback_fn, verbose))
+            for ep in tqdm(range(num_episodes), desc='Test')
         ]
     else:
         # If `warmup_episodes` is 0, we will recreate the environment for each episode to ensure they all start from the same state.
         return [
-            test2(
+            finish(ep, test2(
                 model,
                 make_env(**env_config),
                 preprocess_obs_fn,
@@ -38,7 +49,7 @@ def test(model, env_config, preprocess_obs_fn, video_callback_fn=None, verbose=F
                 verbose=verbose,
                 render=render,
                 metadata={'episode': ep},
-            )
+            ))
             for ep in tqdm(range(num_episodes), desc='Test')
         ]
 
@@ -68,7 +79,7 @@ def test2(model, env, preprocess_obs_fn, video_callback_fn=None, verbose=False,
     terminated = False
     truncated = False
     for step in steps_iterator:
-        with torch.no_grad():
+        with torch.no_grad(), introspection(model):
             model_output = model(obs, hidden)
 
             hidden = model_output['hidden']
@@ -89,9 +100,9 @@ def test2(model, env, preprocess_obs_fn, video_callback_fn=None, verbose=False,
         results['regret'].append(info.get('regret', None))
         if model.has_attention:
             results['attention'].append((
-                [x.numpy() for x in model.last_attention],
-                [x.numpy() for x in model.last_ff_gating],
-                {k: v.numpy() for k,v in model.last_output_attention.items()},
+                [x.cpu().numpy() for x in model.last_attention],
+                [x.cpu().numpy() for x in model.last_ff_gating],
+                {k: v.cpu().numpy() for k,v in model.last_output_attention.items()},
             ))
         results['hidden'].append([
             x.cpu().detach().numpy() for x in model.last_hidden
@@ -123,6 +134,53 @@ def test2(model, env, preprocess_obs_fn, video_callback_fn=None, verbose=False,
     }
 
 
+def test_batched(model, env, preprocess_obs_fn, num_episodes=1, warmup_episodes=0, record_details=True, episode_fn=None, verbose=False):
+    """ Same as `test()`, but runs the episodes in parallel on the vector environment `env`, with one batched forward pass per step. The environments are reused across episodes, so the warmup episodes are run on the same environments before the test episodes. Returns a list with one entry per test episode, each in the format returned by `test2()`. Rendering and videos are not supported. If `record_details` is False, the attention, hidden state and input label streams are left empty, which avoids running the model with introspection enabled. See `evaluate_vector_env` for `episode_fn`, which is only called for the test episodes. """
+    def init_results():
+        return {
+            'reward': [],
+            'regret': [],
+            'attention': [],
+            'hidden': [],
+            'input_labels': [],
+            'target': [], # Goal string
+            'shaped_reward': [], # Predicted shaped reward
+        }
+
+    def sample_action(model_output):
+        action_mean = model_output['action_mean']
+        action_logstd = model_output['action_logstd']
+        action_dist = torch.distributions.Normal(action_mean, action_logstd.exp())
+        return action_dist.sample().cpu().numpy()
+
+    def record(results, model, model_output, index, reward, info, done):
+        results['reward'].append(reward)
+        results['regret'].append(info.get('regret', None))
+        if record_details:
+            if model.has_attention:
+                results['attention'].append((
+                    [x.cpu().numpy() for x in select_batch(model.last_attention, index)],
+                    [x.cpu().numpy() for x in select_batch(model.last_ff_gating, index)],
+                    {k: v.cpu().numpy() for k,v in select_batch(model.last_output_attention, index).items()},
+                ))
+            results['hidden'].append([
+                x.cpu().detach().numpy() for x in select_batch(model_output['hidden'], index)
+            ])
+            results['input_labels'].append(model.last_input_labels)
+
+    kwargs = dict(
+            preprocess_obs_fn = preprocess_obs_fn,
+            sample_action_fn = sample_action,
+            init_results_fn = init_results,
+            record_fn = record,
+            reward_fn = lambda reward, info: info['reward'],
+            verbose = verbose,
+    )
+    if warmup_episodes > 0:
+        evaluate_vector_env(model, env, warmup_episodes, **kwargs) # type: ignore
+    return evaluate_vector_env(model, env, num_episodes, introspect=record_details, episode_fn=episode_fn, **kwargs) # type: ignore
+
+
 def compute_shaped_reward(model):
     query = model.input_modules['obs (shaped_reward)'].key
     key = model.last_keys
@@ -168,6 +226,11 @@ def draw_attention(core_attention, query_gating, output_attention, input_labels)
     font_size = 18
     font = PIL.ImageFont.truetype(font_family, font_size)
 
+    # The recorded values are left on the device they were computed on. Copy them to the host once rather than reading them one element at a time.
+    core_attention = [layer.cpu() for layer in core_attention]
+    query_gating = [layer.cpu() for layer in query_gating]
+    output_attention = {k: v.cpu() for k,v in output_attention.items()}
+
     # Core modules
     core_labels = []
     for label in input_labels:
@@ -336,6 +399,7 @@ def draw_attention2(attention, input_labels, title=None, block_size=24, padding=
     # Attention
     while len(attention.shape) > 2:
         attention = attention.mean(dim=0)
+    attention = attention.cpu()
     num_outputs, num_inputs = attention.shape
     width = num_inputs*block_size + (num_inputs+1)*padding
     height = num_outputs*block_size + (num_outputs+1)*padding
@@ -390,7 +454,7 @@ def draw_observations(observations: dict):
         elif k in ['action']:
             images.append(draw_text(f'{k}: {" ".join(f"{x:.2f}" for x in v.flatten())}'))
         elif k in ['obs (image)']:
-            unnormalized_image = v * 255
+            unnormalized_image = v # Images are not normalized until they reach the model
             #unnormalized_image = (v+v.min())/(v.max()-v.min()) * 255
             unnormalized_image = unnormalized_image.squeeze(0).permute(1,2,0).cpu().numpy().astype(np.uint8)
             images.append(
@@ -487,7 +551,8 @@ class VideoCallback:
 
         obs_image = draw_observations(obs)
         obs_image = draw_observations(obs)
-        if isinstance(model, ModularPolicy8) and isinstance(model.attention, RecurrentAttention16):
+        base_model = model.actor if isinstance(model, LowPrecisionPolicy) else model
+        if isinstance(base_model, ModularPolicy8) and isinstance(base_model.attention, RecurrentAttention16):
             attn_img = draw_attention_mp8ra16(
                     model.last_output,
             )
@@ -562,10 +627,21 @@ class VideoCallback:
 
 
 def preprocess_obs(obs):
-    obs_scale = { 'obs (image)': 1.0 / 255.0 }
+    obs_scale = {}
+    obs_ignore = []
+    return {
+        k: obs_to_tensor(v, device, obs_scale.get(k,1)).unsqueeze(0)
+        for k,v in obs.items()
+        if k not in obs_ignore
+    }
+
+
+def preprocess_obs_batched(obs):
+    """ Same as `preprocess_obs`, for a batch of observations from a vector environment. """
+    obs_scale = {}
     obs_ignore = []
     return {
-        k: torch.tensor(v, dtype=torch.float, device=device).unsqueeze(0)*obs_scale.get(k,1)
+        k: obs_to_tensor(v, device, obs_scale.get(k,1))
         for k,v in obs.items()
         if k not in obs_ignore
     }
@@ -584,6 +660,10 @@ if __name__ == '__main__':
                         help='Number of episodes to test for.')
     parser.add_argument('--warmup-episodes', type=int, default=0,
                         help='')
+    parser.add_argument('--num-envs', type=int, default=1,
+                        help='Number of environments to run in parallel. If greater than 1, the episodes are run on a vector environment with one batched forward pass per step. Rendering and videos are not supported in this case.')
+    parser.add_argument('--sync-vector-env', action='store_true',
+                        help='If set, the vector environment used with `--num-envs` runs the environments in the main process instead of one subprocess per environment.')
     parser.add_argument('--verbose', action='store_true', default=False)
     parser.add_argument('--render', action='store_true', default=False,
                         help='Render the environment during testing. The episode cannot be saved to video if this is enabled.')
@@ -592,10 +672,13 @@ if __name__ == '__main__':
     parser.add_argument('--no-video', action='store_true', default=False,
                         help='Do not save a video of the episode. By default, a video is saved to "test.webm".')
     parser.add_argument('--results', type=str, default=None,
-                        help='Path to a file to save results.')
+                        help='Path to a file to save results. If the file name ends with ".h5", each episode is written to an HDF5 file as soon as it ends (see `big_rl.utils.evaluation.ResultsWriter`), and only the rewards and regrets are kept in memory. Otherwise, all results are saved with `torch.save` at the end.')
     init_parser_model(parser)
     args = parser.parse_args()
 
+    if args.num_envs > 1 and (args.render or not args.no_video):
+        raise ValueError('Rendering and videos are only supported with `--num-envs 1`. Use `--no-video` to run environments in parallel.')
+
     # Create environment
     ENV_CONFIG_PRESETS = env_config_presets()
     env_config = ENV_CONFIG_PRESETS[args.env]
@@ -625,6 +708,15 @@ if __name__ == '__main__':
             device = device,
     )
     model.to(device)
+    if args.fuse_output_modules and hasattr(model, 'fuse_output_modules'):
+        model.fuse_output_modules() # type: ignore
+    if args.fused_recurrent_cell:
+        if not isinstance(getattr(model, 'attention', None), RecurrentAttention16):
+            raise ValueError('`--fused-recurrent-cell` only applies to models with a RecurrentAttention16 core.')
+        model.attention.convert_layer_type(BatchRecurrentAttention16Layer_v3) # type: ignore
+        model.to(device)
+    if args.kv_groups is not None:
+        group_kv_projections_(model, args.kv_groups, method=args.kv_groups_method)
 
     if args.model is not None:
         checkpoint = torch.load(args.model, map_location=device)
@@ -637,6 +729,9 @@ if __name__ == '__main__':
     if 'step' in checkpoint:
         print(f'Checkpoint step: {checkpoint["step"]:,}')
 
+    if args.inference_precision != 'fp32':
+        model = LowPrecisionPolicy(model, args.inference_precision) # type: ignore
+
     # Test model
     video_filename = os.path.abspath(args.video)
     if args.render or args.no_video:
@@ -648,7 +743,25 @@ if __name__ == '__main__':
     #        test3(model, env_config, preprocess_obs, video_callback_fn=video_callback, verbose=args.verbose, metadata={'episode': ep})
     #        for ep in tqdm(range(args.num_episodes))
     #]
-    test_results = test(model, env_config, preprocess_obs, video_callback_fn=video_callback, verbose=args.verbose, num_episodes=args.num_episodes, warmup_episodes=args.warmup_episodes)
+    # Write results to disk as episodes finish
+    results_writer = None
+    if args.results is not None and args.results.endswith('.h5'):
+        results_writer = ResultsWriter(os.path.abspath(args.results))
+
+    def save_episode(episode_number, episode):
+        if results_writer is None:
+            return None
+        results_writer.write_episode(episode, index=episode_number)
+        return episode_summary(episode)
+
+    if args.num_envs > 1:
+        VectorEnv = gymnasium.vector.SyncVectorEnv if args.sync_vector_env else gymnasium.vector.AsyncVectorEnv
+        test_env = VectorEnv([lambda: make_env(**env_config) for _ in range(args.num_envs)]) # type: ignore
+        # Attention and hidden states are only needed if the results are saved
+        test_results = test_batched(model, test_env, preprocess_obs_batched, num_episodes=args.num_episodes, warmup_episodes=args.warmup_episodes, record_details=args.results is not None, episode_fn=save_episode, verbose=True)
+        test_env.close()
+    else:
+        test_results = test(model, env_config, preprocess_obs, video_callback_fn=video_callback, verbose=args.verbose, num_episodes=args.num_episodes, warmup_episodes=args.warmup_episodes, episode_fn=save_episode)
 
     if video_callback is not None:
         video_callback.close()
@@ -669,5 +782,8 @@ if __name__ == '__main__':
 
     if args.results is not None:
         results_filename = os.path.abspath(args.results)
-        torch.save(test_results, results_filename)
+        if results_writer is not None:
+            results_writer.close()
+        else:
+            torch.save(test_results, results_filename)
         print(f'Results saved to {results_filename}')
@@ -1,7 +1,9 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import os
 import itertools
 from typing import Optional, Generator, Dict, List, Any, Callable, Union, Tuple
+import threading
 import time
 
 import gymnasium
@@ -19,7 +21,13 @@ from frankenstein.advantage.gae import generalized_advantage_estimate
 from frankenstein.loss.policy_gradient import clipped_advantage_policy_gradient_loss
 
 from big_rl.mujoco.envs import make_env
-from big_rl.utils import torch_save, zip2, merge_space, generate_id
+from big_rl.model.model import set_introspection, group_kv_projections_
+from big_rl.model.low_precision import LowPrecisionPolicy
+from big_rl.model.recurrent_attention_16 import RecurrentAttention16, BatchRecurrentAttention16Layer_v3
+from big_rl.utils import torch_save, zip2, merge_space, generate_id, recurrent_minibatch_indices, ObservationBuffer, DoubleBufferedVectorEnv, zip_concurrent, ConcatVecHistory, grads_are_finite, obs_to_tensor
+from big_rl.utils.actor_learner import train_actor_learner
+from big_rl.utils.profiler import PhaseTimer
+from big_rl.utils.metrics import AsyncMetricLogger
 from big_rl.mujoco.common import init_model, env_config_presets
 
 
@@ -34,11 +42,34 @@ def compute_ppo_losses(
         entropy_loss_coeff : float,
         vf_loss_coeff : float,
         target_kl : Optional[float],
-        num_epochs : int) -> Generator[Dict[str,Union[torch.Tensor,Tuple[torch.Tensor,...]]],None,None]:
+        num_epochs : int,
+        recompute_old_outputs : bool = False,
+        num_minibatches : int = 1,
+        bptt_length : Optional[int] = None,
+        shuffle_minibatches : bool = False,
+        observations : Optional[Dict[str,torch.Tensor]] = None,
+        env_groups : Optional[List[slice]] = None,
+        timer : Optional[PhaseTimer] = None,
+        timer_group : Optional[str] = None) -> Generator[Dict[str,Union[torch.Tensor,Tuple[torch.Tensor,...]]],None,None]:
     """
     Compute the losses for PPO.
+
+    Args:
+        recompute_old_outputs: If True, the model is run over the entire rollout to obtain the state values and action log probabilities under the policy that generated the data. If False, the outputs saved in the history buffer's misc channel during the rollout are used instead (see `train_single_env`). Both give the same values when the rollout was collected by the model itself, since the model parameters do not change between collecting the rollout and computing the losses. This is not the case if the actions were selected by a reduced precision copy of the model, which is why `train_single_env` always recomputes the outputs when `inference_precision` isn't 'fp32'.
+        num_minibatches: Number of groups to split the environments into. One set of losses is yielded for each minibatch, so the model is updated `num_minibatches` times per epoch (or more if `bptt_length` is set).
+        bptt_length: Number of time steps to backpropagate through. The rollout is split into chunks of this length, and each chunk starts from the hidden state saved during the rollout. If `None`, the whole rollout is used. The `loss` of the last chunk, which can be shorter, is scaled by its length relative to a full chunk so that every time step has the same weight. The other values are unscaled means, for logging.
+        shuffle_minibatches: If True, the minibatches are processed in a random order. Otherwise, the chunks of each group of environments are processed in temporal order.
+        observations: Observations of the rollout as a dictionary of tensors of shape `(n, num_envs, ...)`, already preprocessed (see `ObservationBuffer`). If provided, these are used instead of the observations in `history`, and `preprocess_input_fn` is not applied to them.
+        env_groups: If the rollout contains environments from multiple tasks, the slice of environments belonging to each task. The advantages are normalized and the losses are computed separately for each group, and returned under the `group_losses` key. The top-level losses are the average over all groups.
+        timer: If provided, the time spent recomputing the rollout outputs and advantages (`replay`) and the time spent computing the losses (`forward`) are recorded under `timer_group`.
     """
-    obs = history.obs
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+    if observations is not None:
+        obs = observations
+        preprocess_input_fn = None
+    else:
+        obs = history.obs
     action = history.action
     reward = history.reward
     terminal = history.terminal
@@ -48,28 +79,41 @@ def compute_ppo_losses(
 
     n = len(history.obs_history)
     num_training_envs = len(reward[0])
-    initial_hidden = model.init_hidden(num_training_envs) # type: ignore
-
-    with torch.no_grad():
-        net_output = []
-        curr_hidden = tuple([h[0].detach() for h in hidden])
-        for o,term in zip2(obs,terminal):
-            curr_hidden = tuple([
-                torch.where(term.unsqueeze(1), init_h, h)
-                for init_h,h in zip(initial_hidden,curr_hidden)
-            ])
-            o = preprocess_input_fn(o) if preprocess_input_fn is not None else o
-            no = model(o,curr_hidden)
-            curr_hidden = no['hidden']
-            net_output.append(no)
-        net_output = default_collate(net_output)
-        state_values_old = net_output['value'].squeeze(2)
-        #action_dist = torch.distributions.Categorical(logits=net_output['action'][:n-1])
-        #log_action_probs_old = action_dist.log_prob(action)
-        action_mean = net_output['action_mean'][:n-1]
-        action_logstd = net_output['action_logstd'][:n-1]
-        action_dist = torch.distributions.Normal(action_mean, action_logstd.exp())
-        log_action_probs_old = action_dist.log_prob(action).sum(-1)
+
+    if env_groups is None:
+        groups = [slice(None)]
+    elif num_minibatches > 1:
+        raise ValueError('Losses can only be computed separately for each group of environments if the environments are not split into minibatches.')
+    else:
+        groups = env_groups
+
+    with timer.time('replay', timer_group), torch.no_grad():
+        if recompute_old_outputs:
+            curr_hidden = tuple([h[0].detach() for h in hidden])
+            if hasattr(model, 'forward_sequence'):
+                # Encode the observations of all time steps at once
+                o = preprocess_input_fn(obs) if preprocess_input_fn is not None else obs
+                net_output = model.forward_sequence(o, curr_hidden, terminal) # type: ignore
+            else:
+                net_output = []
+                for o,term in zip2(obs,terminal):
+                    curr_hidden = model.reset_hidden_(curr_hidden, term) # type: ignore
+                    o = preprocess_input_fn(o) if preprocess_input_fn is not None else o
+                    no = model(o,curr_hidden)
+                    curr_hidden = no['hidden']
+                    net_output.append(no)
+                net_output = default_collate(net_output)
+            state_values_old = net_output['value'].squeeze(2)
+            #action_dist = torch.distributions.Categorical(logits=net_output['action'][:n-1])
+            #log_action_probs_old = action_dist.log_prob(action)
+            action_mean = net_output['action_mean'][:n-1]
+            action_logstd = net_output['action_logstd'][:n-1]
+            action_dist = torch.distributions.Normal(action_mean, action_logstd.exp())
+            log_action_probs_old = action_dist.log_prob(action).sum(-1)
+        else:
+            assert 'output' in misc, 'Rollout outputs were not saved. Set `recompute_old_outputs=True` to compute them here instead.'
+            state_values_old = misc['output']['value'].squeeze(2)
+            log_action_probs_old = misc['log_action_prob'][:n-1]
 
         # Advantage
         advantages = generalized_advantage_estimate(
@@ -83,82 +127,141 @@ def compute_ppo_losses(
         returns = advantages + state_values_old[:n-1,:]
 
         if norm_adv:
-            advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+            for group in groups:
+                advantages[:,group] = (advantages[:,group] - advantages[:,group].mean()) / (advantages[:,group].std() + 1e-8)
 
+    num_steps = n-1 # Number of transitions in the rollout
+    chunk_length = min(bptt_length, num_steps) if bptt_length is not None else num_steps
     for _ in range(num_epochs):
-        net_output = []
-        curr_hidden = tuple([h[0].detach() for h in hidden])
-        initial_hidden = model.init_hidden(num_training_envs) # type: ignore
-        for o,term in zip2(obs,terminal):
-            curr_hidden = tuple([
-                torch.where(term.unsqueeze(1), init_h, h)
-                for init_h,h in zip(initial_hidden,curr_hidden)
-            ])
-            o = preprocess_input_fn(o) if preprocess_input_fn is not None else o
-            no = model(o,curr_hidden)
-            curr_hidden = no['hidden']
-            net_output.append(no)
-        net_output = default_collate(net_output)
-
-        assert 'value' in net_output
-        assert 'action_mean' in net_output
-        assert 'action_logstd' in net_output
-        state_values = net_output['value'].squeeze()
-        #action_dist = torch.distributions.Categorical(logits=net_output['action'][:n-1])
-        #log_action_probs = action_dist.log_prob(action)
-        action_mean = net_output['action_mean'][:n-1]
-        action_logstd = net_output['action_logstd'][:n-1]
-        action_dist = torch.distributions.Normal(action_mean, action_logstd.exp())
-        log_action_probs = action_dist.log_prob(action).sum(-1)
-
-        entropy = action_dist.entropy()
+        approx_kls = []
+        # Hidden state after the last observation. Filled in by the minibatches that cover the end of the rollout, and only yielded once all environments are filled in.
+        final_hidden = tuple(h[n-1].detach().clone() for h in hidden)
+        final_hidden_done = torch.zeros(num_training_envs, dtype=torch.bool)
+        for env_idx, t0, t1 in recurrent_minibatch_indices(
+                num_envs = num_training_envs,
+                num_steps = num_steps,
+                num_minibatches = num_minibatches,
+                bptt_length = bptt_length,
+                shuffle = shuffle_minibatches):
+            # The chunk at the end of the rollout also runs through the last observation so that the final hidden state can be recovered
+            t_end = n if t1 == num_steps else t1
+            with timer.time('forward', timer_group):
+                curr_hidden = tuple([h[t0][...,env_idx,:].detach() for h in hidden])
+                if hasattr(model, 'forward_sequence'):
+                    # Encode the observations of all time steps at once
+                    o = {k: v[t0:t_end][:,env_idx] for k,v in obs.items()}
+                    o = preprocess_input_fn(o) if preprocess_input_fn is not None else o
+                    net_output = model.forward_sequence(o, curr_hidden, terminal[t0:t_end,env_idx]) # type: ignore
+                    curr_hidden = net_output['hidden']
+                else:
+                    net_output = []
+                    initial_hidden = model.initial_hidden() # type: ignore
+                    for t in range(t0, t_end):
+                        term = terminal[t,env_idx]
+                        curr_hidden = model.reset_hidden_(curr_hidden, term, initial_hidden) # type: ignore
+                        o = {k: v[t][env_idx] for k,v in obs.items()}
+                        o = preprocess_input_fn(o) if preprocess_input_fn is not None else o
+                        no = model(o,curr_hidden)
+                        curr_hidden = no['hidden']
+                        net_output.append(no)
+                    net_output = default_collate(net_output)
+                if t_end == n:
+                    for fh,h in zip(final_hidden, curr_hidden):
+                        fh[...,env_idx,:] = h.detach()
+                    final_hidden_done[env_idx] = True
+
+                assert 'value' in net_output
+                assert 'action_mean' in net_output
+                assert 'action_logstd' in net_output
+                state_values = net_output['value'][:t1-t0].squeeze(2)
+                action_mean = net_output['action_mean'][:t1-t0]
+                action_logstd = net_output['action_logstd'][:t1-t0]
+                action_dist = torch.distributions.Normal(action_mean, action_logstd.exp())
+                log_action_probs = action_dist.log_prob(action[t0:t1,env_idx]).sum(-1)
+
+                entropy = action_dist.entropy()
+
+                group_losses = []
+                for group in groups:
+                    mb_log_action_probs = log_action_probs[:,group]
+                    mb_log_action_probs_old = log_action_probs_old[t0:t1,env_idx][:,group]
+                    mb_state_values = state_values[:,group]
+                    mb_state_values_old = state_values_old[t0:t1,env_idx][:,group]
+                    mb_advantages = advantages[t0:t1,env_idx][:,group]
+                    mb_returns = returns[t0:t1,env_idx][:,group]
+                    mb_terminal = terminal[t0:t1,env_idx][:,group]
+
+                    with torch.no_grad():
+                        logratio = mb_log_action_probs - mb_log_action_probs_old
+                        ratio = logratio.exp()
+                        approx_kl = ((ratio - 1) - logratio).mean()
+
+                    # Policy loss
+                    pg_loss = clipped_advantage_policy_gradient_loss(
+                            log_action_probs = mb_log_action_probs,
+                            old_log_action_probs = mb_log_action_probs_old,
+                            advantages = mb_advantages,
+                            terminals = mb_terminal,
+                            epsilon=0.1
+                    ).mean()
+
+                    # Value loss
+                    if clip_vf_loss is not None:
+                        v_loss_unclipped = (mb_state_values - mb_returns) ** 2
+                        v_clipped = mb_state_values_old + torch.clamp(
+                            mb_state_values - mb_state_values_old,
+                            -clip_vf_loss,
+                            clip_vf_loss,
+                        )
+                        v_loss_clipped = (v_clipped - mb_returns) ** 2
+                        v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
+                        v_loss = 0.5 * v_loss_max.mean()
+                    else:
+                        v_loss = 0.5 * ((mb_state_values - mb_returns) ** 2).mean()
+
+                    entropy_loss = entropy[:,group].mean()
+                    loss = pg_loss - entropy_loss_coeff * entropy_loss + v_loss * vf_loss_coeff
+                    loss = loss * ((t1 - t0) / chunk_length)
+
+                    group_losses.append({
+                            'loss': loss,
+                            'loss_pi': pg_loss,
+                            'loss_vf': v_loss,
+                            'loss_entropy': -entropy_loss,
+                            'approx_kl': approx_kl,
+                    })
+
+                # Average over groups. If there is only one group, this is the same as the group's losses.
+                mean_losses = {
+                    k: torch.stack([x[k] for x in group_losses]).mean()
+                    for k in group_losses[0].keys()
+                }
+            approx_kls.append(mean_losses['approx_kl'])
 
-        with torch.no_grad():
-            logratio = log_action_probs - log_action_probs_old
-            ratio = logratio.exp()
-            approx_kl = ((ratio - 1) - logratio).mean()
-
-        # Policy loss
-        pg_loss = clipped_advantage_policy_gradient_loss(
-                log_action_probs = log_action_probs,
-                old_log_action_probs = log_action_probs_old,
-                advantages = advantages,
-                terminals = terminal[:n-1],
-                epsilon=0.1
-        ).mean()
-
-        # Value loss
-        if clip_vf_loss is not None:
-            v_loss_unclipped = (state_values[:n-1] - returns) ** 2
-            v_clipped = state_values_old[:n-1] + torch.clamp(
-                state_values[:n-1] - state_values_old[:n-1],
-                -clip_vf_loss,
-                clip_vf_loss,
-            )
-            v_loss_clipped = (v_clipped - returns) ** 2
-            v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-            v_loss = 0.5 * v_loss_max.mean()
-        else:
-            v_loss = 0.5 * ((state_values[:n-1] - returns) ** 2).mean()
-
-        entropy_loss = entropy.mean()
-        loss = pg_loss - entropy_loss_coeff * entropy_loss + v_loss * vf_loss_coeff
-
-        yield {
-                'loss': loss,
-                'loss_pi': pg_loss,
-                'loss_vf': v_loss,
-                'loss_entropy': -entropy_loss,
-                'approx_kl': approx_kl,
-                'output': net_output,
-                'hidden': tuple(h.detach() for h in curr_hidden),
-        }
+            yield {
+                    **mean_losses,
+                    'group_losses': group_losses,
+                    'output': net_output,
+                    'hidden': final_hidden if bool(final_hidden_done.all()) else None,
+            }
 
         if target_kl is not None:
-            if approx_kl > target_kl:
+            if torch.stack(approx_kls).mean() > target_kl:
                 break
 
 
+def _concat_actor_outputs(outputs: List[Tuple[Dict[str,Any],torch.Tensor]]) -> Tuple[Dict[str,Any],torch.Tensor]:
+    """ Concatenate the model outputs and actions computed separately on each half of a `DoubleBufferedVectorEnv`. """
+    model_outputs, actions = zip(*outputs)
+    output = {}
+    for k,v in model_outputs[0].items():
+        if k == 'hidden':
+            output[k] = tuple(torch.cat(h, dim=-2) for h in zip(*[o[k] for o in model_outputs]))
+        elif isinstance(v, torch.Tensor):
+            output[k] = torch.cat([o[k] for o in model_outputs])
+    return output, torch.cat(actions)
+
+
 def train_single_env(
         global_step_counter: List[int],
         model: torch.nn.Module,
@@ -178,7 +281,17 @@ def train_single_env(
         norm_adv: bool = True,
         warmup_steps: int = 0,
         update_hidden_after_grad: bool = False,
-        ) -> Generator[Dict[str, Any], None, None]:
+        recompute_old_outputs: bool = False,
+        num_minibatches: int = 1,
+        bptt_length: Optional[int] = None,
+        shuffle_minibatches: bool = False,
+        yield_rollouts: bool = False,
+        inference_precision: str = 'fp32',
+        timer: Optional[PhaseTimer] = None,
+        timer_group: Optional[str] = None,
+        metric_logger: Optional[AsyncMetricLogger] = None,
+        step_lock: Optional[threading.Lock] = None,
+        ) -> Generator[Dict[str, Any], Optional[Dict[str, Any]], None]:
     """
     Train a model with PPO on an Atari game.
 
@@ -189,9 +302,24 @@ def train_single_env(
 
     Args:
         model: ...
-        env: `gym.vector.VectorEnv`
+        env: `gym.vector.VectorEnv`. If it is a `DoubleBufferedVectorEnv`, then the policy is run on one half of the environments while the other half is stepping.
+        recompute_old_outputs: If False, the model outputs and action log probabilities computed while collecting the rollout are saved to the history buffer's misc channel and reused when computing the PPO losses. If True, they are discarded and recomputed by `compute_ppo_losses`. Always True if `inference_precision` isn't 'fp32', since the outputs of the reduced precision copy differ from those of the model being trained.
+        yield_rollouts: If True, the losses are not computed here. Instead, each rollout is yielded (the history buffer, the preprocessed observations and logging data) and the caller is expected to train on it, then send back the last set of losses it computed (or None) so that the hidden state can be updated if `update_hidden_after_grad` is set. This is used to train on the rollouts of multiple environments at once (see `train`).
+        inference_precision: Precision of the model used to select actions (see `LowPrecisionPolicy`). The model is trained in full precision, and the reduced precision copy is refreshed before each rollout. The state values and action log probabilities used for the PPO losses are recomputed in full precision (see `recompute_old_outputs`), but the hidden states that the BPTT chunks start from are the ones computed by the copy.
+        timer: If provided, the time spent in each phase of the rollout (`inference`, `env_step`, `storage`, `episode_end`) and of the loss computation is recorded under `timer_group`, as well as the time spent compiling the model (`compile`) if it is compiled and refreshing the reduced precision copy of the model (`refresh`) if there is one.
+        metric_logger: Logger used for all W&B logging. If not provided, metrics are logged to W&B immediately.
+        step_lock: Lock held while updating `global_step_counter` and while logging metrics at the current step. Generators that run in different threads (see `train`) must share the same lock, so that no step updates are lost and the logged steps never go backwards.
     """
     num_envs = env.num_envs
+    if inference_precision != 'fp32':
+        # The outputs of the reduced precision copy would bias the advantages and the PPO ratio
+        recompute_old_outputs = True
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+    if metric_logger is None:
+        metric_logger = AsyncMetricLogger(flush_interval=0)
+    if step_lock is None:
+        step_lock = threading.Lock()
 
     env_label_to_id = {label: i for i,label in enumerate(set(env_labels))}
     env_ids = np.array([env_label_to_id[label] for label in env_labels])
@@ -200,7 +328,7 @@ def train_single_env(
 
     def preprocess_input(obs: Dict[str, Any]) -> Dict[str, torch.Tensor]:
         return {
-            k: torch.tensor(v, device=device, dtype=torch.float)*obs_scale.get(k,1)
+            k: obs_to_tensor(v, device, obs_scale.get(k,1))
             for k,v in obs.items() if k not in obs_ignore
         }
 
@@ -208,14 +336,27 @@ def train_single_env(
             num_envs = num_envs,
             max_len=rollout_length+1,
             device=device)
+    obs_buffer = ObservationBuffer(
+            num_envs = num_envs,
+            max_len = rollout_length+1,
+            device = device,
+            scale = obs_scale,
+            ignore = obs_ignore)
     log = {}
 
+    actor = model if inference_precision == 'fp32' else LowPrecisionPolicy(model, inference_precision)
+
     obs, info = env.reset(seed=0)
     hidden = model.init_hidden(num_envs) # type: ignore (???)
     history.append_obs(
             {k:v for k,v in obs.items() if k not in obs_ignore},
             misc = {'hidden': hidden},
     )
+    obs_buffer.reset(obs)
+    if getattr(model, 'static_forward_enabled', False):
+        # Compile the forward pass before the first rollout so that the compilation time isn't counted as inference time
+        with timer.time('compile', timer_group):
+            model.warmup_static_forward(obs_buffer[-1], hidden, seq_len=rollout_length) # type: ignore
     #episode_true_reward = np.zeros(num_envs) # Actual reward we want to optimize before any modifications (e.g. clipping)
     episode_reward = np.zeros(num_envs) # Reward presented to the learning algorithm
     episode_steps = np.zeros(num_envs)
@@ -231,11 +372,7 @@ def train_single_env(
     for _ in range(warmup_steps):
         # Select action
         with torch.no_grad():
-            model_output = model({
-                k: torch.tensor(v, dtype=torch.float, device=device)*obs_scale.get(k,1)
-                for k,v in obs.items()
-                if k not in obs_ignore
-            }, hidden)
+            model_output = actor(obs_buffer[-1], hidden)
             hidden = model_output['hidden']
 
             #action_probs = model_output['action'].softmax(1)
@@ -248,6 +385,7 @@ def train_single_env(
         # Step environment
         obs, reward, terminated, truncated, info = env.step(action) # type: ignore
         done = terminated | truncated
+        obs_buffer.reset(obs)
 
         episode_reward += reward
         #episode_true_reward += info.get('reward', reward)
@@ -255,10 +393,7 @@ def train_single_env(
 
         if done.any():
             # Reset hidden state for finished episodes
-            hidden = tuple(
-                    torch.where(torch.tensor(done, device=device).unsqueeze(1), h0, h)
-                    for h0,h in zip(model.init_hidden(num_envs), hidden) # type: ignore (???)
-            )
+            hidden = model.reset_hidden_(hidden, done) # type: ignore
             # Print stats
             for env_label, env_id in env_label_to_id.items():
                 done2 = done & (env_ids == env_id)
@@ -289,33 +424,57 @@ def train_single_env(
             steps_mean = np.mean(warmup_episode_steps[env_label])
             # TODO: handle case where there are no completed episodes during warmup?
             if wandb.run is not None:
-                data = {
-                    f'reward/{env_label}': reward_mean,
-                    f'episode_length/{env_label}': steps_mean,
-                    'step': global_step_counter[0]-global_step_counter[1],
-                    'step_total': global_step_counter[0],
-                }
-                for k,v in warmup_episode_env_data[env_label].items():
-                    data[f'env/{env_label}/{k}'] = np.mean(v)
-                wandb.log(data, step = global_step_counter[0])
+                with step_lock:
+                    data = {
+                        f'reward/{env_label}': reward_mean,
+                        f'episode_length/{env_label}': steps_mean,
+                        'step': global_step_counter[0]-global_step_counter[1],
+                        'step_total': global_step_counter[0],
+                    }
+                    for k,v in warmup_episode_env_data[env_label].items():
+                        data[f'env/{env_label}/{k}'] = np.mean(v)
+                    metric_logger.log(data, step = global_step_counter[0])
             print(f'\t{env_label}\treward: {reward_mean:.2f} +/- {reward_std:.2f}\t len: {steps_mean:.2f}')
 
     ##################################################
     # Start training
+
+    # If the environments are double-buffered, then the actions for the next step are computed on one half of the environments while the other half is stepping.
+    # The actions are always computed from the latest observation and hidden state of each environment, so this doesn't change the data that is collected.
+    double_buffered = isinstance(env, DoubleBufferedVectorEnv)
+    next_actions = []
+    def act(env_idx: slice, obs: Dict[str,np.ndarray], done: np.ndarray) -> np.ndarray:
+        with timer.time('inference', timer_group), torch.no_grad():
+            curr_hidden = model.reset_hidden_(tuple(h[...,env_idx,:] for h in hidden), done) # type: ignore
+            model_output = actor(obs_buffer.write_next(obs, env_idx), curr_hidden)
+            action_mean = model_output['action_mean']
+            action_logstd = model_output['action_logstd']
+            action_dist = torch.distributions.Normal(action_mean, action_logstd.exp())
+            action_tensor = action_dist.sample()
+        next_actions.append((model_output, action_tensor))
+        return action_tensor.cpu().numpy()
+
     for step in itertools.count():
+        if inference_precision != 'fp32':
+            with timer.time('refresh', timer_group):
+                actor.refresh() # type: ignore
+
         # Gather data
         state_values = [] # For logging purposes
         entropies = [] # For logging purposes
-        for _ in range(rollout_length):
-            global_step_counter[0] += num_envs
+        for t in range(rollout_length):
+            with step_lock:
+                global_step_counter[0] += num_envs
 
             # Select action
-            with torch.no_grad():
-                model_output = model({
-                    k: torch.tensor(v, dtype=torch.float, device=device)*obs_scale.get(k,1)
-                    for k,v in obs.items()
-                    if k not in obs_ignore
-                }, hidden)
+            with timer.time('inference', timer_group), torch.no_grad():
+                if len(next_actions) == 0:
+                    model_output = actor(obs_buffer[-1], hidden)
+                    action_tensor = None
+                else:
+                    # Already computed while the environments were stepping
+                    model_output, action_tensor = _concat_actor_outputs(next_actions)
+                    next_actions = []
                 hidden = model_output['hidden']
 
                 #action_probs = model_output['action'].softmax(1)
@@ -323,109 +482,221 @@ def train_single_env(
                 action_mean = model_output['action_mean']
                 action_logstd = model_output['action_logstd']
                 action_dist = torch.distributions.Normal(action_mean, action_logstd.exp())
-                action = action_dist.sample().cpu().numpy()
+                if action_tensor is None:
+                    action_tensor = action_dist.sample()
+                action = action_tensor.cpu().numpy()
 
                 state_values.append(model_output['value'])
                 entropies.append(action_dist.entropy())
 
+                if not recompute_old_outputs:
+                    # Save the outputs alongside the observation they were computed from so that `compute_ppo_losses` doesn't need to recompute them
+                    history.misc_history[-1]['output'] = {
+                        'value': model_output['value'],
+                        'action_mean': model_output['action_mean'],
+                        'action_logstd': model_output['action_logstd'],
+                    }
+                    history.misc_history[-1]['log_action_prob'] = action_dist.log_prob(action_tensor).sum(-1)
+
             # Step environment
-            obs, reward, terminated, truncated, info = env.step(action) # type: ignore
+            # With double-buffering, this includes the time spent computing the next actions (also recorded under `inference`)
+            with timer.time('env_step', timer_group):
+                if double_buffered:
+                    if t == 0:
+                        env.step_async(action) # type: ignore
+                    # Otherwise, the step was already started by `act`. The actions for the first step of the next rollout are computed after the update.
+                    obs, reward, terminated, truncated, info = env.step_wait(act if t < rollout_length-1 else None) # type: ignore
+                else:
+                    obs, reward, terminated, truncated, info = env.step(action) # type: ignore
             done = terminated | truncated
 
-            history.append_action(action)
-            episode_reward += reward
-            #breakpoint()
-            #episode_true_reward += info.get('reward', reward)
-            episode_steps += 1
+            with timer.time('storage', timer_group):
+                history.append_action(action)
+                episode_reward += reward
+                #breakpoint()
+                #episode_true_reward += info.get('reward', reward)
+                episode_steps += 1
 
-            history.append_obs(
-                    {k:v for k,v in obs.items() if k not in obs_ignore}, reward, done,
-                    misc = {'hidden': hidden}
-            )
-
-            if done.any():
-                print(f'Episode finished ({step * num_envs * rollout_length:,} -- {global_step_counter[0]:,})')
-                for env_label, env_id in env_label_to_id.items():
-                    done2 = done & (env_ids == env_id)
-                    if not done2.any():
-                        continue
-                    episode_true_reward = np.array([x['episode']['r'] for x,d in zip(info['final_info'],done2) if d and x is not None])
-                    if wandb.run is not None:
-                        data = {
-                                f'reward/{env_label}': episode_reward[done2].mean().item(),
-                                f'true_reward/{env_label}': episode_true_reward.mean().item(),
-                                f'episode_length/{env_label}': episode_steps[done2].mean().item(),
-                                'step': global_step_counter[0]-global_step_counter[1],
-                                'step_total': global_step_counter[0],
-                        }
-                        if 'wandb_episode_end' in info['final_info'][done2][0]:
-                            wandb_keys = info['final_info'][done2][0]['wandb_episode_end'].keys()
-                            for k in wandb_keys:
-                                data[f'env/{env_label}/{k}'] = np.mean([fi['wandb_episode_end'][k] for fi in info['final_info'][done2]])
-                        wandb.log(data, step = global_step_counter[0])
-                    print(f'  reward: {episode_reward[done].mean():.2f} \t True reward: {episode_true_reward.mean():.2f}\t len: {episode_steps[done].mean()} \t env: {env_label} ({done2.sum().item()})')
-                # Reset hidden state for finished episodes
-                hidden = tuple(
-                        torch.where(torch.tensor(done, device=device).unsqueeze(1), h0, h)
-                        for h0,h in zip(model.init_hidden(num_envs), hidden) # type: ignore (???)
+                history.append_obs(
+                        {k:v for k,v in obs.items() if k not in obs_ignore}, reward, done,
+                        misc = {'hidden': hidden}
                 )
-                # Reset episode stats
-                episode_reward[done] = 0
-                #episode_true_reward[done] = 0
-                episode_steps[done] = 0
-
-        if type(model).__name__ == 'ModularPolicy5':
-            assert isinstance(model.last_attention, list)
-            assert isinstance(model.last_input_labels, list)
-            assert isinstance(model.last_output_attention, dict)
+                obs_buffer.append(None if len(next_actions) > 0 else obs)
+
+            with timer.time('episode_end', timer_group):
+                if done.any():
+                    print(f'Episode finished ({step * num_envs * rollout_length:,} -- {global_step_counter[0]:,})')
+                    for env_label, env_id in env_label_to_id.items():
+                        done2 = done & (env_ids == env_id)
+                        if not done2.any():
+                            continue
+                        episode_true_reward = np.array([x['episode']['r'] for x,d in zip(info['final_info'],done2) if d and x is not None])
+                        if wandb.run is not None:
+                            with step_lock:
+                                data = {
+                                        f'reward/{env_label}': episode_reward[done2].mean().item(),
+                                        f'true_reward/{env_label}': episode_true_reward.mean().item(),
+                                        f'episode_length/{env_label}': episode_steps[done2].mean().item(),
+                                        'step': global_step_counter[0]-global_step_counter[1],
+                                        'step_total': global_step_counter[0],
+                                }
+                                if 'wandb_episode_end' in info['final_info'][done2][0]:
+                                    wandb_keys = info['final_info'][done2][0]['wandb_episode_end'].keys()
+                                    for k in wandb_keys:
+                                        data[f'env/{env_label}/{k}'] = np.mean([fi['wandb_episode_end'][k] for fi in info['final_info'][done2]])
+                                metric_logger.log(data, step = global_step_counter[0])
+                        print(f'  reward: {episode_reward[done].mean():.2f} \t True reward: {episode_true_reward.mean():.2f}\t len: {episode_steps[done].mean()} \t env: {env_label} ({done2.sum().item()})')
+                    # Reset hidden state for finished episodes
+                    hidden = model.reset_hidden_(hidden, done) # type: ignore
+                    # Reset episode stats
+                    episode_reward[done] = 0
+                    #episode_true_reward[done] = 0
+                    episode_steps[done] = 0
+
+        if not recompute_old_outputs:
+            # The last observation has no action taken from it yet, but its state value is needed for bootstrapping.
+            # The hidden state is not updated here. The next rollout will run the model on this observation again with the updated parameters.
+            with timer.time('inference', timer_group), torch.no_grad():
+                model_output = actor(obs_buffer[-1], hidden)
+                history.misc_history[-1]['output'] = {
+                    'value': model_output['value'],
+                    'action_mean': model_output['action_mean'],
+                    'action_logstd': model_output['action_logstd'],
+                }
+                history.misc_history[-1]['log_action_prob'] = torch.zeros(num_envs, device=device)
+
+        if type(model).__name__ == 'ModularPolicy5' and model.introspect: # type: ignore
+            assert isinstance(actor.last_attention, list)
+            assert isinstance(actor.last_input_labels, list)
+            assert isinstance(actor.last_output_attention, dict)
             log['attention max'] = {
-                label: max([a.max().item() for a in attn])
+                label: torch.stack([a.max().to(device) for a in attn]).max()
                 for label, attn in
-                zip(model.last_input_labels,
+                zip(actor.last_input_labels,
                     zip(
-                        model.last_attention[0].split(1,dim=2),
-                        model.last_output_attention['action_mean'].split(1,dim=1), # type: ignore (???)
-                        model.last_output_attention['action_logstd'].split(1,dim=1), # type: ignore (???)
-                        model.last_output_attention['value'].split(1,dim=1), # type: ignore (???)
+                        actor.last_attention[0].split(1,dim=2),
+                        actor.last_output_attention['action_mean'].split(1,dim=1), # type: ignore (???)
+                        actor.last_output_attention['action_logstd'].split(1,dim=1), # type: ignore (???)
+                        actor.last_output_attention['value'].split(1,dim=1), # type: ignore (???)
                     )
                 )
             }
 
         # Train
-        losses = compute_ppo_losses(
-                history = history,
-                model = model,
-                preprocess_input_fn = preprocess_input,
-                discount = discount,
-                gae_lambda = gae_lambda,
-                norm_adv = norm_adv,
-                clip_vf_loss = clip_vf_loss,
-                vf_loss_coeff = vf_loss_coeff,
-                entropy_loss_coeff = entropy_loss_coeff,
-                target_kl = target_kl,
-                num_epochs = num_epochs,
-        )
-        x = None
-        for x in losses:
+        if yield_rollouts:
+            # The losses are computed by the caller, which sends back the last set of losses when it is done
             log['state_value'] = torch.stack(state_values)
             log['entropy'] = torch.stack(entropies)
-
-            yield {
+            x = yield {
+                'history': history,
+                'observations': obs_buffer.obs,
                 'log': log,
-                **x
             }
-
             log = {}
+        else:
+            losses = compute_ppo_losses(
+                    history = history,
+                    model = model,
+                    preprocess_input_fn = preprocess_input,
+                    discount = discount,
+                    gae_lambda = gae_lambda,
+                    norm_adv = norm_adv,
+                    clip_vf_loss = clip_vf_loss,
+                    vf_loss_coeff = vf_loss_coeff,
+                    entropy_loss_coeff = entropy_loss_coeff,
+                    target_kl = target_kl,
+                    num_epochs = num_epochs,
+                    recompute_old_outputs = recompute_old_outputs,
+                    num_minibatches = num_minibatches,
+                    bptt_length = bptt_length,
+                    shuffle_minibatches = shuffle_minibatches,
+                    observations = obs_buffer.obs,
+                    timer = timer,
+                    timer_group = timer_group,
+            )
+            x = None
+            for x in losses:
+                log['state_value'] = torch.stack(state_values)
+                log['entropy'] = torch.stack(entropies)
+
+                yield {
+                    'log': log,
+                    **x
+                }
+
+                log = {}
 
         # Clear data
         history.clear()
+        obs_buffer.clear()
 
         # Update hidden state
-        if x is not None and update_hidden_after_grad:
+        if x is not None and x['hidden'] is not None and update_hidden_after_grad:
             history.misc_history[-1]['hidden'] = x['hidden']
             hidden = x['hidden']
 
 
+def fused_group_losses(
+        trainers: List[Generator[Dict[str, Any], Optional[Dict[str, Any]], None]],
+        model: torch.nn.Module,
+        concurrent_rollouts: bool = False,
+        **kwargs) -> Generator[Tuple[Dict[str, Any], ...], None, None]:
+    """
+    Compute the PPO losses of all task groups together. The rollouts of all groups are concatenated along the batch dimension, so the model only needs to be run once per time step instead of once per group per time step.
+
+    Args:
+        trainers: Generators returned by `train_single_env` with `yield_rollouts=True`.
+        concurrent_rollouts: If True, the rollouts of all groups are collected concurrently.
+        kwargs: Passed to `compute_ppo_losses`.
+
+    Yields:
+        A tuple with the losses of each group, in the same format as what `train_single_env` yields.
+    """
+    results = [None for _ in trainers]
+    executor = ThreadPoolExecutor(max_workers=len(trainers)) if concurrent_rollouts else None
+    try:
+        while True:
+            # Collect rollouts
+            if executor is not None:
+                rollouts = list(executor.map(lambda tr: tr[0].send(tr[1]), zip(trainers, results)))
+            else:
+                rollouts = [t.send(r) for t,r in zip(trainers, results)]
+
+            num_envs = [len(r['history'].reward[0]) for r in rollouts]
+            env_groups = [slice(sum(num_envs[:i]), sum(num_envs[:i+1])) for i in range(len(num_envs))]
+
+            # Train on all rollouts at once
+            losses = compute_ppo_losses(
+                    history = ConcatVecHistory([r['history'] for r in rollouts]), # type: ignore
+                    model = model,
+                    preprocess_input_fn = None,
+                    observations = {
+                        k: torch.cat([r['observations'][k] for r in rollouts], dim=1)
+                        for k in rollouts[0]['observations'].keys()
+                    },
+                    env_groups = env_groups,
+                    **kwargs,
+            )
+            x = None
+            for x in losses:
+                yield tuple(
+                    {
+                        **{k: r[k] for k in ['log']},
+                        **gl,
+                    }
+                    for r,gl in zip(rollouts, x['group_losses'])
+                )
+
+            # Send back the final hidden state of each group
+            results = [
+                None if x is None or x['hidden'] is None else {'hidden': tuple(h[...,group,:] for h in x['hidden'])}
+                for group in env_groups
+            ]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
 def train(
         model: torch.nn.Module,
         envs: List[gymnasium.vector.VectorEnv],
@@ -449,9 +720,29 @@ def train(
         norm_adv: bool = True,
         warmup_steps: int = 0,
         update_hidden_after_grad: bool = False,
+        recompute_old_outputs: bool = False,
+        num_minibatches: int = 1,
+        bptt_length: Optional[int] = None,
+        shuffle_minibatches: bool = False,
+        concurrent_rollouts: bool = False,
+        fuse_task_groups: bool = False,
+        inference_precision: str = 'fp32',
+        timer: Optional[PhaseTimer] = None,
+        timer_report_interval: int = 10,
+        metric_logger: Optional[AsyncMetricLogger] = None,
+        check_nan_grads: bool = False,
         start_step: int = 0,
         ):
+    if fuse_task_groups and num_minibatches > 1:
+        raise ValueError('`fuse_task_groups` cannot be used with more than one minibatch, since the losses of each task group are computed over all of its environments.')
+    if inference_precision != 'fp32':
+        recompute_old_outputs = True # Same as in `train_single_env`. The fused losses must also recompute the outputs.
     global_step_counter = [start_step, start_step]
+    step_lock = threading.Lock() # Shared by the trainers, which can run in different threads
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+    if metric_logger is None:
+        metric_logger = AsyncMetricLogger(flush_interval=0)
     if max_steps_total > 0 and start_step > max_steps_total:
         print(f'Start step ({start_step}) is greater than max_steps_total ({max_steps_total}). Exiting.')
         return
@@ -459,6 +750,7 @@ def train(
     trainers = [
         train_single_env(
             global_step_counter = global_step_counter,
+            step_lock = step_lock,
             model = model,
             env = env,
             env_labels = labels,
@@ -474,78 +766,124 @@ def train(
             norm_adv = norm_adv,
             warmup_steps = warmup_steps,
             update_hidden_after_grad = update_hidden_after_grad,
+            recompute_old_outputs = recompute_old_outputs,
+            num_minibatches = num_minibatches,
+            bptt_length = bptt_length,
+            shuffle_minibatches = shuffle_minibatches,
+            yield_rollouts = fuse_task_groups,
+            inference_precision = inference_precision,
+            timer = timer,
+            timer_group = group_label,
+            metric_logger = metric_logger,
         )
-        for env,labels in zip(envs, env_labels)
+        for env,labels,group_label in zip(envs, env_labels, env_group_labels)
     ]
     start_time = time.time()
-    for _, losses in enumerate(zip(*trainers)):
-        #env_steps = training_steps * rollout_length * sum(env.num_envs for env in envs)
-        env_steps = global_step_counter[0]
-
-        if max_steps > 0 and env_steps-start_step >= max_steps:
-            print('Reached max steps')
-            break
-        if max_steps_total > 0 and env_steps >= max_steps_total:
-            print('Reached total max steps')
-            break
-
-        mean_loss = torch.stack([x['loss'] for x in losses]).mean()
-        optimizer.zero_grad()
-        mean_loss.backward()
-        if max_grad_norm is not None:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm) # type: ignore
-        for p in model.parameters(): # XXX: Debugging code
-            if p._grad is None:
-                continue
-            if p._grad.isnan().any():
-                print('NaNs in gradients!')
-                breakpoint()
-        optimizer.step()
-
-        if wandb.run is not None:
-            for label,x in zip(env_group_labels, losses):
-                data = {
-                    f'loss/pi/{label}': x['loss_pi'].item(),
-                    f'loss/v/{label}': x['loss_vf'].item(),
-                    f'loss/entropy/{label}': x['loss_entropy'].item(),
-                    f'loss/total/{label}': x['loss'].item(),
-                    f'approx_kl/{label}': x['approx_kl'].item(),
-                    f'state_value/{label}': x['log']['state_value'].mean().item(),
-                    f'entropy/{label}': x['log']['entropy'].mean().item(),
-                    #last_approx_kl=approx_kl.item(),
-                    #'learning_rate': lr_scheduler.get_lr()[0],
-                    'step': global_step_counter[0]-global_step_counter[1],
-                    'step_total': global_step_counter[0],
-                }
-                if 'attention max' in x['log']:
-                    for k,v in x['log']['attention max'].items():
-                        data[f'attention max/{k}'] = v
-                wandb.log(data, step = global_step_counter[0])
+    # Each task group has its own environments, so their rollouts can be collected concurrently. The gradient step is only taken once all groups are done.
+    zip_trainers = zip_concurrent if concurrent_rollouts else zip
+    if fuse_task_groups:
+        group_losses = fused_group_losses(
+                trainers = trainers,
+                model = model,
+                concurrent_rollouts = concurrent_rollouts,
+                discount = discount,
+                gae_lambda = gae_lambda,
+                norm_adv = norm_adv,
+                clip_vf_loss = clip_vf_loss,
+                vf_loss_coeff = vf_loss_coeff,
+                entropy_loss_coeff = entropy_loss_coeff,
+                target_kl = target_kl,
+                num_epochs = num_epochs,
+                recompute_old_outputs = recompute_old_outputs,
+                num_minibatches = num_minibatches,
+                bptt_length = bptt_length,
+                shuffle_minibatches = shuffle_minibatches,
+                timer = timer,
+        )
+    else:
+        group_losses = zip_trainers(*trainers)
+    # Send the queued metrics even if training is interrupted or fails
+    try:
+        for update_count, losses in enumerate(group_losses):
+            #env_steps = training_steps * rollout_length * sum(env.num_envs for env in envs)
+            env_steps = global_step_counter[0]
+
+            if max_steps > 0 and env_steps-start_step >= max_steps:
+                print('Reached max steps')
+                break
+            if max_steps_total > 0 and env_steps >= max_steps_total:
+                print('Reached total max steps')
+                break
 
-        yield {
-            'step': global_step_counter[0],
-        }
+            mean_loss = torch.stack([x['loss'] for x in losses]).mean()
+            optimizer.zero_grad()
+            with timer.time('backward'):
+                mean_loss.backward()
+            grad_norm = None
+            if max_grad_norm is not None:
+                with timer.time('grad_clip'):
+                    grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm) # type: ignore
+            if check_nan_grads:
+                # A single check over all gradients, so that there is only one device sync
+                if not (torch.isfinite(grad_norm) if grad_norm is not None else grads_are_finite(model.parameters())):
+                    print('NaNs in gradients!')
+                    breakpoint()
+            with timer.time('optimizer_step'):
+                optimizer.step()
+
+            with timer.time('logging'):
+                if wandb.run is not None:
+                    for label,x in zip(env_group_labels, losses):
+                        data = {
+                            f'loss/pi/{label}': x['loss_pi'],
+                            f'loss/v/{label}': x['loss_vf'],
+                            f'loss/entropy/{label}': x['loss_entropy'],
+                            f'loss/total/{label}': x['loss'],
+                            f'approx_kl/{label}': x['approx_kl'],
+                            f'state_value/{label}': x['log']['state_value'].mean(),
+                            f'entropy/{label}': x['log']['entropy'].mean(),
+                            #last_approx_kl=approx_kl.item(),
+                            #'learning_rate': lr_scheduler.get_lr()[0],
+                            'step': global_step_counter[0]-global_step_counter[1],
+                            'step_total': global_step_counter[0],
+                        }
+                        if 'attention max' in x['log']:
+                            for k,v in x['log']['attention max'].items():
+                                data[f'attention max/{k}'] = v
+                        metric_logger.log(data, step = global_step_counter[0])
 
-        # Update learning rate
-        if lr_scheduler is not None:
-            lr_scheduler.step()
-
-        # Timing
-        if env_steps > 0:
-            elapsed_time = time.time() - start_time
-            steps_per_sec = (env_steps - start_step) / elapsed_time
-            if max_steps > 0:
-                remaining_time = int((max_steps - env_steps) / steps_per_sec)
-                remaining_hours = remaining_time // 3600
-                remaining_minutes = (remaining_time % 3600) // 60
-                remaining_seconds = (remaining_time % 3600) % 60
-                print(f"Step {env_steps-start_step:,}/{max_steps:,} \t {int(steps_per_sec):,} SPS \t Remaining: {remaining_hours:02d}:{remaining_minutes:02d}:{remaining_seconds:02d}")
-            else:
-                elapsed_time = int(elapsed_time)
-                elapsed_hours = elapsed_time // 3600
-                elapsed_minutes = (elapsed_time % 3600) // 60
-                elapsed_seconds = (elapsed_time % 3600) % 60
-                print(f"Step {env_steps-start_step:,} \t {int(steps_per_sec):,} SPS \t Elapsed: {elapsed_hours:02d}:{elapsed_minutes:02d}:{elapsed_seconds:02d}")
+            if timer.enabled and (update_count+1) % timer_report_interval == 0:
+                timer_summary = timer.report(step = global_step_counter[0])
+                if wandb.run is not None:
+                    metric_logger.log(timer_summary, step = global_step_counter[0])
+            metric_logger.step()
+
+            yield {
+                'step': global_step_counter[0],
+            }
+
+            # Update learning rate
+            if lr_scheduler is not None:
+                lr_scheduler.step()
+
+            # Timing
+            if env_steps > 0:
+                elapsed_time = time.time() - start_time
+                steps_per_sec = (env_steps - start_step) / elapsed_time
+                if max_steps > 0:
+                    remaining_time = int((max_steps - env_steps) / steps_per_sec)
+                    remaining_hours = remaining_time // 3600
+                    remaining_minutes = (remaining_time % 3600) // 60
+                    remaining_seconds = (remaining_time % 3600) % 60
+                    print(f"Step {env_steps-start_step:,}/{max_steps:,} \t {int(steps_per_sec):,} SPS \t Remaining: {remaining_hours:02d}:{remaining_minutes:02d}:{remaining_seconds:02d}")
+                else:
+                    elapsed_time = int(elapsed_time)
+                    elapsed_hours = elapsed_time // 3600
+                    elapsed_minutes = (elapsed_time % 3600) // 60
+                    elapsed_seconds = (elapsed_time % 3600) % 60
+                    print(f"Step {env_steps-start_step:,} \t {int(steps_per_sec):,} SPS \t Elapsed: {elapsed_hours:02d}:{elapsed_minutes:02d}:{elapsed_seconds:02d}")
+    finally:
+        metric_logger.close()
 
 
 if __name__ == '__main__':
@@ -574,6 +912,8 @@ if __name__ == '__main__':
                         help='Number of training steps between checkpoints.')
     parser.add_argument('--sync-vector-env', action='store_true',
                         help='If set, then the vectorized environments are synchronized. This is useful for debugging, but is likely slower, so it should not be used for training.')
+    parser.add_argument('--double-buffered-actor', action='store_true',
+                        help='If set, each vectorized environment is split into two halves, and the policy is run on one half while the other half is stepping. Environments with a single copy (`--num-envs 1`) are stepped normally.')
 
     parser.add_argument('--slurm-split', action='store_true', help='Set this flag to let the script know it is running on a SLURM cluster with one job split across an array job. This ensures that the same checkpoint is used for each of these jobs.')
     parser.add_argument('--cuda', action='store_true', help='Use CUDA.')
@@ -624,10 +964,28 @@ if __name__ == '__main__':
             'reward_clip': args.reward_clip,
     }
     VectorEnv = gymnasium.vector.SyncVectorEnv if args.sync_vector_env else gymnasium.vector.AsyncVectorEnv
-    envs = [
-        VectorEnv([lambda conf=conf: make_env(**conf) for conf in env_config]) # type: ignore (Why is `make_env` missing an argument?)
-        for env_config in env_configs
-    ]
+    if args.actor_learner:
+        # The environments are created in the actor processes. These are only used to get the observation and action spaces.
+        envs = [
+            gymnasium.vector.SyncVectorEnv([lambda conf=env_config[0]: make_env(**conf)]) # type: ignore
+            for env_config in env_configs
+        ]
+    elif args.double_buffered_actor:
+        # Groups with a single environment can't be split in two, so they are stepped normally
+        envs = [
+            DoubleBufferedVectorEnv([
+                VectorEnv([lambda conf=conf: make_env(**conf) for conf in env_config[:len(env_config)//2]]), # type: ignore
+                VectorEnv([lambda conf=conf: make_env(**conf) for conf in env_config[len(env_config)//2:]]), # type: ignore
+            ])
+            if len(env_config) >= 2 else
+            VectorEnv([lambda conf=conf: make_env(**conf) for conf in env_config]) # type: ignore
+            for env_config in env_configs
+        ]
+    else:
+        envs = [
+            VectorEnv([lambda conf=conf: make_env(**conf) for conf in env_config]) # type: ignore (Why is `make_env` missing an argument?)
+            for env_config in env_configs
+        ]
 
     if args.cuda and torch.cuda.is_available():
         print('Using CUDA')
@@ -648,6 +1006,20 @@ if __name__ == '__main__':
             device = device,
     )
     model.to(device)
+    set_introspection(model, args.log_attention)
+    if args.fuse_output_modules and hasattr(model, 'fuse_output_modules'):
+        model.fuse_output_modules() # type: ignore
+    if args.fused_recurrent_cell:
+        if not isinstance(getattr(model, 'attention', None), RecurrentAttention16):
+            raise ValueError('`--fused-recurrent-cell` only applies to models with a RecurrentAttention16 core.')
+        model.attention.convert_layer_type(BatchRecurrentAttention16Layer_v3) # type: ignore
+        model.to(device)
+    if args.kv_groups is not None:
+        group_kv_projections_(model, args.kv_groups, method=args.kv_groups_method)
+    if args.compile_model:
+        if not hasattr(model, 'enable_static_forward'):
+            raise ValueError('`--compile-model` only applies to ModularPolicy8.')
+        model.enable_static_forward(backend=args.compile_backend, cache_dir=args.compile_cache_dir) # type: ignore
 
     # Initialize optimizer
     if args.optimizer == 'Adam':
@@ -686,32 +1058,75 @@ if __name__ == '__main__':
         print(f'Loaded checkpoint from {args.starting_model}')
 
     # Initialize trainer
-    trainer = train(
-            model = model,
-            envs = envs, # type: ignore (??? AsyncVectorEnv is not a subtype of VectorEnv ???)
-            #env_labels = [['doot']*len(envs)], # TODO: Make this configurable
-            #env_labels = [[e]*n for e,n in zip(args.envs, args.num_envs)],
-            env_labels = [[e]*n for e,n in zip(args.envs, args.num_envs)],
-            env_group_labels = args.envs,
-            optimizer = optimizer,
-            lr_scheduler = lr_scheduler,
-            max_steps = args.max_steps,
-            max_steps_total = args.max_steps_total,
-            rollout_length = args.rollout_length,
-            obs_scale = {'obs (image)': 1/255},
-            discount = args.discount,
-            gae_lambda = args.gae_lambda,
-            norm_adv = args.norm_adv,
-            clip_vf_loss = args.clip_vf_loss,
-            vf_loss_coeff = args.vf_loss_coeff,
-            entropy_loss_coeff = args.entropy_loss_coeff,
-            target_kl = args.target_kl,
-            num_epochs = args.num_epochs,
-            max_grad_norm = args.max_grad_norm,
-            warmup_steps = args.warmup_steps,
-            update_hidden_after_grad = args.update_hidden_after_grad,
-            start_step = start_step,
-    )
+    if args.actor_learner:
+        trainer = train_actor_learner(
+                model = model,
+                env_fns = [lambda conf=conf: make_env(**conf) for env_config in env_configs for conf in env_config], # type: ignore
+                env_labels = [e for e,n in zip(args.envs, args.num_envs) for _ in range(n)],
+                optimizer = optimizer,
+                action_dist_fn = lambda output: torch.distributions.Independent(torch.distributions.Normal(output['action_mean'], output['action_logstd'].exp()), 1),
+                num_actors = args.num_actors,
+                inference_precision = args.inference_precision,
+                trajectories_per_batch = args.trajectories_per_batch,
+                queue_size = args.trajectory_queue_size,
+                max_steps = args.max_steps,
+                max_steps_total = args.max_steps_total,
+                rollout_length = args.rollout_length,
+                obs_scale = {},
+                reward_clip = None,
+                reward_scale = 1.0,
+                discount = args.discount,
+                vf_loss_coeff = args.vf_loss_coeff,
+                entropy_loss_coeff = args.entropy_loss_coeff,
+                max_grad_norm = args.max_grad_norm,
+                clip_rho_threshold = args.vtrace_rho_clip,
+                clip_c_threshold = args.vtrace_c_clip,
+                metric_logger = AsyncMetricLogger(flush_interval=args.log_flush_interval),
+                start_step = start_step,
+        )
+    else:
+        trainer = train(
+                model = model,
+                envs = envs, # type: ignore (??? AsyncVectorEnv is not a subtype of VectorEnv ???)
+                #env_labels = [['doot']*len(envs)], # TODO: Make this configurable
+                #env_labels = [[e]*n for e,n in zip(args.envs, args.num_envs)],
+                env_labels = [[e]*n for e,n in zip(args.envs, args.num_envs)],
+                env_group_labels = args.envs,
+                optimizer = optimizer,
+                lr_scheduler = lr_scheduler,
+                max_steps = args.max_steps,
+                max_steps_total = args.max_steps_total,
+                rollout_length = args.rollout_length,
+                obs_scale = {},
+                discount = args.discount,
+                gae_lambda = args.gae_lambda,
+                norm_adv = args.norm_adv,
+                clip_vf_loss = args.clip_vf_loss,
+                vf_loss_coeff = args.vf_loss_coeff,
+                entropy_loss_coeff = args.entropy_loss_coeff,
+                target_kl = args.target_kl,
+                num_epochs = args.num_epochs,
+                max_grad_norm = args.max_grad_norm,
+                warmup_steps = args.warmup_steps,
+                update_hidden_after_grad = args.update_hidden_after_grad,
+                recompute_old_outputs = args.recompute_rollout_outputs,
+                num_minibatches = args.num_recurrent_minibatches,
+                bptt_length = args.bptt_length,
+                shuffle_minibatches = args.shuffle_bptt_chunks,
+                concurrent_rollouts = args.concurrent_rollouts,
+                fuse_task_groups = args.fuse_task_groups,
+                inference_precision = args.inference_precision,
+                timer = PhaseTimer(
+                    enabled = args.profile,
+                    window = args.profile_window,
+                    cuda_sync = args.profile_cuda_sync,
+                    jsonl_path = args.profile_jsonl,
+                ),
+                timer_report_interval = args.profile_interval,
+                metric_logger = AsyncMetricLogger(flush_interval=args.log_flush_interval),
+                check_nan_grads = args.check_nan_grads,
+                start_step = start_step,
+        )
 
     # Run training loop
     if args.model_checkpoint is not None:
@@ -741,6 +1156,7 @@ if __name__ == '__main__':
         except KeyboardInterrupt:
             print('Interrupted')
             pass
+        trainer.close() # Flush the metrics if the interrupt arrived outside of `train()`
         # Sometimes, we run an experiment without intending to save the model, but then change our mind later.
         if x is not None:
             print('Saving model')
@@ -1,10 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import os
 import time
-from typing import Sequence, Iterable, Union, Tuple, Mapping
+from typing import Sequence, Iterable, Union, Tuple, Mapping, Optional, List, Callable, Any
 
 import gymnasium
 import gymnasium.spaces
+import gymnasium.vector
+import numpy as np
 import torch
 
 
@@ -64,6 +67,346 @@ def zip2(*args) -> Iterable[Union[Tuple,Mapping]]:
     return zip(*[zip2(a) for a in args])
 
 
+def zip_concurrent(*iterables: Iterable) -> Iterable[Tuple]:
+    """
+    Same as `zip()`, but the next elements of all iterables are computed concurrently, with one thread per iterable. The next elements are only requested after the previous tuple is consumed, so anything done between iterations (e.g. a gradient step) happens while none of the iterables are running.
+
+    This is useful for generators that spend most of their time waiting on something that releases the GIL, such as stepping an `AsyncVectorEnv` or running a model.
+
+    >>> list(zip_concurrent([1,2,3], (x*2 for x in range(10))))
+    [(1, 0), (2, 2), (3, 4)]
+    """
+    iterators = [iter(x) for x in iterables]
+    done = object()
+    with ThreadPoolExecutor(max_workers=max(len(iterators),1), thread_name_prefix='zip_concurrent') as executor:
+        while True:
+            futures = [executor.submit(next, it, done) for it in iterators]
+            values = tuple(f.result() for f in futures)
+            if len(values) == 0 or any(v is done for v in values):
+                return
+            yield values
+
+
+def grads_are_finite(parameters: Iterable[torch.nn.Parameter]) -> torch.Tensor:
+    """ Check whether all gradients are finite. The norms of all gradients are computed with one fused kernel and checked together, so the result is a single boolean tensor that only needs one device sync to read. """
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if len(grads) == 0:
+        return torch.tensor(True)
+    return torch.isfinite(torch.stack(torch._foreach_norm(grads))).all()
+
+
+def recurrent_minibatch_indices(num_envs: int, num_steps: int, num_minibatches: int = 1, bptt_length: Optional[int] = None, shuffle: bool = False) -> List[Tuple[Union[slice,np.ndarray],int,int]]:
+    """
+    Split a rollout of `num_steps` transitions from `num_envs` environments into minibatches for truncated backpropagation through time. The environments are randomly split into `num_minibatches` groups and the rollout is split into contiguous chunks of `bptt_length` time steps. Each minibatch is one group of environments over one chunk, and is returned as a tuple `(env_idx, start, end)`.
+
+    If there is only one group, `env_idx` is `slice(None)` so that indexing with it does not make a copy. Chunks are ordered by time within each group unless `shuffle` is set, in which case all minibatches are returned in a random order.
+
+    >>> recurrent_minibatch_indices(num_envs=4, num_steps=5, bptt_length=2)
+    [(slice(None, None, None), 0, 2), (slice(None, None, None), 2, 4), (slice(None, None, None), 4, 5)]
+    """
+    if num_minibatches < 1 or num_minibatches > num_envs:
+        raise ValueError(f'Number of minibatches must be between 1 and the number of environments ({num_envs}). Got {num_minibatches}.')
+    if bptt_length is None:
+        bptt_length = num_steps
+    if bptt_length < 1:
+        raise ValueError(f'BPTT length must be positive. Got {bptt_length}.')
+
+    if num_minibatches == 1:
+        env_groups = [slice(None)]
+    else:
+        env_groups = [np.sort(x) for x in np.array_split(np.random.permutation(num_envs), num_minibatches)]
+    minibatches = [
+        (env_idx, start, min(start+bptt_length, num_steps))
+        for env_idx in env_groups
+        for start in range(0, num_steps, bptt_length)
+    ]
+    if shuffle:
+        minibatches = [minibatches[i] for i in np.random.permutation(len(minibatches))]
+    return minibatches
+
+
+def obs_to_tensor(obs, device: torch.device = torch.device('cpu'), scale: float = 1) -> torch.Tensor:
+    """ Convert an observation to a tensor. `uint8` observations (i.e. images) with no scaling factor are kept as `uint8` and shared with the numpy array instead of being copied on the host, and are expected to be normalized by the model (see `ImageInput56`). Other observations are converted to floats and multiplied by `scale`. """
+    x = torch.as_tensor(np.asarray(obs), device=device)
+    if x.dtype == torch.uint8 and scale == 1:
+        return x
+    if scale == 1:
+        return x.float()
+    return x.float() * scale
+
+
+class ObservationBuffer:
+    """
+    Preallocated storage for the observations of a vectorized rollout. Each observation key is stored in a single tensor of shape `(max_len, num_envs, ...)` on `device`, so the observations only need to be converted to tensors once, and can then be used both as the model's input when collecting the rollout and when computing the losses.
+
+    Observations are written in place. The scaling factors in `scale` are applied when the observation is written, and observations are stored as floats, except for `uint8` observations (i.e. images) with no scaling factor, which are stored as `uint8` to save memory and are expected to be normalized by the model (see `ImageInput56`). If `device` is a GPU, the observations are first copied into a pinned staging buffer so that the transfer to the GPU can be done asynchronously.
+
+    >>> buffer = ObservationBuffer(num_envs=2, max_len=3, scale={'a': 0.5})
+    >>> buffer.append({'a': np.array([2, 4])})['a']
+    tensor([1., 2.])
+    >>> _ = buffer.append({'a': np.array([6, 8])})
+    >>> buffer.obs['a']
+    tensor([[1., 2.],
+            [3., 4.]])
+    >>> buffer.clear()
+    >>> buffer.obs['a']
+    tensor([[3., 4.]])
+    >>> ObservationBuffer(num_envs=2, max_len=3).append({'image': np.array([0, 255], dtype=np.uint8)})['image']
+    tensor([  0, 255], dtype=torch.uint8)
+    """
+    def __init__(self, num_envs: int, max_len: int, device: torch.device = torch.device('cpu'), scale: Mapping[str,float] = {}, ignore: Sequence[str] = []):
+        self.num_envs = num_envs
+        self.max_len = max_len
+        self.device = torch.device(device)
+        self.scale = scale
+        self.ignore = ignore
+
+        self._pin_memory = self.device.type == 'cuda'
+        self._storage = None
+        self._staging = None
+        self._copy_done = None
+        self._len = 0
+
+    def _allocate(self, obs: Mapping[str,np.ndarray]):
+        self._storage = {}
+        self._staging = {}
+        for k,v in obs.items():
+            if k in self.ignore:
+                continue
+            v = np.asarray(v)
+            dtype = torch.uint8 if v.dtype == np.uint8 and k not in self.scale else torch.float
+            self._storage[k] = torch.empty((self.max_len, *v.shape), dtype=dtype, device=self.device)
+            if self._pin_memory:
+                self._staging[k] = torch.empty(v.shape, dtype=torch.from_numpy(v).dtype, pin_memory=True)
+
+    def _write(self, index: int, obs: Mapping[str,np.ndarray], env_idx: slice = slice(None)) -> Mapping[str,torch.Tensor]:
+        if self._storage is None:
+            if env_idx != slice(None):
+                raise ValueError('The first observation written to the buffer must include all environments.')
+            self._allocate(obs)
+        assert self._storage is not None
+        assert self._staging is not None
+        if self._copy_done is not None:
+            # The staging buffers are still being read by the last transfer
+            self._copy_done.synchronize()
+        for k,storage in self._storage.items():
+            dest = storage[index,env_idx]
+            src = torch.from_numpy(np.asarray(obs[k]))
+            if self._pin_memory:
+                self._staging[k][env_idx].copy_(src)
+                src = self._staging[k][env_idx]
+            dest.copy_(src, non_blocking=True)
+            if k in self.scale:
+                dest.mul_(self.scale[k])
+        if self._pin_memory:
+            self._copy_done = torch.cuda.Event()
+            self._copy_done.record()
+        return {k: v[index,env_idx] for k,v in self._storage.items()}
+
+    def write_next(self, obs: Mapping[str,np.ndarray], env_idx: slice) -> Mapping[str,torch.Tensor]:
+        """ Write the next observation of a subset of the environments without adding it to the buffer yet. Call `append()` with no arguments once the observations of all environments are written. Returns the written observations as a dictionary of tensors. """
+        if self._len >= self.max_len:
+            raise IndexError(f'Observation buffer is full ({self.max_len} observations).')
+        return self._write(self._len, obs, env_idx)
+
+    def append(self, obs: Optional[Mapping[str,np.ndarray]] = None) -> Mapping[str,torch.Tensor]:
+        """ Add an observation to the end of the buffer and return it as a dictionary of tensors. If `obs` is None, the observations written with `write_next()` are added instead. """
+        if self._len >= self.max_len:
+            raise IndexError(f'Observation buffer is full ({self.max_len} observations).')
+        self._len += 1
+        if obs is None:
+            return self[self._len-1]
+        return self._write(self._len-1, obs)
+
+    def reset(self, obs: Mapping[str,np.ndarray]) -> Mapping[str,torch.Tensor]:
+        """ Remove all observations and replace them with `obs`. """
+        self._len = 1
+        return self._write(0, obs)
+
+    def clear(self):
+        """ Remove all observations except for the last one. Same as `VecHistoryBuffer.clear()`. """
+        if self._storage is None or self._len == 0:
+            return
+        for v in self._storage.values():
+            v[0] = v[self._len-1]
+        self._len = 1
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index: int) -> Mapping[str,torch.Tensor]:
+        if index < 0:
+            index += self._len
+        if index < 0 or index >= self._len:
+            raise IndexError(f'Index {index} out of range for buffer of length {self._len}.')
+        assert self._storage is not None
+        return {k: v[index] for k,v in self._storage.items()}
+
+    @property
+    def obs(self) -> Mapping[str,torch.Tensor]:
+        """ All observations in the buffer, each of shape `(len(self), num_envs, ...)`. """
+        if self._storage is None:
+            return {}
+        return {k: v[:self._len] for k,v in self._storage.items()}
+
+
+def _concat_batch(values: Sequence, dim: int):
+    if isinstance(values[0], Mapping):
+        # Hidden states have the batch dimension second to last
+        return {k: _concat_batch([v[k] for v in values], -2 if k == 'hidden' else dim) for k in values[0].keys()}
+    if isinstance(values[0], (tuple, list)):
+        return type(values[0])(_concat_batch(v, dim) for v in zip(*values))
+    if isinstance(values[0], torch.Tensor):
+        return torch.cat(list(values), dim=dim)
+    return np.concatenate(values, axis=dim)
+
+
+class ConcatVecHistory:
+    """
+    Several `VecHistoryBuffer`s of the same length, concatenated along the batch dimension. This gives the same attributes as a `VecHistoryBuffer` that is read by `compute_ppo_losses`, so the rollouts of multiple vector environments can be trained on as one batch.
+
+    Tensors are concatenated along the batch dimension, which is the second dimension of everything except the hidden states in `misc['hidden']`, where it is the second to last.
+    """
+    def __init__(self, histories: Sequence):
+        self.histories = histories
+        lengths = set(len(h.obs_history) for h in histories)
+        if len(lengths) != 1:
+            raise ValueError(f'All histories must have the same length. Got {lengths}.')
+
+    @property
+    def obs_history(self):
+        return [_concat_batch(obs, 0) for obs in zip(*[h.obs_history for h in self.histories])]
+
+    @property
+    def obs(self):
+        return _concat_batch([h.obs for h in self.histories], 1)
+
+    @property
+    def action(self):
+        return _concat_batch([h.action for h in self.histories], 1)
+
+    @property
+    def reward(self):
+        return _concat_batch([h.reward for h in self.histories], 1)
+
+    @property
+    def terminal(self):
+        return _concat_batch([h.terminal for h in self.histories], 1)
+
+    @property
+    def misc(self):
+        return _concat_batch([h.misc for h in self.histories], 1)
+
+
+def _concat_vector_obs(obs: Sequence):
+    if isinstance(obs[0], Mapping):
+        return {k: _concat_vector_obs([o[k] for o in obs]) for k in obs[0].keys()}
+    if isinstance(obs[0], tuple):
+        return tuple(_concat_vector_obs(o) for o in zip(*obs))
+    return np.concatenate(obs)
+
+
+def _concat_vector_infos(infos: Sequence[Mapping], sizes: Sequence[int]) -> dict:
+    """ Concatenate the info dictionaries returned by vector environments. Entries that are missing from some of the environments are filled with zeros (`False` for the `_key` masks) or `None`. """
+    keys = []
+    for info in infos:
+        keys.extend(k for k in info.keys() if k not in keys)
+    output = {}
+    for k in keys:
+        values = [info.get(k) for info in infos]
+        if any(isinstance(v, Mapping) for v in values):
+            output[k] = _concat_vector_infos([{} if v is None else v for v in values], sizes)
+            continue
+        ref = np.asarray(next(v for v in values if v is not None))
+        output[k] = np.concatenate([
+            np.asarray(v) if v is not None
+            else np.full(n, None, dtype=object) if ref.dtype == object
+            else np.zeros((n, *ref.shape[1:]), dtype=ref.dtype)
+            for v,n in zip(values, sizes)
+        ])
+    return output
+
+
+class DoubleBufferedVectorEnv:
+    """
+    A vector environment split into two halves that are stepped independently, so that one half can be stepped while the policy is computing the actions of the other half.
+
+    When used like a normal vector environment, both halves are stepped at the same time. To overlap environment steps with the policy, start the step with `step_async(actions)` and pass the policy to `step_wait(policy)`. As soon as one half is done stepping, `policy(env_idx, obs, done)` is called with the slice of environments belonging to that half and the results of its step, and must return the next actions for these environments. The next step of that half is started right away, while the policy is run on the other half. Each half always receives actions that are computed from its own latest observation, so the data is still on-policy.
+
+    Args:
+        envs: The two halves. Any vector environments with the same observation and action spaces, each with at least one environment.
+    """
+    def __init__(self, envs: Sequence[gymnasium.vector.VectorEnv]):
+        if len(envs) != 2:
+            raise ValueError(f'Expected two vector environments. Got {len(envs)}.')
+        self.envs = list(envs)
+        self.sizes = [env.num_envs for env in self.envs]
+        if min(self.sizes) < 1:
+            raise ValueError(f'Each half must have at least one environment, so at least two environments are needed. Got halves of size {self.sizes}. Use a regular vector environment instead.')
+        self.num_envs = sum(self.sizes)
+        self.slices = [
+            slice(sum(self.sizes[:i]), sum(self.sizes[:i+1]))
+            for i in range(len(self.envs))
+        ]
+        self.single_observation_space = self.envs[0].single_observation_space
+        self.single_action_space = self.envs[0].single_action_space
+        self.observation_space = gymnasium.vector.utils.batch_space(self.single_observation_space, self.num_envs)
+        self.action_space = gymnasium.vector.utils.batch_space(self.single_action_space, self.num_envs)
+
+        self._pending_actions = [None for _ in self.envs]
+
+    def reset(self, *, seed: Optional[int] = None, options: Optional[dict] = None):
+        results = []
+        for env,sl in zip(self.envs, self.slices):
+            # Offset the seed so that each environment gets the same seed as it would if the halves were a single vector environment
+            results.append(env.reset(seed=None if seed is None else seed+sl.start, options=options))
+        obs, infos = zip(*results)
+        return _concat_vector_obs(obs), _concat_vector_infos(infos, self.sizes)
+
+    def _step_async(self, i: int, actions):
+        env = self.envs[i]
+        if hasattr(env, 'step_async'):
+            env.step_async(actions)
+        else:
+            self._pending_actions[i] = actions
+
+    def _step_wait(self, i: int):
+        env = self.envs[i]
+        if hasattr(env, 'step_async'):
+            return env.step_wait()
+        actions = self._pending_actions[i]
+        self._pending_actions[i] = None
+        return env.step(actions)
+
+    def step_async(self, actions):
+        for i,sl in enumerate(self.slices):
+            self._step_async(i, actions[sl])
+
+    def step_wait(self, policy: Optional[Callable[[slice,Any,np.ndarray],Any]] = None):
+        results = []
+        for i,sl in enumerate(self.slices):
+            obs, reward, terminated, truncated, info = self._step_wait(i)
+            if policy is not None:
+                self._step_async(i, policy(sl, obs, terminated | truncated))
+            results.append((obs, reward, terminated, truncated, info))
+        obs, reward, terminated, truncated, infos = zip(*results)
+        return (
+            _concat_vector_obs(obs),
+            np.concatenate(reward),
+            np.concatenate(terminated),
+            np.concatenate(truncated),
+            _concat_vector_infos(infos, self.sizes),
+        )
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self, **kwargs):
+        for env in self.envs:
+            env.close(**kwargs)
+
+
 ##################################################
 # File IO
 ##################################################
@@ -0,0 +1,445 @@
+"""
+Asynchronous actor-learner training (IMPALA, Espeholt et al. 2018).
+
+Actor processes run a CPU copy of the model on their own environments and push fixed-length trajectories to a bounded queue. The learner consumes batches of trajectories, corrects for the lag between the actors' policy and its own with V-trace, and publishes its updated weights through shared memory. Actors pick up the new weights at the start of their next trajectory.
+"""
+
+import copy
+import queue
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Generator, List, Mapping, Optional, Sequence, Tuple
+
+import gymnasium
+import gymnasium.vector
+import numpy as np
+import torch
+import torch.multiprocessing
+import torch.nn.utils
+import wandb
+
+from big_rl.utils import ObservationBuffer
+from big_rl.model.low_precision import LowPrecisionPolicy
+from big_rl.utils.metrics import AsyncMetricLogger
+
+
+def vtrace(
+        log_rhos: torch.Tensor,
+        discounts: torch.Tensor,
+        rewards: torch.Tensor,
+        values: torch.Tensor,
+        bootstrap_value: torch.Tensor,
+        clip_rho_threshold: Optional[float] = 1.0,
+        clip_pg_rho_threshold: Optional[float] = 1.0,
+        clip_c_threshold: Optional[float] = 1.0,
+        ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute the V-trace value targets and policy gradient advantages.
+
+    Args:
+        log_rhos: Log importance sampling ratios `log(pi(a_t|x_t)/mu(a_t|x_t))` of the target policy `pi` and the behaviour policy `mu`. Shape `[T, B]`.
+        discounts: Discount applied to the value of the next state, i.e. zero if the episode ended at that transition. Shape `[T, B]`.
+        rewards: Shape `[T, B]`.
+        values: State values `V(x_t)` under the target policy. Shape `[T, B]`.
+        bootstrap_value: `V(x_T)`. Shape `[B]`.
+
+    Returns:
+        A tuple `(vs, pg_advantages)`, each of shape `[T, B]`.
+    """
+    with torch.no_grad():
+        rhos = log_rhos.exp()
+        clipped_rhos = rhos if clip_rho_threshold is None else rhos.clamp(max=clip_rho_threshold)
+        clipped_pg_rhos = rhos if clip_pg_rho_threshold is None else rhos.clamp(max=clip_pg_rho_threshold)
+        cs = rhos if clip_c_threshold is None else rhos.clamp(max=clip_c_threshold)
+
+        values_t_plus_1 = torch.cat([values[1:], bootstrap_value.unsqueeze(0)], dim=0)
+        deltas = clipped_rhos * (rewards + discounts * values_t_plus_1 - values)
+
+        vs_minus_v = torch.zeros_like(values)
+        acc = torch.zeros_like(bootstrap_value)
+        for t in reversed(range(len(values))):
+            acc = deltas[t] + discounts[t] * cs[t] * acc
+            vs_minus_v[t] = acc
+        vs = vs_minus_v + values
+
+        vs_t_plus_1 = torch.cat([vs[1:], bootstrap_value.unsqueeze(0)], dim=0)
+        pg_advantages = clipped_pg_rhos * (rewards + discounts * vs_t_plus_1 - values)
+
+    return vs, pg_advantages
+
+
+def _actor(
+        actor_id: int,
+        model: torch.nn.Module,
+        shared_state: Mapping[str, torch.Tensor],
+        version, # multiprocessing.Value
+        env_fns: Sequence[Callable[[], gymnasium.Env]],
+        env_labels: Sequence[str],
+        trajectory_queue,
+        stop_event,
+        action_dist_fn: Callable[[Dict[str, torch.Tensor]], torch.distributions.Distribution],
+        rollout_length: int,
+        obs_scale: Mapping[str, float],
+        obs_ignore: Sequence[str],
+        reward_scale: float,
+        reward_clip: Optional[float],
+        seed: int,
+        inference_precision: str = 'fp32'):
+    torch.set_num_threads(1)
+
+    env = gymnasium.vector.SyncVectorEnv(env_fns)
+    num_envs = env.num_envs
+
+    obs_buffer = ObservationBuffer(
+            num_envs = num_envs,
+            max_len = rollout_length+1,
+            scale = obs_scale,
+            ignore = obs_ignore)
+    obs, _ = env.reset(seed=seed)
+    obs_buffer.reset(obs)
+    hidden = model.init_hidden(num_envs) # type: ignore
+    actor = model if inference_precision == 'fp32' else LowPrecisionPolicy(model, inference_precision)
+    episode_reward = np.zeros(num_envs)
+    episode_steps = np.zeros(num_envs)
+
+    model_version = -1
+    while not stop_event.is_set():
+        # Pull the latest weights
+        if version.value != model_version:
+            with version.get_lock():
+                model.load_state_dict(shared_state)
+                model_version = version.value
+            if inference_precision != 'fp32':
+                actor.refresh() # type: ignore
+
+        initial_hidden = tuple(h.detach().clone() for h in hidden)
+        actions = []
+        log_probs = []
+        rewards = []
+        dones = []
+        episodes = []
+        with torch.no_grad():
+            for _ in range(rollout_length):
+                model_output = actor(obs_buffer[-1], hidden)
+                hidden = model_output['hidden']
+                action_dist = action_dist_fn(model_output)
+                action = action_dist.sample()
+                log_probs.append(action_dist.log_prob(action))
+                actions.append(action)
+
+                obs, reward, terminated, truncated, _ = env.step(action.numpy())
+                done = terminated | truncated
+                obs_buffer.append(obs)
+
+                episode_reward += reward
+                episode_steps += 1
+                reward = reward * reward_scale
+                if reward_clip is not None:
+                    reward = np.clip(reward, -reward_clip, reward_clip)
+                rewards.append(torch.as_tensor(reward, dtype=torch.float))
+                dones.append(torch.as_tensor(done))
+
+                if done.any():
+                    for i in np.flatnonzero(done):
+                        episodes.append((env_labels[i], episode_reward[i].item(), episode_steps[i].item()))
+                    hidden = model.reset_hidden_(hidden, done) # type: ignore
+                    episode_reward[done] = 0
+                    episode_steps[done] = 0
+
+        trajectory_queue.put({
+            'actor_id': actor_id,
+            'version': model_version,
+            # The buffer is reused, so the observations must be copied before they are shared with the learner
+            'obs': {k: v.clone() for k,v in obs_buffer.obs.items()},
+            'action': torch.stack(actions),
+            'log_prob': torch.stack(log_probs),
+            'reward': torch.stack(rewards),
+            'done': torch.stack(dones),
+            'initial_hidden': initial_hidden,
+            'episodes': episodes,
+        })
+        obs_buffer.clear()
+
+    env.close()
+
+
+def _collate_trajectories(trajectories: List[Dict], device: torch.device) -> Dict:
+    """ Concatenate trajectories from different actors along the batch dimension. """
+    return {
+        'obs': {
+            k: torch.cat([t['obs'][k] for t in trajectories], dim=1).to(device)
+            for k in trajectories[0]['obs'].keys()
+        },
+        'action': torch.cat([t['action'] for t in trajectories], dim=1).to(device),
+        'log_prob': torch.cat([t['log_prob'] for t in trajectories], dim=1).to(device),
+        'reward': torch.cat([t['reward'] for t in trajectories], dim=1).to(device),
+        'done': torch.cat([t['done'] for t in trajectories], dim=1).to(device),
+        'initial_hidden': tuple(
+            torch.cat(h, dim=-2).to(device)
+            for h in zip(*[t['initial_hidden'] for t in trajectories])
+        ),
+    }
+
+
+def compute_vtrace_losses(
+        model: torch.nn.Module,
+        batch: Dict,
+        action_dist_fn: Callable[[Dict[str, torch.Tensor]], torch.distributions.Distribution],
+        discount: float,
+        vf_loss_coeff: float,
+        entropy_loss_coeff: float,
+        clip_rho_threshold: Optional[float] = 1.0,
+        clip_c_threshold: Optional[float] = 1.0,
+        ) -> Dict[str, torch.Tensor]:
+    """
+    Compute the IMPALA losses on a batch of trajectories collected by the actors.
+
+    The model is run over the trajectory starting from the hidden state the actor had at the start of it, resetting the hidden state wherever an episode ended.
+    """
+    obs = batch['obs']
+    action = batch['action']
+    done = batch['done']
+    n = len(action)
+
+    curr_hidden = batch['initial_hidden']
+    if hasattr(model, 'forward_sequence'):
+        # Encode the observations of all time steps at once
+        reset = torch.cat([torch.zeros_like(done[:1]), done]) # The hidden state is reset after an episode ends
+        net_output = model.forward_sequence(obs, curr_hidden, reset) # type: ignore
+    else:
+        net_output = []
+        initial_hidden = model.initial_hidden() # type: ignore
+        for t in range(n+1):
+            if t > 0:
+                curr_hidden = model.reset_hidden_(curr_hidden, done[t-1], initial_hidden) # type: ignore
+            no = model({k: v[t] for k,v in obs.items()}, curr_hidden)
+            curr_hidden = no['hidden']
+            net_output.append(no)
+        net_output = {
+            k: torch.stack([o[k] for o in net_output]) for k in net_output[0].keys()
+            if k not in ['hidden', 'misc']
+        }
+
+    values = net_output['value'].squeeze(2)
+    action_dist = action_dist_fn({
+        k: v[:n] for k,v in net_output.items()
+        if k not in ['hidden', 'value']
+    })
+    log_probs = action_dist.log_prob(action)
+    entropy = action_dist.entropy()
+
+    log_rhos = log_probs.detach() - batch['log_prob']
+    vs, pg_advantages = vtrace(
+            log_rhos = log_rhos,
+            discounts = discount * (~done).float(),
+            rewards = batch['reward'],
+            values = values[:n].detach(),
+            bootstrap_value = values[n].detach(),
+            clip_rho_threshold = clip_rho_threshold,
+            clip_pg_rho_threshold = clip_rho_threshold,
+            clip_c_threshold = clip_c_threshold,
+    )
+
+    pg_loss = -(log_probs * pg_advantages).mean()
+    v_loss = 0.5 * ((vs - values[:n]) ** 2).mean()
+    entropy_loss = entropy.mean()
+    loss = pg_loss - entropy_loss_coeff * entropy_loss + v_loss * vf_loss_coeff
+
+    return {
+            'loss': loss,
+            'loss_pi': pg_loss,
+            'loss_vf': v_loss,
+            'loss_entropy': -entropy_loss,
+            'state_value': values.detach(),
+            'entropy': entropy.detach(),
+            'rho': log_rhos.exp(),
+    }
+
+
+def train_actor_learner(
+        model: torch.nn.Module,
+        env_fns: Sequence[Callable[[], gymnasium.Env]],
+        env_labels: Sequence[str],
+        optimizer: torch.optim.Optimizer,
+        action_dist_fn: Callable[[Dict[str, torch.Tensor]], torch.distributions.Distribution],
+        *,
+        num_actors: int = 4,
+        inference_precision: str = 'fp32',
+        trajectories_per_batch: Optional[int] = None,
+        queue_size: Optional[int] = None,
+        max_steps: int = 1000,
+        max_steps_total: int = -1,
+        rollout_length: int = 128,
+        obs_scale: Dict[str,float] = {},
+        obs_ignore: List[str] = ['obs (mission)'],
+        reward_scale: float = 1.0,
+        reward_clip: Optional[float] = 1.0,
+        max_grad_norm: float = 0.5,
+        discount: float = 0.99,
+        vf_loss_coeff: float = 0.5,
+        entropy_loss_coeff: float = 0.01,
+        clip_rho_threshold: Optional[float] = 1.0,
+        clip_c_threshold: Optional[float] = 1.0,
+        metric_logger: Optional[AsyncMetricLogger] = None,
+        start_step: int = 0,
+        ) -> Generator[Dict[str, int], None, None]:
+    """
+    Train a model with IMPALA. The environments are split evenly between `num_actors` actor processes, each of which steps its environments with a CPU copy of the model and sends trajectories of length `rollout_length` to the learner. The learner (this process) takes one gradient step for every `trajectories_per_batch` trajectories received.
+
+    Args:
+        env_fns: Functions that create each environment. Must be usable in a forked process.
+        env_labels: Task label of each environment, used for logging.
+        action_dist_fn: Function that takes the output of the model and returns the action distribution. The distribution's `log_prob` must return one value per environment.
+        inference_precision: Precision of the model used by the actors to select actions (see `LowPrecisionPolicy`). The learner always trains in full precision.
+        trajectories_per_batch: Number of trajectories in each training batch. Defaults to `num_actors`.
+        queue_size: Maximum number of trajectories waiting to be consumed by the learner. Actors block when the queue is full, which bounds how far behind the learner their policy can be. Defaults to `2*trajectories_per_batch`.
+        clip_rho_threshold: Truncation level for the importance weights in the V-trace targets and policy gradient.
+        clip_c_threshold: Truncation level for the trace-cutting coefficients in the V-trace targets.
+        metric_logger: Logger used for all W&B logging. If not provided, metrics are logged to W&B immediately.
+    """
+    if metric_logger is None:
+        metric_logger = AsyncMetricLogger(flush_interval=0)
+    if len(env_fns) < num_actors:
+        raise ValueError(f'Need at least one environment per actor. Got {len(env_fns)} environments for {num_actors} actors.')
+    if trajectories_per_batch is None:
+        trajectories_per_batch = num_actors
+    if queue_size is None:
+        queue_size = 2*trajectories_per_batch
+
+    global_step_counter = start_step
+    if max_steps_total > 0 and start_step > max_steps_total:
+        print(f'Start step ({start_step}) is greater than max_steps_total ({max_steps_total}). Exiting.')
+        return
+
+    device = next(model.parameters()).device
+
+    # Actors and learner share the weights through shared memory. `version` is incremented every time the weights are updated, and its lock guards the weights.
+    ctx = torch.multiprocessing.get_context('fork')
+    shared_state = {
+        k: v.detach().cpu().clone().share_memory_()
+        for k,v in model.state_dict().items()
+    }
+    version = ctx.Value('i', 0)
+    trajectory_queue = ctx.Queue(maxsize=queue_size)
+    stop_event = ctx.Event()
+
+    actor_model = copy.deepcopy(model).cpu()
+    env_splits = np.array_split(np.arange(len(env_fns)), num_actors)
+    actors = [
+        ctx.Process(
+            target = _actor,
+            kwargs = dict(
+                actor_id = i,
+                model = actor_model,
+                shared_state = shared_state,
+                version = version,
+                env_fns = [env_fns[j] for j in env_idx],
+                env_labels = [env_labels[j] for j in env_idx],
+                trajectory_queue = trajectory_queue,
+                stop_event = stop_event,
+                action_dist_fn = action_dist_fn,
+                rollout_length = rollout_length,
+                obs_scale = obs_scale,
+                obs_ignore = obs_ignore,
+                reward_scale = reward_scale,
+                reward_clip = reward_clip,
+                seed = int(env_idx[0]),
+                inference_precision = inference_precision,
+            ),
+            daemon = True,
+        )
+        for i,env_idx in enumerate(env_splits)
+    ]
+    for actor in actors:
+        actor.start()
+
+    try:
+        start_time = time.time()
+        while True:
+            if max_steps > 0 and global_step_counter-start_step >= max_steps:
+                print('Reached max steps')
+                break
+            if max_steps_total > 0 and global_step_counter >= max_steps_total:
+                print('Reached total max steps')
+                break
+
+            # Gather data
+            trajectories = []
+            while len(trajectories) < trajectories_per_batch:
+                try:
+                    trajectories.append(trajectory_queue.get(timeout=10))
+                except queue.Empty:
+                    if not all(actor.is_alive() for actor in actors):
+                        raise RuntimeError('An actor process died.')
+            batch = _collate_trajectories(trajectories, device)
+            global_step_counter += batch['done'].numel()
+
+            episode_rewards = defaultdict(list)
+            episode_steps = defaultdict(list)
+            for t in trajectories:
+                for label,reward,steps in t['episodes']:
+                    episode_rewards[label].append(reward)
+                    episode_steps[label].append(steps)
+            for label in episode_rewards.keys():
+                print(f'  reward: {np.mean(episode_rewards[label]):.2f}\t len: {np.mean(episode_steps[label]):.2f} \t env: {label} ({len(episode_rewards[label])})')
+                if wandb.run is not None:
+                    metric_logger.log({
+                        f'reward/{label}': np.mean(episode_rewards[label]),
+                        f'episode_length/{label}': np.mean(episode_steps[label]),
+                        'step': global_step_counter-start_step,
+                        'step_total': global_step_counter,
+                    }, step = global_step_counter)
+
+            # Train
+            losses = compute_vtrace_losses(
+                    model = model,
+                    batch = batch,
+                    action_dist_fn = action_dist_fn,
+                    discount = discount,
+                    vf_loss_coeff = vf_loss_coeff,
+                    entropy_loss_coeff = entropy_loss_coeff,
+                    clip_rho_threshold = clip_rho_threshold,
+                    clip_c_threshold = clip_c_threshold,
+            )
+            optimizer.zero_grad()
+            losses['loss'].backward()
+            if max_grad_norm is not None:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm) # type: ignore
+            optimizer.step()
+
+            # Publish the new weights
+            with version.get_lock():
+                for k,v in model.state_dict().items():
+                    shared_state[k].copy_(v)
+                version.value += 1
+                policy_lag = np.mean([version.value - t['version'] for t in trajectories])
+
+            if wandb.run is not None:
+                metric_logger.log({
+                    'loss/pi': losses['loss_pi'],
+                    'loss/v': losses['loss_vf'],
+                    'loss/entropy': losses['loss_entropy'],
+                    'loss/total': losses['loss'],
+                    'state_value': losses['state_value'].mean(),
+                    'entropy': losses['entropy'].mean(),
+                    'rho': losses['rho'].mean(),
+                    'policy_lag': policy_lag,
+                    'steps_per_second': (global_step_counter-start_step) / (time.time()-start_time),
+                    'step': global_step_counter-start_step,
+                    'step_total': global_step_counter,
+                }, step = global_step_counter)
+            metric_logger.step()
+
+            yield {
+                'step': global_step_counter,
+            }
+    finally:
+        metric_logger.close()
+        stop_event.set()
+        for actor in actors:
+            # Actors that are blocked on a full queue won't see the stop event
+            actor.join(timeout=1)
+            if actor.is_alive():
+                actor.terminate()
+        trajectory_queue.cancel_join_thread()
+        trajectory_queue.close()
@@ -0,0 +1,596 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+import hashlib
+import json
+import os
+import queue
+import threading
+import warnings
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+
+import cv2
+import gymnasium.vector
+import h5py
+import numpy as np
+import torch
+import torch.multiprocessing
+from tqdm import tqdm
+
+from big_rl.model.model import introspection
+from big_rl.utils import torch_save
+
+
+def select_batch(x, index: int):
+    """ Select batch element `index` from a (nested list/tuple/dict of) tensors whose second to last dimension is the batch dimension, as is the case for the hidden states and the recorded attention of the models. The batch dimension is kept with size 1, so the results have the same shape as when the model is run with a batch size of 1. """
+    if isinstance(x, torch.Tensor):
+        return x[..., index:index+1, :]
+    if isinstance(x, (list, tuple)):
+        return type(x)(select_batch(y, index) for y in x)
+    if isinstance(x, dict):
+        return {k: select_batch(v, index) for k,v in x.items()}
+    return x
+
+
+def env_info(info: Dict[str, Any], index: int) -> Dict[str, Any]:
+    """ Info dictionary of environment `index` from the info of a vector environment. Supports both the gymnasium>=1.0 format (dictionary of arrays with `_key` masks) and the older format where final infos are stored as an array of dictionaries in `info['final_info']`. """
+    output = {}
+    for k,v in info.items():
+        if k.startswith('_'):
+            continue
+        if k == 'final_info':
+            if isinstance(v, dict):
+                final_info = env_info(v, index)
+            elif v[index] is not None:
+                final_info = v[index]
+            else:
+                continue
+            output.update(final_info)
+            continue
+        if k == 'final_observation' or k == 'final_obs':
+            continue
+        mask = info.get(f'_{k}')
+        if mask is not None and not mask[index]:
+            continue
+        if isinstance(v, dict):
+            output[k] = env_info(v, index)
+        elif isinstance(v, (np.ndarray, list, tuple)):
+            output[k] = v[index]
+        else:
+            output[k] = v
+    return output
+
+
+def _autoreset_next_step(env) -> bool:
+    """ True if the vector environment resets finished environments on the step after they finish (gymnasium>=1.0 default), and False if the reset observation is returned on the same step as the final transition. """
+    mode = getattr(env, 'metadata', {}).get('autoreset_mode')
+    return mode is not None and getattr(mode, 'value', mode) == 'NextStep'
+
+
+def evaluate_vector_env(
+        model: torch.nn.Module,
+        env: gymnasium.vector.VectorEnv,
+        num_episodes: int,
+        preprocess_obs_fn: Callable[[Any], Dict[str, torch.Tensor]],
+        sample_action_fn: Callable[[Dict[str, Any]], np.ndarray],
+        init_results_fn: Callable[[], Dict[str, Any]] = lambda: {'reward': []},
+        record_fn: Optional[Callable[..., None]] = None,
+        reward_fn: Optional[Callable[[float, Dict[str, Any]], float]] = None,
+        introspect: bool = False,
+        env_attrs: Sequence[str] = (),
+        episode_fn: Optional[Callable[[int, Dict[str, Any]], Optional[Dict[str, Any]]]] = None,
+        max_steps: Optional[int] = None,
+        seed: Optional[int] = None,
+        verbose: bool = False) -> List[Dict[str, Any]]:
+    """ Run `num_episodes` episodes on the environments of `env` in parallel, with one batched forward pass per step.
+
+    Each environment runs its episodes one after another, and the hidden state of an environment is reset whenever it starts a new episode. Episodes are numbered in the order they start, and once `num_episodes` episodes have started, environments that finish stop recording and keep running until all started episodes are done. Episodes that take longer are therefore not under-represented, as they would be if the first `num_episodes` episodes to finish were kept.
+
+    Args:
+        model: The model to evaluate. Models without a hidden state (i.e. without an `init_hidden` method) are called with the observations only.
+        env: Vector environment. Both the same-step and next-step autoreset modes are supported.
+        num_episodes: Number of episodes to run.
+        preprocess_obs_fn: Convert a batch of observations from `env` to the model's inputs.
+        sample_action_fn: Sample a batch of actions from the model's output.
+        init_results_fn: Create the per-step result streams of a new episode.
+        record_fn: Called as `record_fn(results, model, model_output, index, reward, info, done)` after each transition of an episode, where `results` is the episode's result streams, `index` the index of its environment in the batch (see `select_batch`), `info` the environment's info dictionary (see `env_info`), and `done` whether the episode ended with this transition. By default, only the reward is recorded.
+        reward_fn: Reward added to the episode reward for each transition, given the environment reward and info. Defaults to the environment reward.
+        introspect: Run the model with introspection enabled (see `big_rl.model.model.introspection`), so that attention weights can be recorded by `record_fn`.
+        env_attrs: Attributes read from each environment (with `env.get_attr`) after every step and added to the info dictionary passed to `record_fn`. Each attribute costs one round trip to the environments per step.
+        episode_fn: Called as `episode_fn(episode_number, episode)` when an episode finishes, e.g. to write it to disk with `ResultsWriter`. If it returns a value, the value replaces the episode in the returned list, so the episode's result streams don't need to be kept in memory.
+        max_steps: Maximum number of steps of each episode. Episodes that reach it are truncated.
+        seed: Seed passed to `env.reset()`.
+        verbose: Show a progress bar.
+
+    Returns:
+        A list of `num_episodes` dictionaries ordered by episode number, each with keys 'episode_reward', 'episode_length' and 'results' (the result streams).
+    """
+    num_envs = env.num_envs
+    next_step_reset = _autoreset_next_step(env)
+
+    episodes: List[Optional[Dict[str, Any]]] = [None] * num_episodes
+    current = [-1] * num_envs # Episode running on each environment, or -1 if it isn't recorded
+    num_started = 0
+    num_finished = 0
+
+    def start_episode(i):
+        nonlocal num_started
+        if num_started >= num_episodes:
+            current[i] = -1
+            return
+        current[i] = num_started
+        episodes[num_started] = {
+            'episode_reward': 0.,
+            'episode_length': 0,
+            'results': init_results_fn(),
+        }
+        num_started += 1
+
+    def finish_episode(ep):
+        nonlocal num_finished
+        num_finished += 1
+        pbar.update(1)
+        if episode_fn is not None:
+            output = episode_fn(ep, episodes[ep]) # type: ignore
+            if output is not None:
+                episodes[ep] = output
+
+    pbar = tqdm(total=num_episodes, desc='Test', disable=not verbose)
+    obs, _ = env.reset(seed=seed)
+    for i in range(num_envs):
+        start_episode(i)
+    recurrent = hasattr(model, 'init_hidden')
+    hidden = model.init_hidden(num_envs) if recurrent else None # type: ignore
+    resetting = np.zeros(num_envs, dtype=bool) # Environments whose next transition is a reset (next-step autoreset only)
+
+    while num_finished < num_started or num_started < num_episodes:
+        with torch.no_grad(), introspection(model, introspect):
+            if recurrent:
+                model_output = model(preprocess_obs_fn(obs), hidden)
+                hidden = model_output['hidden']
+            else:
+                model_output = model(preprocess_obs_fn(obs))
+        action = sample_action_fn(model_output)
+
+        obs, reward, terminated, truncated, info = env.step(action)
+        done = terminated | truncated
+        attrs = {k: env.get_attr(k) for k in env_attrs}
+
+        new_episode = np.zeros(num_envs, dtype=bool)
+        for i in range(num_envs):
+            if resetting[i]:
+                # The action was ignored and `obs` is the first observation of the next episode
+                resetting[i] = False
+                new_episode[i] = True
+                start_episode(i)
+                continue
+            ep = current[i]
+            if ep >= 0:
+                episode = episodes[ep]
+                assert episode is not None
+                info_i = env_info(info, i)
+                info_i.update({k: v[i] for k,v in attrs.items()})
+                episode['episode_length'] += 1
+                episode['episode_reward'] += float(reward[i]) if reward_fn is None else float(reward_fn(reward[i], info_i))
+                truncate = max_steps is not None and episode['episode_length'] >= max_steps
+                if record_fn is None:
+                    episode['results']['reward'].append(reward[i])
+                else:
+                    record_fn(episode['results'], model, model_output, i, reward[i], info_i, bool(done[i]) or truncate)
+                if truncate and not done[i]:
+                    # The environment keeps running, but the rest of the episode isn't recorded
+                    current[i] = -1
+                    finish_episode(ep)
+                    continue
+            if done[i]:
+                if ep >= 0:
+                    finish_episode(ep)
+                if next_step_reset:
+                    current[i] = -1
+                    resetting[i] = True
+                else:
+                    new_episode[i] = True
+                    start_episode(i)
+        if recurrent and new_episode.any():
+            hidden = model.reset_hidden_(hidden, new_episode) # type: ignore
+    pbar.close()
+
+    return episodes # type: ignore
+
+
+def episode_summary(episode: Mapping[str, Any], keys: Sequence[str] = ('reward', 'regret', 'target')) -> Dict[str, Any]:
+    """ Copy of an episode without the per-step result streams that aren't in `keys`. The entries of the results that aren't lists (e.g. 'supervision') are kept. Used to keep the results that are needed for the printed summaries in memory when the full results are written to disk. """
+    return {
+        **episode,
+        'results': {
+            k: v for k,v in episode['results'].items()
+            if k in keys or not isinstance(v, list)
+        },
+    }
+
+
+class ResultsStore:
+    """
+    Results of many evaluation jobs stored in one directory.
+
+    Each job is identified by a dictionary of parameters (e.g. checkpoint, environment, seed and evaluation settings). The results of a job (the list returned by `evaluate_vector_env` or the evaluation scripts' `test()`) are saved to their own file (an HDF5 file written with `ResultsWriter`, or a `torch.save` pickle if `format` is 'pt') named after a hash of the job's parameters, and a line with the job's parameters, a summary of its results and the name of the results file is appended to `index.jsonl`. The index can be read without loading any results, and jobs that are already in the index can be skipped when an interrupted evaluation is restarted.
+
+    Usage:
+
+        store = ResultsStore('results/')
+        if not store.contains(job):
+            store.write(job, test_results)
+        for entry in store.index():
+            if entry['job']['env'] == 'fetch-004':
+                with store.load(entry) as reader:
+                    hidden = reader.episode(0, prefix='hidden')
+    """
+    INDEX_FILENAME = 'index.jsonl'
+
+    def __init__(self, directory: str, format: str = 'h5'):
+        if format not in ['h5', 'pt']:
+            raise ValueError(f'Unknown results format {format}. Valid values are: h5, pt.')
+        self.directory = directory
+        self.format = format
+        os.makedirs(directory, exist_ok=True)
+        self._index_filename = os.path.join(directory, self.INDEX_FILENAME)
+        self._keys = {self.key(entry['job']) for entry in self.index() if 'error' not in entry}
+
+    @staticmethod
+    def key(job: Mapping[str, Any]) -> str:
+        """ String that uniquely identifies a job. """
+        return json.dumps(dict(job), sort_keys=True)
+
+    def filename(self, job: Mapping[str, Any]) -> str:
+        """ Name of the results file of `job`, relative to the store's directory. It only depends on the job, so it is the same whichever order the jobs are written in, and a job that runs again after failing overwrites its own partial results. """
+        return f'{hashlib.sha1(self.key(job).encode()).hexdigest()[:16]}.{self.format}'
+
+    def path(self, job: Mapping[str, Any]) -> str:
+        """ Path of the results file of `job` (see `filename`). """
+        return os.path.join(self.directory, self.filename(job))
+
+    def contains(self, job: Mapping[str, Any]) -> bool:
+        """ Whether the results of `job` are already stored. Failed jobs don't count. """
+        return self.key(job) in self._keys
+
+    def index(self) -> List[Dict[str, Any]]:
+        """ All entries of the index, in the order they were written. """
+        if not os.path.exists(self._index_filename):
+            return []
+        with open(self._index_filename, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def write(self, job: Mapping[str, Any], results: List[Dict[str, Any]], **metadata):
+        """ Save the results of `job` and add it to the index. Extra keyword arguments are added to its index entry. """
+        if self.format == 'h5':
+            with ResultsWriter(self.path(job)) as writer:
+                for i,episode in enumerate(results):
+                    writer.write_episode(episode, index=i)
+        else:
+            torch_save(results, self.path(job))
+        self.add(job, results, **metadata)
+
+    def add(self, job: Mapping[str, Any], results: List[Dict[str, Any]], **metadata):
+        """ Add `job` to the index without writing its results, for results that were already saved to `path(job)` in the store's format, e.g. by a worker process with a `ResultsWriter`. Only the 'episode_reward' and 'episode_length' of each episode are used, so `results` can be a list of episode summaries (see `episode_summary`). Extra keyword arguments are added to its index entry. """
+        rewards = [float(r['episode_reward']) for r in results]
+        self._append({
+            'job': dict(job),
+            'results': self.filename(job),
+            'episode_reward': rewards,
+            'episode_length': [int(r['episode_length']) for r in results],
+            'reward_mean': float(np.mean(rewards)) if len(rewards) > 0 else None,
+            'reward_std': float(np.std(rewards)) if len(rewards) > 0 else None,
+            **metadata,
+        })
+        self._keys.add(self.key(job))
+
+    def write_error(self, job: Mapping[str, Any], error: str):
+        """ Record that `job` failed. It isn't considered complete, so it runs again on restart. """
+        self._append({'job': dict(job), 'error': error})
+
+    def load(self, entry: Mapping[str, Any]) -> Union[List[Dict[str, Any]], 'ResultsReader']:
+        """ Load the results of an index entry. HDF5 results are returned as a `ResultsReader`, which must be closed by the caller, and pickled results as a list of episodes. """
+        filename = os.path.join(self.directory, entry['results'])
+        if filename.endswith('.h5'):
+            return ResultsReader(filename)
+        return torch.load(filename, weights_only=False)
+
+    def _append(self, entry: Dict[str, Any]):
+        with open(self._index_filename, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+def _flatten(value, prefix: str = '') -> Iterable[Tuple[str, Any]]:
+    """ Flatten a nested structure of dicts, lists and tuples into `(name, leaf)` pairs, where the name is the path to the leaf joined with '/'. """
+    if isinstance(value, Mapping):
+        for k,v in value.items():
+            yield from _flatten(v, f'{prefix}/{k}' if prefix else str(k))
+    elif isinstance(value, (list, tuple)):
+        for i,v in enumerate(value):
+            yield from _flatten(v, f'{prefix}/{i}' if prefix else str(i))
+    else:
+        yield prefix, value
+
+
+def _stack_column(values: Sequence) -> np.ndarray:
+    """ Stack the values of a column into one array. Strings are stored as variable length strings, and missing values (None) as NaN. """
+    if any(isinstance(v, str) for v in values):
+        return np.array(['' if v is None else v for v in values], dtype=object)
+    values = [v.detach().cpu().numpy() if isinstance(v, torch.Tensor) else v for v in values]
+    if any(v is None for v in values):
+        values = [np.nan if v is None else v for v in values]
+        return np.asarray(values, dtype=np.float64)
+    return np.stack([np.asarray(v) for v in values])
+
+
+def _json_default(x):
+    if isinstance(x, torch.Tensor):
+        return x.tolist()
+    if isinstance(x, (np.ndarray, np.generic)):
+        return x.tolist()
+    raise TypeError(f'Object of type {type(x).__name__} is not JSON serializable')
+
+
+class ResultsWriter:
+    """
+    Writes evaluation results to an HDF5 file one episode at a time, in a columnar layout.
+
+    The episodes have the format returned by the evaluation scripts' `test()` (`{'episode_reward': ..., 'episode_length': ..., 'results': {...}}`). Each per-step stream of `results` (e.g. 'reward', 'hidden', 'attention') is flattened into one or more columns, one per array in the stream's nested structure (e.g. 'hidden/0', 'hidden/1', 'attention/0/1', 'attention/2/action'). The rows of all episodes are appended to the same chunked and compressed dataset under `/steps`, and `/episodes` holds the offset, length, reward and number of each episode. The other entries of `results` (e.g. 'supervision') are stored as one JSON string per episode.
+
+    Only the episode being written is held in memory, so the memory usage doesn't grow with the number of episodes. The file is flushed after each episode, so the episodes written before a crash can still be read. Use `ResultsReader` to read the file.
+    """
+    def __init__(self, filename: str, compression: Optional[str] = 'gzip', step_keys: Optional[Sequence[str]] = None):
+        """
+        Args:
+            filename: Path of the HDF5 file. It is overwritten if it exists.
+            compression: HDF5 compression filter of the step columns ('gzip', 'lzf' or None).
+            step_keys: Keys of `results` that are per-step streams. By default, every list whose length is the episode length is a per-step stream.
+        """
+        self.file = h5py.File(filename, 'w')
+        self.compression = compression
+        self.step_keys = step_keys
+        self._columns: List[str] = []
+        self._num_steps = 0
+        self._num_episodes = 0
+        self.file.attrs['columns'] = json.dumps(self._columns)
+
+    def _append(self, name: str, rows: np.ndarray, offset: int, compression: Optional[str] = None):
+        """ Write `rows` to dataset `name` starting at row `offset`, creating or resizing it as needed. """
+        if name not in self.file:
+            if rows.dtype == object:
+                dtype = h5py.string_dtype()
+            else:
+                dtype = rows.dtype
+            fillvalue = np.nan if np.issubdtype(rows.dtype, np.floating) else None
+            self.file.create_dataset(
+                    name, shape=(0, *rows.shape[1:]), maxshape=(None, *rows.shape[1:]), dtype=dtype,
+                    chunks=True, compression=compression, fillvalue=fillvalue)
+        dataset = self.file[name]
+        assert isinstance(dataset, h5py.Dataset)
+        if dataset.shape[1:] != rows.shape[1:]:
+            raise ValueError(f'Shape mismatch for column "{name}": expected {dataset.shape[1:]}, got {rows.shape[1:]}.')
+        if dataset.shape[0] < offset + len(rows):
+            dataset.resize(offset + len(rows), axis=0)
+        dataset[offset:offset+len(rows)] = rows
+
+    def write_episode(self, episode: Mapping[str, Any], index: Optional[int] = None):
+        """ Append an episode. `index` is the episode's number (e.g. its position in the list returned by `test()`), which defaults to the number of episodes written so far. """
+        results = episode['results']
+        length = int(episode['episode_length'])
+        if self.step_keys is not None:
+            step_keys = [k for k in self.step_keys if k in results and len(results[k]) > 0]
+        else:
+            step_keys = [k for k,v in results.items() if isinstance(v, list) and len(v) == length and length > 0]
+
+        # Step columns
+        columns: Dict[str, List] = {}
+        for key in step_keys:
+            if len(results[key]) != length:
+                raise ValueError(f'Stream "{key}" has {len(results[key])} steps, but the episode has {length}.')
+            for step in results[key]:
+                for name, value in _flatten(step, key):
+                    columns.setdefault(name, []).append(value)
+        for name, values in columns.items():
+            if len(values) != length:
+                raise ValueError(f'Column "{name}" is missing from some steps.')
+            self._append(f'steps/{name}', _stack_column(values), self._num_steps, self.compression)
+            if name not in self._columns:
+                self._columns.append(name)
+                self.file.attrs['columns'] = json.dumps(self._columns)
+
+        # Per-episode data
+        extra = {k: v for k,v in results.items() if k not in step_keys}
+        n = self._num_episodes
+        self._append('episodes/index', np.array([n if index is None else index], dtype=np.int64), n)
+        self._append('episodes/offset', np.array([self._num_steps], dtype=np.int64), n)
+        self._append('episodes/length', np.array([length], dtype=np.int64), n)
+        self._append('episodes/reward', np.array([episode['episode_reward']], dtype=np.float64), n)
+        self._append('episodes/extra', np.array([json.dumps(extra, default=_json_default)], dtype=object), n)
+
+        self._num_steps += length
+        self._num_episodes += 1
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResultsReader:
+    """
+    Reads a file written by `ResultsWriter`. Columns are read lazily, so only the columns (and episodes) that are accessed are loaded from disk. Episodes are ordered by their episode number, not by the order in which they were written.
+
+    Usage:
+
+        with ResultsReader('results.h5') as reader:
+            rewards = reader.episode_reward
+            hidden = reader.episode(0, prefix='hidden') # {'hidden/0': array of shape (episode_length, ...), ...}
+            all_rewards = reader['reward'][:] # All steps of all episodes
+    """
+    def __init__(self, filename: str):
+        self.file = h5py.File(filename, 'r')
+        self._columns: List[str] = json.loads(self.file.attrs['columns']) # type: ignore
+        if 'episodes' in self.file:
+            index = self.file['episodes/index'][:] # type: ignore
+            self._order = np.argsort(index, kind='stable')
+            self.episode_index = index[self._order]
+            self._offset = self.file['episodes/offset'][:][self._order] # type: ignore
+            self.episode_length = self.file['episodes/length'][:][self._order] # type: ignore
+            self.episode_reward = self.file['episodes/reward'][:][self._order] # type: ignore
+        else:
+            self._order = np.zeros(0, dtype=np.int64)
+            self.episode_index = self._offset = self.episode_length = np.zeros(0, dtype=np.int64)
+            self.episode_reward = np.zeros(0)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def columns(self, prefix: Optional[str] = None) -> List[str]:
+        """ Names of the step columns, in the order they were created. If `prefix` is given, only the columns of that stream (e.g. 'hidden' gives 'hidden/0', 'hidden/1', ...) are returned. """
+        if prefix is None:
+            return list(self._columns)
+        return [c for c in self._columns if c == prefix or c.startswith(prefix + '/')]
+
+    def __getitem__(self, column: str):
+        """ The dataset of a step column, with the rows of all episodes in the order they were written. It is read lazily when sliced. String columns are decoded to `str`. """
+        dataset = self.file[f'steps/{column}']
+        assert isinstance(dataset, h5py.Dataset)
+        if h5py.check_string_dtype(dataset.dtype) is not None:
+            return dataset.asstr()
+        return dataset
+
+    def episode(self, i: int, columns: Optional[Sequence[str]] = None, prefix: Optional[str] = None) -> Dict[str, np.ndarray]:
+        """ Load the step columns of episode `i`. By default, all columns are loaded. `columns` selects columns by name, and `prefix` selects the columns of one stream (see `columns()`). """
+        if columns is None:
+            columns = self.columns(prefix)
+        start = self._offset[i]
+        end = start + self.episode_length[i]
+        return {c: self[c][start:end] for c in columns}
+
+    def extra(self, i: int) -> Dict[str, Any]:
+        """ The entries of episode `i`'s results that aren't per-step streams (e.g. 'supervision'). """
+        return json.loads(self.file['episodes/extra'].asstr()[self._order[i]]) # type: ignore
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_END_OF_VIDEO = object() # Tells the writer thread of `AsyncVideoWriter` to stop
+
+
+class AsyncVideoWriter:
+    """
+    Writes a video in the background. Each frame is given as a snapshot of the values needed to draw it, which `compose_frame_fn` turns into a BGR image (as expected by `cv2.VideoWriter`).
+
+    The frames are drawn by a pool of `num_workers` processes (or by a background thread if `num_workers` is 0) and written to the video file by a background thread, in order. `compose_frame_fn` and the snapshots must be picklable if `num_workers` is greater than 0. At most `max_queue_size` frames are waiting to be drawn or written at any time. If the workers fall further behind than that, new frames are dropped (with a warning, and counted in `num_dropped_frames`) so that the caller isn't slowed down, unless `block` is True, in which case `write()` waits for the workers. Errors raised while drawing or writing a frame are raised by the next call to `ready()`, `write()` or `close()`.
+    """
+    def __init__(self, filename: str,
+                 compose_frame_fn: Callable[[Any], np.ndarray],
+                 size: Optional[Tuple[int,int]] = None,
+                 fps: int = 30,
+                 num_workers: int = 2,
+                 max_queue_size: int = 64,
+                 block: bool = False):
+        if not filename.endswith('.webm'):
+            raise ValueError('filename must end with .webm')
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        self.filename = filename
+        self.compose_frame_fn = compose_frame_fn
+        self.fps = fps
+        self.block = block
+        self.num_dropped_frames = 0
+
+        if size is not None:
+            self._video_writer = cv2.VideoWriter( # type: ignore
+                    filename,
+                    cv2.VideoWriter_fourcc(*'VP80'), # type: ignore
+                    fps,
+                    size,
+            )
+        else:
+            self._video_writer = None
+
+        if num_workers > 0:
+            # Spawn rather than fork, so the workers don't inherit the main process's threads
+            ctx = torch.multiprocessing.get_context('spawn')
+            self._pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx)
+        else:
+            self._pool = None
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_frames, daemon=True)
+        self._thread.start()
+
+    def get_video_writer(self, frame=None):
+        if self._video_writer is None:
+            assert frame is not None
+            self._video_writer = cv2.VideoWriter( # type: ignore
+                    self.filename,
+                    cv2.VideoWriter_fourcc(*'VP80'), # type: ignore
+                    self.fps,
+                    (frame.shape[1], frame.shape[0]),
+            )
+        return self._video_writer
+
+    def _write_frames(self):
+        while True:
+            item = self._queue.get()
+            if item is _END_OF_VIDEO:
+                return
+            if self._error is not None:
+                continue # Keep emptying the queue so `write()` doesn't wait forever
+            try:
+                if isinstance(item, Future):
+                    frame = item.result()
+                else:
+                    frame = self.compose_frame_fn(item)
+                self.get_video_writer(frame).write(frame)
+            except Exception as e:
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f'Failed to save a frame to {self.filename}') from self._error
+
+    def ready(self) -> bool:
+        """ Check whether the next frame can be queued. If it can't, the frame is counted as dropped, so the caller should skip it (and avoid the cost of taking its snapshot). Always True if `block` is True. """
+        self._raise_error()
+        # The caller is the only producer, so the queue can't fill up between this check and `write()`
+        if not self.block and self._queue.full():
+            if self.num_dropped_frames == 0:
+                warnings.warn(f'The video workers are falling behind. Frames of {self.filename} are being dropped.')
+            self.num_dropped_frames += 1
+            return False
+        return True
+
+    def write(self, snapshot):
+        """ Queue a frame to be drawn from `snapshot` and written. Call `ready()` first to drop the frame instead of blocking when the workers are behind. """
+        self._raise_error()
+        if self._pool is not None:
+            self._queue.put(self._pool.submit(self.compose_frame_fn, snapshot))
+        else:
+            self._queue.put(snapshot)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_END_OF_VIDEO)
+            self._thread.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self._video_writer is not None:
+            self._video_writer.release()
+            self._video_writer = None
+        if self.num_dropped_frames > 0:
+            warnings.warn(f'Dropped {self.num_dropped_frames} frames of {self.filename}.')
+        self._raise_error()
@@ -0,0 +1,104 @@
+import threading
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+import torch
+import wandb
+
+
+class AsyncMetricLogger:
+    """
+    Logs metrics without synchronizing with the device that computed them.
+
+    Values passed to `log()` can be scalar tensors on any device. They are kept on their device until the next flush, where all pending values on a device are stacked and copied to the host in one non-blocking transfer. The copied values are sent to `log_fn` at the following flush (or on `close()`), by which time the transfer has normally completed, so the training loop never waits on the device. Entries are always sent to `log_fn` in the order they were logged, so W&B steps remain monotonic as long as every `wandb.log` call goes through the same logger.
+
+    If `flush_interval` is 0, values are converted and logged immediately, which is equivalent to calling `log_fn` directly.
+    """
+    def __init__(self, log_fn: Optional[Callable[..., Any]] = None, flush_interval: int = 1):
+        """
+        Args:
+            log_fn: Function called as `log_fn(data, step=step)`. Defaults to `wandb.log`, looked up when logging so that it refers to the current run.
+            flush_interval: Number of calls to `step()` between flushes. If 0, values are logged immediately.
+        """
+        self._log_fn = log_fn
+        self.flush_interval = flush_interval
+
+        self._pending: List[Tuple[Optional[int], Dict[str, Any]]] = []
+        self._in_flight = None
+        self._num_steps = 0
+        self._lock = threading.Lock()
+
+    def _send(self, data: Dict[str, Any], step: Optional[int]):
+        log_fn = self._log_fn if self._log_fn is not None else wandb.log
+        log_fn(data, step=step)
+
+    def log(self, data: Mapping[str, Any], step: Optional[int] = None):
+        """ Queue a dictionary of metrics. Tensor values must be scalars. """
+        if self.flush_interval == 0:
+            with self._lock:
+                self._send({k: v.item() if isinstance(v, torch.Tensor) else v for k,v in data.items()}, step)
+            return
+        with self._lock:
+            self._pending.append((step, {
+                k: v.detach() if isinstance(v, torch.Tensor) else v
+                for k,v in data.items()
+            }))
+
+    def step(self):
+        """ Mark the end of a training update. Pending metrics are flushed every `flush_interval` updates. """
+        self._num_steps += 1
+        if self.flush_interval > 0 and self._num_steps % self.flush_interval == 0:
+            self.flush()
+
+    def flush(self, wait: bool = False):
+        """ Send the metrics from the previous flush to `log_fn` and start copying the pending metrics to the host. If `wait` is True, the pending metrics are also sent. """
+        with self._lock:
+            self._send_in_flight()
+            pending, self._pending = self._pending, []
+            if len(pending) == 0:
+                return
+
+            # Stack the tensors on each device so that each device only needs one copy
+            tensors: Dict[torch.device, List[torch.Tensor]] = {}
+            for _,data in pending:
+                for v in data.values():
+                    if isinstance(v, torch.Tensor):
+                        tensors.setdefault(v.device, []).append(v)
+            host_values = {}
+            events = []
+            for device, values in tensors.items():
+                stacked = torch.stack([v.float().reshape(()) for v in values])
+                if device.type == 'cuda':
+                    host = torch.empty(stacked.shape, dtype=stacked.dtype, pin_memory=True)
+                    host.copy_(stacked, non_blocking=True)
+                    event = torch.cuda.Event()
+                    event.record()
+                    events.append(event)
+                else:
+                    host = stacked.to('cpu')
+                host_values[device] = host
+
+            self._in_flight = (pending, host_values, events)
+            if wait:
+                self._send_in_flight()
+
+    def _send_in_flight(self):
+        if self._in_flight is None:
+            return
+        pending, host_values, events = self._in_flight
+        self._in_flight = None
+        for event in events:
+            event.synchronize()
+        index = {device: 0 for device in host_values.keys()}
+        for step, data in pending:
+            output = {}
+            for k,v in data.items():
+                if isinstance(v, torch.Tensor):
+                    output[k] = host_values[v.device][index[v.device]].item()
+                    index[v.device] += 1
+                else:
+                    output[k] = v
+            self._send(output, step)
+
+    def close(self):
+        """ Send all pending metrics. """
+        self.flush(wait=True)
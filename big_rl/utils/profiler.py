@@ -0,0 +1,120 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import torch
+
+
+class PhaseTimer:
+    """
+    Wall-clock timer for the phases of a training loop (env stepping, inference, backward pass, etc.). The last `window` durations of each phase are kept, and percentiles over that window are reported, along with the cumulative fraction of all recorded time (since the last `reset()`) spent in each phase.
+
+    Phases are named `{phase}/{group}` when a group is given (e.g. the task group that the environments belong to), and `{phase}` otherwise. Timings can be recorded from multiple threads.
+
+    If `enabled` is False, `time()` returns a no-op context manager so that the instrumented code can be left in place at no cost.
+
+    Usage:
+
+        timer = PhaseTimer()
+        with timer.time('env_step', 'fetch'):
+            env.step(action)
+        timer.report(step=...)
+    """
+    def __init__(self,
+            enabled: bool = True,
+            window: int = 100,
+            percentiles: Sequence[int] = (50, 90, 99),
+            cuda_sync: bool = False,
+            jsonl_path: Optional[str] = None):
+        """
+        Args:
+            enabled: If False, nothing is recorded.
+            window: Number of recent durations kept for each phase.
+            percentiles: Percentiles that are reported for each phase.
+            cuda_sync: If True, CUDA is synchronized at the start and end of each phase so that asynchronous GPU work is attributed to the phase that launched it. This slows down training.
+            jsonl_path: If provided, each report is appended to this file as one line of JSON.
+        """
+        self.enabled = enabled
+        self.window = window
+        self.percentiles = percentiles
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.jsonl_path = jsonl_path
+
+        self._durations = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self._totals = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def time(self, phase: str, group: Optional[str] = None):
+        """ Context manager that records the time spent in its body under the given phase. """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._time(phase if group is None else f'{phase}/{group}')
+
+    @contextlib.contextmanager
+    def _time(self, name: str):
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.cuda_sync:
+                torch.cuda.synchronize()
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, duration: float):
+        """ Record a duration (in seconds) that was measured elsewhere. """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._durations[name].append(duration)
+            self._totals[name] += duration
+
+    def summary(self) -> Dict[str, float]:
+        """ Percentiles (in milliseconds) of the last `window` durations of each phase, and the fraction of all the time recorded since the last `reset()` that was spent in each phase. The fraction is cumulative rather than computed over the window, because phases that run at different rates have windows covering different periods. Keys are of the form `time/{phase}/p50` and `time/{phase}/cumulative_fraction`. """
+        with self._lock:
+            durations = {k: np.array(v) for k,v in self._durations.items() if len(v) > 0}
+            totals = dict(self._totals)
+        output = {}
+        grand_total = sum(totals.values())
+        for name in sorted(durations.keys()):
+            values = np.percentile(durations[name], self.percentiles) * 1000
+            for p,v in zip(self.percentiles, values):
+                output[f'time/{name}/p{p}'] = float(v)
+            if grand_total > 0:
+                output[f'time/{name}/cumulative_fraction'] = totals[name] / grand_total
+        return output
+
+    def report(self, step: Optional[int] = None, console: bool = True) -> Dict[str, float]:
+        """ Print the summary to the console and append it to the JSONL file, if there is one. The summary is returned so that it can be logged elsewhere (e.g. W&B). """
+        summary = self.summary()
+        if not self.enabled or len(summary) == 0:
+            return summary
+        if console:
+            print(self.format_summary(summary))
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps({'step': step, 'time': time.time(), **summary}) + '\n')
+        return summary
+
+    def format_summary(self, summary: Dict[str, float]) -> str:
+        names = sorted(set(k[len('time/'):k.rindex('/')] for k in summary.keys()))
+        width = max(len(n) for n in names)
+        header = f'{"phase":<{width}}' + ''.join(f'{f"p{p} (ms)":>12}' for p in self.percentiles) + f'{"cum. %":>8}'
+        lines = [header]
+        for name in names:
+            line = f'{name:<{width}}'
+            for p in self.percentiles:
+                line += f'{summary[f"time/{name}/p{p}"]:>12.2f}'
+            line += f'{summary.get(f"time/{name}/cumulative_fraction", 0) * 100:>8.1f}'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._durations.clear()
+            self._totals.clear()
@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from big_rl.minigrid.envs import make_env
+from big_rl.minigrid.arguments import init_parser_model
+from big_rl.minigrid.common import env_config_presets, init_model
+#from big_rl.mujoco.envs import make_env
+#from big_rl.mujoco.common import env_config_presets, init_model
+
+from big_rl.utils import merge_space, obs_to_tensor
+from big_rl.model.model import introspection
+from big_rl.model.modular_policy_8 import ModularPolicy8
+from big_rl.model.pruning import CRITERIA, ModuleUsage, prune_
+
+
+OBS_IGNORE = ['obs (mission)']
+
+
+def preprocess_obs(obs):
+    return {
+        k: obs_to_tensor(v).unsqueeze(0)
+        for k,v in obs.items()
+        if k not in OBS_IGNORE
+    }
+
+
+def run_episodes(model, env_config, num_episodes, max_steps=None, usage=None):
+    """ Run `num_episodes` episodes with a single environment and return the total reward of each. If `usage` is given, the usage statistics of every step are added to it. """
+    env = make_env(**env_config)
+    episode_rewards = []
+    for _ in tqdm(range(num_episodes)):
+        obs, _ = env.reset()
+        hidden = model.init_hidden(1)
+        episode_reward = 0.
+        step = 0
+        while max_steps is None or step < max_steps:
+            with torch.no_grad(), introspection(model, usage is not None):
+                model_output = model(preprocess_obs(obs), hidden)
+            if usage is not None:
+                usage.update(model_output)
+            hidden = model_output['hidden']
+            action = torch.distributions.Categorical(logits=model_output['action']).sample().item()
+            obs, reward, terminated, truncated, _ = env.step(action)
+            episode_reward += float(reward)
+            step += 1
+            if terminated or truncated:
+                break
+        episode_rewards.append(episode_reward)
+    env.close()
+    return episode_rewards
+
+
+def benchmark(model, env_config, batch_size, num_iterations=100, warmup=10):
+    """ Mean time in seconds of one forward pass with `batch_size` copies of an observation. """
+    env = make_env(**env_config)
+    obs, _ = env.reset()
+    env.close()
+    obs = {k: v.expand(batch_size, *v.shape[1:]) for k,v in preprocess_obs(obs).items()}
+    hidden = model.init_hidden(batch_size)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(obs, hidden)
+        start_time = time.perf_counter()
+        for _ in range(num_iterations):
+            model(obs, hidden)
+        return (time.perf_counter() - start_time) / num_iterations
+
+
+def count_parameters(module):
+    return sum(p.numel() for p in module.parameters())
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='Prune the least used modules of the RecurrentAttention16 core of a ModularPolicy8 model, based on attention and gating statistics collected over an evaluation run.')
+    parser.add_argument('--env', type=str,
+                        help='Environment used to collect statistics and evaluate the model.')
+    parser.add_argument('--model-envs', type=str, nargs='*', default=None,
+                        help='Environments whose observation spaces are used to initialize the model. If not specified, the "--env" environment will be used.')
+    parser.add_argument('--model', type=str, default=None,
+                        help='Path to a model checkpoint to prune.')
+    parser.add_argument('--output-model', type=str, default=None,
+                        help='Path to save the pruned model.')
+    parser.add_argument('--report', type=str, default=None,
+                        help='Path to save the speed/return report as JSON.')
+    parser.add_argument('--num-episodes', type=int, default=10,
+                        help='Number of episodes used to collect statistics, and to evaluate the model before and after pruning.')
+    parser.add_argument('--max-steps', type=int, default=None,
+                        help='Maximum number of steps per episode.')
+    parser.add_argument('--prune-fraction', type=float, default=0.25,
+                        help='Fraction of the modules of each layer to remove.')
+    parser.add_argument('--prune-threshold', type=float, default=0.,
+                        help='Also remove modules whose utility is below this fraction of the highest utility in their layer.')
+    parser.add_argument('--prune-criterion', type=str, default='product', choices=CRITERIA,
+                        help='Utility of a module. "attention": attention received by its outputs. "gates": mean key/value gate. "product": both multiplied together.')
+    parser.add_argument('--min-modules', type=int, default=1,
+                        help='Minimum number of modules kept in each layer.')
+    parser.add_argument('--benchmark-batch-size', type=int, default=16,
+                        help='Batch size used to measure the forward pass time.')
+    init_parser_model(parser)
+    args = parser.parse_args()
+
+    # Validate arguments
+    if args.model is None:
+        raise ValueError('Please specify a model to prune with --model.')
+    if args.output_model is None:
+        raise ValueError('Please specify a path to save the pruned model with --output-model.')
+    if os.path.exists(args.output_model):
+        raise ValueError(f'Output model path {args.output_model} already exists.')
+    if args.model_type != 'ModularPolicy8' or args.recurrence_type != 'RecurrentAttention16':
+        raise ValueError('Pruning is only supported for ModularPolicy8 models with a RecurrentAttention16 core.')
+
+    # Create environment
+    ENV_CONFIG_PRESETS = env_config_presets()
+    env_config = ENV_CONFIG_PRESETS[args.env]
+    env = make_env(**env_config)
+    if args.model_envs is not None:
+        dummy_envs = [make_env(**ENV_CONFIG_PRESETS[c]) for c in args.model_envs]
+    else:
+        dummy_envs = [env]
+
+    # Initialize model
+    model = init_model(
+            observation_space = merge_space(*[e.observation_space for e in dummy_envs]),
+            action_space = env.action_space,
+            model_type = args.model_type,
+            recurrence_type = args.recurrence_type,
+            architecture = args.architecture,
+            ff_size = args.ff_size,
+            device = torch.device('cpu'),
+    )
+    assert isinstance(model, ModularPolicy8)
+    checkpoint = torch.load(args.model, map_location='cpu')
+    model.load_state_dict(checkpoint['model'], strict=False)
+    model.eval()
+    print(f'Loaded checkpoint from {args.model}')
+
+    # Collect statistics and evaluate the original model
+    usage = ModuleUsage(model)
+    rewards_before = run_episodes(model, env_config, args.num_episodes, max_steps=args.max_steps, usage=usage)
+    time_before = benchmark(model, env_config, args.benchmark_batch_size)
+    params_before = count_parameters(model)
+    architecture_before = list(usage.architecture)
+
+    # Prune
+    scores = usage.scores(args.prune_criterion)
+    mask = usage.mask(
+            fraction = args.prune_fraction,
+            threshold = args.prune_threshold,
+            criterion = args.prune_criterion,
+            min_modules = args.min_modules)
+    prune_(model, mask)
+    architecture_after = [sum(m) for m in mask]
+
+    # Evaluate the pruned model
+    rewards_after = run_episodes(model, env_config, args.num_episodes, max_steps=args.max_steps)
+    time_after = benchmark(model, env_config, args.benchmark_batch_size)
+    params_after = count_parameters(model)
+
+    report = {
+        'architecture': {'before': architecture_before, 'after': architecture_after},
+        'mask': mask,
+        'scores': [s.tolist() for s in scores],
+        'criterion': args.prune_criterion,
+        'parameters': {'before': params_before, 'after': params_after},
+        'forward_time': {'before': time_before, 'after': time_after, 'batch_size': args.benchmark_batch_size},
+        'episode_reward': {
+            'before': {'mean': float(np.mean(rewards_before)), 'std': float(np.std(rewards_before))},
+            'after': {'mean': float(np.mean(rewards_after)), 'std': float(np.std(rewards_after))},
+        },
+    }
+
+    print(f'Architecture: {architecture_before} -> {architecture_after}')
+    print(f'Parameters: {params_before:,} -> {params_after:,}')
+    print(f'Forward time (batch size {args.benchmark_batch_size}): {time_before*1000:.2f} ms -> {time_after*1000:.2f} ms ({time_before/time_after:.2f}x)')
+    print(f'Reward mean / std: {np.mean(rewards_before):.2f} / {np.std(rewards_before):.2f} -> {np.mean(rewards_after):.2f} / {np.std(rewards_after):.2f}')
+
+    # Save
+    checkpoint['model'] = model.state_dict()
+    checkpoint['architecture'] = architecture_after
+    checkpoint['pruning'] = report
+    checkpoint.pop('optimizer', None)
+    checkpoint.pop('lr_scheduler', None)
+    torch.save(checkpoint, args.output_model)
+    print(f'Saved checkpoint to {args.output_model}. Load it with `--architecture {" ".join(str(x) for x in architecture_after)}`.')
+
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved report to {args.report}')
@@ -0,0 +1,81 @@
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from big_rl.minigrid.hidden_info.probes import ProbeBank, apply_activation, find_probes, flatten_hidden
+from big_rl.minigrid.hidden_info.train import TARGET_KEYS, Model, make_model
+
+
+INPUT_SIZE = 20
+
+
+def make_probes():
+    probes = {k: make_model(target_key=k, input_size=INPUT_SIZE) for k in TARGET_KEYS}
+    # Probes without hidden layers, and with a hidden size not shared with any other probe
+    probes['linear_1'] = Model(input_size=INPUT_SIZE, hidden_sizes=[], output_size=3)
+    probes['linear_2'] = Model(input_size=INPUT_SIZE, hidden_sizes=[], output_size=5)
+    probes['deep'] = Model(input_size=INPUT_SIZE, hidden_sizes=[7,11,13], output_size=4)
+    return probes
+
+
+@pytest.mark.parametrize('activation', [True, False])
+def test_same_output_as_separate_probes(activation):
+    probes = make_probes()
+    bank = ProbeBank(probes)
+    x = torch.randn(6, INPUT_SIZE)
+
+    with torch.no_grad():
+        output = bank(x, activation=activation)
+    assert list(output.keys()) == list(probes.keys())
+    for k, probe in probes.items():
+        with torch.no_grad():
+            expected = probe(x)
+        if activation:
+            expected = apply_activation(k, expected)
+        assert output[k].shape == expected.shape
+        assert torch.allclose(output[k], expected, atol=1e-5), k
+
+
+def test_flatten_hidden():
+    """ Each row is the hidden state of one environment, flattened in the same order as a single environment's hidden state. """
+    hidden = (torch.randn(3, 4, 5), torch.randn(4, 2), torch.randn(2, 3, 4, 1))
+    flat = flatten_hidden(hidden)
+    assert flat.shape == (4, 3*5 + 2 + 2*3*1)
+    for i in range(4):
+        single = [h[..., i:i+1, :] for h in hidden]
+        assert torch.equal(flat[i], torch.cat([h.flatten() for h in single]))
+
+
+def test_predict(tmp_path):
+    bank = ProbeBank(make_probes())
+    hidden = np.random.randn(10, INPUT_SIZE).astype(np.float32)
+    with torch.no_grad():
+        expected = bank(torch.tensor(hidden))
+
+    filename = str(tmp_path / 'dataset.h5')
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('hidden', data=hidden)
+    with h5py.File(filename, 'r') as f:
+        output = bank.predict(f['hidden'], batch_size=3)
+    for k in expected.keys():
+        assert np.allclose(output[k], expected[k].numpy(), atol=1e-5)
+
+
+def test_load(tmp_path):
+    probes = {k: make_model(target_key=k, input_size=INPUT_SIZE) for k in ['target_idx', 'target_pos']}
+    for k, probe in probes.items():
+        torch.save(probe.state_dict(), str(tmp_path / f'probe-{k}.pt'))
+
+    filenames = find_probes(str(tmp_path / 'probe-{key}.pt'))
+    assert sorted(filenames.keys()) == ['target_idx', 'target_pos'] # Missing probes are skipped
+    bank = ProbeBank.load(filenames)
+
+    x = torch.randn(2, INPUT_SIZE)
+    with torch.no_grad():
+        output = bank(x, activation=False)
+        for k, probe in probes.items():
+            assert torch.allclose(output[k], probe(x), atol=1e-5)
+
+    with pytest.raises(ValueError):
+        find_probes(str(tmp_path / 'probe.pt'))
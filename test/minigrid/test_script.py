@@ -0,0 +1,247 @@
+from types import SimpleNamespace
+
+import gymnasium.vector
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('frankenstein.buffer.vec_history') # Needed by the training script
+from big_rl.minigrid import script
+from big_rl.minigrid.common import env_config_presets, init_model
+from big_rl.minigrid.envs import make_env
+from big_rl.model.modular_policy_8 import ModularPolicy8
+
+
+def _make_env(num_envs=2):
+    config = env_config_presets()['fetch-debug']
+    return gymnasium.vector.SyncVectorEnv([lambda: make_env(**config) for _ in range(num_envs)])
+
+
+def _make_model(env):
+    return init_model(env.single_observation_space, env.single_action_space, model_type='ModularPolicy8', recurrence_type='RecurrentAttention16', architecture=[1,1], ff_size=[8])
+
+
+@pytest.mark.parametrize('inference_precision', ['fp32', 'bf16'])
+def test_reduced_precision_recomputes_outputs(monkeypatch, inference_precision):
+    # The outputs of the reduced precision copy must not be used as the old outputs of the full precision model
+    monkeypatch.setattr(script, 'log_episode_end', lambda **kwargs: None) # Episode statistics aren't needed here
+    env = _make_env()
+    model = _make_model(env)
+    trainer = script.train_single_env(
+            global_step_counter = [0],
+            model = model,
+            env = env,
+            env_labels = ['fetch-debug']*env.num_envs,
+            obs_scale = {'obs (image)': 1/255},
+            rollout_length = 3,
+            yield_rollouts = True,
+            inference_precision = inference_precision,
+    )
+    rollout = next(trainer)
+    misc = rollout['history'].misc
+    assert ('output' in misc) == (inference_precision == 'fp32')
+    trainer.close()
+    env.close()
+
+
+def _make_small_model():
+    return ModularPolicy8(
+        inputs = {
+            'obs': {'type': 'LinearInput', 'config': {'input_size': 6}},
+        },
+        outputs = {
+            'value': {'type': 'LinearOutput', 'config': {'output_size': 1}},
+            'action': {'type': 'LinearOutput', 'config': {'output_size': 3}},
+        },
+        input_size = 8,
+        key_size = 8,
+        value_size = 8,
+        num_heads = 2,
+        recurrence_type = 'RecurrentAttention16',
+        recurrence_kwargs = {'ff_size': [8], 'architecture': [2,2]},
+    )
+
+
+def _stub_rollout(model, num_steps, num_envs):
+    """ History buffer of a rollout, stored the same way as `train_single_env` stores it: the hidden state saved with each observation is the one before the reset of a finished episode, and the outputs saved with each observation are computed from it (after the reset). The outputs of the last observation are only used for bootstrapping. """
+    n = num_steps + 1
+    obs = torch.randn(n, num_envs, 6)
+    reward = torch.randn(n, num_envs)
+    terminal = torch.zeros(n, num_envs, dtype=torch.bool)
+    terminal[3,0] = True # Episode ending in the middle of the rollout
+    terminal[n-1,1] = True # ... and on the last transition
+
+    hidden = model.init_hidden(num_envs)
+    saved_hidden, outputs, log_probs, actions = [], [], [], []
+    with torch.no_grad():
+        for t in range(n):
+            saved_hidden.append(tuple(h.clone() for h in hidden))
+            hidden = model.reset_hidden_(hidden, terminal[t].numpy())
+            output = model({'obs': obs[t]}, hidden)
+            outputs.append(output)
+            if t < n-1:
+                dist = torch.distributions.Categorical(logits=output['action'])
+                action = dist.sample()
+                actions.append(action)
+                log_probs.append(dist.log_prob(action))
+                hidden = output['hidden']
+            else:
+                log_probs.append(torch.zeros(num_envs))
+    history = SimpleNamespace(
+        obs_history = [{'obs': o} for o in obs],
+        obs = None,
+        action = torch.stack(actions),
+        reward = reward,
+        terminal = terminal,
+        misc = {
+            'hidden': tuple(torch.stack(h) for h in zip(*saved_hidden)),
+            'output': {
+                'value': torch.stack([o['value'] for o in outputs]),
+                'action': torch.stack([o['action'] for o in outputs]),
+            },
+            'log_action_prob': torch.stack(log_probs),
+        },
+    )
+    return history, {'obs': obs}
+
+
+@pytest.mark.parametrize('num_minibatches, bptt_length', [(1, None), (2, 2)])
+def test_reuse_same_as_recompute(monkeypatch, num_minibatches, bptt_length):
+    # The outputs saved during the rollout must line up with the actions and observations they were computed from
+    torch.manual_seed(0)
+    model = _make_small_model()
+    history, observations = _stub_rollout(model, num_steps=6, num_envs=2)
+
+    gae_calls = []
+    gae = script.generalized_advantage_estimate
+    def recording_gae(**kwargs):
+        advantages = gae(**kwargs)
+        gae_calls.append({**kwargs, 'advantages': advantages.clone()})
+        return advantages
+    monkeypatch.setattr(script, 'generalized_advantage_estimate', recording_gae)
+
+    losses = {}
+    for recompute in [True, False]:
+        np.random.seed(1) # Same minibatches for both
+        losses[recompute] = list(script.compute_ppo_losses(
+                history = history, # type: ignore
+                model = model,
+                preprocess_input_fn = None,
+                discount = 0.9,
+                gae_lambda = 0.95,
+                norm_adv = True,
+                clip_vf_loss = 0.1,
+                entropy_loss_coeff = 0.01,
+                vf_loss_coeff = 0.5,
+                target_kl = None,
+                num_epochs = 1,
+                recompute_old_outputs = recompute,
+                num_minibatches = num_minibatches,
+                bptt_length = bptt_length,
+                observations = observations,
+        ))
+
+    recomputed, reused = gae_calls
+    for k in ['state_values', 'next_state_values', 'advantages']:
+        assert torch.allclose(recomputed[k], reused[k], atol=1e-5), k
+    assert len(losses[True]) == len(losses[False])
+    for x, y in zip(losses[True], losses[False]):
+        for k in ['loss', 'loss_pi', 'loss_vf', 'approx_kl']:
+            assert torch.allclose(x[k], y[k], atol=1e-5), k
+        # The policy hasn't changed, so the old log probabilities are the same as the new ones
+        assert abs(y['approx_kl'].item()) < 1e-6
+
+
+def _ppo_kwargs(**kwargs):
+    return {
+        'discount': 0.9,
+        'gae_lambda': 0.95,
+        'norm_adv': True,
+        'clip_vf_loss': 0.1,
+        'entropy_loss_coeff': 0.01,
+        'vf_loss_coeff': 0.5,
+        'target_kl': None,
+        'num_epochs': 2,
+        **kwargs,
+    }
+
+
+def _stub_trainer(history, observations):
+    """ Stands in for `train_single_env` with `yield_rollouts=True`, always yielding the same rollout. """
+    while True:
+        yield {'history': history, 'observations': observations, 'log': {}, 'episode_rewards': []}
+
+
+@pytest.mark.parametrize('recompute_old_outputs', [True, False])
+@pytest.mark.parametrize('bptt_length', [None, 2])
+def test_fused_same_as_per_group(recompute_old_outputs, bptt_length):
+    # Training on the concatenated rollouts must give the same losses for each group as training on each group separately
+    torch.manual_seed(0)
+    model = _make_small_model()
+    rollouts = [_stub_rollout(model, num_steps=6, num_envs=num_envs) for num_envs in [2, 3]]
+    # Different reward scales, so that normalizing the advantages over all groups at once would give different losses
+    rollouts[1][0].reward *= 10
+    kwargs = _ppo_kwargs(recompute_old_outputs=recompute_old_outputs, bptt_length=bptt_length)
+
+    expected = [
+        list(script.compute_ppo_losses(history=h, model=model, preprocess_input_fn=None, observations=o, **kwargs)) # type: ignore
+        for h,o in rollouts
+    ]
+
+    trainers = [_stub_trainer(h, o) for h,o in rollouts]
+    fused = script.fused_group_losses(trainers=trainers, model=model, **kwargs) # type: ignore
+    num_updates = len(expected[0])
+    assert num_updates == 2 * (3 if bptt_length == 2 else 1)
+    for i in range(num_updates):
+        losses = next(fused)
+        assert len(losses) == 2
+        for group_losses, exp in zip(losses, expected):
+            for k in ['loss', 'loss_pi', 'loss_vf', 'loss_entropy', 'approx_kl']:
+                assert torch.allclose(group_losses[k], exp[i][k], atol=1e-5), k
+    fused.close()
+
+
+def test_fused_returns_final_hidden_per_group():
+    torch.manual_seed(0)
+    model = _make_small_model()
+    rollouts = [_stub_rollout(model, num_steps=4, num_envs=num_envs) for num_envs in [2, 3]]
+    kwargs = _ppo_kwargs(num_epochs=1)
+
+    expected = [
+        list(script.compute_ppo_losses(history=h, model=model, preprocess_input_fn=None, observations=o, **kwargs))[-1]['hidden'] # type: ignore
+        for h,o in rollouts
+    ]
+
+    results = [[] for _ in rollouts]
+    def trainer(history, observations, results):
+        while True:
+            r = yield {'history': history, 'observations': observations, 'log': {}, 'episode_rewards': []}
+            results.append(r)
+    trainers = [trainer(h, o, r) for (h,o),r in zip(rollouts, results)]
+    fused = script.fused_group_losses(trainers=trainers, model=model, **kwargs) # type: ignore
+    next(fused)
+    next(fused) # Sends the results of the first rollout back to the trainers
+    fused.close()
+
+    for r, exp in zip(results, expected):
+        assert r[0] is not None
+        assert len(r[0]['hidden']) == len(exp)
+        for h, e in zip(r[0]['hidden'], exp):
+            assert torch.allclose(h, e, atol=1e-5)
+
+
+def test_groups_with_minibatches():
+    torch.manual_seed(0)
+    model = _make_small_model()
+    history, observations = _stub_rollout(model, num_steps=4, num_envs=4)
+    losses = script.compute_ppo_losses(
+            history = history, # type: ignore
+            model = model,
+            preprocess_input_fn = None,
+            observations = observations,
+            env_groups = [slice(0,2), slice(2,4)],
+            num_minibatches = 2,
+            **_ppo_kwargs(),
+    )
+    with pytest.raises(ValueError):
+        next(losses)
@@ -0,0 +1,103 @@
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+# The queue and the dropping of frames are tested with `AsyncVideoWriter` in test/utils/test_evaluation.py. This only tests what the callback sends to it.
+evaluate_model = pytest.importorskip('big_rl.minigrid.evaluate_model')
+VideoCallback = evaluate_model.VideoCallback
+compose_frame = evaluate_model.compose_frame
+
+
+class FakeVideoWriter:
+    def __init__(self, wait=None):
+        self.frames = []
+        self.wait = wait
+
+    def write(self, frame):
+        if self.wait is not None:
+            self.wait.wait()
+        self.frames.append(frame)
+
+    def release(self):
+        pass
+
+
+class FakeModel:
+    has_attention = False
+
+
+class FakeEnv:
+    def __init__(self):
+        self.step = 0
+
+    def render(self):
+        # A different frame at each step, so that the order of the frames can be checked
+        frame = np.zeros((8, 8, 3), dtype=np.uint8)
+        frame[:, :self.step % 8] = 255
+        frame[0, 0, 0] = self.step
+        return frame
+
+
+def _results(step):
+    return {
+        'reward': [0.]*step,
+        'regret': [None]*step,
+        'attention': [],
+        'input_labels': [None],
+        'target': [f'target {step}'],
+        'hidden_info': None,
+    }
+
+
+def _snapshot(frame, step):
+    return {
+        'frame': frame,
+        'obs': {'reward': np.array([float(step)])},
+        'attention': None,
+        'input_labels': None,
+        'rewards': [],
+        'total_reward': 0.,
+        'target': f'target {step}',
+        'hidden_info': None,
+    }
+
+
+def _run(callback, num_steps):
+    env = FakeEnv()
+    snapshots = []
+    for step in range(num_steps):
+        env.step = step
+        obs = {'reward': torch.tensor([float(step)])}
+        snapshots.append(_snapshot(env.render(), step))
+        callback(FakeModel(), env, obs, _results(step))
+    return snapshots
+
+
+@pytest.mark.parametrize('num_workers', [0, 1])
+def test_frames_in_order(tmp_path, num_workers):
+    callback = VideoCallback(str(tmp_path / 'video.webm'), num_workers=num_workers, block=True)
+    writer = FakeVideoWriter()
+    callback._writer._video_writer = writer
+    snapshots = _run(callback, 5)
+    callback.close()
+
+    assert len(writer.frames) == 5
+    for frame, snapshot in zip(writer.frames, snapshots):
+        assert np.array_equal(frame, compose_frame(snapshot))
+
+
+def test_drop_frames(tmp_path):
+    # Frames are dropped while the writer is stuck, instead of blocking the caller
+    wait = threading.Event()
+    callback = VideoCallback(str(tmp_path / 'video.webm'), num_workers=0, max_queue_size=1)
+    writer = FakeVideoWriter(wait)
+    callback._writer._video_writer = writer
+    with pytest.warns(UserWarning):
+        _run(callback, 5)
+    assert callback.num_dropped_frames >= 3
+    wait.set()
+    with pytest.warns(UserWarning):
+        callback.close()
+    assert len(writer.frames) + callback.num_dropped_frames == 5
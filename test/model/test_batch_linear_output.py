@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+from big_rl.model.model import BatchLinearOutput, LinearOutput
+
+
+def _make_modules(num_heads):
+    return {
+        'value': LinearOutput(output_size=1, key_size=8, num_heads=num_heads),
+        'action': LinearOutput(output_size=5, key_size=8, num_heads=num_heads),
+        'aux': LinearOutput(output_size=3, key_size=8, num_heads=num_heads),
+    }
+
+
+@pytest.mark.parametrize('num_heads', [1,2])
+@pytest.mark.parametrize('batch_size', [1,3])
+def test_same_as_linear_outputs(num_heads, batch_size):
+    modules = _make_modules(num_heads)
+    batch_output = BatchLinearOutput(modules)
+
+    key = torch.randn(4, batch_size, 8)
+    value = torch.randn(4, batch_size, 8)
+    output = batch_output(key, value)
+
+    assert list(output.keys()) == list(modules.keys())
+    for k,m in modules.items():
+        expected = m(key, value)
+        assert output[k]['output'].shape == expected['output'].shape
+        assert output[k]['attn_output_weights'].shape == expected['attn_output_weights'].shape
+        assert torch.allclose(output[k]['output'], expected['output'], atol=1e-6)
+        assert torch.allclose(output[k]['attn_output_weights'], expected['attn_output_weights'], atol=1e-6)
+
+
+def test_convert_to_linear_outputs():
+    """ Converting back to `LinearOutput` modules gives the original parameters. """
+    modules = _make_modules(2)
+    converted = BatchLinearOutput(modules).to_linear_outputs()
+
+    assert list(converted.keys()) == list(modules.keys())
+    for k in modules.keys():
+        state1 = modules[k].state_dict()
+        state2 = converted[k].state_dict()
+        assert state1.keys() == state2.keys()
+        for p in state1.keys():
+            assert (state1[p] == state2[p]).all()
+
+
+def test_gradients():
+    modules = _make_modules(1)
+    batch_output = BatchLinearOutput(modules)
+
+    key = torch.randn(4, 2, 8)
+    value = torch.randn(4, 2, 8)
+    sum(y['output'].sum() for y in batch_output(key, value).values()).backward()
+    sum(m(key, value)['output'].sum() for m in modules.values()).backward()
+
+    assert batch_output.query.grad is not None
+    for i,m in enumerate(modules.values()):
+        assert torch.allclose(batch_output.query.grad[i], m.query.grad, atol=1e-6)
+        assert torch.allclose(batch_output.ff_weight.grad[i,:m.output_size], m.ff.weight.grad, atol=1e-6)
+        assert (batch_output.ff_weight.grad[i,m.output_size:] == 0).all()
@@ -2,7 +2,7 @@ import pytest
 
 import torch
 
-from big_rl.model.model import BatchMultiHeadAttentionEinsum, BatchMultiHeadAttentionBroadcast, NonBatchMultiHeadAttention
+from big_rl.model.model import BatchMultiHeadAttentionEinsum, BatchMultiHeadAttentionBroadcast, NonBatchMultiHeadAttention, BatchGroupedKVAttentionEinsum, group_kv_projections_
 
 
 @pytest.mark.parametrize("batch_mha_cls", [BatchMultiHeadAttentionEinsum, BatchMultiHeadAttentionBroadcast])
@@ -54,3 +54,107 @@ def test_convert_to_mha_parameters_unchanged(batch_mha_cls):
     for p1,p2 in zip(batch_mha1.parameters(), batch_mha2.parameters()):
         assert p1.shape == p2.shape
         assert (p1 == p2).all()
+
+
+def _group_kv(modules, num_groups):
+    """ Copy the key/value projections of the first module of each group to the rest of the group. """
+    group_size = len(modules) // num_groups
+    with torch.no_grad():
+        for i,m in enumerate(modules):
+            source = modules[i - i % group_size]
+            m.in_proj_weight[6:] = source.in_proj_weight[6:]
+            m.in_proj_bias[6:] = source.in_proj_bias[6:]
+    return modules
+
+
+@pytest.mark.parametrize("num_groups", [1, 2, 6])
+@pytest.mark.parametrize("shared_kv", [True, False])
+def test_grouped_kv_same_as_non_batch(num_groups, shared_kv):
+    """ If the modules in each group have the same key/value projections, grouping them doesn't change the output. """
+    modules = _group_kv([torch.nn.MultiheadAttention(embed_dim=6, num_heads=3) for _ in range(6)], num_groups)
+    grouped_mha = BatchGroupedKVAttentionEinsum(modules, num_heads=3, key_size=6, num_kv_groups=num_groups, default_batch=True)
+    non_batch_mha = NonBatchMultiHeadAttention(modules, num_heads=3, key_size=6, default_batch=True)
+    assert grouped_mha.in_weight[1].shape == (num_groups, 6, 6)
+
+    seq_len = 7
+    batch_size = 11
+    query = torch.randn(6, batch_size, 6)
+    if shared_kv:
+        key = torch.randn(seq_len, batch_size, 6).expand(6, seq_len, batch_size, 6)
+        value = torch.randn(seq_len, batch_size, 6).expand(6, seq_len, batch_size, 6)
+    else:
+        key = torch.randn(6, seq_len, batch_size, 6)
+        value = torch.randn(6, seq_len, batch_size, 6)
+
+    output = grouped_mha(query, key, value)
+    expected_output = non_batch_mha(query, key, value)
+    assert torch.allclose(output[0], expected_output[0], atol=1e-6)
+    assert torch.allclose(output[1], expected_output[1], atol=1e-6)
+
+    # Same keys and values for all modules, unbatched
+    output = grouped_mha(query, key[0], value[0], batched=False)
+    expected_output = non_batch_mha(query, key[0].expand(6, *key.shape[1:]), value[0].expand(6, *value.shape[1:]), batched=True)
+    assert torch.allclose(output[0], expected_output[0], atol=1e-6)
+
+
+@pytest.mark.parametrize("method", ['mean', 'first'])
+def test_grouped_kv_conversion(method):
+    batch_mha = BatchMultiHeadAttentionEinsum([torch.nn.MultiheadAttention(embed_dim=6, num_heads=3) for _ in range(4)], num_heads=3, key_size=6, default_batch=True)
+    grouped_mha = BatchGroupedKVAttentionEinsum.from_attention(batch_mha, num_kv_groups=2, method=method)
+    w_k = batch_mha.in_weight[1].detach()
+    expected = w_k.view(2, 2, 6, 6).mean(1) if method == 'mean' else w_k[[0,2]]
+    assert torch.allclose(grouped_mha.in_weight[1], expected)
+    # Query and output projections are unchanged
+    assert torch.allclose(grouped_mha.in_weight[0], batch_mha.in_weight[0])
+    assert torch.allclose(grouped_mha.out_weight, batch_mha.out_weight)
+
+    # Loading a state dict with per-module projections averages them by default
+    grouped_mha_2 = BatchGroupedKVAttentionEinsum([torch.nn.MultiheadAttention(embed_dim=6, num_heads=3) for _ in range(4)], num_heads=3, key_size=6, num_kv_groups=2)
+    grouped_mha_2.load_state_dict(batch_mha.state_dict())
+    assert torch.allclose(grouped_mha_2.in_weight[1], w_k.view(2, 2, 6, 6).mean(1))
+
+    # ... and with the conversion method otherwise
+    other_mha = BatchMultiHeadAttentionEinsum([torch.nn.MultiheadAttention(embed_dim=6, num_heads=3) for _ in range(4)], num_heads=3, key_size=6, default_batch=True)
+    grouped_mha.load_state_dict(other_mha.state_dict())
+    w_k = other_mha.in_weight[1].detach()
+    expected = w_k.view(2, 2, 6, 6).mean(1) if method == 'mean' else w_k[[0,2]]
+    assert torch.allclose(grouped_mha.in_weight[1], expected)
+
+    # Converting back to MultiheadAttention modules gives the same outputs
+    non_batch_mha = NonBatchMultiHeadAttention(grouped_mha.to_multihead_attention_modules(), num_heads=3, key_size=6, default_batch=True)
+    query = torch.randn(4, 5, 6)
+    key = torch.randn(4, 3, 5, 6)
+    value = torch.randn(4, 3, 5, 6)
+    assert torch.allclose(grouped_mha(query, key, value)[0], non_batch_mha(query, key, value)[0], atol=1e-6)
+
+
+@pytest.mark.parametrize("method", ['mean', 'first'])
+def test_group_kv_projections(method):
+    from big_rl.model.recurrent_attention_16 import RecurrentAttention16, BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer_v3, merge
+    for layer_cls in [BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer_v3]:
+        model = RecurrentAttention16(input_size=6, key_size=6, value_size=6, num_heads=3, ff_size=[4], architecture=[4,2], layer_cls=layer_cls)
+        group_kv_projections_(model, 2, method=method)
+        assert all(isinstance(l.attention, BatchGroupedKVAttentionEinsum) for l in model._layers)
+
+        key = torch.randn(3, 5, 6)
+        value = torch.randn(3, 5, 6)
+        output = model(model.init_state(5), key, value)
+        assert output['key'].shape == (2, 5, 6)
+
+        # Checkpoints without grouped projections can be loaded, including from the other layer type. They are grouped with the same method as the model.
+        checkpoint = RecurrentAttention16(input_size=6, key_size=6, value_size=6, num_heads=3, ff_size=[4], architecture=[4,2], layer_cls=layer_cls)
+        model.load_state_dict(checkpoint.state_dict())
+        w_k = checkpoint._layers[0].attention.in_weight[1].detach()
+        expected = w_k.view(2, 2, 6, 6).mean(1) if method == 'mean' else w_k[[0,2]]
+        assert torch.allclose(model._layers[0].attention.in_weight[1], expected)
+        other_cls = BatchRecurrentAttention16Layer_v3 if layer_cls is BatchRecurrentAttention16Layer_v2 else BatchRecurrentAttention16Layer_v2
+        other_model = RecurrentAttention16(input_size=6, key_size=6, value_size=6, num_heads=3, ff_size=[4], architecture=[4,2], layer_cls=other_cls)
+        group_kv_projections_(other_model, 2, method=method)
+        other_model.load_state_dict(model.state_dict())
+        assert torch.allclose(other_model(other_model.init_state(5), key, value)['key'], model(model.init_state(5), key, value)['key'], atol=1e-6)
+
+        # Modules can't be removed or merged without breaking up the groups
+        with pytest.raises(ValueError):
+            model.remove_modules([[True,True,False,False], [True,True]])
+        with pytest.raises(ValueError):
+            merge([model, checkpoint])
@@ -0,0 +1,18 @@
+import pytest
+import torch
+
+from big_rl.model.model import GreyscaleImageInput, ImageInput56
+
+
+@pytest.mark.parametrize('module_cls,size', [(ImageInput56, 56), (GreyscaleImageInput, 84)])
+def test_uint8_input_with_scale(module_cls, size):
+    """ Passing `uint8` images with `scale` set gives the same output as passing the normalized images as floats. """
+    scaled_module = module_cls(key_size=8, value_size=8, in_channels=3, scale=1/255)
+    module = module_cls(key_size=8, value_size=8, in_channels=3)
+    module.load_state_dict(scaled_module.state_dict())
+
+    x = torch.randint(0, 256, (2,3,size,size), dtype=torch.uint8)
+    output = scaled_module(x)
+    expected = module(x.float() / 255)
+    for k in ['key', 'value']:
+        assert torch.allclose(output[k], expected[k], atol=1e-5)
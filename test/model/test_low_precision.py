@@ -0,0 +1,142 @@
+import pytest
+import torch
+
+from big_rl.model.model import BatchLinear, BatchMultiHeadAttentionEinsum
+from big_rl.model.modular_policy_8 import ModularPolicy8
+from big_rl.model.low_precision import Int8BatchLinear, Int8BatchMultiHeadAttentionEinsum, Int8Conv2d, Int8Linear, LowPrecisionPolicy
+
+
+def _assert_close(output, expected, rtol=0.05):
+    """ Quantization errors are relative to the magnitude of the whole tensor, not to each element. """
+    assert output.shape == expected.shape
+    assert output.dtype == expected.dtype
+    assert (output - expected).abs().max() <= rtol * expected.abs().max()
+
+
+def test_int8_linear():
+    module = torch.nn.Linear(32, 16)
+    x = torch.randn(2, 5, 32)
+    _assert_close(Int8Linear(module)(x), module(x))
+
+
+@pytest.mark.parametrize('stride,padding', [(1,0), (2,1)])
+def test_int8_conv2d(stride, padding):
+    module = torch.nn.Conv2d(3, 8, kernel_size=3, stride=stride, padding=padding)
+    x = torch.randn(2, 3, 11, 11)
+    _assert_close(Int8Conv2d(module)(x), module(x))
+
+
+def test_int8_batch_linear():
+    module = BatchLinear([torch.nn.Linear(32, 16) for _ in range(4)])
+    quantized = Int8BatchLinear.from_float(module)
+
+    x = torch.randn(3, 32)
+    _assert_close(quantized(x, batched=False), module(x, batched=False))
+
+    x = torch.randn(4, 3, 32)
+    _assert_close(quantized(x, batched=True), module(x, batched=True))
+
+    # Inputs expanded from a single tensor take the shared input path
+    x = torch.randn(3, 32).expand(4, 3, 32)
+    _assert_close(quantized(x, batched=True), module(x, batched=True))
+
+
+@pytest.mark.parametrize('num_heads', [1,2])
+def test_int8_batch_mha(num_heads):
+    module = BatchMultiHeadAttentionEinsum([
+        torch.nn.MultiheadAttention(16, num_heads=num_heads) for _ in range(3)
+    ], key_size=16, num_heads=num_heads)
+    quantized = Int8BatchMultiHeadAttentionEinsum(module)
+
+    key = torch.randn(5, 2, 16)
+    value = torch.randn(5, 2, 16)
+    for query in [torch.randn(2, 16), torch.randn(3, 2, 16)]:
+        output, weights = quantized(query, key, value, batched=False)
+        expected_output, expected_weights = module(query, key, value, batched=False)
+        _assert_close(output, expected_output)
+        _assert_close(weights, expected_weights)
+
+    query = torch.randn(3, 2, 16)
+    output, weights = quantized(query, key.expand(3, *key.shape), value.expand(3, *value.shape), batched=True)
+    expected_output, expected_weights = module(query, key.expand(3, *key.shape), value.expand(3, *value.shape), batched=True)
+    _assert_close(output, expected_output)
+    _assert_close(weights, expected_weights)
+
+
+def _init_model():
+    return ModularPolicy8(
+        inputs = {
+            'reward': {
+                'type': 'ScalarInput',
+            },
+            'obs': {
+                'type': 'LinearInput',
+                'config': {
+                    'input_size': 6,
+                },
+            },
+        },
+        outputs = {
+            'value': {
+                'type': 'LinearOutput',
+                'config': {
+                    'output_size': 1,
+                }
+            },
+            'action': {
+                'type': 'LinearOutput',
+                'config': {
+                    'output_size': 5,
+                }
+            },
+        },
+        input_size = 16,
+        key_size = 16,
+        value_size = 16,
+        num_heads = 2,
+        recurrence_type = 'RecurrentAttention16',
+        recurrence_kwargs = {
+            'ff_size': 32,
+            'architecture': (2,3),
+        },
+    )
+
+
+@pytest.mark.parametrize('precision', ['fp32', 'bf16', 'int8'])
+def test_low_precision_policy(precision):
+    """ The outputs are close to the full precision model's, in fp32, and the copy follows the model's weights after `refresh()`. """
+    batch_size = 3
+    model = _init_model()
+    policy = LowPrecisionPolicy(model, precision, min_weight_size=0)
+    if precision == 'int8':
+        assert any(isinstance(m, Int8BatchLinear) for m in policy.actor.modules())
+
+    obs = {
+        'reward': torch.randn(batch_size, 1),
+        'obs': torch.randn(batch_size, 6),
+    }
+    hidden = tuple(torch.randn_like(h) for h in model.init_hidden(batch_size))
+    with torch.no_grad():
+        expected = model(obs, hidden)
+        output = policy(obs, hidden)
+    for k in ['value', 'action']:
+        _assert_close(output[k], expected[k])
+    for h,eh in zip(output['hidden'], expected['hidden']):
+        _assert_close(h, eh)
+    assert all(h.dtype == torch.float for h in policy.init_hidden(batch_size))
+    assert policy.last_hidden[0].dtype == torch.float
+
+    # Update the model
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p) * 0.1)
+        expected = model(obs, hidden)
+        policy.refresh()
+        output = policy(obs, hidden)
+    for k in ['value', 'action']:
+        _assert_close(output[k], expected[k])
+
+
+def test_low_precision_policy_invalid():
+    with pytest.raises(ValueError):
+        LowPrecisionPolicy(_init_model(), 'fp8')
@@ -126,3 +126,50 @@ def test_lstm(batch_size):
         'action': torch.randint(0, 5, (batch_size,)),
     }
     model(obs, hidden)
+
+
+def test_forward_sequence():
+    """ `forward_sequence` should give the same outputs as calling the model one time step at a time. """
+    seq_len, batch_size = 4, 2
+    model = _init_model(
+            ModularPolicy5,
+            inputs = {
+                'obs (image)': {
+                    'type': 'ImageInput56',
+                    'config': {
+                        'in_channels': 3,
+                    },
+                },
+                'reward': {
+                    'type': 'ScalarInput',
+                },
+            },
+            outputs = {
+                'value': {
+                    'type': 'LinearOutput',
+                    'config': {
+                        'output_size': 1,
+                    }
+                },
+            },
+    )
+    obs = {
+        'obs (image)': torch.rand(seq_len, batch_size, 3, 56, 56),
+        'reward': torch.randn(seq_len, batch_size, 1),
+    }
+    done = torch.tensor([[False, False], [True, False], [False, False], [False, True]])
+    hidden = tuple(torch.randn_like(h) for h in model.init_hidden(batch_size))
+
+    expected = []
+    curr_hidden = hidden
+    for t in range(seq_len):
+        curr_hidden = model.reset_hidden_(curr_hidden, done[t])
+        output = model({k: v[t] for k,v in obs.items()}, curr_hidden)
+        curr_hidden = output['hidden']
+        expected.append(output['value'])
+
+    output = model.forward_sequence(obs, hidden, done)
+
+    assert torch.allclose(output['value'], torch.stack(expected), atol=1e-6)
+    for h,eh in zip(output['hidden'], curr_hidden):
+        assert torch.allclose(h, eh, atol=1e-6)
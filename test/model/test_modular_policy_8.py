@@ -1,7 +1,11 @@
+import copy
+
+import numpy as np
 import pytest
 
 import torch
 
+from big_rl.model.model import introspection
 from big_rl.model.modular_policy_8 import ModularPolicy8
 
 
@@ -115,3 +119,307 @@ def test_input_mapping(batch_size):
 
     assert output1.keys() == output2.keys()
     assert torch.allclose(output1['action'], output2['action'])
+
+
+def _random_hidden(model, batch_size):
+    return tuple(torch.randn_like(h) for h in model.init_hidden(batch_size))
+
+
+def test_reset_hidden_in_place():
+    model = _init_model({}, {})
+    hidden = _random_hidden(model, 4)
+    expected = tuple(h.clone() for h in hidden)
+    done = np.array([True, False, False, True])
+
+    with torch.no_grad():
+        new_hidden = model.reset_hidden_(hidden, done)
+
+    for h0,h,e,nh in zip(model.init_hidden(4), hidden, expected, new_hidden):
+        assert nh is h
+        assert torch.allclose(h[...,done,:], h0[...,done,:])
+        assert torch.allclose(h[...,~done,:], e[...,~done,:])
+
+
+def test_reset_hidden_with_grad():
+    model = _init_model({}, {})
+    hidden = _random_hidden(model, 3)
+    done = torch.tensor([False, True, False])
+
+    new_hidden = model.reset_hidden_(hidden, done)
+    sum(h.sum() for h in new_hidden).backward()
+
+    for h0,h,nh in zip(model.init_hidden(3), hidden, new_hidden):
+        assert nh is not h
+        assert torch.allclose(nh[...,1,:], h0[...,1,:])
+    # The gradient reaches the learned initial state
+    assert all(x.grad is not None for x in _default_states(model))
+
+
+def test_initial_hidden_cache_is_invalidated():
+    model = _init_model({}, {})
+    with torch.no_grad():
+        h1 = model.initial_hidden()
+        assert model.initial_hidden() is h1
+        for p in model.parameters():
+            p.add_(1)
+        h2 = model.initial_hidden()
+    assert h2 is not h1
+    for a,b in zip(h2, model.init_hidden(1)):
+        assert torch.allclose(a, b)
+
+
+def test_forward_sequence():
+    """ `forward_sequence` should give the same outputs as calling the model one time step at a time. """
+    seq_len, batch_size = 5, 3
+    model = _init_model(
+            inputs = {
+                'obs (image)': {
+                    'type': 'ImageInput56',
+                    'config': {
+                        'in_channels': 3,
+                    },
+                },
+                'reward': {
+                    'type': 'ScalarInput',
+                },
+            },
+            outputs = {
+                'value': {
+                    'type': 'LinearOutput',
+                    'config': {
+                        'output_size': 1,
+                    }
+                },
+                'action': {
+                    'type': 'LinearOutput',
+                    'config': {
+                        'output_size': 5,
+                    }
+                },
+            },
+    )
+    obs = {
+        'obs (image)': torch.rand(seq_len, batch_size, 3, 56, 56),
+        'reward': torch.randn(seq_len, batch_size, 1),
+    }
+    done = torch.rand(seq_len, batch_size) < 0.3
+    hidden = _random_hidden(model, batch_size)
+
+    expected = []
+    curr_hidden = hidden
+    for t in range(seq_len):
+        curr_hidden = model.reset_hidden_(curr_hidden, done[t])
+        output = model({k: v[t] for k,v in obs.items()}, curr_hidden)
+        curr_hidden = output['hidden']
+        expected.append(output)
+
+    output = model.forward_sequence(obs, hidden, done)
+
+    assert output['action'].shape == (seq_len, batch_size, 5)
+    for k in ['value', 'action']:
+        assert torch.allclose(output[k], torch.stack([o[k] for o in expected]), atol=1e-6)
+    for h,eh in zip(output['hidden'], curr_hidden):
+        assert torch.allclose(h, eh, atol=1e-6)
+
+
+def test_introspection():
+    """ Attention weights and gates are only recorded inside the `introspection` context, and the previous setting is restored when leaving it. """
+    model = _init_model(
+            inputs = {
+                'reward': {
+                    'type': 'ScalarInput',
+                },
+            },
+            outputs = {
+                'value': {
+                    'type': 'LinearOutput',
+                    'config': {
+                        'output_size': 1,
+                    }
+                },
+            },
+    )
+    hidden = model.init_hidden(2)
+    obs = {'reward': torch.randn(2, 1)}
+
+    output = model(obs, hidden)
+    assert output['misc']['core_output']['misc']['attention'] == []
+    assert output['misc']['core_output']['misc']['gates'] == []
+    assert model.last_output_attention == {}
+
+    with introspection(model):
+        assert model.attention.introspect
+        output = model(obs, hidden)
+    assert not model.introspect
+    assert not model.attention.introspect
+
+    core_misc = output['misc']['core_output']['misc']
+    assert len(core_misc['attention']) == 2
+    assert len(core_misc['gates']) == 2
+    assert not core_misc['attention'][0].requires_grad
+    assert model.last_output_attention['value'].shape[0] == 2
+
+
+def test_fuse_output_modules():
+    """ Fusing the output modules doesn't change the outputs, and unfusing them gives back the original state dict. """
+    model = _init_model(
+            inputs = {
+                'reward': {
+                    'type': 'ScalarInput',
+                },
+            },
+            outputs = {
+                'value': {
+                    'type': 'LinearOutput',
+                    'config': {
+                        'output_size': 1,
+                    }
+                },
+                'action_logstd': {
+                    'type': 'StateIndependentOutput',
+                    'config': {
+                        'output_size': 2,
+                    }
+                },
+                'action_mean': {
+                    'type': 'LinearOutput',
+                    'config': {
+                        'output_size': 2,
+                    }
+                },
+            },
+    )
+    hidden = model.init_hidden(3)
+    obs = {'reward': torch.randn(3, 1)}
+    state_dict = {k: v.clone() for k,v in model.state_dict().items()}
+
+    expected = model(obs, hidden)
+    model.fuse_output_modules()
+    assert list(model.output_modules.keys()) == ['action_logstd']
+    output = model(obs, hidden)
+    assert list(output.keys()) == list(expected.keys())
+    for k in ['value', 'action_logstd', 'action_mean']:
+        assert torch.allclose(output[k], expected[k], atol=1e-6)
+
+    # Checkpoints can be loaded whether or not the output modules are fused
+    fused_state_dict = {k: v.clone() for k,v in model.state_dict().items()}
+    model.load_state_dict(state_dict)
+    assert torch.allclose(model(obs, hidden)['action_mean'], expected['action_mean'], atol=1e-6)
+
+    model.unfuse_output_modules()
+    model.load_state_dict(fused_state_dict)
+    assert list(model.output_modules.keys()) == ['value', 'action_logstd', 'action_mean']
+    assert model.state_dict().keys() == state_dict.keys()
+    for k,v in model.state_dict().items():
+        assert (v == state_dict[k]).all()
+
+
+def _init_static_test_model():
+    return _init_model(
+            inputs = {
+                'obs (image)': {
+                    'type': 'ImageInput56',
+                    'config': {
+                        'in_channels': 3,
+                    },
+                },
+                'reward': {
+                    'type': 'ScalarInput',
+                },
+                'action': {
+                    'type': 'DiscreteInput',
+                    'config': {
+                        'input_size': 5,
+                    },
+                },
+            },
+            outputs = {
+                'value': {
+                    'type': 'LinearOutput',
+                    'config': {
+                        'output_size': 1,
+                    }
+                },
+                'action': {
+                    'type': 'LinearOutput',
+                    'config': {
+                        'output_size': 5,
+                    }
+                },
+            },
+    )
+
+
+@pytest.mark.parametrize('compile_kwargs', [
+    None,
+    {'backend': 'eager', 'fullgraph': True},
+])
+def test_static_forward(compile_kwargs):
+    """ The static forward pass gives the same outputs as the regular forward pass, for each set of input keys, and can be captured as a single graph. """
+    batch_size = 3
+    model = _init_static_test_model()
+    model.fuse_output_modules()
+    hidden = _random_hidden(model, batch_size)
+    obs = {
+        'obs (image)': torch.rand(batch_size, 3, 56, 56),
+        'reward': torch.randn(batch_size, 1),
+        'action': torch.randint(0, 5, (batch_size,)),
+    }
+    obs_no_action = {k: v for k,v in obs.items() if k != 'action'}
+    expected = model(obs, hidden)
+    expected_no_action = model(obs_no_action, hidden)
+
+    if compile_kwargs is None:
+        model.enable_static_forward(compile=False)
+    else:
+        model.enable_static_forward(**compile_kwargs)
+    for o,e in [(obs, expected), (obs_no_action, expected_no_action), (obs, expected)]:
+        output = model(o, hidden)
+        assert model.last_input_labels == e['misc']['input_labels']
+        for k in ['value', 'action']:
+            assert torch.allclose(output[k], e[k], atol=1e-6)
+        for h,eh in zip(output['hidden'], e['hidden']):
+            assert torch.allclose(h, eh, atol=1e-6)
+    assert len(model._static_forwards) == 2
+
+    # Gradients flow through the static forward pass
+    model(obs, hidden)['value'].sum().backward()
+    assert model.input_modules['obs (image)'].fc_key.weight.grad is not None
+
+    # Introspection uses the regular forward pass
+    with introspection(model):
+        output = model(obs, hidden)
+    assert len(output['misc']['core_output']['misc']['attention']) == 2
+
+
+def test_static_forward_sequence():
+    """ `forward_sequence` gives the same outputs with the static forward pass, and the static forward pass is not copied with the model. """
+    seq_len, batch_size = 4, 2
+    model = _init_static_test_model()
+    obs = {
+        'obs (image)': torch.rand(seq_len, batch_size, 3, 56, 56),
+        'reward': torch.randn(seq_len, batch_size, 1),
+        'action': torch.randint(0, 5, (seq_len, batch_size)),
+    }
+    done = torch.rand(seq_len, batch_size) < 0.3
+    hidden = _random_hidden(model, batch_size)
+    with torch.no_grad():
+        expected = model.forward_sequence(obs, hidden, done)
+
+    model.enable_static_forward(backend='eager')
+    with torch.no_grad():
+        model({k: v[0] for k,v in obs.items()}, hidden)
+    model_copy = copy.deepcopy(model)
+    assert len(model._static_forwards) == 1
+    assert not model_copy.static_forward_enabled
+
+    model.warmup_static_forward({k: v[0] for k,v in obs.items()}, hidden, seq_len=seq_len)
+    output = model.forward_sequence(obs, hidden, done)
+    for k in ['value', 'action']:
+        assert torch.allclose(output[k], expected[k], atol=1e-6)
+    for h,eh in zip(output['hidden'], expected['hidden']):
+        assert torch.allclose(h, eh, atol=1e-6)
+
+
+def _default_states(model):
+    return [x for layer in model.attention._layers for x in layer.default_state]
@@ -0,0 +1,114 @@
+import pytest
+import torch
+
+from big_rl.model.model import introspection
+from big_rl.model.modular_policy_8 import ModularPolicy8
+from big_rl.model.pruning import ModuleUsage, prune_, prune_mask
+
+
+def _init_model(architecture=(3,4)):
+    return ModularPolicy8(
+        inputs = {
+            'reward': {
+                'type': 'ScalarInput',
+            },
+            'obs': {
+                'type': 'LinearInput',
+                'config': {
+                    'input_size': 6,
+                },
+            },
+        },
+        outputs = {
+            'value': {
+                'type': 'LinearOutput',
+                'config': {
+                    'output_size': 1,
+                }
+            },
+            'action': {
+                'type': 'LinearOutput',
+                'config': {
+                    'output_size': 5,
+                }
+            },
+        },
+        input_size = 8,
+        key_size = 8,
+        value_size = 8,
+        num_heads = 2,
+        recurrence_type = 'RecurrentAttention16',
+        recurrence_kwargs = {
+            'ff_size': 16,
+            'architecture': architecture,
+        },
+    )
+
+
+def _inputs(batch_size):
+    return {
+        'reward': torch.randn(batch_size, 1),
+        'obs': torch.randn(batch_size, 6),
+    }
+
+
+def test_prune_mask():
+    scores = [torch.tensor([0.1, 0.5, 0.3, 0.2]), torch.tensor([1., 0.])]
+    assert prune_mask(scores, fraction=0.5) == [[False, True, True, False], [True, False]]
+    assert prune_mask(scores, threshold=0.5) == [[False, True, True, False], [True, False]]
+    assert prune_mask(scores, fraction=1., min_modules=1) == [[False, True, False, False], [True, False]]
+    assert prune_mask(scores) == [[True]*4, [True]*2]
+
+
+def test_module_usage():
+    batch_size = 3
+    model = _init_model()
+    usage = ModuleUsage(model)
+    hidden = model.init_hidden(batch_size)
+    with torch.no_grad(), introspection(model):
+        for _ in range(4):
+            output = model(_inputs(batch_size), hidden)
+            usage.update(output)
+            hidden = output['hidden']
+    assert usage.count == 4
+
+    scores = usage.scores('attention')
+    assert [s.shape for s in scores] == [(3,), (4,)]
+    # Each module of the second layer attends to the first layer with weights that sum to 1
+    assert torch.allclose(scores[0].sum(), torch.tensor(4.))
+    for criterion in ['gates', 'product']:
+        assert all((s >= 0).all() for s in usage.scores(criterion))
+    assert [len(m) for m in usage.mask(fraction=0.5)] == [3,4]
+
+    with pytest.raises(ValueError):
+        usage.scores('foo')
+
+
+def test_module_usage_requires_introspection():
+    model = _init_model()
+    usage = ModuleUsage(model)
+    with torch.no_grad():
+        output = model(_inputs(2), model.init_hidden(2))
+    with pytest.raises(RuntimeError):
+        usage.update(output)
+
+
+def test_prune():
+    batch_size = 2
+    model = _init_model()
+    inputs = _inputs(batch_size)
+    hidden = model.init_hidden(batch_size)
+
+    # Nothing removed
+    with torch.no_grad():
+        expected = model(inputs, hidden)
+        prune_(model, [[True]*3, [True]*4])
+        output = model(inputs, hidden)
+    assert torch.allclose(output['action'], expected['action'])
+
+    prune_(model, [[True, False, True], [False, True, False, True]])
+    hidden = model.init_hidden(batch_size)
+    assert hidden[0].shape[0] == 2
+    output = model(inputs, hidden)
+    assert output['action'].shape == (batch_size, 5)
+    assert [h.shape for h in output['hidden']] == [h.shape for h in hidden]
@@ -1,8 +1,11 @@
+import copy
+
 import pytest
 
 import torch
 
-from big_rl.model.recurrent_attention_16 import BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer, NonBatchRecurrentAttention16Layer, RecurrentAttention16
+from big_rl.model.modular_policy_8 import ModularPolicy8
+from big_rl.model.recurrent_attention_16 import BatchRecurrentAttention16Layer_v3, BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer, NonBatchRecurrentAttention16Layer, RecurrentAttention16, ablate, merge
 
 
 # Utils
@@ -35,7 +38,7 @@ def dummy_loss(output):
 
 # Test conversion between batched and non-batched
 
-@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2])
+@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer_v3])
 def test_convert_to_batched_same_output(batched_cls):
     # Convert a batched module to a non-batched module.
     # If they're given the same inputs, they should produce the same outputs.
@@ -64,7 +67,7 @@ def test_convert_to_batched_same_output(batched_cls):
     assert_same_output(batched_output, nonbatched_output)
 
 
-@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2])
+@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer_v3])
 def test_convert_to_nonbatched_same_output(batched_cls):
     # Convert a non-batched module to a batched module.
     # If they're given the same inputs, they should produce the same outputs.
@@ -93,7 +96,7 @@ def test_convert_to_nonbatched_same_output(batched_cls):
     assert_same_output(batched_output, nonbatched_output)
 
 
-@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2])
+@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer_v3])
 def test_convert_to_batched_independence(batched_cls):
     # Convert a non-batched module to a batched module.
     # Modifying the weights of one module should not affect the other.
@@ -129,7 +132,7 @@ def test_convert_to_batched_independence(batched_cls):
     assert_same_output(output1, output2)
 
 
-@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2])
+@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer_v3])
 def test_convert_to_nonbatched_independence(batched_cls):
     # Convert a batched module to a non-batched module.
     # Modifying the weights of one module should not affect the other.
@@ -165,7 +168,7 @@ def test_convert_to_nonbatched_independence(batched_cls):
     assert_same_output(output1, output2)
 
 
-@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2])
+@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer_v3])
 def test_same_gradients_after_conversion(batched_cls):
     # Convert a batched module to a non-batched module.
     # Run a step of gradient descent on both modules.
@@ -203,6 +206,48 @@ def test_same_gradients_after_conversion(batched_cls):
     assert_same_output(batched_output, nonbatched_output)
 
 
+# Test the fused layer against the v2 layer
+
+@pytest.mark.parametrize('ff_size', [[], [3], [3,7]])
+def test_v3_same_as_v2(ff_size):
+    # The v3 layer is a reimplementation of the v2 layer, so both should give the same outputs and input gradients
+    v2_module = BatchRecurrentAttention16Layer_v2(input_size=8, key_size=8, value_size=8, num_heads=4, ff_size=ff_size, num_modules=3)
+    v3_module = BatchRecurrentAttention16Layer_v3(input_size=8, key_size=8, value_size=8, num_heads=4, ff_size=ff_size, num_modules=3)
+    v3_module.load_state_dict(v2_module.state_dict())
+
+    state = tuple(torch.randn(3, 5, 8, requires_grad=True) for _ in range(4))
+    key = torch.randn([2, 5, 8], requires_grad=True)
+    value = torch.randn([2, 5, 8], requires_grad=True)
+
+    output1 = v2_module(state, key, value)
+    grads1 = torch.autograd.grad(dummy_loss(output1), [*state, key, value])
+    output2 = v3_module(state, key, value)
+    grads2 = torch.autograd.grad(dummy_loss(output2), [*state, key, value])
+
+    for k in ['query', 'key', 'value', 'state']:
+        assert torch.allclose(output1['gates'][k], output2['gates'][k], atol=1e-6)
+    for x,y in zip(output1['state'], output2['state']):
+        assert torch.allclose(x, y, atol=1e-6)
+    for g1,g2 in zip(grads1, grads2):
+        assert torch.allclose(g1, g2, atol=1e-6)
+
+
+def test_v3_state_dict_roundtrip():
+    # A v2 state dict can be loaded into a v3 layer, and the v3 state dict can be loaded back into a v2 layer without changing the parameters
+    v2_module = BatchRecurrentAttention16Layer_v2(input_size=8, key_size=8, value_size=8, num_heads=4, ff_size=[3,7], num_modules=2)
+    v3_module = BatchRecurrentAttention16Layer_v3(input_size=8, key_size=8, value_size=8, num_heads=4, ff_size=[3,7], num_modules=2)
+    v3_module.load_state_dict(v2_module.state_dict())
+
+    v2_module_2 = BatchRecurrentAttention16Layer_v2(input_size=8, key_size=8, value_size=8, num_heads=4, ff_size=[3,7], num_modules=2)
+    v2_module_2.load_state_dict(v3_module.state_dict())
+
+    state_dict_1 = v2_module.state_dict()
+    state_dict_2 = v2_module_2.state_dict()
+    assert state_dict_1.keys() == state_dict_2.keys()
+    for k in state_dict_1.keys():
+        assert (state_dict_1[k] == state_dict_2[k]).all()
+
+
 # Test merging and removing modules
 def test_remove_modules_no_removals():
     # Make sure `remove_modules` can be called without error and the resulting module works
@@ -359,6 +404,234 @@ def test_merge_and_remove_roundtrip_interleaved():
     assert_same_output(output1, output2)
 
 
+@pytest.mark.parametrize('batched_cls', [BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer_v3])
+@pytest.mark.parametrize('ff_size', [[], [3,7]])
+def test_remove_modules_in_place_same_as_nonbatched(batched_cls, ff_size):
+    # Removing modules from a batched layer in place should give the same result as removing them from its non-batched equivalent.
+    module = batched_cls(
+        input_size=8,
+        key_size=8,
+        value_size=8,
+        num_heads=4,
+        ff_size=ff_size,
+        num_modules=4,
+    )
+    with torch.no_grad():
+        for p in module.default_state:
+            p.normal_()
+    mask = [True, False, True, False]
+    nonbatched_module = module.to_nonbatched()
+    nonbatched_module.remove_modules(mask)
+    module.remove_modules(mask)
+    assert isinstance(module, batched_cls)
+
+    key = torch.randn([3, 5, 8])
+    value = torch.randn(3, 5, 8)
+    state = module.init_state(5)
+    assert state[0].shape[0] == 2
+
+    assert_same_output(module(state, key, value), nonbatched_module(state, key, value))
+
+
+@pytest.mark.parametrize('layer_cls', [BatchRecurrentAttention16Layer, BatchRecurrentAttention16Layer_v2, BatchRecurrentAttention16Layer_v3])
+def test_ablate(layer_cls):
+    module = RecurrentAttention16(
+        input_size=8,
+        key_size=8,
+        value_size=8,
+        num_heads=4,
+        ff_size=[3],
+        architecture=[3,2],
+        layer_cls=layer_cls,
+    )
+    mask = [[True, False, True], [False, True]]
+    ablated = ablate(module, mask)
+
+    # The original module is unchanged
+    assert [l._num_modules for l in module._layers] == [3,2]
+    assert [l._num_modules for l in ablated._layers] == [2,1]
+    assert all(type(l) is layer_cls for l in ablated._layers)
+    assert ablated.num_outputs == 1
+
+    key = torch.randn([2, 5, 8])
+    value = torch.randn(2, 5, 8)
+    output = ablated(ablated.init_state(5), key, value)
+    assert output['key'].shape == (1, 5, 8)
+
+
+@pytest.mark.parametrize('positions', [None, [0,2,3]])
+def test_merge_batched_same_as_nonbatched(positions):
+    module1 = BatchRecurrentAttention16Layer_v2(
+        input_size=8,
+        key_size=8,
+        value_size=8,
+        num_heads=4,
+        ff_size=[3,7],
+        num_modules=2,
+    )
+    module2 = BatchRecurrentAttention16Layer_v2(
+        input_size=8,
+        key_size=8,
+        value_size=8,
+        num_heads=4,
+        ff_size=[3,7],
+        num_modules=3,
+    )
+    with torch.no_grad():
+        for p in [*module1.default_state, *module2.default_state]:
+            p.normal_()
+    nonbatched_module = module1.to_nonbatched()
+    nonbatched_module.merge(module2.to_nonbatched(), positions=positions)
+    module1.merge(module2, positions=positions)
+
+    key = torch.randn([4, 5, 8])
+    value = torch.randn(4, 5, 8)
+    state = module1.init_state(5)
+    assert state[0].shape[0] == 5
+
+    assert_same_output(module1(state, key, value), nonbatched_module(state, key, value))
+
+
+def _cat_outputs(outputs, sources):
+    """ Concatenate the outputs of several models along the module dimension, ordered by `sources`. """
+    index = [0]*len(outputs)
+    rows = []
+    for src in sources:
+        rows.append(outputs[src][index[src]])
+        index[src] += 1
+    return torch.stack(rows)
+
+
+@pytest.mark.parametrize('sources', [None, [[0,1,0], [1,0,1,0,0]]])
+def test_merge_isolated_same_as_separate(sources):
+    # An isolated merge should compute the same thing as running each model separately.
+    models = [
+        RecurrentAttention16(
+            input_size=8,
+            key_size=8,
+            value_size=8,
+            num_heads=4,
+            ff_size=[3],
+            architecture=architecture,
+            layer_cls=layer_cls,
+        )
+        for architecture, layer_cls in [([2,3], BatchRecurrentAttention16Layer_v2), ([1,2], BatchRecurrentAttention16Layer_v3)]
+    ]
+    merged = merge(models, sources=sources)
+    if sources is None:
+        sources = [[0,0,1], [0,0,0,1,1]]
+    assert merged._architecture == [3,5]
+    assert merged.num_outputs == 5
+
+    # The inputs are shared, followed by each model's outputs at the previous step
+    key = torch.randn([2, 4, 8])
+    value = torch.randn(2, 4, 8)
+    recurrent_keys = [torch.randn([m.num_outputs, 4, 8]) for m in models]
+    recurrent_values = [torch.randn([m.num_outputs, 4, 8]) for m in models]
+    states = [tuple(torch.randn_like(s) for s in m.init_state(4)) for m in models]
+    merged_state = tuple(
+        _cat_outputs([s[i] for s in states], sources[i//4])
+        for i in range(merged.state_size)
+    )
+
+    outputs = [
+        m(s, torch.cat([key, k]), torch.cat([value, v]))
+        for m,s,k,v in zip(models, states, recurrent_keys, recurrent_values)
+    ]
+    merged_output = merged(
+            merged_state,
+            torch.cat([key, _cat_outputs(recurrent_keys, sources[-1])]),
+            torch.cat([value, _cat_outputs(recurrent_values, sources[-1])]),
+    )
+
+    for k in ['key', 'value']:
+        assert torch.allclose(merged_output[k], _cat_outputs([o[k] for o in outputs], sources[-1]), atol=1e-6)
+    for i,x in enumerate(merged_output['state']):
+        assert torch.allclose(x, _cat_outputs([o['state'][i] for o in outputs], sources[i//4]), atol=1e-6)
+
+    # Removing the modules of the second model gives back the first model
+    merged.remove_modules([[s == 0 for s in layer_sources] for layer_sources in sources])
+    state = tuple(s.contiguous() for s in states[0])
+    output = merged(state, torch.cat([key, recurrent_keys[0]]), torch.cat([value, recurrent_values[0]]))
+    assert torch.allclose(output['key'], outputs[0]['key'], atol=1e-6)
+
+
+def test_merge_isolated_save_and_load():
+    # The isolation masks are saved with the merged model, and are not silently dropped by layer conversions
+    models = [
+        RecurrentAttention16(input_size=8, key_size=8, value_size=8, num_heads=4, ff_size=[3], architecture=architecture)
+        for architecture in [[2,3], [1,2]]
+    ]
+    merged = merge(models)
+    state_dict = merged.state_dict()
+
+    loaded = RecurrentAttention16(input_size=8, key_size=8, value_size=8, num_heads=4, ff_size=[3], architecture=[3,5])
+    loaded.load_state_dict(state_dict)
+    for layer, merged_layer in zip(loaded._layers, merged._layers):
+        assert torch.equal(layer.attention_mask, merged_layer.attention_mask)
+
+    key = torch.randn([7, 4, 8])
+    value = torch.randn(7, 4, 8)
+    state = tuple(torch.randn_like(s) for s in merged.init_state(4))
+    assert torch.allclose(loaded(state, key, value)['key'], merged(state, key, value)['key'], atol=1e-6)
+
+    # Loading a checkpoint without masks removes them
+    loaded.load_state_dict(RecurrentAttention16(input_size=8, key_size=8, value_size=8, num_heads=4, ff_size=[3], architecture=[3,5]).state_dict())
+    assert all(layer.attention_mask is None for layer in loaded._layers)
+
+    with pytest.raises(ValueError):
+        merged.convert_layer_type(BatchRecurrentAttention16Layer_v3)
+    fused = RecurrentAttention16(input_size=8, key_size=8, value_size=8, num_heads=4, ff_size=[3], architecture=[3,5], layer_cls=BatchRecurrentAttention16Layer_v3)
+    with pytest.raises(ValueError):
+        fused.load_state_dict(state_dict)
+
+
+@pytest.mark.parametrize('sources', [None, [[0,1,0], [1,0,1,0,0]]])
+def test_merge_isolated_same_as_separate_modular_policy(sources):
+    # Over several steps, the recurrent keys of the first layer must also be isolated so that the merged models stay independent.
+    models = [
+        ModularPolicy8(
+            inputs = {
+                'reward': {'type': 'ScalarInput'},
+                'obs': {'type': 'LinearInput', 'config': {'input_size': 6}},
+            },
+            outputs = {
+                'value': {'type': 'LinearOutput', 'config': {'output_size': 1}},
+            },
+            input_size = 8,
+            key_size = 8,
+            value_size = 8,
+            num_heads = 4,
+            recurrence_type = 'RecurrentAttention16',
+            recurrence_kwargs = {
+                'ff_size': [3],
+                'architecture': architecture,
+            },
+        )
+        for architecture in [[2,3], [1,2]]
+    ]
+    models[1].input_modules.load_state_dict(models[0].input_modules.state_dict())
+    merged = copy.deepcopy(models[0])
+    merged.attention = merge([m.attention for m in models], sources=sources)
+    if sources is None:
+        sources = [[0,0,1], [0,0,0,1,1]]
+
+    batch_size = 4
+    hidden = [m.init_hidden(batch_size) for m in models]
+    merged_hidden = merged.init_hidden(batch_size)
+    with torch.no_grad():
+        for _ in range(4):
+            inputs = {
+                'reward': torch.randn(batch_size, 1),
+                'obs': torch.randn(batch_size, 6),
+            }
+            hidden = [m(inputs, h)['hidden'] for m,h in zip(models, hidden)]
+            merged_hidden = merged(inputs, merged_hidden)['hidden']
+            for i,x in enumerate(merged_hidden):
+                layer_sources = sources[-1] if i < 2 else sources[(i-2)//4]
+                assert torch.allclose(x, _cat_outputs([h[i] for h in hidden], layer_sources), atol=1e-5)
+
+
 # misc
 
 @pytest.mark.parametrize('architecture', [[1], [1,1], [1,2]])
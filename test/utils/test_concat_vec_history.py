@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from big_rl.utils import ConcatVecHistory
+
+
+def make_history(num_envs, length, offset=0):
+    return SimpleNamespace(
+        obs_history = [{'x': torch.full((num_envs,2), offset+t)} for t in range(length)],
+        obs = {'x': torch.arange(length*num_envs*2).view(length,num_envs,2) + offset},
+        action = torch.zeros(length-1, num_envs) + offset,
+        reward = torch.ones(length, num_envs) * offset,
+        terminal = torch.zeros(length, num_envs, dtype=torch.bool),
+        misc = {
+            'hidden': (torch.ones(length, 3, num_envs, 4) * offset,),
+            'value': torch.ones(length, num_envs) * offset,
+            'output': {
+                'value': torch.ones(length, num_envs, 1) * offset,
+                'hidden': (torch.ones(3, num_envs, 4) * offset,),
+            },
+        },
+    )
+
+
+def test_concatenates_along_batch_dim():
+    history = ConcatVecHistory([make_history(2, 5, 0), make_history(3, 5, 100)])
+    assert history.obs['x'].shape == (5,5,2)
+    assert history.action.shape == (4,5)
+    assert history.reward.shape == (5,5)
+    assert history.terminal.shape == (5,5)
+    assert (history.reward[:,:2] == 0).all()
+    assert (history.reward[:,2:] == 100).all()
+    assert history.misc['value'].shape == (5,5)
+    assert history.misc['hidden'][0].shape == (5,3,5,4)
+    assert (history.misc['hidden'][0][...,2:,:] == 100).all()
+    # Nested outputs are concatenated along the batch dimension too
+    assert history.misc['output']['value'].shape == (5,5,1)
+    assert (history.misc['output']['value'][:,2:] == 100).all()
+    assert history.misc['output']['hidden'][0].shape == (3,5,4)
+    assert (history.misc['output']['hidden'][0][:,2:] == 100).all()
+    assert len(history.obs_history) == 5
+    assert history.obs_history[1]['x'].shape == (5,2)
+
+
+def test_different_lengths():
+    with pytest.raises(ValueError):
+        ConcatVecHistory([make_history(2, 5), make_history(2, 4)])
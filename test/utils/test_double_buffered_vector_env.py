@@ -0,0 +1,60 @@
+import gymnasium
+import numpy as np
+import pytest
+
+from big_rl.utils import DoubleBufferedVectorEnv
+
+
+def make_env():
+    return gymnasium.make('CartPole-v1')
+
+
+def test_same_as_single_vector_env():
+    env = gymnasium.vector.SyncVectorEnv([make_env for _ in range(5)])
+    env_db = DoubleBufferedVectorEnv([
+        gymnasium.vector.SyncVectorEnv([make_env for _ in range(2)]),
+        gymnasium.vector.SyncVectorEnv([make_env for _ in range(3)]),
+    ])
+    assert env_db.num_envs == 5
+
+    obs, _ = env.reset(seed=0)
+    obs_db, _ = env_db.reset(seed=0)
+    assert np.allclose(obs, obs_db)
+
+    for i in range(20):
+        action = np.array([i%2, 0, 1, (i//2)%2, 1])
+        obs, reward, terminated, truncated, _ = env.step(action)
+        obs_db, reward_db, terminated_db, truncated_db, _ = env_db.step(action)
+        assert np.allclose(obs, obs_db)
+        assert np.allclose(reward, reward_db)
+        assert (terminated == terminated_db).all()
+        assert (truncated == truncated_db).all()
+
+
+def test_policy_called_on_each_half():
+    env = DoubleBufferedVectorEnv([
+        gymnasium.vector.SyncVectorEnv([make_env for _ in range(2)]),
+        gymnasium.vector.SyncVectorEnv([make_env for _ in range(3)]),
+    ])
+    env.reset(seed=0)
+
+    calls = []
+    def policy(env_idx, obs, done):
+        calls.append((env_idx, obs.shape, done.shape))
+        return np.zeros(obs.shape[0], dtype=int)
+
+    env.step_async(np.zeros(5, dtype=int))
+    obs, *_ = env.step_wait(policy)
+    assert obs.shape == (5, 4)
+    assert calls == [(slice(0,2), (2,4), (2,)), (slice(2,5), (3,4), (3,))]
+    env.step_wait()
+
+
+def test_empty_half():
+    class EmptyVectorEnv:
+        num_envs = 0
+    with pytest.raises(ValueError):
+        DoubleBufferedVectorEnv([
+            EmptyVectorEnv(), # type: ignore
+            gymnasium.vector.SyncVectorEnv([make_env]),
+        ])
@@ -0,0 +1,304 @@
+import threading
+
+import gymnasium
+import numpy as np
+import pytest
+import torch
+
+from big_rl.model.model import ResettableHiddenMixin
+from big_rl.utils.evaluation import AsyncVideoWriter, ResultsReader, ResultsStore, ResultsWriter, env_info, episode_summary, evaluate_vector_env, select_batch
+
+
+def make_env():
+    return gymnasium.make('CartPole-v1')
+
+
+class StepCounter(ResettableHiddenMixin, torch.nn.Module):
+    """ Counts the number of steps since the hidden state was reset. """
+    def __init__(self):
+        super().__init__()
+        self.dummy = torch.nn.Parameter(torch.zeros(1))
+
+    def init_hidden(self, batch_size=1):
+        return (torch.zeros(1, batch_size, 1),)
+
+    def forward(self, inputs, hidden):
+        return {
+            'action': torch.zeros(inputs['obs'].shape[0], dtype=torch.long),
+            'hidden': (hidden[0] + 1,),
+        }
+
+
+def preprocess_obs(obs):
+    return {'obs': torch.as_tensor(obs)}
+
+
+def sample_action(model_output):
+    return model_output['action'].numpy()
+
+
+def record_hidden(results, model, model_output, index, reward, info, done):
+    results['reward'].append(reward)
+    results['hidden'].append(select_batch(model_output['hidden'], index)[0].item())
+
+
+@pytest.mark.parametrize('autoreset_mode', ['NextStep', 'SameStep'])
+def test_hidden_reset_per_episode(autoreset_mode):
+    """ Each episode is recorded in full, starting from a fresh hidden state. """
+    kwargs = {}
+    if autoreset_mode == 'SameStep':
+        if not hasattr(gymnasium.vector, 'AutoresetMode'):
+            pytest.skip('Autoreset modes require gymnasium>=1.0')
+        kwargs['autoreset_mode'] = gymnasium.vector.AutoresetMode.SAME_STEP
+    env = gymnasium.vector.SyncVectorEnv([make_env for _ in range(3)], **kwargs)
+    results = evaluate_vector_env(
+            StepCounter(), env, num_episodes=7,
+            preprocess_obs_fn = preprocess_obs,
+            sample_action_fn = sample_action,
+            init_results_fn = lambda: {'reward': [], 'hidden': []},
+            record_fn = record_hidden,
+            seed = 0,
+    )
+    env.close()
+
+    assert len(results) == 7
+    for r in results:
+        length = r['episode_length']
+        assert length > 0
+        assert r['results']['hidden'] == list(range(1, length+1))
+        assert r['episode_reward'] == length # CartPole gives a reward of 1 per step
+        assert len(r['results']['reward']) == length
+
+
+def test_max_steps():
+    env = gymnasium.vector.SyncVectorEnv([make_env for _ in range(2)])
+    results = evaluate_vector_env(
+            StepCounter(), env, num_episodes=5,
+            preprocess_obs_fn = preprocess_obs,
+            sample_action_fn = sample_action,
+            max_steps = 3,
+            seed = 0,
+    )
+    env.close()
+    assert [r['episode_length'] for r in results] == [3]*5
+    assert all(len(r['results']['reward']) == 3 for r in results)
+
+
+def test_non_recurrent_model():
+    class Model(torch.nn.Module):
+        def forward(self, inputs):
+            return {'action': torch.ones(inputs['obs'].shape[0], dtype=torch.long)}
+    env = gymnasium.vector.SyncVectorEnv([make_env for _ in range(2)])
+    results = evaluate_vector_env(
+            Model(), env, num_episodes=3,
+            preprocess_obs_fn = preprocess_obs,
+            sample_action_fn = sample_action,
+            seed = 0,
+    )
+    env.close()
+    assert len(results) == 3
+    assert all(r['episode_reward'] == r['episode_length'] for r in results)
+
+
+def test_env_info():
+    # gymnasium>=1.0 format
+    info = {
+        'regret': np.array([0., 1., 0.]),
+        '_regret': np.array([False, True, False]),
+        'episode': {'r': np.array([1., 2., 3.]), '_r': np.array([True, True, True])},
+        '_episode': np.array([True, True, True]),
+    }
+    assert env_info(info, 0) == {'episode': {'r': 1.}}
+    assert env_info(info, 1) == {'regret': 1., 'episode': {'r': 2.}}
+
+    # Older format, with the final infos stored separately
+    info = {
+        'final_info': np.array([None, {'supervised_trials': 2}], dtype=object),
+        '_final_info': np.array([False, True]),
+    }
+    assert env_info(info, 0) == {}
+    assert env_info(info, 1) == {'supervised_trials': 2}
+
+
+@pytest.mark.parametrize('format', ['h5', 'pt'])
+def test_results_store(tmp_path, format):
+    job1 = {'model': 'a.pt', 'env': 'fetch-004', 'seed': 0}
+    job2 = {'model': 'a.pt', 'env': 'fetch-004', 'seed': 1}
+    results = [
+        {'episode_reward': 1., 'episode_length': 10, 'results': {'reward': [np.float32(0.1)]*10}},
+        {'episode_reward': 3., 'episode_length': 20, 'results': {'reward': [np.float32(0.15)]*20}},
+    ]
+
+    store = ResultsStore(str(tmp_path), format=format)
+    store.write(job1, results, step=100)
+    store.write_error(job2, 'Traceback ...')
+    assert store.contains(job1)
+    assert store.contains({'seed': 0, 'env': 'fetch-004', 'model': 'a.pt'}) # Key order doesn't matter
+    assert not store.contains(job2)
+
+    # Reopen the store, as when an evaluation is restarted
+    store = ResultsStore(str(tmp_path), format=format)
+    assert store.contains(job1)
+    assert not store.contains(job2)
+    index = store.index()
+    assert len(index) == 2
+    assert index[0]['job'] == job1
+    assert index[0]['reward_mean'] == 2.
+    assert index[0]['episode_length'] == [10, 20]
+    assert index[0]['step'] == 100
+    assert index[1]['error'] == 'Traceback ...'
+    loaded = store.load(index[0])
+    if format == 'h5':
+        with loaded as reader:
+            assert reader.episode(1)['reward'].tolist() == [np.float32(0.15)]*20
+    else:
+        assert loaded[1]['results']['reward'] == [np.float32(0.15)]*20
+
+    store.write(job2, results)
+    assert store.contains(job2)
+    assert store.index()[-1]['results'] != index[0]['results']
+
+    # Results files are named after the job, not the order in which jobs were written
+    other_store = ResultsStore(str(tmp_path / 'other'), format=format)
+    other_store.write(job2, results)
+    assert other_store.index()[0]['results'] == store.index()[-1]['results'] == store.filename(job2)
+    assert store.filename({**job1, 'settings': {'num_episodes': 10}}) != store.filename(job1)
+
+
+def test_results_store_add(tmp_path):
+    # Results written separately (e.g. by a worker process) are added to the index from their summaries
+    job = {'model': 'a.pt', 'env': 'fetch-004', 'seed': 0}
+    episodes = [
+        {'episode_reward': 1., 'episode_length': 2, 'results': {'reward': [0.5, 0.5], 'hidden': [np.zeros(3)]*2}},
+        {'episode_reward': 0., 'episode_length': 1, 'results': {'reward': [0.], 'hidden': [np.zeros(3)]}},
+    ]
+    store = ResultsStore(str(tmp_path))
+    with ResultsWriter(store.path(job)) as writer:
+        for i, episode in enumerate(episodes):
+            writer.write_episode(episode, index=i)
+    store.add(job, [episode_summary(e, keys=()) for e in episodes], worker=123)
+
+    assert store.contains(job)
+    entry = store.index()[0]
+    assert entry['episode_length'] == [2, 1]
+    assert entry['worker'] == 123
+    with store.load(entry) as reader:
+        assert reader.episode(0)['hidden'].shape == (2, 3)
+
+
+def test_results_writer(tmp_path):
+    """ Episodes written out of order are read back in order, with nested streams split into columns. """
+    def make_episode(length, reward):
+        return {
+            'episode_reward': reward,
+            'episode_length': length,
+            'results': {
+                'reward': [float(i) for i in range(length)],
+                'regret': [None if i % 2 else 1. for i in range(length)],
+                'hidden': [(torch.full((2,1,3), float(i)), np.zeros((1,1,4))) for i in range(length)],
+                'attention': [([np.ones((2,1,5))], {'action': np.ones((1,6))}) for _ in range(length)],
+                'target': ['red ball'] * length,
+                'shaped_reward': [],
+                'supervision': {'supervised_trials': 3},
+            },
+        }
+
+    filename = str(tmp_path / 'results.h5')
+    with ResultsWriter(filename) as writer:
+        writer.write_episode(make_episode(3, 1.), index=1)
+        writer.write_episode(make_episode(2, 5.), index=0)
+
+    with ResultsReader(filename) as reader:
+        assert len(reader) == 2
+        assert reader.episode_length.tolist() == [2, 3]
+        assert reader.episode_reward.tolist() == [5., 1.]
+        assert reader.columns('hidden') == ['hidden/0', 'hidden/1']
+        assert reader.columns('attention') == ['attention/0/0', 'attention/1/action']
+        assert 'shaped_reward' not in reader.columns()
+
+        episode = reader.episode(1)
+        assert episode['reward'].tolist() == [0., 1., 2.]
+        assert np.isnan(episode['regret'][1]) and episode['regret'][2] == 1.
+        assert episode['hidden/0'].shape == (3, 2, 1, 3)
+        assert (episode['hidden/0'][2] == 2).all()
+        assert episode['attention/1/action'].shape == (3, 1, 6)
+        assert list(episode['target']) == ['red ball'] * 3
+
+        assert list(reader.episode(0, prefix='hidden').keys()) == ['hidden/0', 'hidden/1']
+        assert reader['reward'].shape == (5,)
+        assert reader.extra(0) == {'shaped_reward': [], 'supervision': {'supervised_trials': 3}}
+
+
+class FakeVideoWriter:
+    def __init__(self, wait=None):
+        self.frames = []
+        self.wait = wait
+
+    def write(self, frame):
+        if self.wait is not None:
+            self.wait.wait()
+        self.frames.append(frame)
+
+    def release(self):
+        pass
+
+
+def compose_frame(step):
+    # Module-level, so that it can be sent to the worker processes
+    if step is None:
+        raise ValueError('Nothing to draw')
+    frame = np.zeros((8, 8, 3), dtype=np.uint8)
+    frame[:, :step % 8] = 255
+    frame[0, 0, 0] = step
+    return frame
+
+
+def _write(video, num_frames):
+    written = []
+    for step in range(num_frames):
+        if video.ready():
+            video.write(step)
+            written.append(step)
+    return written
+
+
+@pytest.mark.parametrize('num_workers', [0, 1])
+def test_async_video_writer_in_order(tmp_path, num_workers):
+    video = AsyncVideoWriter(str(tmp_path / 'video.webm'), compose_frame, num_workers=num_workers, max_queue_size=2, block=True)
+    writer = FakeVideoWriter()
+    video._video_writer = writer
+    assert _write(video, 10) == list(range(10))
+    video.close()
+
+    assert video.num_dropped_frames == 0
+    assert len(writer.frames) == 10
+    for step, frame in enumerate(writer.frames):
+        assert np.array_equal(frame, compose_frame(step))
+
+
+@pytest.mark.parametrize('num_workers', [0, 1])
+def test_async_video_writer_error_raised_on_close(tmp_path, num_workers):
+    video = AsyncVideoWriter(str(tmp_path / 'video.webm'), compose_frame, num_workers=num_workers)
+    video._video_writer = FakeVideoWriter()
+    video.write(None) # Can't be drawn
+    with pytest.raises(RuntimeError):
+        video.close()
+
+
+def test_async_video_writer_drop_frames(tmp_path):
+    # Frames are dropped while the writer is stuck, instead of blocking the caller
+    wait = threading.Event()
+    video = AsyncVideoWriter(str(tmp_path / 'video.webm'), compose_frame, num_workers=0, max_queue_size=1)
+    writer = FakeVideoWriter(wait)
+    video._video_writer = writer
+    with pytest.warns(UserWarning):
+        written = _write(video, 5)
+    assert video.num_dropped_frames >= 3
+    assert len(written) + video.num_dropped_frames == 5
+    wait.set()
+    with pytest.warns(UserWarning):
+        video.close()
+    # The frames that weren't dropped are written in order
+    assert len(writer.frames) == len(written)
+    for step, frame in zip(written, writer.frames):
+        assert np.array_equal(frame, compose_frame(step))
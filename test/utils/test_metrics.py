@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from big_rl.utils.metrics import AsyncMetricLogger
+
+
+def test_immediate():
+    logged = []
+    logger = AsyncMetricLogger(log_fn=lambda data, step: logged.append((step, data)), flush_interval=0)
+    logger.log({'a': torch.tensor(1.5), 'b': 2}, step=3)
+    assert logged == [(3, {'a': 1.5, 'b': 2})]
+
+
+def test_delayed_by_one_flush():
+    logged = []
+    logger = AsyncMetricLogger(log_fn=lambda data, step: logged.append((step, data)), flush_interval=2)
+    logger.log({'a': torch.tensor(1.)}, step=1)
+    logger.step()
+    logger.log({'a': torch.tensor(2.), 'b': 'x'}, step=2)
+    logger.step() # Values are copied to the host here
+    assert logged == []
+    logger.log({'a': torch.tensor(3.)}, step=3)
+    logger.step()
+    logger.step() # The previous values are logged here
+    assert logged == [(1, {'a': 1.}), (2, {'a': 2., 'b': 'x'})]
+    logger.close()
+    assert logged[-1] == (3, {'a': 3.})
+
+
+def test_grad_tensors_are_detached():
+    logged = []
+    logger = AsyncMetricLogger(log_fn=lambda data, step: logged.append((step, data)))
+    x = torch.tensor(2., requires_grad=True)
+    logger.log({'loss': x * 3}, step=0)
+    logger.close()
+    assert logged == [(0, {'loss': pytest.approx(6.)})]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA not available')
+def test_cuda():
+    logged = []
+    logger = AsyncMetricLogger(log_fn=lambda data, step: logged.append((step, data)))
+    logger.log({'a': torch.tensor(1., device='cuda'), 'b': torch.tensor(2.)}, step=0)
+    logger.close()
+    assert logged == [(0, {'a': 1., 'b': 2.})]
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import torch
+
+from big_rl.utils import ObservationBuffer
+
+
+def test_scale_and_ignore():
+    buffer = ObservationBuffer(num_envs=2, max_len=4, scale={'image': 1/255}, ignore=['mission'])
+    obs = buffer.append({
+        'image': np.full((2,3,3), 255, dtype=np.uint8),
+        'reward': np.array([1.,2.]),
+        'mission': np.array(['a','b']),
+    })
+    assert set(obs.keys()) == {'image', 'reward'}
+    assert obs['image'].dtype == torch.float
+    assert torch.allclose(obs['image'], torch.ones(2,3,3))
+    assert torch.allclose(obs['reward'], torch.tensor([1.,2.]))
+
+
+def test_append_and_clear():
+    buffer = ObservationBuffer(num_envs=3, max_len=5)
+    for i in range(5):
+        buffer.append({'x': np.full((3,2), i)})
+    assert len(buffer) == 5
+    assert buffer.obs['x'].shape == (5,3,2)
+    assert (buffer.obs['x'][:,0,0] == torch.arange(5)).all()
+    with pytest.raises(IndexError):
+        buffer.append({'x': np.zeros((3,2))})
+
+    buffer.clear()
+    assert len(buffer) == 1
+    assert (buffer[0]['x'] == 4).all()
+    buffer.append({'x': np.full((3,2), 5)})
+    assert (buffer.obs['x'][:,0,0] == torch.tensor([4,5])).all()
+
+
+def test_reset():
+    buffer = ObservationBuffer(num_envs=1, max_len=3)
+    buffer.append({'x': np.array([1])})
+    buffer.append({'x': np.array([2])})
+    buffer.reset({'x': np.array([3])})
+    assert len(buffer) == 1
+    assert buffer[-1]['x'].item() == 3
+
+
+def test_uint8_storage():
+    """ Unscaled uint8 observations are stored as uint8. Scaled ones are stored as floats. """
+    buffer = ObservationBuffer(num_envs=2, max_len=4, scale={'scaled': 0.5})
+    obs = buffer.append({
+        'image': np.full((2,3,3), 255, dtype=np.uint8),
+        'scaled': np.full((2,3,3), 4, dtype=np.uint8),
+    })
+    assert obs['image'].dtype == torch.uint8
+    assert (obs['image'] == 255).all()
+    assert obs['scaled'].dtype == torch.float
+    assert (obs['scaled'] == 2).all()
+    assert buffer.obs['image'].dtype == torch.uint8
@@ -0,0 +1,71 @@
+import json
+import threading
+
+import pytest
+
+from big_rl.utils.profiler import PhaseTimer
+
+
+def test_percentiles():
+    timer = PhaseTimer(percentiles=(50,100))
+    for i in range(1,11):
+        timer.add('env_step/a', i/1000)
+    timer.add('backward', 0.055)
+    summary = timer.summary()
+    assert summary['time/env_step/a/p50'] == pytest.approx(5.5)
+    assert summary['time/env_step/a/p100'] == pytest.approx(10)
+    assert summary['time/env_step/a/cumulative_fraction'] == pytest.approx(0.5)
+    assert summary['time/backward/cumulative_fraction'] == pytest.approx(0.5)
+
+
+def test_window():
+    timer = PhaseTimer(window=2, percentiles=(0,))
+    for d in [1,2,3]:
+        timer.add('x', d)
+    assert timer.summary()['time/x/p0'] == pytest.approx(2000)
+    # The fraction covers every recorded duration, not only the window
+    timer.add('y', 2)
+    assert timer.summary()['time/y/cumulative_fraction'] == pytest.approx(0.25)
+
+
+def test_context_manager_groups():
+    timer = PhaseTimer()
+    with timer.time('inference', 'a'):
+        pass
+    with timer.time('inference'):
+        pass
+    names = set(k.rsplit('/',1)[0] for k in timer.summary().keys())
+    assert names == {'time/inference/a', 'time/inference'}
+
+
+def test_disabled():
+    timer = PhaseTimer(enabled=False)
+    with timer.time('inference', 'a'):
+        pass
+    timer.add('x', 1)
+    assert timer.summary() == {}
+    assert timer.report() == {}
+
+
+def test_threads():
+    timer = PhaseTimer(window=1000)
+    def f():
+        for _ in range(100):
+            timer.add('x', 1)
+    threads = [threading.Thread(target=f) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(timer._durations['x']) == 400
+
+
+def test_jsonl(tmp_path):
+    path = tmp_path / 'timing.jsonl'
+    timer = PhaseTimer(jsonl_path=str(path))
+    timer.add('x', 1)
+    timer.report(step=1, console=False)
+    timer.report(step=2, console=False)
+    lines = [json.loads(l) for l in path.read_text().splitlines()]
+    assert [l['step'] for l in lines] == [1,2]
+    assert 'time/x/p50' in lines[0]
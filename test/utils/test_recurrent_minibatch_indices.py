@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from big_rl.utils import recurrent_minibatch_indices
+
+
+def test_full_batch():
+    minibatches = recurrent_minibatch_indices(num_envs=4, num_steps=10)
+    assert minibatches == [(slice(None), 0, 10)]
+
+
+@pytest.mark.parametrize('num_envs', [4, 5])
+@pytest.mark.parametrize('num_minibatches', [1, 2, 4])
+@pytest.mark.parametrize('bptt_length', [None, 1, 3, 10, 20])
+@pytest.mark.parametrize('shuffle', [True, False])
+def test_covers_every_transition_once(num_envs, num_minibatches, bptt_length, shuffle):
+    num_steps = 10
+    count = np.zeros((num_steps, num_envs), dtype=int)
+    minibatches = recurrent_minibatch_indices(
+            num_envs=num_envs,
+            num_steps=num_steps,
+            num_minibatches=num_minibatches,
+            bptt_length=bptt_length,
+            shuffle=shuffle)
+    for env_idx, start, end in minibatches:
+        assert 0 <= start < end <= num_steps
+        if bptt_length is not None:
+            assert end - start <= bptt_length
+        count[start:end, env_idx] += 1
+    assert (count == 1).all()
+
+
+def test_temporal_order_without_shuffle():
+    minibatches = recurrent_minibatch_indices(num_envs=4, num_steps=10, num_minibatches=2, bptt_length=3)
+    assert len(minibatches) == 8
+    for i in range(0, 8, 4):
+        group = minibatches[i:i+4]
+        assert [(start,end) for _,start,end in group] == [(0,3),(3,6),(6,9),(9,10)]
+        for env_idx,_,_ in group:
+            assert (env_idx == group[0][0]).all()
+
+
+def test_too_many_minibatches():
+    with pytest.raises(ValueError):
+        recurrent_minibatch_indices(num_envs=4, num_steps=10, num_minibatches=5)
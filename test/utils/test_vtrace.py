@@ -0,0 +1,55 @@
+import pytest
+import torch
+
+from big_rl.utils.actor_learner import vtrace
+
+
+def discounted_returns(rewards, discounts, bootstrap_value):
+    returns = torch.zeros_like(rewards)
+    acc = bootstrap_value
+    for t in reversed(range(len(rewards))):
+        acc = rewards[t] + discounts[t] * acc
+        returns[t] = acc
+    return returns
+
+
+@pytest.mark.parametrize('seq_len', [1, 5])
+@pytest.mark.parametrize('batch_size', [1, 3])
+def test_on_policy_is_monte_carlo_return(seq_len, batch_size):
+    rewards = torch.randn(seq_len, batch_size)
+    values = torch.randn(seq_len, batch_size)
+    discounts = 0.9 * (torch.rand(seq_len, batch_size) > 0.2).float()
+    bootstrap_value = torch.randn(batch_size)
+
+    vs, pg_advantages = vtrace(
+            log_rhos = torch.zeros(seq_len, batch_size),
+            discounts = discounts,
+            rewards = rewards,
+            values = values,
+            bootstrap_value = bootstrap_value,
+    )
+    returns = discounted_returns(rewards, discounts, bootstrap_value)
+    assert torch.allclose(vs, returns, atol=1e-5)
+
+    next_vs = torch.cat([vs[1:], bootstrap_value.unsqueeze(0)])
+    assert torch.allclose(pg_advantages, rewards + discounts * next_vs - values, atol=1e-5)
+
+
+def test_importance_weights_are_truncated():
+    seq_len, batch_size = 4, 2
+    rewards = torch.randn(seq_len, batch_size)
+    values = torch.randn(seq_len, batch_size)
+    discounts = torch.full((seq_len, batch_size), 0.9)
+    bootstrap_value = torch.randn(batch_size)
+
+    # Importance weights above the threshold give the same result as weights at the threshold
+    vs_1, adv_1 = vtrace(torch.full((seq_len, batch_size), 2.), discounts, rewards, values, bootstrap_value)
+    vs_2, adv_2 = vtrace(torch.zeros(seq_len, batch_size), discounts, rewards, values, bootstrap_value)
+    assert torch.allclose(vs_1, vs_2)
+    assert torch.allclose(adv_1, adv_2)
+
+    # A zero importance weight on the last step ignores its reward
+    log_rhos = torch.zeros(seq_len, batch_size)
+    log_rhos[-1] = -float('inf')
+    vs, _ = vtrace(log_rhos, discounts, rewards, values, bootstrap_value)
+    assert torch.allclose(vs[-1], values[-1])
@@ -0,0 +1,36 @@
+import time
+
+from big_rl.utils import zip_concurrent
+
+
+def test_same_as_zip():
+    a = [1,2,3,4]
+    b = 'abc'
+    assert list(zip_concurrent(a, b)) == list(zip(a, b))
+    assert list(zip_concurrent()) == []
+
+
+def test_runs_concurrently():
+    def slow_generator():
+        for i in range(3):
+            time.sleep(0.1)
+            yield i
+
+    start_time = time.time()
+    output = list(zip_concurrent(*[slow_generator() for _ in range(5)]))
+    assert output == [(i,)*5 for i in range(3)]
+    assert time.time() - start_time < 1.0
+
+
+def test_waits_for_consumer():
+    log = []
+    def generator(label):
+        for i in range(3):
+            log.append((label, i))
+            yield i
+
+    for x in zip_concurrent(generator('a'), generator('b')):
+        # Both generators have produced exactly one more element, and neither is running while the loop body runs
+        assert len(log) == 2*(x[0]+1)
+        time.sleep(0.01)
+        assert len(log) == 2*(x[0]+1)